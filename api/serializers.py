@@ -28,10 +28,24 @@ class TripSerializer(serializers.ModelSerializer):
 
 class BookingSerializer(serializers.ModelSerializer):
     bus = BusSerializer(read_only=True)
+    bus_id = serializers.PrimaryKeyRelatedField(
+        source="bus",
+        queryset=Bus.objects.filter(is_active=True),
+        write_only=True,
+    )
 
     class Meta:
         model = Booking
         fields = "__all__"
+        read_only_fields = ["user", "trip", "distance_km", "total_fare"]
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        from_stop = attrs.get("from_stop")
+        to_stop = attrs.get("to_stop")
+        if from_stop and to_stop and from_stop.sequence_number >= to_stop.sequence_number:
+            raise serializers.ValidationError("Destination stop must be after boarding stop.")
+        return attrs
 
 
 class LiveLocationSerializer(serializers.ModelSerializer):
@@ -1,3 +1,45 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from bookings import reservations
+from bookings.models import Booking
+from bookings.tests import TRAVEL_DATE, make_bus, new_booking, stop
+
+
+class BookingApiTests(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        self.user = User.objects.create(username='passenger')
+        self.client.force_login(self.user)
+        self.data = {
+            'bus_id': self.bus.pk,
+            'travel_date': TRAVEL_DATE.isoformat(),
+            'from_stop': stop(self.bus, 1).pk,
+            'to_stop': stop(self.bus, 3).pk,
+            'seats_booked': 2,
+            'passenger_name': "Passenger",
+            'passenger_phone': "9999999999",
+        }
+
+    def test_books(self):
+        response = self.client.post('/api/bookings/', self.data)
+        self.assertEqual(response.status_code, 201)
+        booking = Booking.objects.get()
+        self.assertEqual((booking.user, booking.total_fare), (self.user, 200))
+        self.assertIsNotNone(booking.trip)
+
+    def test_full_bus_is_a_bad_request(self):
+        reservations.reserve(new_booking(self.user, self.bus, 2, 4, seats=9))
+        response = self.client.post('/api/bookings/', self.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), [str(reservations.SeatsUnavailable(1))])
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_conflict_is_a_bad_request(self):
+        with mock.patch('api.views.reserve', side_effect=reservations.ReservationConflict()):
+            response = self.client.post('/api/bookings/', self.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), [str(reservations.ReservationConflict())])
+        self.assertFalse(Booking.objects.exists())
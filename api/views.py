@@ -1,10 +1,12 @@
 from django.shortcuts import render
 
 from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 
 from buses.models import Bus, Route, Trip
 from bookings.models import Booking
+from bookings.reservations import reserve, ReservationError
 from tracking.models import LiveLocation
 
 from .serializers import (
@@ -39,6 +41,19 @@ class BookingViewSet(viewsets.ModelViewSet):
     serializer_class = BookingSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
+    def perform_create(self, serializer):
+        data = dict(serializer.validated_data)
+        seats = data.pop("selected_seats", [])
+
+        booking = Booking(user=self.request.user, **data)
+        try:
+            reserve(booking)
+        except ReservationError as exc:
+            raise ValidationError(str(exc))
+
+        booking.selected_seats.set(seats)
+        serializer.instance = booking
+
 
 class LiveLocationViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = LiveLocation.objects.select_related("bus")
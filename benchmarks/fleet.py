@@ -0,0 +1,516 @@
+"""
+Synthetic fleet data at production scale, for ``manage.py generate_fleet``.
+
+``FleetGenerator`` builds a road network of cities with routes between
+near neighbours, each a chain of stops along a bent line with distances,
+fares and timetable offsets; buses with seat layouts and drivers on every
+route; one trip per bus per day over a date range; segment bookings that
+fill each trip to a random load factor without double-selling a seat on
+any segment; and GPS traces for trips that have run. ``SegmentOccupancy``,
+``TripInventory`` and ``StopSearchIndex`` rows are written alongside, as
+the signal handlers would have.
+
+Every route, bus and trip draws from its own ``random.Random`` seeded with
+``seed`` and its index, so the same options give the same rows, and
+adding days or routes leaves the existing ones unchanged. Trip statuses
+and the traces of trips in progress depend on ``now`` and dates on
+``start``; pass both for identical data on another day.
+
+Rows go through ``Loader``: COPY on PostgreSQL, elsewhere the batched
+INSERT that ``bulk_create`` would issue, without building a model
+instance and compiling SQL per row. Primary keys are assigned here, so
+rows can reference each other before they are flushed, and sequences are
+reset afterwards.
+Everything generated is named with ``prefix`` so ``clear`` can remove it.
+Neither sends signals, so the command rebuilds the dashboard counters
+(``users.dashboard``) and the analytics rollups (``users.rollups``)
+afterwards.
+"""
+import datetime
+import io
+import math
+import random
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+
+from bookings.models import Booking, Payment, SegmentOccupancy, TripInventory
+from buses import search
+from buses.models import Bus, PerformanceMetrics, Route, Seat, Stop, StopSearchIndex, Trip
+from tracking.models import ETACalculation, LiveLocation, TripTrajectory
+from users.models import DailyBookingRollup, DailyTripRollup, Driver, UserProfile
+
+User = get_user_model()
+SelectedSeat = Booking.selected_seats.through
+
+# Roughly peninsular India; cities land anywhere inside
+LATITUDES = (12.0, 28.0)
+LONGITUDES = (72.0, 86.0)
+ROAD_FACTOR = 1.25          # road distance over great-circle distance
+NEIGHBOURS = 5              # a route ends at one of its source's nearest cities
+
+SYLLABLES = (
+    'ra', 'ma', 'na', 'ga', 'ko', 'li', 'sa', 'dha', 'ja', 'la', 'pa', 'ti',
+    'ha', 'ri', 'de', 'va', 'be', 'ku', 'bi', 'ka', 'lo', 'shi', 'go', 'chi',
+)
+SUFFIXES = ('pur', 'nagar', 'abad', 'gaon', 'wadi', 'garh', 'kot', 'palli', '')
+FIRST_NAMES = ('Aarav', 'Vivaan', 'Aditya', 'Ananya', 'Diya', 'Ishaan', 'Kavya', 'Meera', 'Rohan', 'Saanvi')
+LAST_NAMES = ('Sharma', 'Patil', 'Iyer', 'Reddy', 'Khan', 'Singh', 'Das', 'Joshi', 'Nair', 'Kulkarni')
+BUS_TYPES = (('ac', 40, 4), ('non_ac', 40, 4), ('sleeper', 30, 3), ('semi_sleeper', 36, 4))
+BUS_TYPE_WEIGHTS = (35, 35, 15, 15)
+AMENITIES = ('WiFi', 'Charging point', 'Water bottle', 'Blanket', 'Reading light', 'CCTV')
+PARTY_SIZES = (1, 2, 3, 4)
+PARTY_WEIGHTS = (70, 20, 7, 3)
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def _bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    y = math.sin(lon2 - lon1) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+    return (math.degrees(math.atan2(y, x)) + 360) % 360
+
+
+def _place_name(rng):
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+    return (name + rng.choice(SUFFIXES)).capitalize()
+
+
+def _coordinate(value):
+    return Decimal(value).quantize(Decimal('0.0000001'))
+
+
+def _money(value):
+    return Decimal(value).quantize(Decimal('0.01'))
+
+
+# -----------------------------
+# LOADER
+# -----------------------------
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+class Loader:
+    """Buffers rows per model and writes them in batches."""
+
+    def __init__(self, using='default', method='auto', batch_size=10000):
+        self.connection = connections[using]
+        self.using = using
+        if method == 'auto':
+            method = 'copy' if self.connection.vendor == 'postgresql' else 'bulk'
+        self.method = method
+        self.batch_size = batch_size
+        self.now = timezone.now()
+        self.counts = {}
+        self._rows = {}
+        self._next_id = {}
+
+    def next_id(self, model):
+        if model not in self._next_id:
+            self._next_id[model] = (model._default_manager.using(self.using).aggregate(top=Max('pk'))['top'] or 0) + 1
+        pk = self._next_id[model]
+        self._next_id[model] += 1
+        return pk
+
+    def add(self, model, **values):
+        """Queue one row; returns its primary key."""
+        if 'id' not in values:
+            values['id'] = self.next_id(model)
+        rows = self._rows.setdefault(model, [])
+        rows.append(values)
+        if len(rows) >= self.batch_size:
+            self.flush(model)
+        return values['id']
+
+    def flush(self, model=None):
+        for model in [model] if model else list(self._rows):
+            rows, self._rows[model] = self._rows.get(model, []), []
+            if not rows:
+                continue
+            for field in model._meta.concrete_fields:
+                if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                    for row in rows:
+                        row.setdefault(field.attname, self.now)
+            if self.method == 'copy':
+                self._copy(model, rows)
+            else:
+                self._insert(model, rows)
+            self.counts[model] = self.counts.get(model, 0) + len(rows)
+
+    def _adapter(self, field):
+        """The backend's conversion for values of ``field``, as ``get_db_prep_save`` applies it."""
+        ops = self.connection.ops
+        kind = field.get_internal_type()
+        if kind == 'DateTimeField':
+            return ops.adapt_datetimefield_value
+        if kind == 'DateField':
+            return ops.adapt_datefield_value
+        if kind == 'TimeField':
+            return ops.adapt_timefield_value
+        return None
+
+    def _insert(self, model, rows):
+        fields = {field.attname: field for field in model._meta.concrete_fields}
+        names = list(rows[0])
+        adapters = [(name, self._adapter(fields[name])) for name in names]
+        quote = self.connection.ops.quote_name
+        sql = (
+            f'INSERT INTO {quote(model._meta.db_table)} '
+            f'({", ".join(quote(fields[name].column) for name in names)}) '
+            f'VALUES ({", ".join(["%s"] * len(names))})'
+        )
+        params = [
+            tuple(adapt(row[name]) if adapt else row[name] for name, adapt in adapters)
+            for row in rows
+        ]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    def _copy(self, model, rows):
+        columns = {field.attname: field.column for field in model._meta.concrete_fields}
+        names = list(rows[0])
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(row[name]) for name in names))
+            buffer.write('\n')
+        quote = self.connection.ops.quote_name
+        sql = (
+            f'COPY {quote(model._meta.db_table)} '
+            f'({", ".join(quote(columns[name]) for name in names)}) FROM STDIN'
+        )
+        with self.connection.cursor() as cursor:
+            raw = cursor.cursor
+            if hasattr(raw, 'copy_expert'):     # psycopg2
+                buffer.seek(0)
+                raw.copy_expert(sql, buffer)
+            else:                               # psycopg 3
+                with raw.copy(sql) as copy:
+                    copy.write(buffer.getvalue())
+
+    def finish(self):
+        """Flush everything and move sequences past the ids assigned here."""
+        self.flush()
+        statements = self.connection.ops.sequence_reset_sql(no_style(), list(self.counts))
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+        return self.counts
+
+
+# -----------------------------
+# GENERATOR
+# -----------------------------
+class FleetGenerator:
+    def __init__(self, loader, seed=42, prefix='SYN', routes=200, cities=None, stops=(8, 24),
+                 buses_per_route=2, passengers=5000, start=None, days=14, ping_interval=30,
+                 now=None):
+        self.loader = loader
+        self.seed = seed
+        self.prefix = prefix
+        self.routes = routes
+        self.cities = cities or max(20, routes // 5)
+        self.stops = stops
+        self.buses_per_route = buses_per_route
+        self.passengers = passengers
+        self.now = now or timezone.now()
+        today = timezone.localdate(self.now)
+        self.start = start or today - datetime.timedelta(days=days // 2)
+        self.days = days
+        self.ping_interval = ping_interval
+        self.today = today
+        self.bus_count = 0
+
+    def rng(self, *key):
+        return random.Random(':'.join(map(str, (self.seed, *key))))
+
+    def run(self):
+        cities = self._cities()
+        self.passenger_ids = [self._user('passenger', n, 'user') for n in range(self.passengers)]
+        for index in range(self.routes):
+            self._route(index, cities)
+        return self.loader.finish()
+
+    # Network
+    def _cities(self):
+        rng = self.rng('cities')
+        names, cities = set(), []
+        while len(cities) < self.cities:
+            name = _place_name(rng)
+            if name in names:
+                continue
+            names.add(name)
+            cities.append((name, rng.uniform(*LATITUDES), rng.uniform(*LONGITUDES)))
+        return cities
+
+    def _user(self, role, n, profile_role):
+        rng = self.rng('user', role, n)
+        joined = self.now - datetime.timedelta(days=rng.uniform(30, 720))
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        user_id = self.loader.add(
+            User,
+            username=f'{self.prefix.lower()}_{role}_{n}', password='!',
+            first_name=first, last_name=last,
+            email=f'{self.prefix.lower()}.{role}.{n}@example.com',
+            is_staff=False, is_superuser=False, is_active=True,
+            date_joined=joined, last_login=None,
+        )
+        self.loader.add(
+            UserProfile, user_id=user_id, role=profile_role,
+            phone=f'9{rng.randrange(10 ** 9):09d}', address=None,
+            created_at=joined, updated_at=joined,
+        )
+        return user_id
+
+    def _route(self, index, cities):
+        rng = self.rng('route', index)
+        source = rng.choice(cities)
+        nearest = sorted(
+            (c for c in cities if c is not source),
+            key=lambda c: _haversine_km(source[1], source[2], c[1], c[2]),
+        )[:NEIGHBOURS]
+        destination = rng.choice(nearest)
+        if rng.random() < 0.5:
+            source, destination = destination, source
+
+        count = rng.randint(*self.stops)
+        bend = rng.gauss(0, 0.08)
+        d_lat, d_lon = destination[1] - source[1], destination[2] - source[2]
+        names = [f'{source[0]} Bus Stand']
+        names += [f'{_place_name(rng)} {rng.choice(("Phata", "Chowk", "Naka", "Stand", "Gate"))}' for _ in range(count - 2)]
+        names.append(f'{destination[0]} Bus Stand')
+
+        created = self.now - datetime.timedelta(days=rng.uniform(self.days + 30, 900))
+        route_id = self.loader.add(
+            Route, name=f'{self.prefix} {index:05d} {source[0]} - {destination[0]}',
+            source=source[0], destination=destination[0], is_active=True, created_at=created,
+        )
+
+        rate = rng.uniform(1.0, 1.8)
+        speed = rng.uniform(35, 55)
+        stops, previous, offset = [], None, 0.0
+        for seq, name in enumerate(names, start=1):
+            t = (seq - 1) / (count - 1)
+            lat = source[1] + d_lat * t - d_lon * bend * math.sin(math.pi * t) + rng.gauss(0, 0.003)
+            lon = source[2] + d_lon * t + d_lat * bend * math.sin(math.pi * t) + rng.gauss(0, 0.003)
+            if previous is None:
+                distance = fare = Decimal('0')
+            else:
+                km = max(_haversine_km(previous[0], previous[1], lat, lon) * ROAD_FACTOR, 0.5)
+                distance = _money(km)
+                fare = _money(max(round(km * rate * 2) / 2, 5))
+                offset += km / speed * 60 + 2
+            stop_id = self.loader.add(
+                Stop, route_id=route_id, name=name, latitude=_coordinate(lat), longitude=_coordinate(lon),
+                sequence_number=seq, distance_from_previous_km=distance, fare_from_previous=fare,
+                estimated_arrival_offset_minutes=int(offset),
+            )
+            stops.append((stop_id, seq, lat, lon, distance, fare, offset))
+            previous = (lat, lon)
+
+        for row in search.entries_for_route(route_id, source[0], destination[0], [(s[0], n, s[1]) for s, n in zip(stops, names)]):
+            self.loader.add(
+                StopSearchIndex, token=row.token, route_id=route_id,
+                stop_id=row.stop_id, sequence_number=row.sequence_number,
+            )
+
+        for _ in range(self.buses_per_route):
+            self._bus(route_id, stops, speed, created)
+
+    # Buses and trips
+    def _bus(self, route_id, stops, speed, created):
+        n = self.bus_count
+        self.bus_count += 1
+        rng = self.rng('bus', n)
+        bus_type, total_seats, per_row = rng.choices(BUS_TYPES, BUS_TYPE_WEIGHTS)[0]
+        departure = datetime.time(*divmod(rng.randrange(5 * 60, 22 * 60, 15), 60))
+        duration = datetime.timedelta(minutes=stops[-1][6])
+        arrival = (datetime.datetime.combine(self.start, departure) + duration).time()
+
+        driver_user = self._user('driver', n, 'driver')
+        driver_id = self.loader.add(
+            Driver, user_id=driver_user, license_number=f'{self.prefix}-DL-{n:08d}',
+            experience_years=rng.randint(1, 25), is_available=True,
+            rating=Decimal(rng.randint(350, 500)) / 100, created_at=created,
+        )
+        bus_id = self.loader.add(
+            Bus, bus_number=f'{self.prefix}-{n:06d}', bus_name=f'{rng.choice(LAST_NAMES)} Travels {n}',
+            bus_type=bus_type, total_seats=total_seats, route_id=route_id, driver_id=driver_id,
+            departure_time=departure, arrival_time=arrival,
+            amenities=', '.join(rng.sample(AMENITIES, rng.randint(0, 4))), is_active=True, created_at=created,
+        )
+        letters = 'ABCD'[:per_row]
+        seats = [
+            self.loader.add(
+                Seat, bus_id=bus_id, seat_number=f'{k // per_row + 1}{letters[k % per_row]}',
+                is_window=k % per_row in (0, per_row - 1),
+            )
+            for k in range(total_seats)
+        ]
+        for day in range(self.days):
+            self._trip(n, bus_id, stops, seats, departure, duration, speed, self.start + datetime.timedelta(days=day))
+
+    def _trip(self, bus_index, bus_id, stops, seats, departure, duration, speed, date):
+        rng = self.rng('trip', bus_index, date.isoformat())
+        scheduled = timezone.make_aware(datetime.datetime.combine(date, departure))
+        delay = rng.randint(0, 4) if rng.random() < 0.7 else int(rng.expovariate(1 / 15))
+        started = scheduled + datetime.timedelta(minutes=delay)
+        ended = started + duration * rng.uniform(0.95, 1.15)
+
+        if rng.random() < 0.03:
+            status = 'cancelled'
+        elif ended <= self.now:
+            status = 'completed'
+        elif started <= self.now:
+            status = 'delayed' if delay >= 15 else 'running'
+        else:
+            status = 'not_started'
+        trip_id = self.loader.add(
+            Trip, bus_id=bus_id, date=date, status=status,
+            actual_departure_time=started if status in ('running', 'delayed', 'completed') else None,
+            actual_arrival_time=ended if status == 'completed' else None,
+            delay_minutes=delay if status != 'cancelled' else 0,
+            remarks='', created_at=min(scheduled - datetime.timedelta(days=30), self.now),
+        )
+        self.loader.add(TripInventory, bus_id=bus_id, travel_date=date, version=0)
+        self._bookings(rng, bus_id, trip_id, date, stops, seats, scheduled, status)
+        if status in ('running', 'delayed', 'completed'):
+            self._trace(rng, bus_id, trip_id, stops, started, min(ended, self.now), speed)
+
+    def _bookings(self, rng, bus_id, trip_id, date, stops, seats, scheduled, trip_status):
+        last = len(stops)
+        ahead = (date - self.today).days
+        load = rng.uniform(0.5, 0.95) * (max(0.1, 1 - ahead / 30) if ahead > 0 else 1)
+        capacity = len(seats) * (last - 1)
+        masks = [0] * len(seats)        # bit i: seat held on the segment arriving at stop i + 1
+        occupancy = [0] * (last + 1)
+        used = attempts = 0
+        while used < load * capacity and attempts < capacity:
+            attempts += 1
+            origin = rng.randrange(1, last)
+            length = min(1 + int(rng.expovariate(3 / (last - 1))), last - origin)
+            mask = ((1 << length) - 1) << origin
+            party = rng.choices(PARTY_SIZES, PARTY_WEIGHTS)[0]
+            chosen = [k for k, held in enumerate(masks) if not held & mask][:party]
+            if len(chosen) < party:
+                continue
+
+            if trip_status == 'cancelled' or rng.random() < 0.05:
+                status = 'cancelled'
+            elif trip_status == 'completed':
+                status = 'completed'
+            else:
+                status = 'confirmed' if rng.random() < 0.9 else 'pending'
+            booked_at = scheduled - datetime.timedelta(hours=min(rng.expovariate(1 / 72), 30 * 24))
+            earlier = datetime.timedelta(seconds=rng.randrange(1, 7 * 24 * 3600))
+            if booked_at > self.now:
+                booked_at = self.now - earlier
+
+            from_stop, to_stop = stops[origin - 1], stops[origin + length - 1]
+            distance = sum((s[4] for s in stops[origin:origin + length]), Decimal('0'))
+            fare = sum((s[5] for s in stops[origin:origin + length]), Decimal('0'))
+            booking_id = self.loader.next_id(Booking)
+            self.loader.add(
+                Booking, id=booking_id, booking_id=f'{self.prefix}{booking_id:012d}',
+                user_id=rng.choice(self.passenger_ids), bus_id=bus_id, trip_id=trip_id, travel_date=date,
+                from_stop_id=from_stop[0], to_stop_id=to_stop[0], seats_booked=party,
+                distance_km=distance, total_fare=fare * party, status=status,
+                passenger_name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                passenger_phone=f'9{rng.randrange(10 ** 9):09d}', passenger_email='', booked_at=booked_at,
+            )
+            used += party * length
+            if status == 'cancelled':
+                continue
+            for k in chosen:
+                masks[k] |= mask
+                self.loader.add(SelectedSeat, booking_id=booking_id, seat_id=seats[k])
+            if status in ('confirmed', 'pending'):
+                for seq in range(origin + 1, origin + length + 1):
+                    occupancy[seq] += party
+
+        for seq, held in enumerate(occupancy):
+            if held:
+                self.loader.add(SegmentOccupancy, bus_id=bus_id, travel_date=date, sequence_number=seq, seats_booked=held)
+
+    def _trace(self, rng, bus_id, trip_id, stops, started, ended, speed):
+        offsets = [s[6] for s in stops]
+        headings = [0.0] + [round(_bearing(a[2], a[3], b[2], b[3]), 2) for a, b in zip(stops, stops[1:])]
+        total = offsets[-1] or 1
+        span = (ended - started).total_seconds()
+        step = self.ping_interval
+        elapsed = 0.0
+        leg = 1
+        # Plain floats: the pings are the bulk of the rows, and Decimal
+        # columns store them the same
+        while elapsed <= span:
+            # Position along the timetable, stretched to the trip's actual duration
+            minutes = elapsed / span * total if span else total
+            while leg < len(stops) - 1 and offsets[leg] < minutes:
+                leg += 1
+            a, b = stops[leg - 1], stops[leg]
+            width = (b[6] - a[6]) or 1
+            t = min(max((minutes - a[6]) / width, 0), 1)
+            self.loader.add(
+                LiveLocation, bus_id=bus_id, trip_id=trip_id,
+                latitude=round(a[2] + (b[2] - a[2]) * t + rng.gauss(0, 0.00005), 7),
+                longitude=round(a[3] + (b[3] - a[3]) * t + rng.gauss(0, 0.00005), 7),
+                speed_kmh=round(speed * rng.uniform(0.6, 1.3), 2),
+                heading=headings[leg],
+                timestamp=started + datetime.timedelta(seconds=elapsed),
+            )
+            elapsed += step * rng.uniform(0.9, 1.1)
+
+
+# -----------------------------
+# CLEAR
+# -----------------------------
+def clear(prefix, using='default'):
+    """Delete everything a previous run with ``prefix`` generated; returns {model: rows}.
+
+    Deletes table by table without loading rows: the per-row booking
+    signals would take hours at this scale, and the occupancy rows they
+    maintain go with the buses anyway.
+    """
+    bus_filter = {'bus_number__startswith': f'{prefix}-'}
+    route_filter = {'name__startswith': f'{prefix} '}
+    user_filter = {'username__startswith': f'{prefix.lower()}_'}
+    buses = Bus.objects.using(using).filter(**bus_filter).values('pk')
+    routes = Route.objects.using(using).filter(**route_filter).values('pk')
+    users = User.objects.using(using).filter(**user_filter).values('pk')
+    bookings = Booking.objects.using(using).filter(bus__in=buses).values('pk')
+    user_bookings = Booking.objects.using(using).filter(user__in=users).values('pk')
+
+    steps = [
+        (Payment, {'booking__in': bookings}), (Payment, {'booking__in': user_bookings}),
+        (SelectedSeat, {'booking__in': bookings}), (SelectedSeat, {'booking__in': user_bookings}),
+        (Booking, {'bus__in': buses}), (Booking, {'user__in': users}),
+        (SegmentOccupancy, {'bus__in': buses}), (TripInventory, {'bus__in': buses}),
+        (LiveLocation, {'bus__in': buses}), (ETACalculation, {'bus__in': buses}),
+        (TripTrajectory, {'bus__in': buses}), (PerformanceMetrics, {'bus__in': buses}),
+        (DailyBookingRollup, {'bus__in': buses}), (DailyTripRollup, {'bus__in': buses}),
+        (Trip, {'bus__in': buses}), (Seat, {'bus__in': buses}), (Bus, bus_filter),
+        (StopSearchIndex, {'route__in': routes}), (Stop, {'route__in': routes}), (Route, route_filter),
+        (Driver, {'user__in': users}), (UserProfile, {'user__in': users}), (User, user_filter),
+    ]
+    deleted = {}
+    for model, lookups in steps:
+        queryset = model._default_manager.using(using).filter(**lookups)
+        deleted[model] = deleted.get(model, 0) + queryset._raw_delete(using)
+    return deleted
@@ -0,0 +1,474 @@
+"""
+In-process load test of the booking funnel, for ``manage.py bench_funnel``.
+
+Passengers, drivers and viewers are coroutines on one event loop that
+call ``bustrack.asgi.application`` directly through channels' test
+communicators: no sockets and no server, but the same routing,
+middleware, thread hops and database connections as under daphne.
+
+* A passenger searches, opens the bus page, loads the seat layout, opens
+  the booking form (which sets its CSRF cookie), posts it and pays. The
+  payment view talks to ``PayPalStandIn``, a server on localhost that
+  answers the PayPal REST calls of ``bookings.views`` after ``latency``
+  seconds; the passenger then returns to ``payment_success`` and follows
+  the redirect to the booking page.
+* A driver posts a GPS ping for one of the buses every ``ping_interval``.
+* A viewer holds a live-bus WebSocket subscribed to one bus and counts
+  the frames it receives.
+
+``LockWatch`` times the statements where bookings queue for each other
+(the ``TripInventory`` lock or version swap of ``bookings.reservations``)
+on every connection, and counts version swaps that lost a race (each one
+a retry) and "database is locked" errors. ``check`` looks for oversold
+segments, occupancy rows out of step with the bookings, and payments out
+of step with their bookings.
+"""
+import asyncio
+import datetime
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import OperationalError
+from django.db.backends.signals import connection_created
+from django.db.models import Count, Max, Q
+from django.test import Client as DjangoClient
+
+from bookings import occupancy
+from bookings.models import Booking, Payment, SegmentOccupancy
+from buses.models import Bus, Route, Stop, Trip
+from users.models import Driver, UserProfile
+
+STEPS = ('search', 'detail', 'seat_layout', 'book_form', 'book', 'payment', 'payment_return', 'confirmation')
+PING_PATH = '/tracking/api/update-location/'
+
+
+# -----------------------------
+# PAYPAL STAND-IN
+# -----------------------------
+class PayPalStandIn:
+    """Answers the PayPal REST calls of ``bookings.views`` on localhost.
+
+    Use as a context manager and point ``PAYPAL_ENDPOINT`` at ``url``.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.payments = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name='paypal-stand-in', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, method, path, body):
+        """(status, data) for one API call."""
+        parts = urlparse(path).path.strip('/').split('/')
+        if parts == ['v1', 'oauth2', 'token']:
+            return 200, {'access_token': 'bench', 'token_type': 'Bearer', 'expires_in': 32400}
+        if parts[:3] != ['v1', 'payments', 'payment']:
+            return 404, {'name': 'RESOURCE_NOT_FOUND'}
+
+        if len(parts) == 3 and method == 'POST':
+            payment = json.loads(body or b'{}')
+            with self._lock:
+                payment_id = f"PAY-BENCH{next(self._ids)}"
+                payment.update(id=payment_id, state='created', links=[{
+                    'rel': 'approval_url', 'method': 'REDIRECT',
+                    'href': f"{self.url}/checkout?paymentId={payment_id}",
+                }])
+                self.payments[payment_id] = payment
+            return 201, payment
+
+        with self._lock:
+            payment = self.payments.get(parts[3]) if len(parts) > 3 else None
+            if payment is None:
+                return 404, {'name': 'INVALID_RESOURCE_ID'}
+            if parts[4:] == ['execute'] and method == 'POST':
+                if payment['state'] != 'created':
+                    return 400, {'name': 'PAYMENT_STATE_INVALID'}
+                payment['state'] = 'approved'
+                payment['payer'] = {**payment.get('payer', {}), 'payer_info': json.loads(body or b'{}')}
+            elif parts[4:] or method != 'GET':
+                return 404, {'name': 'RESOURCE_NOT_FOUND'}
+            return 200, dict(payment)
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                status, data = stand_in.answer(self.command, self.path, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = _serve
+
+        return Handler
+
+
+# -----------------------------
+# DATABASE LOCK WAITS
+# -----------------------------
+class LockWatch:
+    """Times the statements bookings queue on, on every new connection.
+
+    A context manager: connections opened inside it (each request
+    thread opens its own) get the wrapper.
+    """
+
+    def __init__(self):
+        self.waits = []
+        self.busy = 0
+        self.races = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        swap = sql.startswith('UPDATE "bookings_tripinventory"')
+        started = time.perf_counter()
+        try:
+            result = execute(sql, params, many, context)
+            if swap and not context['cursor'].rowcount:
+                # Another booking bumped the version first; reserve retries
+                with self._lock:
+                    self.races += 1
+            return result
+        except OperationalError as exc:
+            if 'locked' in str(exc):
+                with self._lock:
+                    self.busy += 1
+            raise
+        finally:
+            if swap or 'FOR UPDATE' in sql:
+                with self._lock:
+                    self.waits.append(time.perf_counter() - started)
+
+    def _install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self._install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._install)
+
+
+# -----------------------------
+# FIXTURES
+# -----------------------------
+class Fixtures:
+    """A route with ``buses`` buses on it, passengers and drivers with sessions."""
+
+    def __init__(self, buses=4, stops=8, seats=40, passengers=100, drivers=10, travel_date=None):
+        tag = uuid.uuid4().hex[:8]
+        self.tag = tag
+        self.travel_date = travel_date or datetime.date.today() + datetime.timedelta(days=1)
+        self.route = Route.objects.create(
+            name=f"BENCH {tag}", source=f"Benchpur {tag} 01", destination=f"Benchpur {tag} {stops:02d}",
+        )
+        self.stops = [
+            Stop.objects.create(
+                route=self.route,
+                name=f"Benchpur {tag} {seq:02d}",
+                latitude=18.5 + seq / 100,
+                longitude=73.8,
+                sequence_number=seq,
+                distance_from_previous_km=5 if seq > 1 else 0,
+                fare_from_previous=25 if seq > 1 else 0,
+            )
+            for seq in range(1, stops + 1)
+        ]
+        self.buses = [
+            Bus.objects.create(
+                bus_number=f"BENCH-{tag}-{n}",
+                bus_name="Benchmark Express",
+                total_seats=seats,
+                route=self.route,
+                departure_time=datetime.time(8, 0),
+                arrival_time=datetime.time(12, 0),
+            )
+            for n in range(buses)
+        ]
+        for bus in self.buses:
+            Trip.objects.create(bus=bus, date=self.travel_date, status='running')
+
+        self.users = []
+        self.passenger_sessions = [self._session(f"bench-passenger-{tag}-{n}", 'user') for n in range(passengers)]
+        self.driver_sessions = [self._session(f"bench-driver-{tag}-{n}", 'driver') for n in range(drivers)]
+
+    def _session(self, username, role):
+        user = User.objects.create(username=username, email=f"{username}@example.com")
+        UserProfile.objects.update_or_create(user=user, defaults={'role': role})
+        if role == 'driver':
+            Driver.objects.create(user=user, license_number=username[-20:])
+        self.users.append(user)
+        client = DjangoClient()
+        client.force_login(user)
+        return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def delete(self):
+        for bus in self.buses:
+            bus.delete()
+        self.route.delete()
+        User.objects.filter(pk__in=[user.pk for user in self.users]).delete()
+
+
+# -----------------------------
+# CLIENT
+# -----------------------------
+class Client:
+    """Sends requests to an ASGI application in-process, keeping cookies."""
+
+    def __init__(self, application, cookies=None, timeout=60):
+        self.application = application
+        self.cookies = dict(cookies or {})
+        self.timeout = timeout
+        self._finishing = set()
+
+    async def request(self, method, path, body=b'', content_type=None, **params):
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        headers = [(b'host', b'localhost')]
+        if self.cookies:
+            headers.append((b'cookie', '; '.join(f"{k}={v}" for k, v in self.cookies.items()).encode('latin1')))
+        if content_type:
+            headers.append((b'content-type', content_type.encode()))
+        communicator = HttpCommunicator(self.application, method, path, body=body, headers=headers)
+        response = await communicator.get_response(self.timeout)
+        # The application still closes the response and its connection after
+        # the body is sent; let it finish without counting that as latency
+        finishing = asyncio.ensure_future(communicator.wait(self.timeout))
+        self._finishing.add(finishing)
+        finishing.add_done_callback(self._finishing.discard)
+        for name, value in response['headers']:
+            if name.lower() == b'set-cookie':
+                for key, morsel in SimpleCookie(value.decode('latin1')).items():
+                    if morsel['max-age'] == '0':
+                        self.cookies.pop(key, None)
+                    else:
+                        self.cookies[key] = morsel.value
+        return response
+
+    async def close(self):
+        await asyncio.gather(*self._finishing, return_exceptions=True)
+
+    def get(self, path, **params):
+        return self.request('GET', path, **params)
+
+    def post(self, path, data, **params):
+        return self.request(
+            'POST', path, urlencode(data).encode(), 'application/x-www-form-urlencoded', **params
+        )
+
+
+def location(response):
+    for name, value in response['headers']:
+        if name.lower() == b'location':
+            return value.decode('latin1')
+    return ''
+
+
+# -----------------------------
+# SCENARIO
+# -----------------------------
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)      # step -> [seconds]
+        self.statuses = defaultdict(Counter)    # step -> {status: n}
+        self.outcomes = Counter()               # funnel outcome -> n
+        self.frames = Counter()                 # viewer -> frames received
+        self.viewer_errors = 0
+
+    async def step(self, name, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except asyncio.TimeoutError:
+            self.statuses[name]['timeout'] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - started)
+        self.statuses[name][response['status']] += 1
+        return response
+
+
+async def passenger(client, fixtures, journeys, results, stand_in_url, think=0.0):
+    for bus, from_stop, to_stop, seats in journeys:
+        outcome = await _book(client, fixtures, bus, from_stop, to_stop, seats, results, stand_in_url)
+        results.outcomes[outcome] += 1
+        if think:
+            await asyncio.sleep(think)
+    await client.close()
+
+
+async def _book(client, fixtures, bus, from_stop, to_stop, seats, results, stand_in_url):
+    date = fixtures.travel_date.isoformat()
+    response = await results.step('search', client.get(
+        '/buses/search/', source=from_stop.name, destination=to_stop.name, date=date,
+    ))
+    if response is None or response['status'] != 200:
+        return 'error'
+    for name, request in (
+        ('detail', client.get(f'/buses/{bus.pk}/')),
+        ('seat_layout', client.get(
+            f'/bookings/api/seats/{bus.pk}/', date=date, from_stop=from_stop.pk, to_stop=to_stop.pk,
+        )),
+        ('book_form', client.get(f'/bookings/book/{bus.pk}/', date=date)),
+    ):
+        response = await results.step(name, request)
+        if response is None or response['status'] != 200:
+            return 'error'
+
+    response = await results.step('book', client.post(f'/bookings/book/{bus.pk}/', {
+        'csrfmiddlewaretoken': client.cookies.get(settings.CSRF_COOKIE_NAME, ''),
+        'travel_date': date,
+        'from_stop': from_stop.pk,
+        'to_stop': to_stop.pk,
+        'seats_booked': seats,
+        'passenger_name': 'Bench Passenger',
+        'passenger_phone': '9999999999',
+        'passenger_email': 'bench@example.com',
+    }))
+    if response is None:
+        return 'error'
+    if response['status'] == 200:
+        # The form came back: the segment sold out, or the reservation kept losing races
+        return 'refused'
+    if response['status'] != 302:
+        return 'error'
+
+    response = await results.step('payment', client.get(location(response)))
+    if response is None:
+        return 'payment_error'
+    approval = location(response)
+    if response['status'] != 302 or not approval.startswith(stand_in_url):
+        return 'payment_error'
+    payment_id = parse_qs(urlparse(approval).query)['paymentId'][0]
+
+    response = await results.step('payment_return', client.get(
+        '/bookings/payment/success/', paymentId=payment_id, PayerID='BENCHPAYER',
+    ))
+    if response is None or response['status'] != 302 or not location(response).startswith('/bookings/'):
+        return 'payment_error'
+    target = location(response)
+    response = await results.step('confirmation', client.get(target))
+    if response is None or response['status'] != 200:
+        return 'error'
+    return 'confirmed' if target.rstrip('/').split('/')[-1].isdigit() else 'payment_error'
+
+
+async def driver(client, fixtures, rng, results, interval, stop):
+    ping = 0
+    while not stop.is_set():
+        bus = fixtures.buses[ping % len(fixtures.buses)]
+        stop_row = fixtures.stops[ping % len(fixtures.stops)]
+        ping += 1
+        body = json.dumps({
+            'bus_id': bus.pk,
+            'latitude': float(stop_row.latitude) + rng.uniform(-0.001, 0.001),
+            'longitude': float(stop_row.longitude) + rng.uniform(-0.001, 0.001),
+            'speed': rng.uniform(0, 60),
+            'heading': rng.uniform(0, 360),
+        }).encode()
+        await results.step('ping', client.request('POST', PING_PATH, body, 'application/json'))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+    await client.close()
+
+
+async def viewer(application, number, bus, results, stop, timeout=60):
+    communicator = WebsocketCommunicator(application, '/ws/tracking/')
+    try:
+        connected, _ = await communicator.connect(timeout)
+    except asyncio.TimeoutError:
+        connected = False
+    if not connected:
+        results.viewer_errors += 1
+        return
+    await communicator.send_json_to({'action': 'subscribe', 'bus': bus.pk})
+
+    # receive_output cancels the application when it times out, so wait
+    # on the stop event alongside instead of polling
+    stopped = asyncio.ensure_future(stop.wait())
+    try:
+        while True:
+            received = asyncio.ensure_future(communicator.receive_output(timeout=None))
+            await asyncio.wait({received, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if not received.done():
+                received.cancel()
+                break
+            message = received.result()
+            if message['type'] == 'websocket.close':
+                results.viewer_errors += 1
+                return
+            results.frames[number] += 1
+    finally:
+        stopped.cancel()
+    await communicator.disconnect()
+
+
+# -----------------------------
+# CHECKS
+# -----------------------------
+def check(fixtures, results):
+    """Invariant violations after a run, as messages."""
+    problems = []
+    for bus in fixtures.buses:
+        peak = SegmentOccupancy.objects.filter(
+            bus=bus, travel_date=fixtures.travel_date,
+        ).aggregate(peak=Max('seats_booked'))['peak'] or 0
+        if peak > bus.total_seats:
+            problems.append(f"bus {bus.pk} oversold: {peak}/{bus.total_seats} seats on a segment")
+        for _, _, seq, expected, stored in occupancy.find_inconsistencies(bus.pk, fixtures.travel_date):
+            problems.append(f"bus {bus.pk} segment {seq}: occupancy {stored}, bookings hold {expected}")
+
+    bookings = Booking.objects.filter(bus__in=fixtures.buses)
+    unpaid = bookings.filter(status='confirmed').exclude(payment__status='success').count()
+    if unpaid:
+        problems.append(f"{unpaid} confirmed booking(s) without a successful payment")
+    stuck = Payment.objects.filter(booking__in=bookings, status='success').exclude(booking__status='confirmed').count()
+    if stuck:
+        problems.append(f"{stuck} successful payment(s) on unconfirmed bookings")
+    confirmed = bookings.filter(status='confirmed').count()
+    if confirmed != results.outcomes['confirmed']:
+        problems.append(f"{confirmed} confirmed booking(s) for {results.outcomes['confirmed']} confirmed funnels")
+    return problems
+
+
+def booking_counts(fixtures):
+    return Booking.objects.filter(bus__in=fixtures.buses).aggregate(
+        bookings=Count('pk'),
+        pending=Count('pk', filter=Q(status='pending')),
+        confirmed=Count('pk', filter=Q(status='confirmed')),
+    )
@@ -0,0 +1,133 @@
+"""
+The hot read paths of the site, replayed by ``manage.py check_query_plans``
+and ``manage.py check_query_budgets``.
+
+``build_fixture`` creates a few of everything (routes with stops, buses
+with drivers, today's trips with pings and ETAs, bookings) so that a
+page listing rows shows up as repeated queries if it loads them one by
+one. ``hot_requests`` returns the requests to replay as
+``(client, method, path, data)``, optionally only those under one URL
+namespace. Callers run both inside a transaction they roll back (a
+``TestCase`` does).
+"""
+import datetime
+
+from django.contrib.auth.models import User
+from django.test import Client
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from bookings.models import Booking
+from buses import fares
+from buses.models import Bus, Route, Stop, Trip
+from tracking.models import ETACalculation, LiveLocation
+from users.models import Driver, UserProfile
+
+ROWS = 5
+
+# Pages that list every row of a table by design: {view name: tables}
+FULL_LISTINGS = {
+    'admin_panel:booking_list': {'bookings_booking'},
+}
+
+
+def build_fixture(rows=ROWS):
+    now = timezone.now()
+    suffix = now.strftime('%H%M%S%f')
+
+    def user(name, role, **extra):
+        account = User.objects.create_user(f'hotpath_{name}_{suffix}', password=None, **extra)
+        UserProfile.objects.create(user=account, role=role)
+        return account
+
+    passenger = user('passenger', 'user')
+    admin = user('admin', 'admin', is_staff=True)
+    drivers = [
+        Driver.objects.create(user=user(f'driver{i}', 'driver'), license_number=f'HOT{i}{suffix}')
+        for i in range(rows)
+    ]
+
+    buses, trips, bookings = [], [], []
+    for i in range(rows):
+        route = Route.objects.create(name=f'Hot path {i}', source=f'Hot {i}A', destination=f'Hot {i}C')
+        stops = [
+            Stop.objects.create(
+                route=route, name=f'Hot {i}{name}', sequence_number=seq,
+                latitude=18.5 + seq / 100, longitude=73.8 + i / 10 + seq / 100,
+                distance_from_previous_km=5 if seq > 1 else 0, fare_from_previous=20 if seq > 1 else 0,
+            )
+            for seq, name in enumerate('ABC', start=1)
+        ]
+        bus = Bus.objects.create(
+            bus_number=f'H{i}{suffix}'[:20], bus_name=f'Hot path {i}', route=route, driver=drivers[i],
+            departure_time=datetime.time(8), arrival_time=datetime.time(12),
+        )
+        trip = Trip.objects.create(bus=bus, date=now.date(), status='running')
+        LiveLocation.objects.bulk_create([
+            LiveLocation(bus=bus, trip=trip, latitude=18.5, longitude=73.8 + i / 10 + n / 1000,
+                         timestamp=now - datetime.timedelta(seconds=10 * (30 - n)))
+            for n in range(30)
+        ])
+        ETACalculation.objects.create(
+            bus=bus, trip=trip, destination_name=stops[-1].name,
+            destination_latitude=stops[-1].latitude, destination_longitude=stops[-1].longitude,
+            distance_remaining_km=10, estimated_arrival_time=now + datetime.timedelta(minutes=30),
+        )
+        bookings.append(Booking.objects.create(
+            user=passenger, bus=bus, trip=trip, travel_date=now.date(),
+            from_stop=stops[0], to_stop=stops[1], passenger_name='Hot Path',
+            passenger_phone='9999999999', status='confirmed',
+        ))
+        buses.append((bus, stops))
+        trips.append(trip)
+        # Bookings built the route's fare table; start pages from a cold cache
+        fares.invalidate(route.pk)
+
+    return {
+        'passenger': passenger, 'driver': drivers[0].user, 'admin': admin,
+        'buses': buses, 'trips': trips, 'bookings': bookings,
+    }
+
+
+def hot_requests(fixture, namespace=None):
+    today = timezone.now().date().isoformat()
+    (bus, stops), trip, booking = fixture['buses'][0], fixture['trips'][0], fixture['bookings'][0]
+
+    passenger, driver, admin = Client(), Client(), Client()
+    passenger.force_login(fixture['passenger'])
+    driver.force_login(fixture['driver'])
+    admin.force_login(fixture['admin'])
+
+    requests = [
+        (passenger, 'get', reverse('bookings:list'), None),
+        (passenger, 'get', reverse('bookings:detail', args=[booking.pk]), None),
+        (passenger, 'get', reverse('bookings:track', args=[booking.pk]), None),
+        (passenger, 'get', reverse('bookings:book', args=[bus.pk]), None),
+        (passenger, 'post', reverse('bookings:book', args=[bus.pk]), {
+            'travel_date': today, 'from_stop': stops[0].pk, 'to_stop': stops[-1].pk,
+            'seats_booked': 1, 'passenger_name': 'Hot Path', 'passenger_phone': '9999999999',
+        }),
+        (passenger, 'get', reverse('bookings:seat_layout_api', args=[bus.pk]),
+         {'date': today, 'from_stop': stops[0].pk, 'to_stop': stops[-1].pk}),
+        (passenger, 'get', reverse('bookings:seat_map_batch_api'), {
+            'buses': ','.join(str(b.pk) for b, _ in fixture['buses']), 'date': today,
+            'source': stops[0].name, 'destination': stops[-1].name,
+        }),
+        (passenger, 'get', reverse('bookings:seat_status_api', args=[bus.pk]), {'date': today}),
+        (passenger, 'get', reverse('tracking:get_bus_location', args=[bus.pk]), None),
+        (passenger, 'get', reverse('tracking:trip_replay', args=[trip.pk]), {'offset': 60}),
+        (driver, 'get', reverse('tracking:driver_view'), None),
+        (admin, 'get', reverse('routes:route_list'), None),
+    ] + [
+        (admin, 'get', reverse(f'admin_panel:{name}'), None)
+        for name in ('dashboard', 'bus_list', 'driver_list', 'user_list', 'booking_list',
+                     'live_tracking', 'analytics')
+    ]
+    if namespace is not None:
+        requests = [request for request in requests if resolve(request[2]).namespace == namespace]
+    return requests
+
+
+def full_listing(path):
+    """Tables the page at ``path`` lists in full by design."""
+    return FULL_LISTINGS.get(resolve(path).view_name, set())
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from benchmarks.utils import FanoutLayer
+from tracking import broadcast
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare per-update WebSocket broadcasts with the coalescing "
+        "broadcaster (one pre-encoded frame per group per tick). Reports "
+        "messages and bytes per client and CPU per delivered bus update. "
+        "Needs no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['coalesced', 'per-update'], default='coalesced')
+        parser.add_argument('--buses', type=int, default=400)
+        parser.add_argument('--routes', type=int, default=20)
+        parser.add_argument('--ping-hz', type=float, default=1.0, help="Pings per bus per second.")
+        parser.add_argument('--tick', type=float, default=0.5, help="Broadcaster tick in seconds.")
+        parser.add_argument('--seconds', type=int, default=10, help="Simulated seconds.")
+        parser.add_argument('--fleet-clients', type=int, default=200)
+        parser.add_argument('--route-clients', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=9)
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        rng = random.Random(options['seed'])
+        layer = FanoutLayer()
+        buses = [
+            {
+                'bus_id': n + 1,
+                'bus_name': f"Bus {n + 1}",
+                'bus_number': f"MH-{n + 1:04d}",
+                'route_id': rng.randrange(options['routes']) + 1,
+                'route': "Pune → Mumbai",
+                'status': 'running',
+                'latitude': rng.uniform(18.3, 19.3),
+                'longitude': rng.uniform(72.8, 74.2),
+                'speed': 40.0,
+                'heading': 90.0,
+                'next_stop': "Shivajinagar",
+                'eta': {'estimated_arrival': timezone.now().isoformat(), 'distance_remaining_km': 2.5},
+            }
+            for n in range(options['buses'])
+        ]
+
+        channels = []
+        for n in range(options['fleet_clients']):
+            channels.append(f"fleet.{n}")
+            await layer.group_add(broadcast.FLEET_GROUP, channels[-1])
+        for n in range(options['route_clients']):
+            channels.append(f"route.{n}")
+            await layer.group_add(broadcast.route_group(rng.randrange(options['routes']) + 1), channels[-1])
+
+        # Pings spread evenly over each second, drained once per tick
+        ticks = int(options['seconds'] / options['tick'])
+        pings_per_tick = int(len(buses) * options['ping_hz'] * options['tick'])
+        broadcaster = broadcast.Broadcaster(tick=options['tick'])
+
+        messages = updates = sent_bytes = 0
+        cpu_started = time.process_time()
+        cursor = 0
+        for _ in range(ticks):
+            states = []
+            for _ in range(pings_per_tick):
+                bus = buses[cursor % len(buses)]
+                cursor += 1
+                bus['latitude'] += rng.uniform(-0.001, 0.001)
+                bus['longitude'] += rng.uniform(-0.001, 0.001)
+                states.append({**bus, 'timestamp': timezone.now().isoformat()})
+
+            if options['mode'] == 'coalesced':
+                broadcaster.collect(states)
+                for group, event in broadcaster.frames():
+                    await layer.group_send(group, event)
+            else:
+                for state in states:
+                    event = broadcast.location_event(state)
+                    for group in broadcast.groups_for_state(state):
+                        await layer.group_send(group, event)
+
+            # What each consumer writes to its socket
+            for channel in channels:
+                for event in layer.drain(channel):
+                    if event['type'] == 'send_frame':
+                        text = event['text']
+                        updates += text.count('"bus_id"')
+                    else:
+                        text = json.dumps(event)
+                        updates += 1
+                    messages += 1
+                    sent_bytes += len(text)
+        cpu = time.process_time() - cpu_started
+
+        clients = len(channels)
+        self.stdout.write(
+            f"mode={options['mode']} buses={len(buses)} ping_hz={options['ping_hz']} "
+            f"tick_s={options['tick']} clients={clients} simulated_s={options['seconds']}"
+        )
+        self.stdout.write(
+            f"messages_per_client_per_s={messages / clients / options['seconds']:.1f} "
+            f"bytes_per_client_per_s={sent_bytes / clients / options['seconds']:.0f} "
+            f"updates_delivered={updates}"
+        )
+        self.stdout.write(
+            f"cpu_s={cpu:.2f} cpu_us_per_update={cpu / max(updates, 1) * 1e6:.2f}"
+        )
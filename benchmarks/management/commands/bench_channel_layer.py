@@ -0,0 +1,113 @@
+import asyncio
+import multiprocessing
+import os
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.utils import format_summary, summarize
+from tracking import layers
+
+GROUP = 'bench_layer_{}'
+
+
+def _subscriber(worker, options, ready, results):
+    """Runs in a separate process: join groups, then count what arrives."""
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bustrack.settings')
+    django.setup()
+    results.put(asyncio.run(_subscribe(worker, options, ready)))
+
+
+async def _subscribe(worker, options, ready):
+    layer = get_channel_layer()
+    channels = []
+    for n in range(options['channels']):
+        channel = await layer.new_channel(f'bench{worker}.')
+        await layer.group_add(GROUP.format(n % options['groups']), channel)
+        channels.append(channel)
+    ready.put(worker)
+
+    expected = options['messages'] // options['groups']
+    latencies = []
+
+    async def drain(channel):
+        for _ in range(expected):
+            message = await layer.receive(channel)
+            latencies.append(time.time() - message['sent'])
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(drain(channel) for channel in channels)), options['timeout']
+        )
+    except asyncio.TimeoutError:
+        pass
+    for n, channel in enumerate(channels):
+        await layer.group_discard(GROUP.format(n % options['groups']), channel)
+    return {'worker': worker, 'received': len(latencies), 'latencies': latencies}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cross-process delivery through the configured channel layer: "
+        "subscriber processes join groups, this process group_sends to them. "
+        "Reports aggregate messages delivered per second and delivery latency. "
+        "Needs a channel layer shared between processes (set REDIS_URL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Subscriber processes.")
+        parser.add_argument('--channels', type=int, default=50, help="Channels (clients) per worker.")
+        parser.add_argument('--groups', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=1000, help="group_send calls in total.")
+        parser.add_argument('--timeout', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not layers.is_shared(layer):
+            raise CommandError(
+                f"{layers.backend_name(layer)} does not deliver between processes; set REDIS_URL."
+            )
+
+        context = multiprocessing.get_context('spawn')
+        ready, results = context.Queue(), context.Queue()
+        processes = [
+            context.Process(target=_subscriber, args=(n, options, ready, results))
+            for n in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get(timeout=options['timeout'])
+
+        started = time.perf_counter()
+        asyncio.run(self._publish(layer, options))
+        published = time.perf_counter() - started
+
+        reports = [results.get(timeout=options['timeout'] + 10) for _ in processes]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        received = sum(report['received'] for report in reports)
+        expected = (options['messages'] // options['groups']) * options['channels'] * options['workers']
+        latencies = [value for report in reports for value in report['latencies']]
+        self.stdout.write(
+            f"backend={layers.backend_name(layer)} workers={options['workers']} "
+            f"channels={options['channels'] * options['workers']} groups={options['groups']} "
+            f"group_sends={options['messages']}"
+        )
+        self.stdout.write(
+            f"received={received}/{expected} publish_s={published:.2f} elapsed_s={elapsed:.2f} "
+            f"delivered_per_s={received / elapsed:.0f}"
+        )
+        self.stdout.write(f"latency {format_summary(summarize(latencies))}")
+
+    async def _publish(self, layer, options):
+        for n in range(options['messages'] - options['messages'] % options['groups']):
+            await layer.group_send(
+                GROUP.format(n % options['groups']),
+                {'type': 'bench.message', 'sent': time.time()},
+            )
@@ -0,0 +1,102 @@
+import math
+import random
+import time
+from bisect import bisect_right
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from geopy.distance import geodesic
+
+from benchmarks.utils import format_summary, summarize
+from tracking.eta import ARRIVAL_RADIUS_KM, KM_PER_DEGREE, RouteGeometry, TripProgress
+
+
+def legacy_next_stop(stops, latitude, longitude, speed):
+    """The per-ping loop update_location used to run: first stop more than 50 m away."""
+    for index, (name, lat, lng) in enumerate(stops):
+        dist = geodesic((latitude, longitude), (lat, lng)).km
+        if dist > 0.05:
+            speed_used = speed if speed > 5 else 40
+            return index, timezone.now() + timezone.timedelta(minutes=dist / speed_used * 60)
+    return None, None
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare tracking.eta.TripProgress against the legacy geodesic loop on a "
+        "synthetic trip: time per ping and how often an already-passed stop is "
+        "reported as the next one. Needs no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stops', type=int, default=40)
+        parser.add_argument('--step-m', type=float, default=80, help="Distance driven between pings.")
+        parser.add_argument('--noise-m', type=float, default=15, help="GPS noise (std dev).")
+        parser.add_argument('--trips', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        stops = self._route(rng, options['stops'])
+        geometry = RouteGeometry(None, stops)
+
+        results = {'legacy': ([], 0), 'incremental': ([], 0)}
+        pings = 0
+        for _ in range(options['trips']):
+            trip = self._drive(rng, geometry, options['step_m'] / 1000, options['noise_m'] / 1000)
+            pings += len(trip)
+            tracker = TripProgress(geometry)
+            for name, run in (
+                ('legacy', lambda lat, lng, speed: legacy_next_stop(stops, lat, lng, speed)[0]),
+                ('incremental', lambda lat, lng, speed: tracker.update(lat, lng, speed).next_index),
+            ):
+                times, passed = results[name]
+                for lat, lng, speed, expected in trip:
+                    started = time.perf_counter()
+                    index = run(lat, lng, speed)
+                    times.append(time.perf_counter() - started)
+                    if index is not None and expected is not None and index < expected:
+                        passed += 1
+                results[name] = (times, passed)
+
+        self.stdout.write(
+            f"stops={len(stops)} route_km={geometry.total_km:.1f} pings={pings} "
+            f"noise_m={options['noise_m']}"
+        )
+        for name, (times, passed) in results.items():
+            per_ping_us = sum(times) / len(times) * 1e6
+            self.stdout.write(
+                f"{name:<12} mean_us={per_ping_us:.1f} passed_stop_rate={passed / pings:.3f} "
+                f"{format_summary(summarize(times))}"
+            )
+
+    def _route(self, rng, count):
+        lat, lng, bearing = 18.52, 73.85, rng.uniform(0, 2 * math.pi)
+        stops = []
+        for n in range(count):
+            stops.append((f"Stop {n + 1}", lat, lng))
+            bearing += rng.uniform(-0.6, 0.6)
+            step_km = rng.uniform(0.8, 3.0)
+            lat += step_km * math.cos(bearing) / KM_PER_DEGREE
+            lng += step_km * math.sin(bearing) / (KM_PER_DEGREE * math.cos(math.radians(lat)))
+        return stops
+
+    def _drive(self, rng, geometry, step_km, noise_km):
+        """Noisy positions along the route with the true next-stop index for each."""
+        pings = []
+        along = 0.0
+        while along < geometry.total_km:
+            segment = min(bisect_right(geometry.cumulative, along), len(geometry) - 1)
+            t = (along - geometry.cumulative[segment - 1]) / geometry.lengths[segment]
+            lat = geometry.latitudes[segment - 1] + t * (
+                geometry.latitudes[segment] - geometry.latitudes[segment - 1]
+            )
+            lng = geometry.longitudes[segment - 1] + t * (
+                geometry.longitudes[segment] - geometry.longitudes[segment - 1]
+            )
+            lat += rng.gauss(0, noise_km) / geometry.ky
+            lng += rng.gauss(0, noise_km) / geometry.kx
+            expected = bisect_right(geometry.cumulative, along + ARRIVAL_RADIUS_KM)
+            pings.append((lat, lng, rng.uniform(20, 60), expected if expected < len(geometry) else None))
+            along += step_km
+        return pings
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from benchmarks.utils import FanoutLayer, percentile
+from tracking import broadcast
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate WebSocket fan-out of fleet updates to many consumers, with "
+        "every client in the fleet group (legacy) or on per-bus/route/tile "
+        "groups. Reports messages delivered per second and per-client "
+        "bandwidth. Needs no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['sharded', 'fleet'], default='sharded')
+        parser.add_argument('--consumers', type=int, default=10000)
+        parser.add_argument('--buses', type=int, default=200)
+        parser.add_argument('--routes', type=int, default=20)
+        parser.add_argument('--seconds', type=int, default=3, help="Simulated seconds at one ping per bus per second.")
+        parser.add_argument('--fleet-share', type=float, default=0.01, help="Clients watching the whole fleet.")
+        parser.add_argument('--route-share', type=float, default=0.1, help="Clients watching a route.")
+        parser.add_argument('--tile-share', type=float, default=0.09, help="Clients watching a map area.")
+        parser.add_argument('--seed', type=int, default=5)
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        rng = random.Random(options['seed'])
+        layer = FanoutLayer()
+        buses = [
+            {
+                'bus_id': n + 1,
+                'bus_name': f"Bus {n + 1}",
+                'bus_number': f"MH-{n + 1:04d}",
+                'route_id': rng.randrange(options['routes']) + 1,
+                'route': "Pune → Mumbai",
+                'status': 'running',
+                'latitude': rng.uniform(18.3, 19.3),
+                'longitude': rng.uniform(72.8, 74.2),
+            }
+            for n in range(options['buses'])
+        ]
+
+        channels = [f"bench.{n}" for n in range(options['consumers'])]
+        for channel in channels:
+            for group in self._subscription(rng, options, buses):
+                await layer.group_add(group, channel)
+
+        delivered = 0
+        received_bytes = {channel: 0 for channel in channels}
+        started = time.perf_counter()
+        for _ in range(options['seconds']):
+            for bus in buses:
+                bus['latitude'] += rng.uniform(-0.002, 0.002)
+                bus['longitude'] += rng.uniform(-0.002, 0.002)
+                state = {**bus, 'speed': 40.0, 'timestamp': timezone.now().isoformat()}
+                event = broadcast.location_event(state)
+                if options['mode'] == 'fleet':
+                    groups = [broadcast.FLEET_GROUP]
+                else:
+                    groups = broadcast.groups_for_state(state)
+                for group in groups:
+                    await layer.group_send(group, event)
+
+            # Each consumer serialises what it received, as send_location does
+            for channel in channels:
+                seen = set()
+                for message in layer.drain(channel):
+                    key = (message['bus_id'], message['timestamp'])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    received_bytes[channel] += len(json.dumps(message))
+                    delivered += 1
+        elapsed = time.perf_counter() - started
+
+        per_client = [total / options['seconds'] for total in received_bytes.values()]
+        self.stdout.write(
+            f"mode={options['mode']} consumers={len(channels)} buses={len(buses)} "
+            f"simulated_s={options['seconds']} groups={len(layer.groups)}"
+        )
+        self.stdout.write(
+            f"delivered={delivered} elapsed_s={elapsed:.2f} "
+            f"delivered_per_s={delivered / elapsed:.0f} "
+            f"server_s_per_simulated_s={elapsed / options['seconds']:.2f}"
+        )
+        self.stdout.write(
+            f"per_client_bytes_per_s mean={sum(per_client) / len(per_client):.0f} "
+            f"p50={percentile(per_client, 50):.0f} p99={percentile(per_client, 99):.0f} "
+            f"max={max(per_client):.0f}"
+        )
+
+    def _subscription(self, rng, options, buses):
+        if options['mode'] == 'fleet':
+            return [broadcast.FLEET_GROUP]
+        roll = rng.random()
+        if roll < options['fleet_share']:
+            return [broadcast.FLEET_GROUP]
+        roll -= options['fleet_share']
+        if roll < options['route_share']:
+            return [broadcast.route_group(rng.randrange(options['routes']) + 1)]
+        roll -= options['route_share']
+        if roll < options['tile_share']:
+            bus = rng.choice(buses)
+            return [broadcast.tile_group(*broadcast.tile_for(bus['latitude'], bus['longitude']))]
+        return [broadcast.bus_group(rng.choice(buses)['bus_id'])]
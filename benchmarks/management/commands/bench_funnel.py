@@ -0,0 +1,151 @@
+import asyncio
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+
+from benchmarks import funnel
+from benchmarks.utils import format_summary, summarize
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the booking funnel through the ASGI application in-process: "
+        "concurrent passengers search, open the bus, load the seat layout, book "
+        "and pay against a local PayPal stand-in, while drivers post GPS pings "
+        "and viewers hold live-bus WebSockets. Reports throughput, latency per "
+        "step, time spent waiting on the booking locks, and oversold or "
+        "inconsistent bookings (exit status 1). Needs a database that is shared "
+        "between connections (a file-backed SQLite or PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--passengers', type=int, default=100, help="Concurrent passengers.")
+        parser.add_argument('--funnels', type=int, default=2, help="Bookings each passenger attempts.")
+        parser.add_argument('--max-party', type=int, default=3, help="Largest seats_booked per attempt.")
+        parser.add_argument('--think-ms', type=float, default=0, help="Pause between a passenger's bookings.")
+        parser.add_argument('--buses', type=int, default=4)
+        parser.add_argument('--stops', type=int, default=8)
+        parser.add_argument('--seats', type=int, default=40, help="Seats per bus.")
+        parser.add_argument('--drivers', type=int, default=10)
+        parser.add_argument('--ping-interval', type=float, default=1.0, help="Seconds between a driver's pings.")
+        parser.add_argument('--viewers', type=int, default=50)
+        parser.add_argument('--paypal-latency-ms', type=float, default=100, help="Stand-in PayPal response time.")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds before a request counts as timed out.")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark buses, bookings and users.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise CommandError("An in-memory SQLite database cannot be shared between request threads.")
+        if options['stops'] < 2 or min(options['buses'], options['passengers'], options['funnels']) < 1:
+            raise CommandError("Need at least 2 --stops and 1 bus, passenger and funnel.")
+
+        from bustrack.asgi import application
+
+        fixtures = funnel.Fixtures(
+            buses=options['buses'],
+            stops=options['stops'],
+            seats=options['seats'],
+            passengers=options['passengers'],
+            drivers=options['drivers'],
+        )
+        try:
+            with funnel.PayPalStandIn(options['paypal_latency_ms'] / 1000) as stand_in, override_settings(
+                PAYPAL_CLIENT_ID='bench', PAYPAL_CLIENT_SECRET='bench', PAYPAL_ENDPOINT=stand_in.url,
+            ), funnel.LockWatch() as locks:
+                results, elapsed = asyncio.run(self._run(application, fixtures, stand_in, options))
+            connections.close_all()
+            counts = funnel.booking_counts(fixtures)
+            problems = funnel.check(fixtures, results)
+        finally:
+            if not options['keep']:
+                fixtures.delete()
+
+        self._report(options, results, elapsed, locks, counts)
+        if problems:
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(f"  {problem}"))
+            raise CommandError(f"{len(problems)} consistency violation(s).")
+        self.stdout.write(self.style.SUCCESS("No segment oversold; bookings, occupancy and payments agree."))
+
+    async def _run(self, application, fixtures, stand_in, options):
+        rng = random.Random(options['seed'])
+        stop = asyncio.Event()
+        results = funnel.Results()
+
+        plans = []
+        for _ in fixtures.passenger_sessions:
+            journeys = []
+            for _ in range(options['funnels']):
+                start = rng.randrange(0, len(fixtures.stops) - 1)
+                end = rng.randrange(start + 1, len(fixtures.stops))
+                journeys.append((
+                    rng.choice(fixtures.buses), fixtures.stops[start], fixtures.stops[end],
+                    rng.randint(1, options['max_party']),
+                ))
+            plans.append(journeys)
+
+        def client(session):
+            return funnel.Client(application, {settings.SESSION_COOKIE_NAME: session}, options['timeout'])
+
+        background = [
+            asyncio.ensure_future(funnel.viewer(
+                application, n, fixtures.buses[n % len(fixtures.buses)], results, stop, options['timeout'],
+            ))
+            for n in range(options['viewers'])
+        ] + [
+            asyncio.ensure_future(funnel.driver(
+                client(session), fixtures, random.Random(rng.random()), results, options['ping_interval'], stop,
+            ))
+            for session in fixtures.driver_sessions
+        ]
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            funnel.passenger(
+                client(session), fixtures, journeys, results, stand_in.url, options['think_ms'] / 1000,
+            )
+            for session, journeys in zip(fixtures.passenger_sessions, plans)
+        ))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*background)
+        return results, elapsed
+
+    def _report(self, options, results, elapsed, locks, counts):
+        funnels = sum(results.outcomes.values())
+        requests = sum(sum(statuses.values()) for statuses in results.statuses.values())
+        self.stdout.write(
+            f"backend={connection.vendor} passengers={options['passengers']} buses={options['buses']} "
+            f"seats={options['seats']} drivers={options['drivers']} viewers={options['viewers']}"
+        )
+        self.stdout.write(
+            f"elapsed_s={elapsed:.2f} funnels_per_s={funnels / elapsed:.1f} "
+            f"confirmed_per_s={results.outcomes['confirmed'] / elapsed:.1f} requests_per_s={requests / elapsed:.0f}"
+        )
+        self.stdout.write(f"outcomes={dict(sorted(results.outcomes.items()))}")
+        for step in (*funnel.STEPS, 'ping'):
+            if step not in results.statuses:
+                continue
+            self.stdout.write(
+                f"  {step:<15}{format_summary(summarize(results.latencies[step]))} "
+                f"status={dict(sorted(results.statuses[step].items(), key=str))}"
+            )
+
+        frames = sum(results.frames.values())
+        connected = max(options['viewers'] - results.viewer_errors, 1)
+        self.stdout.write(
+            f"viewers frames={frames} per_viewer_per_s={frames / connected / elapsed:.1f} "
+            f"failed={results.viewer_errors}"
+        )
+        self.stdout.write(
+            f"lock_waits statements={len(locks.waits)} total_s={sum(locks.waits):.2f} "
+            f"{format_summary(summarize(locks.waits))} lost_races={locks.races} database_locked_errors={locks.busy}"
+        )
+        self.stdout.write(
+            f"bookings={counts['bookings']} confirmed={counts['confirmed']} pending={counts['pending']}"
+        )
@@ -0,0 +1,168 @@
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from benchmarks.utils import format_summary, summarize
+from buses.models import Bus, Route, Stop, Trip
+from tracking import ingest, views
+from tracking.models import LiveLocation
+from users import dashboard, rollups
+from users.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive tracking.views.update_location from many threads and report "
+        "sustained pings per second (until every ping is written) and ack "
+        "latency, for the batched queue or the inline write path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['queue', 'inline'], default='queue')
+        parser.add_argument('--buses', type=int, default=400)
+        parser.add_argument('--pings', type=int, default=20000, help="Total pings to send.")
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--stops', type=int, default=20, help="Stops on the benchmark route.")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--flush-interval', type=float, default=0.5)
+        parser.add_argument('--max-pending', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=11)
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark buses and pings.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise CommandError("An in-memory SQLite database cannot be shared between threads.")
+
+        user, route, buses = self._fixtures(options)
+        config = {
+            'ENABLED': options['mode'] == 'queue',
+            'BATCH_SIZE': options['batch_size'],
+            'FLUSH_INTERVAL': options['flush_interval'],
+            'MAX_PENDING': options['max_pending'],
+        }
+        try:
+            with override_settings(TRACKING_INGEST=config):
+                ingest.reset_queue()
+                self._run(options, user, buses)
+                ingest.reset_queue()
+        finally:
+            if not options['keep']:
+                Bus.objects.filter(pk__in=[bus.pk for bus in buses]).delete()
+                route.delete()
+
+    def _run(self, options, user, buses):
+        rng = random.Random(options['seed'])
+        factory = RequestFactory()
+        bodies = []
+        for n in range(options['pings']):
+            bus = buses[n % len(buses)]
+            bodies.append(json.dumps({
+                'bus_id': bus.pk,
+                'latitude': 18.5 + rng.random() / 10,
+                'longitude': 73.8 + rng.random() / 10,
+                'speed': rng.uniform(0, 60),
+                'heading': rng.uniform(0, 360),
+            }))
+
+        statuses = {}
+        latencies = []
+        lock = threading.Lock()
+        cursor = iter(bodies)
+        barrier = threading.Barrier(options['threads'])
+
+        def worker():
+            barrier.wait()
+            try:
+                while True:
+                    with lock:
+                        body = next(cursor, None)
+                    if body is None:
+                        return
+                    request = factory.post(
+                        '/tracking/api/update-location/', body, content_type='application/json'
+                    )
+                    request.user = user
+                    started = time.perf_counter()
+                    response = views.update_location(request)
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        acked = time.perf_counter() - started
+
+        queue = ingest.get_queue() if options['mode'] == 'queue' else None
+        if queue is not None:
+            queue.flush()
+        durable = time.perf_counter() - started
+
+        written = LiveLocation.objects.filter(bus__in=buses).count()
+        self.stdout.write(
+            f"mode={options['mode']} backend={connection.vendor} buses={len(buses)} "
+            f"threads={options['threads']} pings={len(latencies)}"
+        )
+        self.stdout.write(
+            f"ack_s={acked:.2f} durable_s={durable:.2f} "
+            f"sustained_pings_per_s={len(latencies) / durable:.1f}"
+        )
+        self.stdout.write(f"ack latency {format_summary(summarize(latencies))}")
+        self.stdout.write(f"http_status={dict(sorted(statuses.items()))} rows_written={written}")
+        if queue is not None:
+            self.stdout.write(f"queue {dict(sorted(queue.stats.items()))}")
+
+    def _fixtures(self, options):
+        tag = uuid.uuid4().hex[:8]
+        user, _ = User.objects.get_or_create(username='bench-driver')
+        UserProfile.objects.update_or_create(user=user, defaults={'role': 'driver'})
+        user = User.objects.select_related('profile').get(pk=user.pk)
+
+        route = Route.objects.create(
+            name=f"BENCH {tag}",
+            source="Bench Origin",
+            destination="Bench Terminus",
+        )
+        Stop.objects.bulk_create(
+            Stop(
+                route=route,
+                name=f"Bench Stop {seq}",
+                latitude=18.5 + seq / 100,
+                longitude=73.8 + seq / 100,
+                sequence_number=seq,
+            )
+            for seq in range(1, options['stops'] + 1)
+        )
+        buses = Bus.objects.bulk_create(
+            Bus(
+                bus_number=f"BENCH-{tag}-{n}",
+                bus_name="Benchmark Express",
+                route=route,
+                departure_time=datetime.time(8, 0),
+                arrival_time=datetime.time(12, 0),
+            )
+            for n in range(options['buses'])
+        )
+        trips = Trip.objects.bulk_create(
+            Trip(bus=bus, date=timezone.now().date(), status='running') for bus in buses
+        )
+        # The cleanup deletes these through signals, so count them in too
+        dashboard.record_created(Bus, buses)
+        dashboard.record_created(Trip, trips)
+        rollups.record_created(Trip, trips)
+        return user, route, buses
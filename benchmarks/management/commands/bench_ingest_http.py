@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+
+from benchmarks.utils import format_summary, summarize
+from buses.models import Bus, Route, Trip
+from users import dashboard, rollups
+from users.models import Driver, UserProfile
+
+APPLICATIONS = {
+    # LocationIngestConsumer on the event loop
+    'async': 'bustrack.asgi:application',
+    # views.update_location behind Django's middleware, as before
+    'django': 'bustrack.asgi:django_asgi_app',
+    # DriverLocationConsumer, one socket per driver
+    'websocket': 'bustrack.asgi:application',
+}
+PATH = '/tracking/api/update-location/'
+WS_PATH = '/ws/driver/'
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test driver GPS ingest under daphne: the async HTTP consumer, "
+        "the Django view, or the driver WebSocket stream. HTTP modes post "
+        "pings on keep-alive connections as fast as they are acknowledged; "
+        "websocket mode streams them on one socket per driver. Reports pings "
+        "per second, ack latency (HTTP) and daphne CPU per ping. Needs a "
+        "database daphne can share (not in-memory SQLite)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=sorted(APPLICATIONS), default='async')
+        parser.add_argument('--connections', type=int, default=64)
+        parser.add_argument('--requests', type=int, default=20000)
+        parser.add_argument('--buses', type=int, default=400)
+        parser.add_argument('--warmup', type=int, default=500)
+        parser.add_argument('--port', type=int, default=0, help="Default: a free port.")
+        parser.add_argument(
+            '--settle', type=float, default=3.0,
+            help="Seconds to wait for the write-behind queue before reading daphne's CPU time.",
+        )
+        parser.add_argument('--seed', type=int, default=14)
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise CommandError("daphne cannot share an in-memory SQLite database.")
+
+        sessions, route, buses, users = self._fixtures(options)
+        port = options['port'] or self._free_port()
+        # A file rather than a pipe, so a chatty daphne never blocks on a full buffer
+        log = tempfile.TemporaryFile()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-p', str(port), APPLICATIONS[options['mode']]],
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'bustrack.settings')},
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+        try:
+            self._wait_for(port, server, log)
+            load = self._stream if options['mode'] == 'websocket' else self._load
+            cpu_before = self._cpu_seconds(server.pid)
+            latencies, statuses, elapsed, handled = asyncio.run(load(options, port, sessions, buses))
+            time.sleep(options['settle'])
+            cpu = self._cpu_seconds(server.pid) - cpu_before
+        finally:
+            server.terminate()
+            server.wait(10)
+            log.close()
+            Bus.objects.filter(pk__in=[bus.pk for bus in buses]).delete()
+            route.delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+        pings = sum(statuses.values())
+        self.stdout.write(
+            f"mode={options['mode']} connections={options['connections']} "
+            f"pings={pings} backend={connection.vendor}"
+        )
+        self.stdout.write(
+            f"elapsed_s={elapsed:.2f} pings_per_s={pings / elapsed:.0f} "
+            f"server_cpu_us_per_ping={cpu / max(handled, 1) * 1e6:.0f}"
+        )
+        if latencies:
+            self.stdout.write(f"latency {format_summary(summarize(latencies))}")
+        self.stdout.write(f"status={dict(sorted(statuses.items()))}")
+
+    def _bodies(self, options, buses, with_bus=True):
+        rng = random.Random(options['seed'])
+        return [
+            json.dumps({
+                **({'bus_id': buses[n % len(buses)].pk} if with_bus else {}),
+                'latitude': 18.5 + rng.random() / 10,
+                'longitude': 73.8 + rng.random() / 10,
+                'speed': rng.uniform(0, 60),
+                'heading': rng.uniform(0, 360),
+            }).encode()
+            for n in range(options['warmup'] + options['requests'])
+        ]
+
+    async def _load(self, options, port, sessions, buses):
+        requests = [
+            (
+                f"POST {PATH} HTTP/1.1\r\nHost: localhost\r\n"
+                f"Cookie: sessionid={sessions[0]}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n"
+            ).encode() + body
+            for body in self._bodies(options, buses)
+        ]
+
+        latencies, statuses = [], {}
+        cursor = iter(requests)
+        warmup = options['warmup']
+
+        async def client():
+            nonlocal warmup
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                for request in cursor:
+                    started = time.perf_counter()
+                    writer.write(request)
+                    status = await self._read_response(reader)
+                    if warmup > 0:
+                        warmup -= 1
+                        continue
+                    latencies.append(time.perf_counter() - started)
+                    statuses[status] = statuses.get(status, 0) + 1
+            finally:
+                writer.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(options['connections'])))
+        return latencies, statuses, time.perf_counter() - started, len(requests)
+
+    async def _stream(self, options, port, sessions, buses):
+        """One driver socket per connection; closing it waits for every frame to be handled."""
+        # Like the driver app: a bound socket's frames leave the bus out
+        bodies = self._bodies(options, buses, with_bus=False)
+        per_socket = len(bodies) // len(sessions)
+        sockets = [await self._ws_connect(port, session) for session in sessions]
+
+        async def driver(n, reader, writer):
+            for body in bodies[n * per_socket:(n + 1) * per_socket]:
+                writer.write(self._ws_frame(0x1, body))
+            writer.write(self._ws_frame(0x8, (1000).to_bytes(2, 'big')))
+            errors = 0
+            while True:
+                opcode, _ = await self._ws_read(reader)
+                if opcode == 0x8:
+                    break
+                errors += 1
+            writer.close()
+            return errors
+
+        started = time.perf_counter()
+        errors = sum(await asyncio.gather(
+            *(driver(n, reader, writer) for n, (reader, writer) in enumerate(sockets))
+        ))
+        elapsed = time.perf_counter() - started
+        sent = per_socket * len(sessions)
+        return [], {'sent': sent - errors, 'errors': errors}, elapsed, sent
+
+    async def _ws_connect(self, port, session):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f"GET {WS_PATH} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+            f"Sec-WebSocket-Version: 13\r\nCookie: sessionid={session}\r\n\r\n"
+        ).encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in head.split(b'\r\n', 1)[0]:
+            raise CommandError(f"WebSocket handshake failed: {head[:80]!r}")
+        opcode, payload = await self._ws_read(reader)
+        if opcode != 0x1 or json.loads(payload).get('type') != 'bound':
+            raise CommandError("Driver socket was not bound to a bus.")
+        return reader, writer
+
+    @staticmethod
+    def _ws_frame(opcode, payload):
+        # Client frames must be masked; an all-zero key leaves the payload as is
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+        return header + b'\0\0\0\0' + payload
+
+    @staticmethod
+    async def _ws_read(reader):
+        first, second = await reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+        return first & 0x0F, await reader.readexactly(length)
+
+    @staticmethod
+    def _cpu_seconds(pid):
+        """User + system CPU of a process, from /proc (0 where unavailable)."""
+        try:
+            with open(f'/proc/{pid}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return 0.0
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    @staticmethod
+    async def _read_response(reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin1').split('\r\n')
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        await reader.readexactly(length)
+        return int(lines[0].split()[1])
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def _wait_for(port, server, log, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and server.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        log.seek(0)
+        stderr = log.read().decode(errors='replace').strip()
+        if server.poll() is None:
+            reason = f"did not start listening on port {port} within {timeout}s"
+        else:
+            reason = f"exited with status {server.returncode}"
+        raise CommandError(f"daphne {reason}." + (f"\n{stderr}" if stderr else ""))
+
+    def _fixtures(self, options):
+        tag = uuid.uuid4().hex[:8]
+        route = Route.objects.create(name=f"BENCH {tag}", source="Bench Origin", destination="Bench Terminus")
+        buses = Bus.objects.bulk_create(
+            Bus(
+                bus_number=f"BENCH-{tag}-{n}",
+                bus_name="Benchmark Express",
+                route=route,
+                departure_time=datetime.time(8, 0),
+                arrival_time=datetime.time(12, 0),
+            )
+            for n in range(options['buses'])
+        )
+        trips = Trip.objects.bulk_create(
+            Trip(bus=bus, date=timezone.now().date(), status='running') for bus in buses
+        )
+        # The cleanup deletes these through signals, so count them in too
+        dashboard.record_created(Bus, buses)
+        dashboard.record_created(Trip, trips)
+        rollups.record_created(Trip, trips)
+
+        # A driver socket is bound to the driver's own bus, so websocket mode needs one driver per connection
+        drivers = options['connections'] if options['mode'] == 'websocket' else 1
+        if drivers > len(buses):
+            raise CommandError("websocket mode needs at least as many --buses as --connections.")
+        users, sessions = [], []
+        for n in range(drivers):
+            user = User.objects.create(username=f"bench-driver-{tag}-{n}")
+            UserProfile.objects.update_or_create(user=user, defaults={'role': 'driver'})
+            driver = Driver.objects.create(user=user, license_number=f"BENCH-{tag}-{n}")
+            Bus.objects.filter(pk=buses[n].pk).update(driver=driver)
+            client = Client()
+            client.force_login(user)
+            users.append(user)
+            sessions.append(client.cookies['sessionid'].value)
+        return sessions, route, buses, users
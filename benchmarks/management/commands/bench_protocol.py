@@ -0,0 +1,76 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tracking import broadcast, protocol
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare wire size and encode time of live bus updates as JSON "
+        "(per-update events and coalesced frames) and as the binary "
+        "msgpack/CBOR tuple frames. Needs no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buses', type=int, default=400, help="Updates per frame.")
+        parser.add_argument('--repeat', type=int, default=200, help="Frames encoded per format.")
+        parser.add_argument('--seed', type=int, default=4)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        eta = timezone.now().isoformat()
+        updates = [
+            broadcast.location_update({
+                'bus_id': n + 1,
+                'bus_name': f"Shivneri Express {n + 1}",
+                'bus_number': f"MH-12-AB-{n + 1:04d}",
+                'route_id': n % 20 + 1,
+                'route': "Pune Station → Mumbai Central",
+                'status': 'running',
+                'latitude': round(rng.uniform(18.3, 19.3), 7),
+                'longitude': round(rng.uniform(72.8, 74.2), 7),
+                'speed': round(rng.uniform(0, 80), 2),
+                'heading': round(rng.uniform(0, 360), 2),
+                'timestamp': timezone.now().isoformat(),
+                'next_stop': "Shivajinagar Bus Stand",
+                'next_stop_index': rng.randrange(20),
+                'eta': {'estimated_arrival': eta, 'distance_remaining_km': 2.5},
+            })
+            for n in range(options['buses'])
+        ]
+
+        formats = {
+            'json per-update': lambda: [json.dumps({'type': 'send_location', **u}) for u in updates],
+            'json frame': lambda: [json.dumps(
+                {'type': 'frame', 'tick': 1, 'buses': updates}, separators=(',', ':')
+            )],
+        }
+        for name, encoder in protocol.ENCODERS.items():
+            formats[name] = lambda encoder=encoder: [encoder(protocol.updates_frame(
+                1, [protocol.update_row(u) for u in updates]
+            ))]
+
+        self.stdout.write(f"updates_per_frame={len(updates)} repeat={options['repeat']}")
+        for name, encode in formats.items():
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                payloads = encode()
+            elapsed = time.perf_counter() - started
+            size = sum(len(p) for p in payloads)
+            self.stdout.write(
+                f"{name:<22} bytes_per_update={size / len(updates):6.1f} "
+                f"encode_us_per_update={elapsed / options['repeat'] / len(updates) * 1e6:6.2f}"
+            )
+
+        dictionary = protocol.dictionary_frame(
+            [protocol.bus_row(u) for u in updates],
+            [[n + 1, "Pune Station → Mumbai Central", [f"Stop {i}" for i in range(20)]] for n in range(20)],
+        )
+        for name in protocol.ENCODERS:
+            self.stdout.write(
+                f"{name:<22} dictionary_frame_bytes={len(protocol.encode(name, dictionary))} (once per client)"
+            )
@@ -0,0 +1,154 @@
+import datetime
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Max
+from django.utils import timezone
+
+from benchmarks.utils import format_summary, summarize
+from bookings import occupancy
+from bookings.models import Booking, SegmentOccupancy
+from bookings.reservations import ReservationConflict, SeatsUnavailable, reserve
+from buses.models import Bus, Route, Stop
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer bookings.reservations.reserve from many threads against one "
+        "bus and verify that no segment is ever oversold. Needs a database "
+        "that is shared between connections (a file-backed SQLite or PostgreSQL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--attempts', type=int, default=2000, help="Total reservation attempts.")
+        parser.add_argument('--seats', type=int, default=40, help="Bus capacity.")
+        parser.add_argument('--stops', type=int, default=10, help="Stops on the benchmark route.")
+        parser.add_argument('--max-party', type=int, default=3, help="Largest seats_booked per attempt.")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark bus and bookings.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise CommandError("An in-memory SQLite database cannot be shared between threads.")
+
+        rng = random.Random(options['seed'])
+        user, route, stops, bus = self._fixtures(options)
+        travel_date = timezone.now().date() + datetime.timedelta(days=1)
+
+        plan = []
+        for _ in range(options['attempts']):
+            start = rng.randrange(0, len(stops) - 1)
+            end = rng.randrange(start + 1, len(stops))
+            plan.append((stops[start], stops[end], rng.randint(1, options['max_party'])))
+
+        outcomes = Counter()
+        latencies = []
+        lock = threading.Lock()
+        cursor = iter(plan)
+        barrier = threading.Barrier(options['threads'])
+
+        def worker():
+            barrier.wait()
+            try:
+                while True:
+                    with lock:
+                        item = next(cursor, None)
+                    if item is None:
+                        return
+                    from_stop, to_stop, seats = item
+                    booking = Booking(
+                        user=user,
+                        bus=bus,
+                        travel_date=travel_date,
+                        from_stop=from_stop,
+                        to_stop=to_stop,
+                        seats_booked=seats,
+                        passenger_name="Bench Passenger",
+                        passenger_phone="0000000000",
+                    )
+                    started = time.perf_counter()
+                    try:
+                        reserve(booking)
+                        outcome = 'booked'
+                    except SeatsUnavailable:
+                        outcome = 'full'
+                    except ReservationConflict:
+                        outcome = 'conflict'
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        outcomes[outcome] += 1
+                        latencies.append(elapsed)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        peak = SegmentOccupancy.objects.filter(
+            bus=bus, travel_date=travel_date
+        ).aggregate(peak=Max('seats_booked'))['peak'] or 0
+        problems = occupancy.find_inconsistencies(bus_id=bus.pk, travel_date=travel_date)
+        oversold = peak > bus.total_seats
+
+        self.stdout.write(
+            f"backend={connection.vendor} threads={options['threads']} "
+            f"attempts={len(latencies)} elapsed_s={elapsed:.2f} "
+            f"attempts_per_s={len(latencies) / elapsed:.1f}"
+        )
+        self.stdout.write(
+            f"booked={outcomes['booked']} full={outcomes['full']} conflict={outcomes['conflict']}"
+        )
+        self.stdout.write(f"latency {format_summary(summarize(latencies))}")
+        self.stdout.write(
+            f"peak_segment_occupancy={peak}/{bus.total_seats} inconsistent_rows={len(problems)}"
+        )
+
+        if not options['keep']:
+            bus.delete()
+            route.delete()
+
+        if oversold or problems:
+            raise CommandError("Reservation invariant violated: trip oversold or occupancy out of sync.")
+        self.stdout.write(self.style.SUCCESS("No segment was oversold."))
+
+    def _fixtures(self, options):
+        tag = uuid.uuid4().hex[:8]
+        user, _ = User.objects.get_or_create(username='bench-passenger')
+        route = Route.objects.create(
+            name=f"BENCH {tag}",
+            source="Bench Origin",
+            destination="Bench Terminus",
+        )
+        stops = [
+            Stop.objects.create(
+                route=route,
+                name=f"Bench Stop {seq}",
+                latitude=18.5 + seq / 100,
+                longitude=73.8,
+                sequence_number=seq,
+                distance_from_previous_km=5 if seq > 1 else 0,
+                fare_from_previous=25 if seq > 1 else 0,
+            )
+            for seq in range(1, options['stops'] + 1)
+        ]
+        bus = Bus.objects.create(
+            bus_number=f"BENCH-{tag}",
+            bus_name="Benchmark Express",
+            total_seats=options['seats'],
+            route=route,
+            departure_time=datetime.time(8, 0),
+            arrival_time=datetime.time(12, 0),
+        )
+        return user, route, stops, bus
@@ -0,0 +1,122 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from benchmarks.utils import format_summary, stopwatch, summarize
+from buses import search
+from buses.models import Route, Stop
+
+SYLLABLES = ['ka', 'ra', 'pu', 'ne', 'sa', 'ta', 'ma', 'li', 'go', 'ba', 'di', 've', 'no', 'shi', 'ur']
+SUFFIXES = ['pur', 'nagar', 'gaon', 'wadi', 'abad', 'ganj']
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark stop-level 'A to B' search over a synthetic network. "
+        "Everything is created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=5000)
+        parser.add_argument('--stops-per-route', type=int, default=20)
+        parser.add_argument('--places', type=int, default=4000, help="Distinct stop names.")
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _run(self, options):
+        rng = random.Random(options['seed'])
+        places = self._places(rng, options['places'])
+        per_route = options['stops_per_route']
+
+        with stopwatch() as built:
+            routes = Route.objects.bulk_create(
+                Route(name=f"Synthetic {n}", source='', destination='')
+                for n in range(options['routes'])
+            )
+            chains = {}
+            stops = []
+            for route in routes:
+                # Neighbouring places so routes overlap like a real corridor network
+                start = rng.randrange(0, len(places) - per_route * 3)
+                chain = sorted(rng.sample(range(start, start + per_route * 3), per_route))
+                if rng.random() < 0.5:
+                    chain.reverse()
+                names = [places[i] for i in chain]
+                chains[route.pk] = names
+                route.source, route.destination = names[0], names[-1]
+                stops.extend(
+                    Stop(
+                        route=route,
+                        name=name,
+                        latitude=18 + idx / 1000,
+                        longitude=73 + idx / 1000,
+                        sequence_number=seq,
+                    )
+                    for seq, (idx, name) in enumerate(zip(chain, names), start=1)
+                )
+            Route.objects.bulk_update(routes, ['source', 'destination'], batch_size=1000)
+            Stop.objects.bulk_create(stops, batch_size=5000)
+            indexed = search.rebuild()
+
+        self.stdout.write(
+            f"network routes={len(routes)} stops={len(stops)} index_rows={indexed} "
+            f"build_s={built['seconds']:.2f}"
+        )
+
+        pairs = []
+        route_ids = list(chains)
+        for _ in range(options['queries']):
+            names = chains[rng.choice(route_ids)]
+            a = rng.randrange(0, len(names) - 1)
+            b = rng.randrange(a + 1, len(names))
+            pairs.append((names[a], names[b]))
+
+        indexed_times, indexed_hits = self._time(
+            pairs, lambda a, b: list(search.matching_route_ids(a, b))
+        )
+        legacy_times, legacy_hits = self._time(
+            pairs,
+            lambda a, b: list(
+                Route.objects.filter(source__icontains=a, destination__icontains=b).values('pk')
+            ),
+        )
+
+        self.stdout.write(
+            f"indexed stop search  hits/query={indexed_hits / len(pairs):.2f} "
+            f"{format_summary(summarize(indexed_times))}"
+        )
+        self.stdout.write(
+            f"legacy icontains     hits/query={legacy_hits / len(pairs):.2f} "
+            f"{format_summary(summarize(legacy_times))}"
+        )
+
+    def _time(self, pairs, run):
+        times, hits = [], 0
+        for a, b in pairs:
+            started = time.perf_counter()
+            hits += len(run(a, b))
+            times.append(time.perf_counter() - started)
+        return times, hits
+
+    def _places(self, rng, count):
+        names = set()
+        while len(names) < count:
+            stem = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+            names.add(f"{stem.capitalize()} {rng.choice(SUFFIXES).capitalize()}")
+        names = sorted(names)
+        rng.shuffle(names)
+        return names
@@ -0,0 +1,114 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from benchmarks import suite
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the hot functions (form clean, booking save, seat availability, "
+        "seat layout, bus search, location update, active buses, admin "
+        "dashboard, analytics) against the data in the database: wall time, "
+        "queries and memory allocated per call. Stops if a view answers with "
+        "an error or a redirect. Runs in a transaction that is rolled back. "
+        "Save results with --save, and compare two saved runs (say, from two "
+        "checkouts) with --compare BASE HEAD, or this run with --baseline BASE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', default='', help="Comma-separated case names.")
+        parser.add_argument('--repeat', type=int, default=50, help="Timed calls per case and round.")
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--profile-repeat', type=int, default=5, help="Calls counting queries and allocations.")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--save', type=Path, help="Write results to this JSON file.")
+        parser.add_argument('--baseline', type=Path, help="Compare this run against a saved one.")
+        parser.add_argument('--compare', nargs=2, type=Path, metavar=('BASE', 'HEAD'),
+                            help="Compare two saved runs without running anything.")
+        parser.add_argument('--threshold', type=float, default=15, help="Percent growth that counts as a regression.")
+        parser.add_argument('--min-delta-ms', type=float, default=0.05)
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            base, head = (self._load(path) for path in options['compare'])
+            return self._compare(base, head, options)
+
+        names = [name for name in options['only'].split(',') if name] or list(suite.CASES)
+        unknown = set(names) - set(suite.CASES)
+        if unknown:
+            raise CommandError(f"Unknown case(s): {', '.join(sorted(unknown))}. Known: {', '.join(suite.CASES)}.")
+        base = self._load(options['baseline']) if options['baseline'] else None
+
+        try:
+            with transaction.atomic():
+                head = self._run(names, options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+        if options['save']:
+            options['save'].write_text(json.dumps(head, indent=2) + '\n')
+            self.stdout.write(f"Saved {options['save']}.")
+        if base:
+            self._compare(base, head, options)
+
+    def _run(self, names, options):
+        try:
+            data = suite.Dataset(seed=options['seed'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        meta = suite.metadata(data, options['seed'], options['repeat'], options['rounds'])
+        self.stdout.write(
+            f"backend={meta['backend']} revision={meta['revision']} "
+            + ' '.join(f"{key}={value}" for key, value in meta['dataset'].items())
+        )
+        try:
+            results = suite.run(
+                names, data, options['repeat'], options['warmup'], options['profile_repeat'], options['rounds'],
+            )
+        except suite.CaseError as exc:
+            raise CommandError(f"A case did not get a successful response: {exc}")
+        self.stdout.write(f"{'case':<26}{'p50 ms':>10}{'p95 ms':>10}{'noise':>8}{'queries':>9}{'alloc KB':>10}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<26}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['noise']:>8.0%}"
+                f"{result['queries']:>9}{result['alloc_peak_kb']:>10.1f}"
+            )
+        return {'meta': meta, 'results': results}
+
+    def _load(self, path):
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Cannot read {path}: {exc}")
+        if data.get('meta', {}).get('format') != suite.FORMAT_VERSION:
+            raise CommandError(f"{path} was written by another version of bench_suite.")
+        return data
+
+    def _compare(self, base, head, options):
+        self.stdout.write(f"Comparing {base['meta']['revision']} -> {head['meta']['revision']}")
+        for difference in suite.mismatched_setup(base, head):
+            self.stdout.write(self.style.WARNING(f"  setup differs, {difference}"))
+
+        regressions = 0
+        for name, metric, old, new, regressed in suite.compare(
+            base, head, options['threshold'] / 100, options['min_delta_ms'],
+        ):
+            change = f"{(new - old) / old * 100:+.0f}%" if old else ("" if old == new else "new")
+            line = f"  {name:<26}{metric:<15}{old:>10.2f} -> {new:>10.2f} {change:>7}"
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"{regressions} regression(s) beyond {options['threshold']:g}%.")
+        self.stdout.write(self.style.SUCCESS("No regressions."))
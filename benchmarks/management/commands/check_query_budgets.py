@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from benchmarks.hotpaths import build_fixture, hot_requests
+from bustrack import querybudget
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay the hot booking, tracking and admin views with query recording "
+        "on, and fail if one exceeds its @query_budget or repeats a query shape "
+        "(N+1). Runs inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5, help="Routes, buses and bookings in the fixture.")
+
+    def handle(self, *args, **options):
+        self.failures = 0
+        config = {**querybudget.get_config(), 'ENABLED': True, 'SAMPLE_RATE': 1.0, 'RAISE': False}
+        try:
+            with override_settings(QUERY_BUDGET=config), transaction.atomic():
+                self._check_all(options['rows'], config['N_PLUS_ONE_THRESHOLD'])
+                raise _Rollback
+        except _Rollback:
+            pass
+        if self.failures:
+            raise CommandError(f"{self.failures} view(s) over budget or issuing N+1 queries.")
+        self.stdout.write(self.style.SUCCESS("Every hot view is within its query budget."))
+
+    def _check_all(self, rows, threshold):
+        for client, method, path, data in hot_requests(build_fixture(rows)):
+            response = getattr(client, method)(path, data or {})
+            stats, budget = response.query_stats, response.query_budget
+            self.stdout.write(
+                f"{method.upper()} {path} -> {response.status_code}: {stats.count} queries"
+                f"{f' (budget {budget})' if budget is not None else ''}, {stats.time_ms:.1f} ms"
+            )
+            problems = stats.report(budget, threshold)
+            if problems:
+                self.failures += 1
+                for problem in problems:
+                    self.stdout.write(self.style.ERROR(f"  {problem}"))
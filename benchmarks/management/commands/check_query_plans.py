@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from benchmarks import plans
+from benchmarks.hotpaths import build_fixture, full_listing, hot_requests
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN every SELECT issued by the hot booking, tracking and admin "
+        "views and fail if one reads a table without an index. Runs against "
+        "the configured database inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plans', action='store_true', help="Print the plan of every statement.")
+
+    def handle(self, *args, **options):
+        self.failures = 0
+        try:
+            with transaction.atomic():
+                plans.disable_seqscan()
+                self._check_all(options['plans'])
+                raise _Rollback
+        except _Rollback:
+            pass
+        if self.failures:
+            raise CommandError(f"{self.failures} statement(s) fall back to a full table scan.")
+        self.stdout.write(self.style.SUCCESS("Every hot query uses an index."))
+
+    def _check_all(self, show_plans):
+        for client, method, path, data in hot_requests(build_fixture()):
+            response, statements = plans.capture(client, method, path, data)
+            self.stdout.write(f"{method.upper()} {path} -> {response.status_code}, {len(statements)} SELECT(s)")
+            listed = full_listing(path)
+            for sql in dict.fromkeys(statements):
+                plan = plans.explain(sql)
+                if plan.full_scans and plans.whole_table_aggregate(sql):
+                    self.stdout.write(self.style.WARNING(f"  whole-table aggregate: {sql}"))
+                elif plan.full_scans and set(plan.full_scans) <= listed:
+                    self.stdout.write(self.style.WARNING(f"  lists {', '.join(plan.full_scans)} in full: {sql}"))
+                elif plan.full_scans:
+                    self.failures += 1
+                    self.stdout.write(self.style.ERROR(f"  full scan of {', '.join(plan.full_scans)}: {sql}"))
+                elif show_plans:
+                    self.stdout.write(f"  {sql}")
+                if show_plans or (plan.full_scans and not plans.whole_table_aggregate(sql)):
+                    for line in plan.lines:
+                        self.stdout.write(f"    {line}")
@@ -0,0 +1,149 @@
+"""
+Query-plan checks for the hot read paths.
+
+``capture`` runs a request through the test client and records the
+SELECT statements it issues; ``explain`` asks the database for a
+statement's plan and lists the tables it reads in full.
+
+A table is read in full by a sequential scan, or by walking a whole index
+without a condition on it (done for ordering or for an index-only
+count), unless a LIMIT stops the walk early. PostgreSQL prefers a
+sequential scan on a small table whatever indexes exist, so plans are
+taken with ``enable_seqscan`` off: a Seq Scan left in the plan means no
+index could serve the query. SQLite plans without statistics and reports
+``SCAN <table>`` where PostgreSQL would report a Seq Scan, and ``SEARCH``
+for an index lookup.
+
+An aggregate over a whole table (``COUNT(*)`` with no WHERE) reads every
+row whatever the indexes; ``whole_table_aggregate`` tells those apart so
+they can be reported without failing the check.
+
+The apps' tests replay their views' hot requests (``benchmarks.hotpaths``)
+through ``QueryPlanTestMixin.assertUsesIndexes``, so a view that loses its
+index fails ``manage.py test``; ``manage.py check_query_plans`` runs the
+same check against a real database and prints the plans.
+"""
+import json
+import re
+from collections import namedtuple
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# Lookup tables with one row per route, bus or driver: reading them in
+# full is cheaper than any index and does not grow with traffic.
+SMALL_TABLES = {'buses_route', 'buses_bus', 'users_driver'}
+
+Plan = namedtuple('Plan', 'lines full_scans')
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX \w+)?$')
+_SQLITE_LIMIT = re.compile(r'\bLIMIT \d+(?: OFFSET \d+)?$')
+_ALIAS = re.compile(r'"(\w+)" ([A-Z]\d+)\b')
+_PG_SCANS = {'Seq Scan', 'Index Scan', 'Index Only Scan'}
+_AGGREGATE = re.compile(r'\b(?:COUNT|SUM|AVG|MIN|MAX)\(')
+
+
+def capture(client, method, path, data=None):
+    """(response, [SELECT statements]) for one request."""
+    with CaptureQueriesContext(connection) as queries:
+        response = getattr(client, method)(path, data or {})
+        if getattr(response, 'streaming', False):
+            b''.join(response.streaming_content)
+    statements = [q['sql'] for q in queries.captured_queries if q['sql'].lstrip().upper().startswith('SELECT')]
+    return response, statements
+
+
+def disable_seqscan():
+    """Make PostgreSQL pick an index whenever one applies, for the current transaction."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+
+def explain(sql):
+    """The ``Plan`` of ``sql``: its lines of text and the tables it reads in full."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+            plan = cursor.fetchone()[0]
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            return _pg_plan(plan[0]['Plan'])
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return _sqlite_plan(sql, [row[-1] for row in cursor.fetchall()])
+
+
+def full_scans(statements, allowed=()):
+    """{sql: tables it reads in full} for ``statements``, besides whole-table aggregates and ``allowed`` tables."""
+    scans = {}
+    for sql in dict.fromkeys(statements):
+        tables = [table for table in explain(sql).full_scans if table not in allowed]
+        if tables and not whole_table_aggregate(sql):
+            scans[sql] = tables
+    return scans
+
+
+class QueryPlanTestMixin:
+    """For ``TestCase``: assert that a request's SELECTs all use an index."""
+
+    def assertUsesIndexes(self, client, method, path, data=None, allowed=()):
+        disable_seqscan()
+        response, statements = capture(client, method, path, data)
+        self.assertLess(response.status_code, 400, f"{method.upper()} {path}")
+        self.assertEqual(
+            full_scans(statements, allowed), {}, f"{method.upper()} {path} reads a table without an index"
+        )
+
+    def assertHotPathsUseIndexes(self, namespace):
+        from .hotpaths import build_fixture, full_listing, hot_requests
+
+        requests = hot_requests(build_fixture(), namespace)
+        self.assertTrue(requests, f"no hot requests in {namespace!r}")
+        for client, method, path, data in requests:
+            with self.subTest(path=path, method=method):
+                self.assertUsesIndexes(client, method, path, data, full_listing(path))
+
+
+def whole_table_aggregate(sql):
+    return bool(_AGGREGATE.search(sql)) and ' WHERE ' not in sql and ' JOIN ' not in sql
+
+
+def _pg_plan(root):
+    lines, scans = [], []
+
+    def walk(node, depth, limited):
+        lines.append('  ' * depth + ' '.join(filter(None, (
+            node['Node Type'], node.get('Relation Name'), node.get('Index Name'), node.get('Index Cond'),
+        ))))
+        if node['Node Type'] == 'Limit':
+            limited = True
+        elif node['Node Type'] in ('Sort', 'Aggregate', 'Hash'):
+            limited = False     # consumes its whole input before returning a row
+        if node['Node Type'] in _PG_SCANS and 'Index Cond' not in node:
+            if node['Node Type'] == 'Seq Scan' or not limited:
+                scans.append(node['Relation Name'])
+        for child in node.get('Plans', []):
+            walk(child, depth + 1, limited)
+
+    walk(root, 0, False)
+    return Plan(lines, _big(scans))
+
+
+def _sqlite_plan(sql, lines):
+    aliases = {alias: table for table, alias in _ALIAS.findall(sql)}
+    known = set(connection.introspection.table_names())
+    # An ordered index walk stops at the LIMIT unless the rows are sorted afterwards
+    limited = bool(_SQLITE_LIMIT.search(sql.strip())) and not any('TEMP B-TREE' in line for line in lines)
+    scans = []
+    for line in lines:
+        match = _SQLITE_SCAN.match(line)
+        if not match:
+            continue
+        table = aliases.get(match.group(1), match.group(1))
+        # Subqueries and CTEs are reported as scans too
+        if table in known and ('USING' not in line or not limited):
+            scans.append(table)
+    return Plan(lines, _big(scans))
+
+
+def _big(tables):
+    return [table for table in dict.fromkeys(tables) if table not in SMALL_TABLES]
@@ -0,0 +1,362 @@
+"""
+Micro-benchmarks of the hot functions, with JSON baselines, for
+``manage.py bench_suite``.
+
+Each case is registered with ``@case`` and times one call of a real code
+path: a form clean, a model save, a view called with a ``RequestFactory``
+request (no middleware). Calls rotate over ``Dataset.journeys``, a
+seeded sample of buses, segments and travel dates from the database, so
+run ``manage.py generate_fleet`` first for numbers at a realistic scale.
+
+``run`` times each call with nothing else attached, then calls it a few
+more times counting queries (``bustrack.querybudget``) and the memory it
+allocates (``tracemalloc``): the peak above the starting point, and what
+is still held afterwards.
+
+``compare`` sets two result files side by side and lists the cases that
+got slower or allocate more by more than a threshold, or that run more
+queries. A slowdown within the round-to-round noise of either run is not
+counted.
+"""
+import datetime
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import django
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import connection
+from django.db.models import Count
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from benchmarks.utils import percentile
+from bookings.forms import BookingForm
+from bookings.models import Booking
+from bookings.views import seat_layout_api
+from bustrack import querybudget
+from buses.models import Bus, Route, Stop
+from buses.views import BusSearchView
+from tracking.models import LiveLocation
+from tracking.views import get_all_active_buses, update_location
+from users.admin_views import ANALYTICS_MAX_DAYS, admin_dashboard, analytics
+from users.models import UserProfile
+
+FORMAT_VERSION = 1
+CASES = {}
+
+
+class CaseError(Exception):
+    """A view case got an error or a redirect, so its timings would not be of the real path."""
+
+
+def case(name):
+    """Register ``factory(dataset)``, which returns the function to time: ``call(i)``."""
+    def decorator(factory):
+        CASES[name] = factory
+        return factory
+    return decorator
+
+
+# -----------------------------
+# DATASET
+# -----------------------------
+class Dataset:
+    """A seeded sample of journeys, plus users to make the requests as."""
+
+    def __init__(self, seed=42, size=20):
+        rng = random.Random(seed)
+        bus_ids = list(
+            Bus.objects.filter(is_active=True, route__isnull=False)
+            .annotate(stop_count=Count('route__stops')).filter(stop_count__gte=3)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        if not bus_ids:
+            raise ValueError("No active bus with a route of three or more stops; run generate_fleet first.")
+
+        buses = Bus.objects.select_related('route').in_bulk(rng.sample(bus_ids, min(size, len(bus_ids))))
+        stops = {}
+        for stop in Stop.objects.filter(route__buses__in=buses).order_by('sequence_number'):
+            stops.setdefault(stop.route_id, []).append(stop)
+
+        today = timezone.localdate()
+        self.journeys = []
+        for bus_id in sorted(buses):
+            bus = buses[bus_id]
+            route_stops = stops[bus.route_id]
+            start = rng.randrange(0, len(route_stops) - 1)
+            end = rng.randrange(start + 1, len(route_stops))
+            self.journeys.append((bus, route_stops[start], route_stops[end], today + datetime.timedelta(days=rng.randint(0, 3))))
+
+        tag = f'{seed}{int(time.time() * 1000)}'
+        self.passenger = self._user(f'bench_passenger_{tag}', 'user')
+        self.driver = self._user(f'bench_driver_{tag}', 'driver')
+        self.admin = self._user(f'bench_admin_{tag}', 'admin', is_staff=True)
+        self.factory = RequestFactory()
+
+    @staticmethod
+    def _user(username, role, **extra):
+        user = User.objects.create_user(username, password=None, **extra)
+        UserProfile.objects.create(user=user, role=role)
+        return user
+
+    def journey(self, i):
+        return self.journeys[i % len(self.journeys)]
+
+    def size(self):
+        return {
+            'routes': Route.objects.count(),
+            'buses': Bus.objects.count(),
+            'bookings': Booking.objects.count(),
+            'locations': LiveLocation.objects.count(),
+        }
+
+    def get(self, path, user, **params):
+        request = self.factory.get(path, params)
+        request.user = user
+        request._messages = CookieStorage(request)
+        return request
+
+
+def _ok(response):
+    if response.status_code != 200:
+        raise CaseError(f"{response.status_code} {response.content[:200].decode(errors='replace')}")
+    return response
+
+
+# -----------------------------
+# CASES
+# -----------------------------
+@case('booking_form_clean')
+def booking_form_clean(data):
+    def call(i):
+        bus, from_stop, to_stop, date = data.journey(i)
+        form = BookingForm({
+            'travel_date': date.isoformat(), 'from_stop': from_stop.pk, 'to_stop': to_stop.pk,
+            'seats_booked': 1, 'passenger_name': 'Bench', 'passenger_phone': '9999999999',
+        }, bus=bus)
+        form.is_valid()
+    return call
+
+
+@case('booking_save')
+def booking_save(data):
+    def call(i):
+        bus, from_stop, to_stop, date = data.journey(i)
+        Booking(
+            user=data.passenger, bus=bus, travel_date=date, from_stop=from_stop, to_stop=to_stop,
+            seats_booked=1, passenger_name='Bench', passenger_phone='9999999999', status='confirmed',
+        ).save()
+    return call
+
+
+@case('seats_available_between')
+def seats_available_between(data):
+    def call(i):
+        bus, from_stop, to_stop, date = data.journey(i)
+        bus.seats_available_between(from_stop, to_stop, date)
+    return call
+
+
+@case('seat_layout_api')
+def seat_layout(data):
+    def call(i):
+        bus, from_stop, to_stop, date = data.journey(i)
+        _ok(seat_layout_api(data.get(
+            f'/bookings/api/seats/{bus.pk}/', data.passenger,
+            date=date.isoformat(), from_stop=from_stop.pk, to_stop=to_stop.pk,
+        ), bus.pk))
+    return call
+
+
+@case('bus_search_queryset')
+def bus_search(data):
+    def call(i):
+        bus, from_stop, to_stop, date = data.journey(i)
+        view = BusSearchView()
+        view.setup(data.get(
+            '/buses/search/', data.passenger,
+            source=from_stop.name, destination=to_stop.name, date=date.isoformat(),
+        ))
+        list(view.get_queryset())
+    return call
+
+
+@case('update_location')
+def location_update(data):
+    # Written inline: the queued path only appends to a list, and timing
+    # the write is the point
+    def call(i):
+        bus, from_stop, _, _ = data.journey(i)
+        request = data.factory.post('/tracking/api/update-location/', json.dumps({
+            'bus_id': bus.pk, 'latitude': float(from_stop.latitude), 'longitude': float(from_stop.longitude),
+            'speed': 40, 'heading': 90,
+        }), content_type='application/json')
+        request.user = data.driver
+        with override_settings(TRACKING_INGEST={'ENABLED': False}):
+            _ok(update_location(request))
+    return call
+
+
+@case('get_all_active_buses')
+def active_buses(data):
+    def call(i):
+        _ok(get_all_active_buses(data.get('/tracking/api/active-buses/', data.passenger)))
+    return call
+
+
+@case('admin_dashboard')
+def dashboard(data):
+    def call(i):
+        request = data.get('/admin-panel/', data.admin)
+        request.session = {}
+        _ok(admin_dashboard(request))
+    return call
+
+
+@case('analytics')
+def analytics_page(data):
+    # The longest range the page allows, so the cost of a long range shows
+    end = timezone.now().date()
+    start = end - datetime.timedelta(days=ANALYTICS_MAX_DAYS - 1)
+
+    def call(i):
+        request = data.get('/admin-panel/analytics/', data.admin, start=start.isoformat(), end=end.isoformat())
+        request.session = {}
+        _ok(analytics(request))
+    return call
+
+
+# -----------------------------
+# RUNNING
+# -----------------------------
+def _time(call, repeat):
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        call(i)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def _profile(call, repeat):
+    queries, peaks, retained = [], [], []
+    tracemalloc.start()
+    try:
+        for i in range(repeat):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            with querybudget.record() as stats:
+                call(i)
+            current, peak = tracemalloc.get_traced_memory()
+            queries.append(stats.count)
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+    return {
+        'queries': max(queries, default=0),
+        'alloc_peak_kb': statistics.median(peaks) / 1024 if peaks else 0,
+        'alloc_retained_kb': statistics.median(retained) / 1024 if retained else 0,
+    }
+
+
+def run(names, data, repeat=50, warmup=5, profile_repeat=5, rounds=3):
+    """{case: result} for the named cases.
+
+    Timing runs in ``rounds`` passes over all the cases, so a burst of
+    load on the machine hits every case alike instead of one. ``p50_ms``
+    is the best round's median, ``p95_ms`` the median round's p95, and
+    ``noise`` how far apart the round medians were, as a fraction.
+    """
+    calls = {name: CASES[name](data) for name in names}
+    for name, call in calls.items():
+        try:
+            for i in range(max(warmup, 1)):
+                call(i)
+        except CaseError as exc:
+            raise CaseError(f"{name}: {exc}") from None
+
+    rounds_by_case = {name: [] for name in calls}
+    for _ in range(rounds):
+        for name, call in calls.items():
+            rounds_by_case[name].append(_time(call, repeat))
+
+    results = {}
+    for name, call in calls.items():
+        medians = [percentile(times, 50) for times in rounds_by_case[name]]
+        results[name] = {
+            'p50_ms': min(medians) * 1000,
+            'p95_ms': statistics.median(percentile(times, 95) for times in rounds_by_case[name]) * 1000,
+            'mean_ms': statistics.fmean(t for times in rounds_by_case[name] for t in times) * 1000,
+            'noise': (max(medians) - min(medians)) / min(medians) if min(medians) else 0.0,
+            **_profile(call, profile_repeat),
+        }
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(data, seed, repeat, rounds):
+    return {
+        'format': FORMAT_VERSION,
+        'created': timezone.now().isoformat(),
+        'revision': _git_revision(),
+        'backend': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'machine': platform.machine(),
+        'seed': seed,
+        'repeat': repeat,
+        'rounds': rounds,
+        'dataset': data.size(),
+    }
+
+
+# -----------------------------
+# COMPARING
+# -----------------------------
+def compare(base, head, threshold=0.15, min_delta_ms=0.05):
+    """[(case, metric, base, head, regressed)] for the cases in both result sets.
+
+    Time and allocations regress when they grow by more than
+    ``threshold`` (a fraction). Timings must also grow by more than either
+    run's noise and by ``min_delta_ms``, which keeps jitter on
+    sub-millisecond cases out. Any extra query is a regression.
+    """
+    rows = []
+    for name in base['results']:
+        if name not in head['results']:
+            continue
+        old, new = base['results'][name], head['results'][name]
+        allowed = max(threshold, old.get('noise', 0), new.get('noise', 0))
+        for metric in ('p50_ms', 'p95_ms'):
+            grew = new[metric] - old[metric]
+            rows.append((name, metric, old[metric], new[metric],
+                         grew > min_delta_ms and grew > old[metric] * allowed))
+        rows.append((name, 'queries', old['queries'], new['queries'], new['queries'] > old['queries']))
+        rows.append((name, 'alloc_peak_kb', old['alloc_peak_kb'], new['alloc_peak_kb'],
+                     new['alloc_peak_kb'] > old['alloc_peak_kb'] * (1 + threshold) + 1))
+    return rows
+
+
+def mismatched_setup(base, head):
+    """Differences in the run setup that make a comparison unfair."""
+    keys = ('backend', 'python', 'django', 'seed', 'dataset')
+    return [
+        f"{key}: {base['meta'].get(key)} vs {head['meta'].get(key)}"
+        for key in keys if base['meta'].get(key) != head['meta'].get(key)
+    ]
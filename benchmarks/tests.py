@@ -0,0 +1,53 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from bookings.models import Booking
+from bookings.tests import make_bus
+from buses.models import Bus, Route, Stop, Trip
+from tracking.models import LiveLocation
+
+from . import suite
+
+
+class BenchSuiteTests(TestCase):
+    def test_every_case_runs(self):
+        make_bus()
+        out = StringIO()
+        call_command('bench_suite', repeat=1, rounds=1, warmup=1, profile_repeat=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[2:]], list(suite.CASES))
+
+
+class GenerateFleetTests(TestCase):
+    def generate(self, **options):
+        out = StringIO()
+        call_command(
+            'generate_fleet', routes=4, min_stops=3, max_stops=5, passengers=30, days=3,
+            ping_interval=900, stdout=out, **options,
+        )
+        return out.getvalue()
+
+    def check(self, command):
+        out = StringIO()
+        call_command(command, stdout=out)
+        return out.getvalue().strip()
+
+    def counts(self):
+        return {model: model.objects.count() for model in (Route, Stop, Bus, Trip, Booking, LiveLocation)}
+
+    def test_generated_fleet_is_consistent(self):
+        self.generate()
+        self.assertTrue(all(self.counts().values()), self.counts())
+        # Loaded around the signals, so the stored aggregates must match anyway
+        self.assertEqual(self.check('check_occupancy'), "Occupancy is consistent.")
+        self.assertEqual(self.check('check_dashboard'), "Dashboard counters are consistent.")
+
+    def test_clear_replaces_an_earlier_run(self):
+        self.generate()
+        counts = self.counts()
+        self.assertIn("Cleared", self.generate(clear=True))
+        self.assertEqual(self.counts(), counts)
+        self.assertEqual(self.check('check_occupancy'), "Occupancy is consistent.")
+        self.assertEqual(self.check('check_dashboard'), "Dashboard counters are consistent.")
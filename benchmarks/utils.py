@@ -0,0 +1,63 @@
+"""Small helpers shared by the benchmark management commands."""
+import math
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (pct in 0-100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def summarize(latencies):
+    """p50/p95/p99/max of a list of seconds, returned in milliseconds."""
+    return {
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0) * 1000,
+    }
+
+
+def format_summary(summary):
+    return ' '.join(f"{key}={value:.2f}" for key, value in summary.items())
+
+
+@contextmanager
+def stopwatch():
+    """Yield a dict whose ``seconds`` key is filled in on exit."""
+    result = {'seconds': 0.0}
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result['seconds'] = time.perf_counter() - start
+
+
+class FanoutLayer:
+    """Group bookkeeping of a channel layer without transport or expiry.
+
+    ``channels.layers.InMemoryChannelLayer`` sweeps every channel for
+    expired messages on each ``group_send``, which would swamp the fan-out
+    cost the WebSocket benchmarks measure.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.inboxes = {}
+
+    async def group_add(self, group, channel):
+        self.groups.setdefault(group, set()).add(channel)
+        self.inboxes.setdefault(channel, [])
+
+    async def group_send(self, group, message):
+        for channel in self.groups.get(group, ()):
+            self.inboxes[channel].append(message)
+
+    def drain(self, channel):
+        inbox, self.inboxes[channel] = self.inboxes[channel], []
+        return inbox
@@ -1,20 +1,18 @@
 from django import forms
 from django.utils import timezone
-from django.db.models import Sum
 from .models import Booking
+from . import occupancy
 from buses.models import Stop
 
 class StopSelect(forms.Select):
     """Custom Select widget that adds data-sequence and data-fare to each <option>."""
     def create_option(self, name, value, label, selected, index, subindex=None, attrs=None):
         option = super().create_option(name, value, label, selected, index, subindex, attrs)
-        if value:
-            try:
-                stop = Stop.objects.get(pk=int(value))
-                option['attrs']['data-sequence'] = stop.sequence_number
-                option['attrs']['data-fare'] = float(stop.fare_from_previous)
-            except (Stop.DoesNotExist, ValueError, TypeError):
-                pass
+        # ModelChoiceField hands over the Stop itself, so no query per option
+        stop = getattr(value, 'instance', None)
+        if stop is not None:
+            option['attrs']['data-sequence'] = stop.sequence_number
+            option['attrs']['data-fare'] = float(stop.fare_from_previous)
         return option
 
 class BookingForm(forms.ModelForm):
@@ -84,33 +82,13 @@ class BookingForm(forms.ModelForm):
         # -----------------------------
         # SEGMENT-BASED SEAT VALIDATION
         # -----------------------------
-        requested_segment_stops = Stop.objects.filter(
-            route=self.bus.route,
-            sequence_number__gt=from_stop.sequence_number,
-            sequence_number__lte=to_stop.sequence_number
+        available_seats = occupancy.seats_available(
+            self.bus,
+            travel_date,
+            from_stop.sequence_number,
+            to_stop.sequence_number,
         )
 
-        overlapping_bookings = Booking.objects.filter(
-            bus=self.bus,
-            travel_date=travel_date,
-            status__in=['pending', 'confirmed']
-        )
-
-        max_booked_on_any_segment = 0
-
-        for stop in requested_segment_stops:
-            booked_on_segment = overlapping_bookings.filter(
-                from_stop__sequence_number__lt=stop.sequence_number,
-                to_stop__sequence_number__gte=stop.sequence_number,
-            ).aggregate(
-                total=Sum('seats_booked')
-            )['total'] or 0
-
-            if booked_on_segment > max_booked_on_any_segment:
-                max_booked_on_any_segment = booked_on_segment
-
-        available_seats = self.bus.total_seats - max_booked_on_any_segment
-
         if seats_requested > available_seats:
             raise forms.ValidationError(
                 f"Only {available_seats} seat(s) available for the selected route segment."
@@ -0,0 +1,49 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookings import occupancy
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Compare stored segment occupancy against the bookings table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bus', type=int, help="Only check this bus id.")
+        parser.add_argument('--date', help="Only check this travel date (YYYY-MM-DD).")
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help="Rebuild the checked scope when mismatches are found.",
+        )
+
+    def handle(self, *args, **options):
+        problems = occupancy.find_inconsistencies(
+            bus_id=options['bus'], travel_date=options['date']
+        )
+
+        if not problems:
+            self.stdout.write(self.style.SUCCESS("Occupancy is consistent."))
+            return
+
+        for bus_id, travel_date, seq, expected, stored in problems:
+            self.stdout.write(
+                f"bus={bus_id} date={travel_date} segment={seq} "
+                f"expected={expected} stored={stored}"
+            )
+
+        if options['fix']:
+            rows = occupancy.rebuild(bus_id=options['bus'], travel_date=options['date'])
+            # Drift means a write went around sync_booking; make the repair
+            # visible in deploy and application logs instead of hiding it
+            logger.warning(
+                "Repaired %d inconsistent occupancy row(s); rebuilt %d row(s).", len(problems), rows
+            )
+            self.stdout.write(self.style.WARNING(
+                f"Repaired {len(problems)} inconsistent occupancy row(s); rebuilt {rows} row(s)."
+            ))
+            return
+
+        raise CommandError(f"{len(problems)} inconsistent occupancy row(s).")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from bookings import occupancy
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-segment seat occupancy from existing bookings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bus', type=int, help="Only rebuild this bus id.")
+        parser.add_argument('--date', help="Only rebuild this travel date (YYYY-MM-DD).")
+
+    def handle(self, *args, **options):
+        rows = occupancy.rebuild(bus_id=options['bus'], travel_date=options['date'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} occupancy row(s)."))
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0003_payment'),
+        ('buses', '0002_alter_performancemetrics_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentOccupancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('travel_date', models.DateField()),
+                ('sequence_number', models.IntegerField()),
+                ('seats_booked', models.IntegerField(default=0)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segment_occupancy', to='buses.bus')),
+            ],
+            options={
+                'verbose_name_plural': 'Segment occupancy',
+                'unique_together': {('bus', 'travel_date', 'sequence_number')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0004_segmentoccupancy'),
+        ('buses', '0002_alter_performancemetrics_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('travel_date', models.DateField()),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventories', to='buses.bus')),
+            ],
+            options={
+                'verbose_name_plural': 'Trip inventories',
+                'unique_together': {('bus', 'travel_date')},
+            },
+        ),
+    ]
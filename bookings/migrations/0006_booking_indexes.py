@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0005_tripinventory'),
+        ('buses', '0004_trip_date_status_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['bus', 'travel_date', 'status'], name='booking_bus_date_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(condition=models.Q(('status__in', ('pending', 'confirmed'))), fields=['bus', 'travel_date', 'seats_booked'], name='booking_active_seats_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['travel_date', 'status'], name='booking_date_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['user', '-booked_at'], name='booking_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['-booked_at'], name='booking_recent_idx'),
+        ),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from buses.models import Bus, Trip, Stop, Seat
+from buses.fares import fare_table
 import uuid
 
+from . import occupancy
+
 class Booking(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -28,29 +31,99 @@ class Booking(models.Model):
     passenger_email = models.EmailField(blank=True)
     booked_at = models.DateTimeField(auto_now_add=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what was loaded so occupancy can be moved, not recounted
+        if not instance.get_deferred_fields():
+            instance._occupancy_state = occupancy.snapshot(instance)
+            # ... and the revenue users.rollups has counted it with
+            instance._loaded_fare = instance.total_fare
+        return instance
+
+    def _fare_inputs_changed(self):
+        previous = getattr(self, '_occupancy_state', None)
+        if previous is None or self.total_fare is None:
+            return True
+        bus_id, _, from_stop_id, to_stop_id, seats, _ = previous
+        return (bus_id, from_stop_id, to_stop_id, seats) != (
+            self.bus_id, self.from_stop_id, self.to_stop_id, self.seats_booked
+        )
+
     def save(self, *args, **kwargs):
         if not self.booking_id:
             self.booking_id = f"BK{uuid.uuid4().hex[:8].upper()}"
 
-        if self.from_stop_id and self.to_stop_id:
-            stops = Stop.objects.filter(
-                route=self.bus.route,
-                sequence_number__gt=self.from_stop.sequence_number,
-                sequence_number__lte=self.to_stop.sequence_number
-            )
-            self.distance_km = sum(s.distance_from_previous_km for s in stops)
-            self.total_fare = sum(s.fare_from_previous for s in stops) * self.seats_booked
-        else:
-            self.distance_km = 0
-            self.total_fare = 0
+        if not self._state.adding and not hasattr(self, '_occupancy_state'):
+            self._occupancy_state = occupancy.load_snapshot(self.pk)
 
-        super().save(*args, **kwargs)
+        # Status-only saves (cancel, payment) keep the stored fare
+        if self._fare_inputs_changed():
+            if self.from_stop_id and self.to_stop_id:
+                distance, fare = fare_table(self.bus.route_id).between(
+                    self.from_stop.sequence_number,
+                    self.to_stop.sequence_number,
+                )
+                self.distance_km = distance
+                self.total_fare = fare * self.seats_booked
+            else:
+                self.distance_km = 0
+                self.total_fare = 0
+
+        # Occupancy is updated from post_save, so keep both in one transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.booking_id} - {self.user.username}"
 
     class Meta:
         ordering = ['-booked_at']
+        indexes = [
+            models.Index(fields=['bus', 'travel_date', 'status'], name='booking_bus_date_status_idx'),
+            # Seats still held per bus and date, summed without touching the table
+            models.Index(
+                fields=['bus', 'travel_date', 'seats_booked'],
+                condition=models.Q(status__in=occupancy.ACTIVE_STATUSES),
+                name='booking_active_seats_idx',
+            ),
+            models.Index(fields=['travel_date', 'status'], name='booking_date_status_idx'),
+            models.Index(fields=['user', '-booked_at'], name='booking_user_recent_idx'),
+            models.Index(fields=['-booked_at'], name='booking_recent_idx'),
+        ]
+
+
+class SegmentOccupancy(models.Model):
+    """Seats held on one route segment of a bus for one travel date.
+
+    ``sequence_number`` is the stop the segment arrives at. Maintained by
+    ``bookings.signals``; see ``bookings.occupancy`` for the read helpers.
+    """
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='segment_occupancy')
+    travel_date = models.DateField()
+    sequence_number = models.IntegerField()
+    seats_booked = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.bus} {self.travel_date} #{self.sequence_number}: {self.seats_booked}"
+
+    class Meta:
+        unique_together = ['bus', 'travel_date', 'sequence_number']
+        verbose_name_plural = "Segment occupancy"
+
+
+class TripInventory(models.Model):
+    """One row per bus and travel date that reservations serialise on."""
+    bus = models.ForeignKey(Bus, on_delete=models.CASCADE, related_name='inventories')
+    travel_date = models.DateField()
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.bus} {self.travel_date} v{self.version}"
+
+    class Meta:
+        unique_together = ['bus', 'travel_date']
+        verbose_name_plural = "Trip inventories"
 
 
 class Payment(models.Model):
@@ -0,0 +1,250 @@
+"""
+Per-segment seat occupancy for (bus, travel date).
+
+A segment is identified by the sequence number of the stop it arrives at,
+so a booking from stop 2 to stop 5 holds its seats on segments 3, 4 and 5.
+The ``SegmentOccupancy`` rows are kept in step with ``Booking`` rows by the
+signal handlers in ``bookings.signals``; ``rebuild`` and
+``find_inconsistencies`` recompute them from scratch.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from buses.models import Stop
+
+ACTIVE_STATUSES = ('pending', 'confirmed')
+
+
+def segment_range(from_seq, to_seq):
+    return range(from_seq + 1, to_seq + 1)
+
+
+def max_booked(bus, travel_date, from_seq, to_seq):
+    """Highest number of seats held on any segment in (from_seq, to_seq]."""
+    from .models import SegmentOccupancy
+
+    return SegmentOccupancy.objects.filter(
+        bus=bus,
+        travel_date=travel_date,
+        sequence_number__gt=from_seq,
+        sequence_number__lte=to_seq,
+    ).aggregate(booked=Max('seats_booked'))['booked'] or 0
+
+
+def seats_available(bus, travel_date, from_seq, to_seq):
+    return max(bus.total_seats - max_booked(bus, travel_date, from_seq, to_seq), 0)
+
+
+def annotate_available_seats(buses, travel_date, from_seq='origin_seq', to_seq='destination_seq'):
+    """Annotate a Bus queryset with ``available_seats`` for one travel date.
+
+    ``from_seq``/``to_seq`` name annotations (or fields) on the queryset
+    holding each bus's journey segment. One correlated subquery per row,
+    so the whole result set is still a single SQL statement.
+    """
+    from .models import SegmentOccupancy
+
+    booked = (
+        SegmentOccupancy.objects
+        .filter(
+            bus=OuterRef('pk'),
+            travel_date=travel_date,
+            sequence_number__gt=OuterRef(from_seq),
+            sequence_number__lte=OuterRef(to_seq),
+        )
+        .values('bus')
+        .annotate(peak=Max('seats_booked'))
+        .values('peak')
+    )
+    return buses.annotate(
+        available_seats=Greatest(
+            F('total_seats') - Coalesce(Subquery(booked), Value(0)),
+            Value(0),
+        )
+    )
+
+
+def apply(bus_id, travel_date, from_seq, to_seq, delta):
+    """Add ``delta`` seats to every segment in (from_seq, to_seq]."""
+    from .models import SegmentOccupancy
+
+    if not delta or from_seq >= to_seq:
+        return
+
+    # Releasing seats never needs new rows, and must not recreate rows
+    # for a bus that is being cascade-deleted.
+    if delta > 0:
+        SegmentOccupancy.objects.bulk_create(
+            [
+                SegmentOccupancy(bus_id=bus_id, travel_date=travel_date, sequence_number=seq)
+                for seq in segment_range(from_seq, to_seq)
+            ],
+            ignore_conflicts=True,
+        )
+    SegmentOccupancy.objects.filter(
+        bus_id=bus_id,
+        travel_date=travel_date,
+        sequence_number__gt=from_seq,
+        sequence_number__lte=to_seq,
+    ).update(seats_booked=F('seats_booked') + delta)
+
+
+# -----------------------------
+# BOOKING FOOTPRINTS
+# -----------------------------
+def snapshot(booking):
+    """Raw field values that decide which seats a booking holds."""
+    return (
+        booking.bus_id,
+        booking.travel_date,
+        booking.from_stop_id,
+        booking.to_stop_id,
+        booking.seats_booked,
+        booking.status,
+    )
+
+
+def load_snapshot(pk):
+    """Snapshot of a booking as currently stored, or None if it does not exist."""
+    from .models import Booking
+
+    return Booking.objects.filter(pk=pk).values_list(
+        'bus_id', 'travel_date', 'from_stop_id', 'to_stop_id', 'seats_booked', 'status'
+    ).first()
+
+
+def _footprint(state, stop_sequences):
+    bus_id, travel_date, from_stop_id, to_stop_id, seats, status = state
+    if status not in ACTIVE_STATUSES or not (from_stop_id and to_stop_id):
+        return None
+    return (
+        bus_id,
+        travel_date,
+        stop_sequences[from_stop_id],
+        stop_sequences[to_stop_id],
+        seats,
+    )
+
+
+def _stop_sequences(booking, *states):
+    sequences = {}
+    for field in ('from_stop', 'to_stop'):
+        descriptor = getattr(type(booking), field)
+        if descriptor.is_cached(booking):
+            stop = getattr(booking, field)
+            if stop is not None:
+                sequences[stop.pk] = stop.sequence_number
+
+    missing = {
+        stop_id
+        for state in states if state
+        for stop_id in state[2:4]
+        if stop_id and stop_id not in sequences
+    }
+    if missing:
+        sequences.update(
+            Stop.objects.filter(pk__in=missing).values_list('pk', 'sequence_number')
+        )
+    return sequences
+
+
+def sync_booking(booking, deleted=False):
+    """Move the booking's seats from its last saved footprint to its current one."""
+    previous = getattr(booking, '_occupancy_state', None)
+    current = None if deleted else snapshot(booking)
+
+    if previous == current:
+        return
+
+    sequences = _stop_sequences(booking, previous, current)
+    old = _footprint(previous, sequences) if previous else None
+    new = _footprint(current, sequences) if current else None
+
+    with transaction.atomic():
+        if old != new:
+            if old:
+                apply(*old[:4], -old[4])
+            if new:
+                apply(*new[:4], new[4])
+
+    booking._occupancy_state = current
+
+
+# -----------------------------
+# REBUILD / CONSISTENCY CHECK
+# -----------------------------
+def _scope(queryset, bus_id=None, travel_date=None):
+    if bus_id is not None:
+        queryset = queryset.filter(bus_id=bus_id)
+    if travel_date is not None:
+        queryset = queryset.filter(travel_date=travel_date)
+    return queryset
+
+
+def expected_occupancy(bus_id=None, travel_date=None):
+    """Recompute {(bus_id, travel_date, sequence_number): seats} from bookings."""
+    from .models import Booking
+
+    bookings = _scope(
+        Booking.objects.filter(
+            status__in=ACTIVE_STATUSES,
+            from_stop__isnull=False,
+            to_stop__isnull=False,
+        ),
+        bus_id,
+        travel_date,
+    ).values_list(
+        'bus_id',
+        'travel_date',
+        'from_stop__sequence_number',
+        'to_stop__sequence_number',
+        'seats_booked',
+    )
+
+    counts = defaultdict(int)
+    for bus, date, from_seq, to_seq, seats in bookings.iterator():
+        for seq in segment_range(from_seq, to_seq):
+            counts[(bus, date, seq)] += seats
+    return counts
+
+
+def rebuild(bus_id=None, travel_date=None, batch_size=1000):
+    """Replace the stored occupancy rows in scope with freshly computed ones."""
+    from .models import SegmentOccupancy
+
+    counts = expected_occupancy(bus_id, travel_date)
+    rows = [
+        SegmentOccupancy(bus_id=bus, travel_date=date, sequence_number=seq, seats_booked=seats)
+        for (bus, date, seq), seats in counts.items()
+        if seats
+    ]
+
+    with transaction.atomic():
+        _scope(SegmentOccupancy.objects.all(), bus_id, travel_date).delete()
+        SegmentOccupancy.objects.bulk_create(rows, batch_size=batch_size)
+
+    return len(rows)
+
+
+def find_inconsistencies(bus_id=None, travel_date=None):
+    """List (bus_id, travel_date, sequence_number, expected, stored) mismatches."""
+    from .models import SegmentOccupancy
+
+    expected = expected_occupancy(bus_id, travel_date)
+    stored = {
+        (bus, date, seq): seats
+        for bus, date, seq, seats in _scope(
+            SegmentOccupancy.objects.exclude(seats_booked=0), bus_id, travel_date
+        ).values_list('bus_id', 'travel_date', 'sequence_number', 'seats_booked').iterator()
+    }
+
+    problems = []
+    for key in sorted(set(expected) | set(stored)):
+        want = expected.get(key, 0)
+        have = stored.get(key, 0)
+        if want != have:
+            problems.append((*key, want, have))
+    return problems
@@ -0,0 +1,128 @@
+"""
+Atomic seat reservation.
+
+``reserve`` is the single entry point for turning an unsaved ``Booking``
+into a held reservation. The availability check and the insert run inside
+one transaction that is serialised per (bus, travel date) through a
+``TripInventory`` row:
+
+* backends with ``SELECT ... FOR UPDATE`` (PostgreSQL) lock the row;
+* everything else (SQLite) bumps the row's version with a compare-and-swap
+  update and retries the whole attempt when another writer got there first.
+"""
+import random
+import time
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import F
+
+from buses.models import Trip
+from . import occupancy
+from .models import TripInventory
+
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 0.005
+
+
+class ReservationError(Exception):
+    pass
+
+
+class SeatsUnavailable(ReservationError):
+    def __init__(self, available):
+        self.available = available
+        super().__init__(
+            f"Only {available} seat(s) available for the selected route segment."
+        )
+
+
+class ReservationConflict(ReservationError):
+    def __init__(self):
+        super().__init__("This bus is being booked heavily right now. Please try again.")
+
+
+class _VersionChanged(Exception):
+    pass
+
+
+def _check_and_save(booking):
+    if booking.from_stop_id and booking.to_stop_id:
+        available = occupancy.seats_available(
+            booking.bus,
+            booking.travel_date,
+            booking.from_stop.sequence_number,
+            booking.to_stop.sequence_number,
+        )
+        if booking.seats_booked > available:
+            raise SeatsUnavailable(available)
+
+    booking.save()
+
+
+def _reset(booking):
+    # A rolled back attempt leaves the instance looking saved
+    booking.pk = None
+    booking.booking_id = ''
+    booking._state.adding = True
+    booking.__dict__.pop('_occupancy_state', None)
+    booking.__dict__.pop('_rolled_up', None)
+
+
+def _inventory(booking):
+    if booking.trip_id is None:
+        booking.trip, _ = Trip.objects.get_or_create(
+            bus=booking.bus,
+            date=booking.travel_date,
+            defaults={'status': 'not_started'},
+        )
+
+    inventory, _ = TripInventory.objects.get_or_create(
+        bus_id=booking.bus_id,
+        travel_date=booking.travel_date,
+    )
+    return inventory
+
+
+def _reserve_locked(booking):
+    inventory = _inventory(booking)
+    with transaction.atomic():
+        inventory = TripInventory.objects.select_for_update().get(pk=inventory.pk)
+        _check_and_save(booking)
+        TripInventory.objects.filter(pk=inventory.pk).update(version=F('version') + 1)
+
+
+def _reserve_optimistic(booking, max_attempts):
+    for attempt in range(max_attempts):
+        try:
+            inventory = _inventory(booking)
+            with transaction.atomic():
+                # Swap first: on SQLite this also takes the write lock, so the
+                # availability check below cannot see a stale snapshot.
+                swapped = TripInventory.objects.filter(
+                    pk=inventory.pk,
+                    version=inventory.version,
+                ).update(version=F('version') + 1)
+                if not swapped:
+                    raise _VersionChanged
+                _check_and_save(booking)
+            return
+        except (_VersionChanged, OperationalError):
+            _reset(booking)
+            time.sleep(BACKOFF_SECONDS * (2 ** attempt) * random.random())
+
+    raise ReservationConflict()
+
+
+def reserve(booking, max_attempts=MAX_ATTEMPTS):
+    """Check availability and save ``booking`` as one atomic operation.
+
+    Attaches the day's ``Trip`` when the booking has none. Raises
+    ``SeatsUnavailable`` when the segment is full and ``ReservationConflict``
+    when the optimistic path keeps losing the race.
+    """
+    if connection.features.has_select_for_update:
+        _reserve_locked(booking)
+    else:
+        _reserve_optimistic(booking, max_attempts)
+
+    return booking
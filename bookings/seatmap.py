@@ -0,0 +1,79 @@
+"""
+Segment-aware seat maps.
+
+A seat is taken for a journey when an active booking that selected it
+overlaps the journey's segment: it boards before the journey ends and
+alights after the journey starts. Bookings without stops hold the seat
+for the whole route.
+"""
+from django.db.models import Q
+
+from buses.models import Seat
+from .models import Booking
+from .occupancy import ACTIVE_STATUSES
+
+
+def _overlap(bus_id, segment):
+    condition = Q(booking__bus_id=bus_id)
+    if segment is None:
+        return condition
+    from_seq, to_seq = segment
+    return condition & (
+        Q(booking__from_stop__isnull=True)
+        | Q(booking__to_stop__isnull=True)
+        | Q(
+            booking__from_stop__sequence_number__lt=to_seq,
+            booking__to_stop__sequence_number__gt=from_seq,
+        )
+    )
+
+
+def booked_seat_ids(travel_date, segments):
+    """{bus_id: set(seat_id)} for ``segments`` ({bus_id: (from_seq, to_seq) or None}).
+
+    Runs one query regardless of how many buses are asked for.
+    """
+    booked = {bus_id: set() for bus_id in segments}
+    if not segments:
+        return booked
+
+    overlap = Q()
+    for bus_id, segment in segments.items():
+        overlap |= _overlap(bus_id, segment)
+
+    rows = Booking.selected_seats.through.objects.filter(
+        overlap,
+        booking__travel_date=travel_date,
+        booking__status__in=ACTIVE_STATUSES,
+    ).values_list('booking__bus_id', 'seat_id')
+
+    for bus_id, seat_id in rows:
+        booked[bus_id].add(seat_id)
+    return booked
+
+
+def seat_maps(travel_date, segments):
+    """Compact seat maps keyed by bus id.
+
+    Each map lists seat ids and numbers in seat-number order plus a
+    ``booked`` bitmap string with '1' for taken seats in the same order.
+    """
+    booked = booked_seat_ids(travel_date, segments)
+    maps = {bus_id: {'ids': [], 'numbers': [], 'booked': []} for bus_id in segments}
+
+    seats = (
+        Seat.objects
+        .filter(bus_id__in=segments.keys())
+        .order_by('bus_id', 'seat_number')
+        .values_list('bus_id', 'id', 'seat_number')
+    )
+    for bus_id, seat_id, number in seats:
+        entry = maps[bus_id]
+        entry['ids'].append(seat_id)
+        entry['numbers'].append(number)
+        entry['booked'].append('1' if seat_id in booked[bus_id] else '0')
+
+    for entry in maps.values():
+        entry['booked'] = ''.join(entry['booked'])
+        entry['available'] = entry['booked'].count('0')
+    return maps
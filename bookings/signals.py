@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import occupancy
+from .models import Booking
+
+
+@receiver(post_save, sender=Booking)
+def update_occupancy_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    occupancy.sync_booking(instance)
+
+
+@receiver(post_delete, sender=Booking)
+def update_occupancy_on_delete(sender, instance, **kwargs):
+    occupancy.sync_booking(instance, deleted=True)
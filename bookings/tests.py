@@ -1,3 +1,462 @@
-from django.test import TestCase
+import datetime
+import threading
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.urls import reverse
+
+from benchmarks.plans import QueryPlanTestMixin
+from buses.models import Bus, Route, Seat, Stop
+from bustrack.querybudget import QueryBudgetTestMixin
+
+from . import occupancy, reservations, seatmap
+from .models import Booking, SegmentOccupancy, TripInventory
+from .views import MAX_SEAT_MAP_BUSES
+
+TRAVEL_DATE = datetime.date(2030, 1, 15)
+
+
+def make_bus(stops=4, seats=10, number='T-1'):
+    """A bus on a route of ``stops`` stops, 10 km and 50 apart."""
+    route = Route.objects.create(name=f"Route {number}", source="Stop 1", destination=f"Stop {stops}")
+    for seq in range(1, stops + 1):
+        Stop.objects.create(
+            route=route,
+            name=f"Stop {seq}",
+            latitude=18.5 + seq / 100,
+            longitude=73.8 + seq / 100,
+            sequence_number=seq,
+            distance_from_previous_km=10 if seq > 1 else 0,
+            fare_from_previous=50 if seq > 1 else 0,
+        )
+    return Bus.objects.create(
+        bus_number=number,
+        bus_name="Test Express",
+        total_seats=seats,
+        route=route,
+        departure_time=datetime.time(8, 0),
+        arrival_time=datetime.time(12, 0),
+    )
+
+
+def stop(bus, seq):
+    return bus.route.stops.get(sequence_number=seq)
+
+
+def new_booking(user, bus, from_seq, to_seq, seats=2, **fields):
+    return Booking(
+        user=user,
+        bus=bus,
+        travel_date=TRAVEL_DATE,
+        from_stop=stop(bus, from_seq),
+        to_stop=stop(bus, to_seq),
+        seats_booked=seats,
+        passenger_name="Passenger",
+        passenger_phone="9999999999",
+        **fields,
+    )
+
+
+class OccupancyTestCase(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        self.user = User.objects.create(username='passenger')
+
+    def book(self, from_seq, to_seq, seats=2, status='confirmed'):
+        booking = new_booking(self.user, self.bus, from_seq, to_seq, seats, status=status)
+        booking.save()
+        return booking
+
+    def stored(self):
+        """{segment: seats} held for the bus on TRAVEL_DATE."""
+        return dict(
+            SegmentOccupancy.objects.filter(bus=self.bus, travel_date=TRAVEL_DATE)
+            .exclude(seats_booked=0)
+            .values_list('sequence_number', 'seats_booked')
+        )
+
+    def assertConsistent(self):
+        self.assertEqual(occupancy.find_inconsistencies(self.bus.pk), [])
+
+
+class SyncBookingTests(OccupancyTestCase):
+    def test_create_holds_the_segments_of_the_journey(self):
+        self.book(1, 3)
+        self.book(2, 4, seats=1)
+        self.assertEqual(self.stored(), {2: 2, 3: 3, 4: 1})
+        self.assertConsistent()
+
+    def test_cancelled_booking_holds_nothing(self):
+        self.book(1, 3, status='cancelled')
+        self.assertEqual(self.stored(), {})
+
+    def test_cancel_releases_and_uncancel_holds_again(self):
+        booking = self.book(1, 3)
+        booking.status = 'cancelled'
+        booking.save()
+        self.assertEqual(self.stored(), {})
+
+        booking.status = 'confirmed'
+        booking.save()
+        self.assertEqual(self.stored(), {2: 2, 3: 2})
+        self.assertConsistent()
+
+    def test_segment_change_moves_the_seats(self):
+        booking = self.book(1, 3)
+        booking.from_stop = stop(self.bus, 3)
+        booking.to_stop = stop(self.bus, 4)
+        booking.save()
+        self.assertEqual(self.stored(), {4: 2})
+        self.assertConsistent()
+
+    def test_seat_count_change(self):
+        booking = self.book(1, 3)
+        booking.seats_booked = 5
+        booking.save()
+        self.assertEqual(self.stored(), {2: 5, 3: 5})
+        self.assertConsistent()
+
+    def test_delete_releases(self):
+        booking = self.book(1, 3)
+        booking.delete()
+        self.assertEqual(self.stored(), {})
+
+    def test_reloaded_instance_moves_from_what_is_stored(self):
+        booking = self.book(1, 3)
+        reloaded = Booking.objects.get(pk=booking.pk)
+        reloaded.status = 'cancelled'
+        reloaded.save()
+        self.assertEqual(self.stored(), {})
+
+    def test_deferred_load_reads_the_stored_state_on_save(self):
+        # from_db skips the snapshot when fields are deferred
+        booking = self.book(1, 3)
+        deferred = Booking.objects.defer('passenger_email').get(pk=booking.pk)
+        self.assertFalse(hasattr(deferred, '_occupancy_state'))
+        deferred.seats_booked = 4
+        deferred.save()
+        self.assertEqual(self.stored(), {2: 4, 3: 4})
+
+        deferred = Booking.objects.only('pk', 'status').get(pk=booking.pk)
+        deferred.status = 'cancelled'
+        deferred.save(update_fields=['status'])
+        self.assertEqual(self.stored(), {})
+        self.assertConsistent()
+
+    def test_available_seats_follow_the_busiest_segment(self):
+        self.book(1, 3, seats=6)
+        self.book(3, 4, seats=3)
+        self.assertEqual(occupancy.seats_available(self.bus, TRAVEL_DATE, 1, 2), 4)
+        self.assertEqual(occupancy.seats_available(self.bus, TRAVEL_DATE, 1, 4), 4)
+        self.assertEqual(occupancy.seats_available(self.bus, TRAVEL_DATE, 3, 4), 7)
+
+
+class CheckOccupancyTests(OccupancyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book(1, 3)
+        # A write that went around the signals
+        SegmentOccupancy.objects.filter(bus=self.bus, sequence_number=3).update(
+            seats_booked=F('seats_booked') + 5
+        )
+
+    def test_reports_drift(self):
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check_occupancy', stdout=out)
+        self.assertIn("segment=3 expected=2 stored=7", out.getvalue())
+
+    def test_fix_repairs_and_says_how_much(self):
+        out = StringIO()
+        with self.assertLogs('bookings.management.commands.check_occupancy', 'WARNING'):
+            call_command('check_occupancy', '--fix', stdout=out)
+        self.assertIn("Repaired 1 inconsistent occupancy row(s)", out.getvalue())
+        self.assertEqual(self.stored(), {2: 2, 3: 2})
+
+        out = StringIO()
+        call_command('check_occupancy', stdout=out)
+        self.assertIn("Occupancy is consistent.", out.getvalue())
+
+    def test_rebuild_recomputes_from_bookings(self):
+        SegmentOccupancy.objects.all().delete()
+        call_command('rebuild_occupancy', stdout=StringIO())
+        self.assertEqual(self.stored(), {2: 2, 3: 2})
+
+
+# -----------------------------
+# RESERVATIONS
+# -----------------------------
+class ReserveTests(OccupancyTestCase):
+    def test_reserves_up_to_capacity(self):
+        reservations.reserve(new_booking(self.user, self.bus, 1, 3, seats=6))
+        reservations.reserve(new_booking(self.user, self.bus, 2, 4, seats=4))
+
+        with self.assertRaises(reservations.SeatsUnavailable) as raised:
+            reservations.reserve(new_booking(self.user, self.bus, 1, 4, seats=1))
+        self.assertEqual(raised.exception.available, 0)
+        self.assertEqual(Booking.objects.count(), 2)
+        self.assertEqual(self.stored(), {2: 6, 3: 10, 4: 4})
+
+    def test_other_segments_stay_bookable(self):
+        reservations.reserve(new_booking(self.user, self.bus, 1, 2, seats=10))
+        reservations.reserve(new_booking(self.user, self.bus, 2, 4, seats=10))
+        self.assertEqual(self.stored(), {2: 10, 3: 10, 4: 10})
+
+    def test_attaches_the_days_trip_and_bumps_the_inventory(self):
+        booking = reservations.reserve(new_booking(self.user, self.bus, 1, 3))
+        self.assertEqual((booking.trip.bus, booking.trip.date), (self.bus, TRAVEL_DATE))
+        inventory = TripInventory.objects.get(bus=self.bus, travel_date=TRAVEL_DATE)
+        self.assertEqual(inventory.version, 1)
+
+
+@mock.patch.object(reservations, 'BACKOFF_SECONDS', 0)
+@mock.patch.object(connection.features, 'has_select_for_update', False)
+class OptimisticReserveTests(OccupancyTestCase):
+    def stale_inventory(self, conflicts):
+        """``_inventory`` that hands out an outdated version ``conflicts`` times."""
+        real = reservations._inventory
+        calls = []
+
+        def inventory(booking):
+            calls.append(booking)
+            current = real(booking)
+            if len(calls) <= conflicts:
+                current.version -= 1
+            return current
+        return mock.patch.object(reservations, '_inventory', side_effect=inventory), calls
+
+    def test_retries_after_a_version_conflict(self):
+        reservations.reserve(new_booking(self.user, self.bus, 1, 2, seats=1))
+        patch, calls = self.stale_inventory(conflicts=2)
+        with patch:
+            booking = reservations.reserve(new_booking(self.user, self.bus, 1, 3))
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(Booking.objects.filter(pk=booking.pk).count(), 1)
+        self.assertEqual(Booking.objects.count(), 2)
+        self.assertEqual(self.stored(), {2: 3, 3: 2})
+        self.assertConsistent()
+
+    def test_gives_up_after_max_attempts(self):
+        reservations.reserve(new_booking(self.user, self.bus, 1, 2, seats=1))
+        patch, calls = self.stale_inventory(conflicts=reservations.MAX_ATTEMPTS)
+        booking = new_booking(self.user, self.bus, 1, 3)
+        with patch, self.assertRaises(reservations.ReservationConflict):
+            reservations.reserve(booking)
+
+        self.assertEqual(len(calls), reservations.MAX_ATTEMPTS)
+        self.assertIsNone(booking.pk)
+        self.assertEqual(Booking.objects.count(), 1)
+        self.assertEqual(self.stored(), {2: 1})
+
+    def test_full_segment_is_not_retried(self):
+        reservations.reserve(new_booking(self.user, self.bus, 1, 3, seats=10))
+        with mock.patch.object(reservations, '_inventory', wraps=reservations._inventory) as inventory:
+            with self.assertRaises(reservations.SeatsUnavailable):
+                reservations.reserve(new_booking(self.user, self.bus, 2, 4))
+        self.assertEqual(inventory.call_count, 1)
+
+
+@override_settings(ADMIN_DASHBOARD={'LIVE': False})
+class ConcurrentReserveTests(TransactionTestCase):
+    """Many requests for the last seats at once never sell more than the bus holds."""
+
+    passengers = 8
+    seats = 3
+
+    def setUp(self):
+        self.bus = make_bus(seats=10)
+        self.users = [User.objects.create(username=f'passenger-{n}') for n in range(self.passengers)]
+
+    def race(self, reserve):
+        barrier = threading.Barrier(self.passengers)
+        outcomes = []
+
+        def attempt(user):
+            booking = new_booking(user, Bus.objects.get(pk=self.bus.pk), 1, 4, seats=self.seats)
+            try:
+                barrier.wait()
+                reserve(booking)
+                outcomes.append('reserved')
+            except reservations.SeatsUnavailable:
+                outcomes.append('full')
+            except reservations.ReservationConflict:
+                outcomes.append('conflict')
+            except Exception as exc:
+                outcomes.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        return outcomes
+
+    def assertNotOversold(self, outcomes):
+        self.assertEqual(
+            [outcome for outcome in outcomes if not isinstance(outcome, str)], [], "unexpected errors"
+        )
+        booked = Booking.objects.filter(bus=self.bus).values_list('seats_booked', flat=True)
+        self.assertEqual(len(booked), outcomes.count('reserved'))
+        self.assertLessEqual(sum(booked), self.bus.total_seats)
+        self.assertEqual(occupancy.find_inconsistencies(self.bus.pk), [])
+        # Whoever was turned away found the bus full, not merely busy
+        if outcomes.count('full'):
+            self.assertEqual(sum(booked), self.bus.total_seats // self.seats * self.seats)
+
+    def test_reserve(self):
+        outcomes = self.race(lambda booking: reservations.reserve(booking, max_attempts=100))
+        self.assertNotOversold(outcomes)
+        self.assertGreater(outcomes.count('reserved'), 0)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_locked_path(self):
+        outcomes = self.race(reservations._reserve_locked)
+        self.assertNotOversold(outcomes)
+        self.assertEqual(outcomes.count('reserved'), self.bus.total_seats // self.seats)
+
+
+# -----------------------------
+# VIEWS
+# -----------------------------
+class BookBusViewTests(OccupancyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.url = reverse('bookings:book', args=[self.bus.pk])
+        self.data = {
+            'travel_date': TRAVEL_DATE.isoformat(),
+            'from_stop': stop(self.bus, 1).pk,
+            'to_stop': stop(self.bus, 3).pk,
+            'seats_booked': 2,
+            'passenger_name': "Passenger",
+            'passenger_phone': "9999999999",
+        }
+
+    def test_books(self):
+        response = self.client.post(self.url, self.data)
+        booking = Booking.objects.get()
+        self.assertRedirects(
+            response, reverse('bookings:create_payment', args=[booking.pk]), fetch_redirect_response=False
+        )
+        self.assertEqual(self.stored(), {2: 2, 3: 2})
+
+    def test_reservation_errors_are_shown_on_the_form(self):
+        # Seats taken between the form's own check and the reservation
+        for error in (reservations.SeatsUnavailable(1), reservations.ReservationConflict()):
+            with mock.patch('bookings.views.reserve', side_effect=error):
+                response = self.client.post(self.url, self.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['form'].non_field_errors(), [str(error)])
+        self.assertFalse(Booking.objects.exists())
+
+
+class SeatMapTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='passenger')
+        self.bus = make_bus()
+        self.seats = [Seat.objects.create(bus=self.bus, seat_number=f"A{n}") for n in range(1, 6)]
+        self.book(1, 3, self.seats[0])
+        self.book(3, 4, self.seats[1])
+        self.book(None, None, self.seats[2])
+        self.book(1, 4, self.seats[3], status='cancelled')
+
+    def book(self, from_seq, to_seq, seat, status='confirmed'):
+        booking = new_booking(self.user, self.bus, 1, 4, seats=1, status=status)
+        if from_seq is None:
+            booking.from_stop = booking.to_stop = None
+        else:
+            booking.from_stop, booking.to_stop = stop(self.bus, from_seq), stop(self.bus, to_seq)
+        booking.save()
+        booking.selected_seats.set([seat])
+
+    def booked(self, segment):
+        return seatmap.booked_seat_ids(TRAVEL_DATE, {self.bus.pk: segment})[self.bus.pk]
+
+    def test_overlapping_segments_hold_the_seat(self):
+        first, second, whole_route, _, _ = (seat.pk for seat in self.seats)
+        self.assertEqual(self.booked((2, 4)), {first, second, whole_route})
+        self.assertEqual(self.booked(None), {first, second, whole_route})
+
+    def test_back_to_back_segments_do_not_conflict(self):
+        first, second, whole_route, _, _ = (seat.pk for seat in self.seats)
+        # Booked 1-3 and 3-4: each is free on the other's segment
+        self.assertEqual(self.booked((3, 4)), {second, whole_route})
+        self.assertEqual(self.booked((1, 3)), {first, whole_route})
+        self.assertEqual(self.booked((1, 2)), {first, whole_route})
+
+    def test_booked_bitmap(self):
+        with self.assertNumQueries(2):
+            maps = seatmap.seat_maps(TRAVEL_DATE, {self.bus.pk: (3, 4)})
+        self.assertEqual(maps, {self.bus.pk: {
+            'ids': [seat.pk for seat in self.seats],
+            'numbers': ["A1", "A2", "A3", "A4", "A5"],
+            'booked': "01100",
+            'available': 3,
+        }})
+
+    def test_other_dates_are_free(self):
+        maps = seatmap.seat_maps(TRAVEL_DATE + datetime.timedelta(days=1), {self.bus.pk: None})
+        self.assertEqual(maps[self.bus.pk]['booked'], "00000")
+
+
+class SeatMapBatchApiTests(SeatMapTests):
+    def get(self, **params):
+        return self.client.get(reverse('bookings:seat_map_batch_api'), params)
+
+    def test_maps_every_bus_for_the_searched_segment(self):
+        empty = make_bus(number='T-2')
+        Seat.objects.create(bus=empty, seat_number="A1")
+        response = self.get(
+            buses=f"{self.bus.pk},{empty.pk}", date=TRAVEL_DATE.isoformat(),
+            source="stop 3", destination="Stop 4",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'date': TRAVEL_DATE.isoformat(),
+            'buses': {
+                str(self.bus.pk): {
+                    'from_sequence': 3, 'to_sequence': 4,
+                    'seats': ["A1", "A2", "A3", "A4", "A5"], 'booked': "01100", 'available': 3,
+                },
+                str(empty.pk): {
+                    'from_sequence': 3, 'to_sequence': 4, 'seats': ["A1"], 'booked': "0", 'available': 1,
+                },
+            },
+        })
+
+    def test_without_a_segment_maps_the_whole_route(self):
+        response = self.get(buses=str(self.bus.pk), date=TRAVEL_DATE.isoformat())
+        bus = response.json()['buses'][str(self.bus.pk)]
+        self.assertEqual((bus['from_sequence'], bus['booked']), (None, "11100"))
+
+    def test_rejects_bad_requests(self):
+        date = TRAVEL_DATE.isoformat()
+        too_many = ",".join(str(pk) for pk in range(1, MAX_SEAT_MAP_BUSES + 2))
+        for params, error in (
+            ({'buses': str(self.bus.pk)}, "A valid date is required"),
+            ({'buses': str(self.bus.pk), 'date': "2030-02-30"}, "A valid date is required"),
+            ({'buses': f"{self.bus.pk},x", 'date': date}, "Invalid bus id"),
+            ({'buses': "", 'date': date}, f"Pass between 1 and {MAX_SEAT_MAP_BUSES} bus ids"),
+            ({'buses': too_many, 'date': date}, f"Pass between 1 and {MAX_SEAT_MAP_BUSES} bus ids"),
+        ):
+            with self.subTest(params=params):
+                response = self.get(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': error})
+
+
+class HotPathTests(QueryPlanTestMixin, QueryBudgetTestMixin, TestCase):
+    def test_views_use_indexes(self):
+        self.assertHotPathsUseIndexes('bookings')
+
+    def test_views_stay_within_query_budgets(self):
+        self.assertHotPathsWithinBudget('bookings')
@@ -11,6 +11,7 @@ urlpatterns = [
     path('<int:pk>/track/', views.track_booking, name='track'),
 
     path("api/seats/<int:bus_id>/", views.seat_layout_api, name="seat_layout_api"),
+    path("api/seat-map/", views.seat_map_batch_api, name="seat_map_batch_api"),
     path('api/seats/status/<int:bus_id>/', views.booking_seat_status_api, name='seat_status_api'),
 
     # PayPal Payment URLs
@@ -2,11 +2,16 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.http import JsonResponse
 from django.db import models
 from .models import Booking, Payment
+from . import occupancy
 from .forms import BookingForm
-from buses.models import Bus, Trip, Seat
+from .reservations import reserve, ReservationError
+from .seatmap import seat_maps
+from buses.models import Bus, Stop
+from bustrack.querybudget import query_budget
 from django.views.decorators.http import require_GET
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
@@ -16,19 +21,24 @@ import paypalrestsdk
 import os
 import google.generativeai as genai
 
-# Configure PayPal lazily — only when credentials are available
-_paypal_configured = False
+# Configure PayPal lazily — only when credentials are available, and
+# again whenever the settings change
+_paypal_configured = None
 
 def _ensure_paypal_configured():
     global _paypal_configured
-    if not _paypal_configured and settings.PAYPAL_CLIENT_ID and settings.PAYPAL_CLIENT_SECRET:
-        paypalrestsdk.configure({
-            "mode": settings.PAYPAL_MODE,
-            "client_id": settings.PAYPAL_CLIENT_ID,
-            "client_secret": settings.PAYPAL_CLIENT_SECRET,
-        })
-        _paypal_configured = True
+    options = {
+        "mode": settings.PAYPAL_MODE,
+        "client_id": settings.PAYPAL_CLIENT_ID,
+        "client_secret": settings.PAYPAL_CLIENT_SECRET,
+    }
+    if settings.PAYPAL_ENDPOINT:
+        options["endpoint"] = settings.PAYPAL_ENDPOINT
+    if options != _paypal_configured and settings.PAYPAL_CLIENT_ID and settings.PAYPAL_CLIENT_SECRET:
+        paypalrestsdk.configure(options)
+        _paypal_configured = options
 
+@query_budget(30)
 @login_required
 def book_bus(request, bus_id):
     bus = get_object_or_404(Bus, pk=bus_id, is_active=True)
@@ -41,15 +51,13 @@ def book_bus(request, bus_id):
             booking.user = request.user
             booking.bus = bus
 
-            trip, _ = Trip.objects.get_or_create(
-                bus=bus,
-                date=booking.travel_date,
-                defaults={'status': 'not_started'}
-            )
-            booking.trip = trip
-            booking.save()
-            messages.success(request, f"Booking created! Booking ID: {booking.booking_id}")
-            return redirect('bookings:create_payment', booking_id=booking.pk)
+            try:
+                reserve(booking)
+            except ReservationError as exc:
+                form.add_error(None, str(exc))
+            else:
+                messages.success(request, f"Booking created! Booking ID: {booking.booking_id}")
+                return redirect('bookings:create_payment', booking_id=booking.pk)
     else:
         form = BookingForm(
             bus=bus,
@@ -62,11 +70,13 @@ def book_bus(request, bus_id):
 
     return render(request, 'bookings/book.html', {'form': form, 'bus': bus})
 
+@query_budget(4)
 @login_required
 def booking_list(request):
-    bookings = Booking.objects.filter(user=request.user)
+    bookings = Booking.objects.filter(user=request.user).select_related('bus__route')
     return render(request, 'bookings/list.html', {'bookings': bookings})
 
+@query_budget(6)
 @login_required
 def booking_detail(request, pk):
     booking = get_object_or_404(Booking, pk=pk, user=request.user)
@@ -84,6 +94,7 @@ def cancel_booking(request, pk):
     messages.success(request, "Booking cancelled successfully.")
     return redirect('bookings:list')
 
+@query_budget(6)
 @login_required
 def track_booking(request, pk):
     booking = get_object_or_404(Booking, pk=pk, user=request.user)
@@ -93,6 +104,7 @@ def track_booking(request, pk):
 # ------------------------------
 # Seat availability API
 # ------------------------------
+@query_budget(3)
 def booking_seat_status_api(request, bus_id):
     bus = get_object_or_404(Bus, pk=bus_id)
     date = request.GET.get("date", timezone.now().date())
@@ -100,7 +112,7 @@ def booking_seat_status_api(request, bus_id):
     booked = Booking.objects.filter(
         bus=bus,
         travel_date=date,
-        status__in=["confirmed", "pending"]
+        status__in=occupancy.ACTIVE_STATUSES
     ).aggregate(models.Sum("seats_booked"))["seats_booked__sum"] or 0
 
     return JsonResponse({
@@ -110,27 +122,122 @@ def booking_seat_status_api(request, bus_id):
         "available_seats": total - booked
     })
 
+def _date_param(request):
+    """``?date=`` as a date, or None when missing or not a real date."""
+    try:
+        return parse_date(request.GET.get("date") or "")
+    except ValueError:
+        # Well formed but out of range, e.g. 2030-02-30
+        return None
+
+
+def _parse_travel_date(request):
+    return _date_param(request) or timezone.now().date()
+
+
+def _segment_from_stop_ids(bus, from_stop_id, to_stop_id):
+    """(from_seq, to_seq) for two stop ids on the bus's route, or None for the whole route."""
+    if not (from_stop_id and to_stop_id and bus.route_id):
+        return None
+    try:
+        ids = [int(from_stop_id), int(to_stop_id)]
+    except ValueError:
+        return None
+    sequences = dict(
+        Stop.objects.filter(route_id=bus.route_id, pk__in=ids).values_list("pk", "sequence_number")
+    )
+    if len(sequences) != 2 or sequences[ids[0]] >= sequences[ids[1]]:
+        return None
+    return sequences[ids[0]], sequences[ids[1]]
+
+
+def _segments_from_stop_names(route_by_bus, source, destination):
+    """Resolve boarding/alighting stop names per route into (from_seq, to_seq)."""
+    segments = {bus_id: None for bus_id in route_by_bus}
+    if not (source and destination):
+        return segments
+
+    source, destination = source.strip().lower(), destination.strip().lower()
+    positions = {}
+    stops = Stop.objects.filter(
+        models.Q(name__iexact=source) | models.Q(name__iexact=destination),
+        route_id__in=set(route_by_bus.values()),
+    ).values_list("route_id", "name", "sequence_number")
+    for route_id, name, seq in stops:
+        key = "from" if name.lower() == source else "to"
+        positions.setdefault(route_id, {}).setdefault(key, seq)
+
+    for bus_id, route_id in route_by_bus.items():
+        found = positions.get(route_id, {})
+        if "from" in found and "to" in found and found["from"] < found["to"]:
+            segments[bus_id] = (found["from"], found["to"])
+    return segments
+
+
+@query_budget(5)
 @require_GET
 def seat_layout_api(request, bus_id):
     bus = get_object_or_404(Bus, pk=bus_id)
-    date = request.GET.get("date")
-    booked_seats = Booking.objects.filter(
-        bus=bus,
-        travel_date=date,
-        status__in=["pending", "confirmed"]
-    ).values_list("selected_seats__id", flat=True)
+    travel_date = _parse_travel_date(request)
+    segment = _segment_from_stop_ids(
+        bus, request.GET.get("from_stop"), request.GET.get("to_stop")
+    )
+    layout = seat_maps(travel_date, {bus.id: segment})[bus.id]
 
-    seats = Seat.objects.filter(bus=bus).order_by("seat_number")
     data = {
         "bus_id": bus.id,
         "seats": [
-            {"id": seat.id, "number": seat.seat_number, "is_booked": seat.id in booked_seats}
-            for seat in seats
+            {"id": seat_id, "number": number, "is_booked": flag == "1"}
+            for seat_id, number, flag in zip(layout["ids"], layout["numbers"], layout["booked"])
         ]
     }
     return JsonResponse(data)
 
 
+MAX_SEAT_MAP_BUSES = 100
+
+
+@query_budget(5)
+@require_GET
+def seat_map_batch_api(request):
+    """Seat maps for many buses in one call, e.g. for search results.
+
+    ``?buses=1,2,3&date=YYYY-MM-DD[&source=<stop>&destination=<stop>]``
+    """
+    travel_date = _date_param(request)
+    if not travel_date:
+        return JsonResponse({"error": "A valid date is required"}, status=400)
+
+    try:
+        bus_ids = [int(pk) for pk in request.GET.get("buses", "").split(",") if pk.strip()]
+    except ValueError:
+        return JsonResponse({"error": "Invalid bus id"}, status=400)
+    if not bus_ids or len(bus_ids) > MAX_SEAT_MAP_BUSES:
+        return JsonResponse(
+            {"error": f"Pass between 1 and {MAX_SEAT_MAP_BUSES} bus ids"}, status=400
+        )
+
+    route_by_bus = dict(Bus.objects.filter(pk__in=bus_ids).values_list("pk", "route_id"))
+    segments = _segments_from_stop_names(
+        route_by_bus, request.GET.get("source"), request.GET.get("destination")
+    )
+    maps = seat_maps(travel_date, segments)
+
+    return JsonResponse({
+        "date": travel_date.isoformat(),
+        "buses": {
+            str(bus_id): {
+                "from_sequence": segments[bus_id][0] if segments[bus_id] else None,
+                "to_sequence": segments[bus_id][1] if segments[bus_id] else None,
+                "seats": layout["numbers"],
+                "booked": layout["booked"],
+                "available": layout["available"],
+            }
+            for bus_id, layout in maps.items()
+        },
+    })
+
+
 # ------------------------------
 # PayPal Payment integration
 # ------------------------------
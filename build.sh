@@ -9,3 +9,4 @@ find . -type d -name "__pycache__" -exec rm -rf {} + 2>/dev/null || true
 
 python manage.py collectstatic --noinput
 python manage.py migrate
+python manage.py check_occupancy --fix
@@ -0,0 +1,100 @@
+"""
+Prefix-sum distance and fare tables per route.
+
+Each ``RouteFareTable`` holds the route's stop sequence numbers in order
+together with running totals of ``distance_from_previous_km`` and
+``fare_from_previous``, so the distance or fare between any two stops is
+one subtraction. Tables live in the Django cache and are dropped by the
+``Stop`` signal handlers in ``buses.signals`` whenever a stop changes.
+"""
+from bisect import bisect_right
+from decimal import Decimal
+from itertools import accumulate
+
+from django.core.cache import cache
+
+CACHE_KEY = 'buses:fare-table:{route_id}'
+ZERO = Decimal('0')
+
+
+class RouteFareTable:
+    def __init__(self, route_id, stops):
+        """``stops`` is an ordered iterable of (sequence, distance, fare)."""
+        stops = list(stops)
+        self.route_id = route_id
+        self.sequences = [seq for seq, _, _ in stops]
+        self.distances = [ZERO, *accumulate(distance for _, distance, _ in stops)]
+        self.fares = [ZERO, *accumulate(fare for _, _, fare in stops)]
+
+    @classmethod
+    def build(cls, route_id):
+        from .models import Stop
+
+        return cls(
+            route_id,
+            Stop.objects.filter(route_id=route_id)
+            .order_by('sequence_number')
+            .values_list('sequence_number', 'distance_from_previous_km', 'fare_from_previous'),
+        )
+
+    def _position(self, sequence_number):
+        # Number of stops whose sequence is <= sequence_number
+        return bisect_right(self.sequences, sequence_number)
+
+    def between(self, from_seq, to_seq):
+        """(distance_km, fare per seat) for stops in (from_seq, to_seq]."""
+        start, end = self._position(from_seq), self._position(to_seq)
+        if end <= start:
+            return ZERO, ZERO
+        return (
+            self.distances[end] - self.distances[start],
+            self.fares[end] - self.fares[start],
+        )
+
+    @property
+    def total_distance(self):
+        return self.distances[-1]
+
+    @property
+    def first_sequence(self):
+        return self.sequences[0] if self.sequences else None
+
+    @property
+    def last_sequence(self):
+        return self.sequences[-1] if self.sequences else None
+
+
+def fare_table(route_id):
+    key = CACHE_KEY.format(route_id=route_id)
+    table = cache.get(key)
+    if table is None:
+        table = RouteFareTable.build(route_id)
+        cache.set(key, table, None)
+    return table
+
+
+def fare_tables(route_ids):
+    """{route_id: table} for many routes: one cache round trip, one query for the misses."""
+    from .models import Stop
+
+    keys = {route_id: CACHE_KEY.format(route_id=route_id) for route_id in route_ids}
+    cached = cache.get_many(keys.values())
+    tables = {route_id: cached[key] for route_id, key in keys.items() if key in cached}
+    missing = [route_id for route_id in keys if route_id not in tables]
+    if missing:
+        stops = {route_id: [] for route_id in missing}
+        rows = (
+            Stop.objects.filter(route_id__in=missing)
+            .order_by('route_id', 'sequence_number')
+            .values_list('route_id', 'sequence_number', 'distance_from_previous_km', 'fare_from_previous')
+        )
+        for route_id, *stop in rows:
+            stops[route_id].append(stop)
+        built = {route_id: RouteFareTable(route_id, stops[route_id]) for route_id in missing}
+        cache.set_many({keys[route_id]: table for route_id, table in built.items()}, None)
+        tables.update(built)
+    return tables
+
+
+def invalidate(route_id):
+    cache.delete(CACHE_KEY.format(route_id=route_id))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from buses import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the stop-name search index from routes and stops."
+
+    def handle(self, *args, **options):
+        rows = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {rows} search token(s)."))
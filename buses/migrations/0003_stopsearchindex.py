@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from buses.search import ROUTE_DESTINATION_SEQUENCE, ROUTE_SOURCE_SEQUENCE, tokens
+
+
+def build_search_index(apps, schema_editor):
+    Route = apps.get_model('buses', 'Route')
+    Stop = apps.get_model('buses', 'Stop')
+    StopSearchIndex = apps.get_model('buses', 'StopSearchIndex')
+
+    rows = []
+    for route in Route.objects.all().iterator():
+        for name, seq in ((route.source, ROUTE_SOURCE_SEQUENCE), (route.destination, ROUTE_DESTINATION_SEQUENCE)):
+            rows.extend(StopSearchIndex(token=token, route_id=route.pk, sequence_number=seq) for token in tokens(name))
+    for stop in Stop.objects.all().iterator():
+        rows.extend(
+            StopSearchIndex(token=token, route_id=stop.route_id, stop_id=stop.pk, sequence_number=stop.sequence_number)
+            for token in tokens(stop.name)
+        )
+    StopSearchIndex.objects.bulk_create(rows, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0002_alter_performancemetrics_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StopSearchIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+                ('sequence_number', models.IntegerField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_entries', to='buses.route')),
+                ('stop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_entries', to='buses.stop')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['token', 'route', 'sequence_number'], name='stop_search_token_idx')],
+            },
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
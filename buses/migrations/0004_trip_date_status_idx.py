@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0003_stopsearchindex'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['date', 'status'], name='trip_date_status_idx'),
+        ),
+    ]
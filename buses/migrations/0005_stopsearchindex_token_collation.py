@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def set_collation(collation):
+    def run(apps, schema_editor):
+        # buses.search.token_filter compares tokens by code point. SQLite's
+        # default BINARY collation already does; PostgreSQL's default
+        # collation may not, and ALTER ... TYPE rebuilds the index with it
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(
+                f'ALTER TABLE buses_stopsearchindex ALTER COLUMN token TYPE varchar(100) COLLATE "{collation}"'
+            )
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0004_trip_date_status_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_collation('C'), set_collation('default')),
+    ]
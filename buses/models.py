@@ -14,9 +14,9 @@ class Route(models.Model):
 
     @property
     def total_distance_km(self):
-        return self.stops.aggregate(
-            total=models.Sum('distance_from_previous_km')
-        )['total'] or 0
+        from .fares import fare_table
+
+        return fare_table(self.pk).total_distance
 
     class Meta:
         ordering = ['source', 'destination']
@@ -55,6 +55,33 @@ class Stop(models.Model):
         unique_together = ['route', 'sequence_number']
 
 
+class StopSearchIndex(models.Model):
+    """Normalised stop-name token → (route, sequence). See ``buses.search``."""
+    # "C" collation on PostgreSQL (migration 0005), for search.token_filter's ranges
+    token = models.CharField(max_length=100)
+    route = models.ForeignKey(
+        Route,
+        on_delete=models.CASCADE,
+        related_name='search_entries'
+    )
+    stop = models.ForeignKey(
+        Stop,
+        on_delete=models.CASCADE,
+        related_name='search_entries',
+        null=True,
+        blank=True
+    )
+    sequence_number = models.IntegerField()
+
+    def __str__(self):
+        return f"{self.token} → route {self.route_id} #{self.sequence_number}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['token', 'route', 'sequence_number'], name='stop_search_token_idx'),
+        ]
+
+
 class Bus(models.Model):
     BUS_TYPE_CHOICES = [
         ('ac', 'AC'),
@@ -99,21 +126,14 @@ class Bus(models.Model):
 
     # ✅ SEGMENT-WISE SEAT AVAILABILITY
     def seats_available_between(self, from_stop, to_stop, date):
-        from bookings.models import Booking
-
-        overlapping = Booking.objects.filter(
-            bus=self,
-            travel_date=date,
-            status__in=['pending', 'confirmed'],
-            from_stop__sequence_number__lt=to_stop.sequence_number,
-            to_stop__sequence_number__gt=from_stop.sequence_number,
-        )
+        from bookings import occupancy
 
-        booked = overlapping.aggregate(
-            models.Sum('seats_booked')
-        )['seats_booked__sum'] or 0
-
-        return max(self.total_seats - booked, 0)
+        return occupancy.seats_available(
+            self,
+            date,
+            from_stop.sequence_number,
+            to_stop.sequence_number,
+        )
 
     class Meta:
         verbose_name_plural = "Buses"
@@ -149,6 +169,9 @@ class Trip(models.Model):
     class Meta:
         unique_together = ['bus', 'date']
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['date', 'status'], name='trip_date_status_idx'),
+        ]
 
 
 class PerformanceMetrics(models.Model):
@@ -0,0 +1,196 @@
+"""
+Stop-name search index.
+
+``StopSearchIndex`` maps normalised stop-name tokens to (route, sequence
+number) so "A to B" can be answered with one indexed join: every route
+where a stop matching A comes before a stop matching B. Each stop is
+indexed under its full normalised name and under each word of it; the
+route's own source and destination are indexed as pseudo-stops before
+the first and after the last stop so routes without stops stay findable.
+
+Rows are kept current by the ``Route``/``Stop`` signal handlers in
+``buses.signals``; ``manage.py rebuild_search_index`` rebuilds them.
+"""
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q, Subquery, Value
+
+ROUTE_SOURCE_SEQUENCE = 0
+ROUTE_DESTINATION_SEQUENCE = 2 ** 31 - 1
+TOKEN_MAX_LENGTH = 100
+
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text):
+    """Lower-case, accent-free, single-spaced alphanumerics."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_ALNUM.sub(' ', text.lower()).strip()[:TOKEN_MAX_LENGTH]
+
+
+def tokens(name):
+    key = normalize(name)
+    if not key:
+        return set()
+    return {key, *(word for word in key.split() if len(word) > 1)}
+
+
+def token_filter(query, prefix=True, field='token'):
+    """Q matching ``query`` exactly, or as a prefix via an index-friendly range.
+
+    The range ends at ``query`` followed by U+FFFF, which bounds every
+    token starting with ``query`` only under code-point ordering. SQLite
+    compares that way by default; on PostgreSQL migration 0005 gives the
+    token column the "C" collation, since a linguistic one can sort
+    U+FFFF anywhere (or ignore it) and drop matches.
+    """
+    key = normalize(query)
+    if not prefix:
+        return Q(**{field: key})
+    return Q(**{f'{field}__gte': key, f'{field}__lt': key + '\uffff'})
+
+
+def entries_for_route(route_id, source, destination, stops):
+    """Index rows for a route; ``stops`` yields (stop_id, name, sequence_number)."""
+    from .models import StopSearchIndex
+
+    rows = [
+        StopSearchIndex(token=token, route_id=route_id, sequence_number=seq)
+        for name, seq in ((source, ROUTE_SOURCE_SEQUENCE), (destination, ROUTE_DESTINATION_SEQUENCE))
+        for token in tokens(name)
+    ]
+    rows.extend(
+        StopSearchIndex(token=token, route_id=route_id, stop_id=stop_id, sequence_number=seq)
+        for stop_id, name, seq in stops
+        for token in tokens(name)
+    )
+    return rows
+
+
+def reindex_route(route):
+    from .models import StopSearchIndex
+
+    rows = entries_for_route(
+        route.pk,
+        route.source,
+        route.destination,
+        route.stops.values_list('pk', 'name', 'sequence_number'),
+    )
+    with transaction.atomic():
+        StopSearchIndex.objects.filter(route_id=route.pk).delete()
+        StopSearchIndex.objects.bulk_create(rows)
+
+
+def reindex_stop(stop):
+    from .models import StopSearchIndex
+
+    with transaction.atomic():
+        StopSearchIndex.objects.filter(stop_id=stop.pk).delete()
+        StopSearchIndex.objects.bulk_create(
+            entries_for_route(stop.route_id, '', '', [(stop.pk, stop.name, stop.sequence_number)])
+        )
+
+
+def rebuild(batch_size=5000):
+    """Rebuild the whole index; returns the number of rows written."""
+    from .models import Route, Stop, StopSearchIndex
+
+    stops_by_route = {}
+    for route_id, stop_id, name, seq in Stop.objects.values_list(
+        'route_id', 'pk', 'name', 'sequence_number'
+    ).iterator():
+        stops_by_route.setdefault(route_id, []).append((stop_id, name, seq))
+
+    written = 0
+    with transaction.atomic():
+        StopSearchIndex.objects.all().delete()
+        batch = []
+        for route_id, source, destination in Route.objects.values_list(
+            'pk', 'source', 'destination'
+        ).iterator():
+            batch.extend(entries_for_route(
+                route_id, source, destination, stops_by_route.get(route_id, [])
+            ))
+            if len(batch) >= batch_size:
+                StopSearchIndex.objects.bulk_create(batch, batch_size=batch_size)
+                written += len(batch)
+                batch = []
+        StopSearchIndex.objects.bulk_create(batch, batch_size=batch_size)
+        written += len(batch)
+    return written
+
+
+# -----------------------------
+# QUERIES
+# -----------------------------
+def origin_matches(origin, destination=None, prefix=True):
+    """Index rows matching ``origin`` that have a ``destination`` match further along."""
+    from .models import StopSearchIndex
+
+    matches = StopSearchIndex.objects.filter(token_filter(origin, prefix))
+    if destination:
+        later = StopSearchIndex.objects.filter(
+            token_filter(destination, prefix),
+            route=OuterRef('route'),
+            sequence_number__gt=OuterRef('sequence_number'),
+        )
+        matches = matches.filter(Exists(later))
+    return matches
+
+
+def destination_matches(destination, prefix=True):
+    from .models import StopSearchIndex
+
+    return StopSearchIndex.objects.filter(token_filter(destination, prefix))
+
+
+def matching_route_ids(origin='', destination='', prefix=True):
+    """Route ids served between ``origin`` and ``destination`` (either may be blank).
+
+    Returns None when neither is given, meaning "no stop filter".
+    """
+    if normalize(origin):
+        return origin_matches(
+            origin, destination if normalize(destination) else None, prefix
+        ).values('route_id')
+    if normalize(destination):
+        return destination_matches(destination, prefix).values('route_id')
+    return None
+
+
+def segment_annotations(origin='', destination='', prefix=True, route_field='route'):
+    """Annotations giving each row's journey as ``origin_seq``/``destination_seq``.
+
+    The tightest matching segment is used: the last origin match that still
+    has a destination after it, then the first destination after that.
+    Blank ends fall back to the route's pseudo source/destination.
+    """
+    from .models import StopSearchIndex
+
+    if normalize(origin):
+        origin_seq = Subquery(
+            origin_matches(origin, destination if normalize(destination) else None, prefix)
+            .filter(route=OuterRef(route_field))
+            .order_by('-sequence_number')
+            .values('sequence_number')[:1]
+        )
+    else:
+        origin_seq = Value(ROUTE_SOURCE_SEQUENCE)
+
+    if normalize(destination):
+        destination_seq = Subquery(
+            StopSearchIndex.objects.filter(
+                token_filter(destination, prefix),
+                route=OuterRef(route_field),
+                sequence_number__gt=OuterRef('origin_seq'),
+            )
+            .order_by('sequence_number')
+            .values('sequence_number')[:1]
+        )
+    else:
+        destination_seq = Value(ROUTE_DESTINATION_SEQUENCE)
+
+    return {'origin_seq': origin_seq, 'destination_seq': destination_seq}
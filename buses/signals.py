@@ -0,0 +1,23 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import fares, search
+from .models import Route, Stop
+
+
+@receiver(post_save, sender=Stop)
+@receiver(post_delete, sender=Stop)
+def invalidate_fare_table(sender, instance, **kwargs):
+    fares.invalidate(instance.route_id)
+
+
+@receiver(post_save, sender=Stop)
+def index_stop(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.reindex_stop(instance)
+
+
+@receiver(post_save, sender=Route)
+def index_route(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.reindex_route(instance)
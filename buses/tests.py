@@ -1,3 +1,198 @@
+import datetime
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from bookings import occupancy
+from bookings.tests import TRAVEL_DATE, make_bus, new_booking, stop
+
+from . import search
+from .models import Bus, Route, Stop, StopSearchIndex
+
+
+class FarePreviewApiTests(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        self.url = reverse('buses:fare_api', args=[self.bus.pk])
+
+    def test_fare_between_stops(self):
+        response = self.client.get(self.url, {
+            'from_stop': stop(self.bus, 2).pk, 'to_stop': stop(self.bus, 4).pk, 'seats': 3,
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['from_sequence'], data['to_sequence']), (2, 4))
+        self.assertEqual((data['distance_km'], data['fare_per_seat'], data['estimated_fare']), (20, 100, 300))
+
+    def test_whole_route_by_default(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual((data['from_sequence'], data['to_sequence'], data['seats']), (1, 4, 1))
+
+    def test_stop_names(self):
+        params = {'source': stop(self.bus, 1).name, 'destination': stop(self.bus, 2).name.lower()}
+        data = self.client.get(self.url, params).json()
+        self.assertEqual((data['from_sequence'], data['to_sequence']), (1, 2))
+
+    def test_invalid_stop_id(self):
+        for params in ({'from_stop': 'abc'}, {'to_stop': '1.5'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {"error": "Invalid stop id"})
+
+    def test_unknown_stop(self):
+        other = make_bus(number='T-2')
+        response = self.client.get(self.url, {'from_stop': stop(other, 1).pk})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stops_out_of_order(self):
+        response = self.client.get(self.url, {'from_stop': stop(self.bus, 3).pk, 'to_stop': stop(self.bus, 2).pk})
+        self.assertEqual(response.status_code, 400)
+
+
+class BusSearchViewTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='passenger')
+        # Same stop names on every route, so each search finds all three
+        self.early, self.middle, self.late = (make_bus(number=f'S-{n}') for n in range(3))
+        for bus, hour in ((self.early, 6), (self.middle, 9), (self.late, 14)):
+            Bus.objects.filter(pk=bus.pk).update(departure_time=datetime.time(hour))
+        new_booking(user, self.early, 1, 2, seats=9, status='confirmed').save()
+        new_booking(user, self.middle, 2, 4, seats=4, status='confirmed').save()
+
+    def search(self, source, destination, **params):
+        response = self.client.get(reverse('buses:search'), {
+            'source': source, 'destination': destination, 'date': TRAVEL_DATE.isoformat(), **params,
+        })
+        self.assertEqual(response.status_code, 200)
+        return [(bus.pk, bus.available_seats) for bus in response.context['buses']]
+
+    def expected(self, from_seq, to_seq, *buses):
+        return [(bus.pk, occupancy.seats_available(bus, TRAVEL_DATE, from_seq, to_seq)) for bus in buses]
+
+    def test_available_seats_are_for_the_searched_segment(self):
+        self.assertEqual(
+            self.search("Stop 2", "Stop 4", sort='departure'),
+            self.expected(2, 4, self.early, self.middle, self.late),
+        )
+        self.assertEqual(
+            self.search("Stop 1", "Stop 2", sort='departure'),
+            self.expected(1, 2, self.early, self.middle, self.late),
+        )
+        self.assertEqual(
+            self.expected(1, 2, self.early, self.middle, self.late),
+            [(self.early.pk, 1), (self.middle.pk, 10), (self.late.pk, 10)],
+        )
+
+    def test_another_date_is_empty(self):
+        response = self.client.get(reverse('buses:search'), {
+            'source': "Stop 1", 'destination': "Stop 2", 'date': (TRAVEL_DATE + datetime.timedelta(days=1)).isoformat(),
+        })
+        self.assertEqual({bus.available_seats for bus in response.context['buses']}, {10})
+
+    def test_min_seats(self):
+        self.assertEqual(
+            self.search("Stop 2", "Stop 4", sort='departure', min_seats=7),
+            [(self.early.pk, 10), (self.late.pk, 10)],
+        )
+        self.assertEqual(len(self.search("Stop 2", "Stop 4", min_seats='lots')), 3)
+
+    def test_sort_orders(self):
+        self.assertEqual(
+            self.search("Stop 2", "Stop 4", sort='seats_asc'),
+            [(self.middle.pk, 6), (self.early.pk, 10), (self.late.pk, 10)],
+        )
+        self.assertEqual(
+            self.search("Stop 2", "Stop 4", sort='seats_desc'),
+            [(self.early.pk, 10), (self.late.pk, 10), (self.middle.pk, 6)],
+        )
+        self.assertEqual(
+            [pk for pk, _ in self.search("Stop 1", "Stop 3", sort='departure')],
+            [self.early.pk, self.middle.pk, self.late.pk],
+        )
+
+    def test_results_load_seat_maps_in_one_batch(self):
+        response = self.client.get(reverse('buses:search'), {'source': "Stop 2", 'destination': "Stop 4"})
+        self.assertContains(response, f'data-seat-map-url="{reverse("bookings:seat_map_batch_api")}"')
+        # Without a date the page searches today, and so must the seat maps
+        self.assertContains(response, f'data-date="{timezone.now().date().isoformat()}"')
+        for bus in (self.early, self.middle, self.late):
+            self.assertContains(response, f'<div class="seat-strip" data-bus-id="{bus.pk}">', count=1)
+        self.assertContains(response, 'js/search_seats.js')
+
+
+class StopSearchIndexTests(TestCase):
+    def setUp(self):
+        self.route = Route.objects.create(name="Deccan Line", source="Swargate Depot", destination="Pimpri Chowk")
+        self.stops = [
+            Stop.objects.create(route=self.route, name=name, latitude=18.5, longitude=73.8, sequence_number=seq)
+            for seq, name in enumerate(["Swargate", "Shivaji Nagar", "Pimpri"], start=1)
+        ]
+
+    def tokens(self, **filters):
+        return set(StopSearchIndex.objects.filter(route=self.route, **filters).values_list('token', flat=True))
+
+    def routes(self, origin='', destination='', prefix=True):
+        return list(search.matching_route_ids(origin, destination, prefix).values_list('route_id', flat=True).distinct())
+
+    def test_stop_save_and_delete_reindex(self):
+        shivaji = self.stops[1]
+        self.assertEqual(self.tokens(stop=shivaji), {'shivaji nagar', 'shivaji', 'nagar'})
+
+        shivaji.name = "Deccan Gymkhana"
+        shivaji.save()
+        self.assertEqual(self.tokens(stop=shivaji), {'deccan gymkhana', 'deccan', 'gymkhana'})
+        self.assertEqual(self.routes('shivaji'), [])
+
+        shivaji.delete()
+        self.assertEqual(self.routes('deccan'), [])
+
+    def test_route_save_and_delete_reindex(self):
+        self.assertEqual(self.tokens(stop__isnull=True), {'swargate depot', 'swargate', 'depot', 'pimpri chowk', 'pimpri', 'chowk'})
+        self.route.destination = "Nigdi"
+        self.route.save()
+        self.assertIn('nigdi', self.tokens(stop__isnull=True))
+        self.assertNotIn('chowk', self.tokens())
+
+        self.route.delete()
+        self.assertFalse(StopSearchIndex.objects.exists())
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.routes('shiv'), [self.route.pk])
+        self.assertEqual(self.routes('Shivaji  Nagar!'), [self.route.pk])
+        self.assertEqual(self.routes('nag'), [self.route.pk])
+        self.assertEqual(self.routes('shiv', prefix=False), [])
+        self.assertEqual(self.routes('shivaji', prefix=False), [self.route.pk])
+        self.assertEqual(self.routes('hivaji'), [])
+        self.assertIsNone(search.matching_route_ids('', ' - '))
+
+    def test_origin_comes_before_destination(self):
+        self.assertEqual(self.routes('swargate', 'shivaji'), [self.route.pk])
+        self.assertEqual(self.routes('shivaji', 'pimpri'), [self.route.pk])
+        self.assertEqual(self.routes('shivaji', 'swargate'), [])
+        self.assertEqual(self.routes('pimpri', 'shivaji'), [])
+
+    def test_segment_is_the_tightest_match(self):
+        route = Route.objects.annotate(**search.segment_annotations('swar', 'pimp', route_field='pk')).get(pk=self.route.pk)
+        self.assertEqual((route.origin_seq, route.destination_seq), (1, 3))
+
+    def test_rebuild(self):
+        def rows():
+            return set(StopSearchIndex.objects.values_list('token', 'route_id', 'stop_id', 'sequence_number'))
+
+        before = rows()
+        StopSearchIndex.objects.all().delete()
+        self.assertEqual(search.rebuild(), len(before))
+        self.assertEqual(rows(), before)
 
-# Create your tests here.
+    @skipUnless(connection.vendor == 'postgresql', "needs PostgreSQL")
+    def test_token_compares_by_code_point(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT collation_name FROM information_schema.columns "
+                "WHERE table_name = 'buses_stopsearchindex' AND column_name = 'token'"
+            )
+            self.assertEqual(cursor.fetchone()[0], 'C')
@@ -5,29 +5,51 @@ from django.http import JsonResponse
 from django.views.generic import ListView, DetailView
 from django.utils import timezone
 from django.db import models
+from django.utils.dateparse import parse_date
 from datetime import datetime
 from .models import Bus, Route, Stop, Trip
+from .fares import fare_table
+from . import search
+from bookings.occupancy import annotate_available_seats
 
 
 class BusSearchView(ListView):
     model = Bus
     template_name = 'buses/search.html'
     context_object_name = 'buses'
-    
+
+    SORT_ORDERS = {
+        'departure': ['departure_time'],
+        'seats_desc': ['-available_seats', 'departure_time'],
+        'seats_asc': ['available_seats', 'departure_time'],
+    }
+
+    def get_travel_date(self):
+        return parse_date(self.request.GET.get('date', '')) or timezone.now().date()
+
     def get_queryset(self):
         queryset = Bus.objects.filter(is_active=True).select_related('route', 'driver')
         
         source = self.request.GET.get('source', '')
         destination = self.request.GET.get('destination', '')
-        travel_date = self.request.GET.get('date', '')
         bus_type = self.request.GET.get('bus_type', '')
+        sort = self.request.GET.get('sort', '')
+        min_seats = self.request.GET.get('min_seats', '')
         
-        if source:
-            queryset = queryset.filter(route__source__icontains=source)
-        if destination:
-            queryset = queryset.filter(route__destination__icontains=destination)
+        route_ids = search.matching_route_ids(source, destination)
+        if route_ids is not None:
+            queryset = queryset.filter(route__in=route_ids)
         if bus_type:
             queryset = queryset.filter(bus_type=bus_type)
+
+        # Seats left on the searched segment, from the occupancy store
+        queryset = queryset.annotate(**search.segment_annotations(source, destination))
+        queryset = annotate_available_seats(queryset, self.get_travel_date())
+
+        if min_seats.isdigit():
+            queryset = queryset.filter(available_seats__gte=int(min_seats))
+        if sort in self.SORT_ORDERS:
+            queryset = queryset.order_by(*self.SORT_ORDERS[sort])
         
         return queryset
     
@@ -39,7 +61,10 @@ class BusSearchView(ListView):
             'destination': self.request.GET.get('destination', ''),
             'date': self.request.GET.get('date', ''),
             'bus_type': self.request.GET.get('bus_type', ''),
+            'sort': self.request.GET.get('sort', ''),
+            'min_seats': self.request.GET.get('min_seats', ''),
         }
+        context['travel_date'] = self.get_travel_date()
         return context
 
 
@@ -99,25 +124,57 @@ def get_available_seats(request, bus_id):
 # ✅ NEW API 1: Fare Preview API
 # ==================================================
 def fare_preview_api(request, bus_id):
-    bus = get_object_or_404(Bus, pk=bus_id)
+    bus = get_object_or_404(Bus.objects.select_related('route'), pk=bus_id)
 
     source = request.GET.get('source')
     destination = request.GET.get('destination')
 
-    base_fare = getattr(bus, "base_fare", 0)
+    try:
+        seats = max(int(request.GET.get('seats', 1)), 1)
+    except ValueError:
+        return JsonResponse({"error": "Invalid seat count"}, status=400)
+
+    try:
+        from_stop_id = int(request.GET['from_stop']) if request.GET.get('from_stop') else None
+        to_stop_id = int(request.GET['to_stop']) if request.GET.get('to_stop') else None
+    except ValueError:
+        return JsonResponse({"error": "Invalid stop id"}, status=400)
+
+    if not bus.route_id:
+        return JsonResponse({"error": "Bus has no route"}, status=400)
+
+    table = fare_table(bus.route_id)
+    stops = Stop.objects.filter(route_id=bus.route_id)
+
+    def resolve(stop_id, name, default_seq):
+        if stop_id is not None:
+            stop = stops.filter(pk=stop_id).first()
+        elif name:
+            stop = stops.filter(name__iexact=name.strip()).first()
+        else:
+            return default_seq
+        return stop.sequence_number if stop else None
+
+    from_seq = resolve(from_stop_id, source, table.first_sequence)
+    to_seq = resolve(to_stop_id, destination, table.last_sequence)
 
-    # Simple fallback logic (safe even if stop pricing not implemented)
-    multiplier = 1
-    if source and destination and source != destination:
-        multiplier = 1.0
+    if from_seq is None or to_seq is None:
+        return JsonResponse({"error": "Stop not found on this route"}, status=404)
+    if from_seq >= to_seq:
+        return JsonResponse({"error": "Destination stop must be after boarding stop"}, status=400)
 
-    estimated_fare = base_fare * multiplier
+    distance, fare = table.between(from_seq, to_seq)
 
     return JsonResponse({
         "bus_id": bus.id,
         "source": source,
         "destination": destination,
-        "estimated_fare": estimated_fare
+        "from_sequence": from_seq,
+        "to_sequence": to_seq,
+        "seats": seats,
+        "distance_km": float(distance),
+        "fare_per_seat": float(fare),
+        "estimated_fare": float(fare * seats),
     })
 
 
@@ -11,16 +11,27 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
-import tracking.routing
+from django.urls import re_path
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bustrack.settings')
 
+# Populates the app registry, so it must run before anything that imports models
+django_asgi_app = get_asgi_application()
+
+import tracking.routing  # noqa: E402
+import users.routing  # noqa: E402
+from bustrack import metrics  # noqa: E402
+
+metrics.start_exporter()
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": URLRouter(
+        tracking.routing.http_urlpatterns + [re_path(r'', django_asgi_app)]
+    ),
     "websocket": AuthMiddlewareStack(
         URLRouter(
-            tracking.routing.websocket_urlpatterns
+            tracking.routing.websocket_urlpatterns + users.routing.websocket_urlpatterns
         )
     ),
 })
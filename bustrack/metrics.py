@@ -0,0 +1,377 @@
+"""
+In-process metrics, exposed in the Prometheus text format at ``/metrics/``.
+
+Counters, gauges and histograms are declared once at import with
+``counter()``, ``gauge()`` and ``histogram()`` and updated from the hot
+paths: request latency and DB time per URL name (``MetricsMiddleware``),
+GPS pings by outcome and batch writes (``tracking.ingest``), fan-out of
+each broadcast (``tracking.broadcast``), and open WebSockets and send
+latency per consumer (``tracking.consumers``).
+
+Incrementing a counter or observing a histogram appends to a deque,
+which needs no lock under CPython. The values are folded into totals
+under the series' lock when the metrics are read, or once every
+``FOLD_EVERY`` updates. Gauges change rarely and take the lock directly.
+
+Each process has its own registry. When ``settings.METRICS_DIR`` is set
+(``manage.py runworkers`` sets it for its workers), every server process
+writes a snapshot to ``<dir>/<pid>.json`` every ``FLUSH_INTERVAL``
+seconds and at exit, and ``render`` adds up the snapshots of all
+processes. Counters and histograms include processes that have exited,
+so rates stay continuous across restarts; gauges only count live ones.
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+FOLD_EVERY = 1024
+FLUSH_INTERVAL = 5.0
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+# -----------------------------
+# SERIES
+# -----------------------------
+class _FoldedSeries:
+    """Updates queue up in a deque and are applied under the lock in batches."""
+
+    def __init__(self):
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def _add(self, value):
+        self._pending.append(value)
+        if len(self._pending) >= FOLD_EVERY:
+            self._fold()
+
+    def _fold(self):
+        with self._lock:
+            while self._pending:
+                self._apply(self._pending.popleft())
+
+
+class _CounterSeries(_FoldedSeries):
+    def __init__(self, buckets=None):
+        super().__init__()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self._add(amount)
+
+    def _apply(self, amount):
+        self.value += amount
+
+    def snapshot(self):
+        self._fold()
+        return self.value
+
+
+class _HistogramSeries(_FoldedSeries):
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._add(value)
+
+    def _apply(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        self._fold()
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class _GaugeSeries:
+    def __init__(self, buckets=None):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function):
+        """Read the value from ``function()`` whenever metrics are collected."""
+        self.function = function
+
+    def snapshot(self):
+        return float(self.function()) if self.function else self.value
+
+
+# -----------------------------
+# METRICS
+# -----------------------------
+class Metric:
+    series_class = {'counter': _CounterSeries, 'gauge': _GaugeSeries, 'histogram': _HistogramSeries}
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS) if kind == 'histogram' else None
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                series = self._series.setdefault(key, self.series_class[self.kind](self.buckets))
+        return series
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def snapshot(self):
+        return {
+            'type': self.kind,
+            'help': self.documentation,
+            'labels': list(self.labelnames),
+            'buckets': list(self.buckets) if self.buckets else None,
+            'samples': [[list(key), series.snapshot()] for key, series in list(self._series.items())],
+        }
+
+
+def _register(kind, name, documentation, labelnames=(), buckets=None):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Metric(kind, name, documentation, labelnames, buckets)
+        elif metric.kind != kind:
+            raise ValueError(f"{name} is already registered as a {metric.kind}")
+    return metric
+
+
+def counter(name, documentation, labelnames=()):
+    return _register('counter', name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return _register('gauge', name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=None):
+    return _register('histogram', name, documentation, labelnames, buckets)
+
+
+# -----------------------------
+# COLLECTION AND EXPOSITION
+# -----------------------------
+def snapshot():
+    return {'pid': os.getpid(), 'metrics': {name: metric.snapshot() for name, metric in list(_registry.items())}}
+
+
+def _metrics_dir():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    return Path(directory) if directory else None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_snapshot():
+    directory = _metrics_dir()
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{os.getpid()}.json'
+    temporary = path.with_suffix('.tmp')
+    temporary.write_text(json.dumps(snapshot()))
+    os.replace(temporary, path)
+
+
+def _snapshots():
+    """(snapshot, alive) of this process and of every other process in ``METRICS_DIR``."""
+    yield snapshot(), True
+    directory = _metrics_dir()
+    if directory is None or not directory.is_dir():
+        return
+    for path in directory.glob('*.json'):
+        try:
+            pid = int(path.stem)
+            if pid == os.getpid():
+                continue
+            data = json.loads(path.read_text())
+        except (ValueError, OSError):
+            continue    # half-written or removed meanwhile
+        yield data, _alive(pid)
+
+
+def _merge(snapshots):
+    merged = {}
+    for data, alive in snapshots:
+        for name, metric in data['metrics'].items():
+            if metric['type'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, {**metric, 'samples': {}})
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                current = target['samples'].get(key)
+                if metric['type'] != 'histogram':
+                    target['samples'][key] = (current or 0) + value
+                elif current is None:
+                    target['samples'][key] = {'counts': list(value['counts']), 'sum': value['sum']}
+                else:
+                    current['counts'] = [a + b for a, b in zip(current['counts'], value['counts'])]
+                    current['sum'] += value['sum']
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render():
+    """Every metric of every process, in the Prometheus text format."""
+    lines = []
+    for name, metric in sorted(_merge(_snapshots()).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for values, value in sorted(metric['samples'].items()):
+            if metric['type'] != 'histogram':
+                lines.append(f"{name}{_labels(metric['labels'], values)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric['buckets'], '+Inf'], value['counts']):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f"{name}_bucket{_labels(metric['labels'], values, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], values)} {_number(value['sum'])}")
+            lines.append(f"{name}_count{_labels(metric['labels'], values)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+_exporter = None
+
+
+def start_exporter():
+    """Write this process's snapshot to ``METRICS_DIR`` periodically and at exit."""
+    global _exporter
+    if _metrics_dir() is None or _exporter is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                write_snapshot()
+            except OSError:
+                pass
+
+    _exporter = threading.Thread(target=run, name='metrics-exporter', daemon=True)
+    _exporter.start()
+    atexit.register(write_snapshot)
+
+
+# -----------------------------
+# HTTP REQUESTS
+# -----------------------------
+REQUESTS = counter('http_requests_total', 'HTTP requests by URL name, method and status class.',
+                   ['view', 'method', 'status'])
+REQUEST_SECONDS = histogram('http_request_duration_seconds', 'HTTP request latency by URL name.',
+                            ['view', 'method'])
+REQUEST_DB_SECONDS = histogram('http_request_db_seconds', 'Database time per HTTP request by URL name.',
+                               ['view'])
+
+
+def observe_request(view, method, status, seconds, db_seconds=None):
+    method = method if method in METHODS else 'other'
+    REQUESTS.labels(view, method, f'{status // 100}xx').inc()
+    REQUEST_SECONDS.labels(view, method).observe(seconds)
+    if db_seconds is not None:
+        REQUEST_DB_SECONDS.labels(view).observe(db_seconds)
+
+
+class _DatabaseTimer:
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Latency and DB time of every request, labelled with its URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = _DatabaseTimer()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(timer))
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        observe_request(
+            match.view_name if match else 'unmatched',
+            request.method, response.status_code,
+            time.perf_counter() - started, timer.seconds,
+        )
+        return response
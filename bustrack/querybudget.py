@@ -0,0 +1,181 @@
+"""
+Per-request query counting and N+1 detection.
+
+``QueryBudgetMiddleware`` records every statement a request runs: the
+count, the database time and a fingerprint of each statement's shape
+(its SQL before parameters are bound, with ``IN`` lists collapsed).
+A shape that runs ``N_PLUS_ONE_THRESHOLD`` times or more in one request
+is reported as an N+1 suspect; it is almost always a query issued per
+row of a list. A view may declare how many queries it should need with
+``@query_budget(n)``.
+
+Findings are logged and returned in ``X-Query-*`` and ``Server-Timing``
+headers; ``manage.py check_query_budgets`` fails on them. With ``RAISE``
+on (tests) an exceeded budget raises ``QueryBudgetExceeded`` instead.
+Recording is off unless ``settings.QUERY_BUDGET['ENABLED']``;
+``SAMPLE_RATE`` then records only that fraction of requests.
+
+``assert_max_queries`` applies the same checks to a block of code, and
+``QueryBudgetTestMixin`` to the views in an app's tests, so a view that
+grows past its budget or starts an N+1 fails ``manage.py test``.
+"""
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 1.0,
+    'N_PLUS_ONE_THRESHOLD': 3,
+    'DEFAULT_BUDGET': None,
+    'RAISE': False,
+}
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'QUERY_BUDGET', {})}
+
+
+def fingerprint(sql):
+    """The shape of a statement: same for every set of parameters it runs with."""
+    return _WHITESPACE.sub(' ', _IN_LIST.sub('IN (...)', sql)).strip()
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = []       # (fingerprint, seconds)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((fingerprint(sql), time.perf_counter() - started))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time_ms(self):
+        return sum(seconds for _, seconds in self.queries) * 1000
+
+    def duplicates(self):
+        """{fingerprint: times run} for every shape run more than once."""
+        counts = Counter(shape for shape, _ in self.queries)
+        return {shape: n for shape, n in counts.most_common() if n > 1}
+
+    def n_plus_one(self, threshold):
+        return {shape: n for shape, n in self.duplicates().items() if n >= threshold}
+
+    def report(self, budget=None, threshold=None):
+        """Problems found, one line each: budget overrun first, then N+1 suspects."""
+        threshold = threshold or get_config()['N_PLUS_ONE_THRESHOLD']
+        problems = []
+        if budget is not None and self.count > budget:
+            problems.append(f"{self.count} queries, budget {budget}")
+        problems.extend(
+            f"N+1 suspect, {n} times: {shape}" for shape, n in self.n_plus_one(threshold).items()
+        )
+        return problems
+
+
+@contextmanager
+def record(using=None):
+    """Yield a ``QueryStats`` that records every query run on ``using`` (all databases by default)."""
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for alias in [using] if using else connections:
+            stack.enter_context(connections[alias].execute_wrapper(stats))
+        yield stats
+
+
+@contextmanager
+def assert_max_queries(budget, using=None, threshold=None):
+    """Raise ``QueryBudgetExceeded`` if the block runs more than ``budget`` queries or an N+1."""
+    with record(using) as stats:
+        yield stats
+    problems = stats.report(budget, threshold)
+    if problems:
+        raise QueryBudgetExceeded('; '.join(problems))
+
+
+class QueryBudgetTestMixin:
+    """For ``TestCase``: assert that requests stay within their view's ``@query_budget``, without N+1."""
+
+    def assertWithinBudget(self, client, method, path, data=None):
+        from django.test.utils import override_settings
+
+        config = {**get_config(), 'ENABLED': True, 'SAMPLE_RATE': 1.0, 'RAISE': False}
+        with override_settings(QUERY_BUDGET=config):
+            response = getattr(client, method)(path, data or {})
+        self.assertLess(response.status_code, 400, f"{method.upper()} {path}")
+        problems = response.query_stats.report(response.query_budget, config['N_PLUS_ONE_THRESHOLD'])
+        self.assertEqual(problems, [], f"{method.upper()} {path}")
+        return response
+
+    def assertHotPathsWithinBudget(self, namespace):
+        from benchmarks.hotpaths import build_fixture, hot_requests
+
+        requests = hot_requests(build_fixture(), namespace)
+        self.assertTrue(requests, f"no hot requests in {namespace!r}")
+        for client, method, path, data in requests:
+            with self.subTest(path=path, method=method):
+                self.assertWithinBudget(client, method, path, data)
+
+
+def query_budget(budget):
+    """Declare the most queries a view should need."""
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+    return decorator
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_config()
+        if not config['ENABLED'] or random.random() >= config['SAMPLE_RATE']:
+            return self.get_response(request)
+
+        request._query_budget = config['DEFAULT_BUDGET']
+        with record() as stats:
+            response = self.get_response(request)
+
+        budget = request._query_budget
+        problems = stats.report(budget, config['N_PLUS_ONE_THRESHOLD'])
+        response['X-Query-Count'] = str(stats.count)
+        response['X-Query-Duplicates'] = str(sum(n - 1 for n in stats.duplicates().values()))
+        response['Server-Timing'] = f'db;dur={stats.time_ms:.1f}'
+        if budget is not None:
+            response['X-Query-Budget'] = str(budget)
+        # For the test client and manage.py check_query_budgets
+        response.query_stats, response.query_budget = stats, budget
+        if problems:
+            message = f"{request.method} {request.path}: " + '; '.join(problems)
+            if config['RAISE'] and budget is not None and stats.count > budget:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_query_budget'):
+            request._query_budget = getattr(view_func, 'query_budget', request._query_budget)
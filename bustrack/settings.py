@@ -29,11 +29,14 @@ INSTALLED_APPS = [
     'api',
     'channels',
     'routes',
+    'benchmarks',
 ]
 
 MIDDLEWARE = [
+    'bustrack.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'bustrack.querybudget.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -73,6 +76,92 @@ DATABASE_URL = config('DATABASE_URL', default=None)
 if DATABASE_URL:
     DATABASES['default'] = dj_database_url.parse(DATABASE_URL)
 
+# Cache, live tracking state and WebSocket fan-out. Set REDIS_URL to share
+# them between workers (required for runworkers --workers > 1); otherwise
+# each process keeps its own copy and only reaches its own clients.
+REDIS_URL = config('REDIS_URL', default=None)
+
+CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+}
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+TRACKING_STATE_STORE = {
+    'BACKEND': 'tracking.state.LocalStateStore',
+    'OPTIONS': {},
+}
+
+if REDIS_URL:
+    # Fare tables and route geometry versions are invalidated through it
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+    CACHES['tracking'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+    TRACKING_STATE_STORE = {
+        'BACKEND': 'tracking.state.RedisStateStore',
+        'OPTIONS': {'CACHE': 'tracking'},
+    }
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': [REDIS_URL],
+            'capacity': config('CHANNEL_LAYER_CAPACITY', default=1000, cast=int),
+            'expiry': 10,
+        },
+    }
+
+# Driver GPS pings are queued and written in batches (tracking.ingest)
+TRACKING_INGEST = {
+    'ENABLED': config('TRACKING_INGEST_ENABLED', default=True, cast=bool),
+    'BATCH_SIZE': config('TRACKING_INGEST_BATCH_SIZE', default=500, cast=int),
+    'FLUSH_INTERVAL': config('TRACKING_INGEST_FLUSH_INTERVAL', default=1.0, cast=float),
+    'MAX_PENDING': config('TRACKING_INGEST_MAX_PENDING', default=20000, cast=int),
+}
+
+# Admin dashboard counters (users.dashboard); with LIVE, open dashboards get
+# changes over a WebSocket at most once per PUSH_INTERVAL seconds
+ADMIN_DASHBOARD = {
+    'LIVE': config('ADMIN_DASHBOARD_LIVE', default=True, cast=bool),
+    'PUSH_INTERVAL': config('ADMIN_DASHBOARD_PUSH_INTERVAL', default=1.0, cast=float),
+}
+
+# LiveLocation retention tiers, applied daily by manage.py prune_locations
+TRACKING_RETENTION = {
+    'RAW_DAYS': config('TRACKING_RAW_DAYS', default=7, cast=int),
+    'DOWNSAMPLED_DAYS': config('TRACKING_DOWNSAMPLED_DAYS', default=90, cast=int),
+    'BATCH_SIZE': 5000,
+    'PAUSE': 0.05,
+    # Douglas-Peucker tolerance for archived tracks; 0 keeps every ping
+    'SIMPLIFY_METRES': config('TRACKING_SIMPLIFY_METRES', default=5.0, cast=float),
+}
+
+# Live updates are coalesced into one WebSocket frame per group per tick
+# (tracking.broadcast); 0 sends every update on its own
+TRACKING_BROADCAST = {
+    'TICK': config('TRACKING_BROADCAST_TICK', default=0.5, cast=float),
+}
+
+# Per-request query counts and N+1 detection (bustrack.querybudget); off
+# unless enabled, and then only for QUERY_BUDGET_SAMPLE_RATE of requests
+QUERY_BUDGET = {
+    'ENABLED': config('QUERY_BUDGET_ENABLED', default=DEBUG, cast=bool),
+    'SAMPLE_RATE': config('QUERY_BUDGET_SAMPLE_RATE', default=1.0, cast=float),
+    'N_PLUS_ONE_THRESHOLD': 3,
+}
+
+# Prometheus metrics at /metrics/ (bustrack.metrics), for staff or with
+# "Authorization: Bearer $METRICS_TOKEN". With METRICS_DIR set, each
+# server process writes its metrics there and the endpoint sums them all
+METRICS_DIR = config('METRICS_DIR', default=None)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -116,4 +205,6 @@ PAYPAL_MODE = "sandbox"
 
 PAYPAL_CLIENT_ID = config("PAYPAL_CLIENT_ID", default="")
 PAYPAL_CLIENT_SECRET = config("PAYPAL_CLIENT_SECRET", default="")
+# Overrides the PayPal API base URL of PAYPAL_MODE (a stand-in for load tests)
+PAYPAL_ENDPOINT = config("PAYPAL_ENDPOINT", default="")
 
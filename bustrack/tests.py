@@ -0,0 +1,106 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from bookings.tests import make_bus
+from tracking import ingest
+from tracking import state as live_state
+from users.models import UserProfile
+
+from . import metrics
+
+
+class EntryPointTests(SimpleTestCase):
+    def assertImports(self, module):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'bustrack.settings'}
+        result = subprocess.run(
+            [sys.executable, '-c', f'import {module}'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_asgi_imports_in_a_fresh_process(self):
+        self.assertImports('bustrack.asgi')
+
+    def test_wsgi_imports_in_a_fresh_process(self):
+        self.assertImports('bustrack.wsgi')
+
+
+@override_settings(
+    METRICS_TOKEN='scrape-token', METRICS_DIR=None,
+    TRACKING_INGEST={'ENABLED': False}, TRACKING_BROADCAST={'TICK': 0},
+)
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        for reset in (ingest.forget_buses, live_state.reset_store):
+            reset()
+            self.addCleanup(reset)
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def post_ping(self):
+        driver = User.objects.create(username='driver')
+        UserProfile.objects.create(user=driver, role='driver')
+        self.client.force_login(driver)
+        ping = {'bus_id': self.bus.pk, 'latitude': 18.52, 'longitude': 73.85}
+        response = self.client.post(reverse('tracking:update_location'), json.dumps(ping), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.client.logout()
+
+    def test_needs_staff_or_the_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_exposes_request_ingest_and_broadcast_series(self):
+        written = ingest.PINGS.labels(ingest.WRITTEN).snapshot()
+        self.client.get(reverse('buses:detail', args=[self.bus.pk]))
+        self.post_ping()
+        text = self.scrape()
+
+        for line in (
+            '# TYPE http_requests_total counter',
+            'http_requests_total{view="buses:detail",method="GET",status="2xx"}',
+            'http_request_duration_seconds_bucket{view="buses:detail",method="GET",le="+Inf"}',
+            'http_request_db_seconds_count{view="tracking:update_location"}',
+            f'tracking_pings_total{{outcome="written"}} {int(written) + 1}',
+            '# TYPE tracking_ingest_queue_depth gauge',
+            'tracking_broadcast_fanout_messages_count ',
+            'tracking_broadcast_send_seconds_count ',
+        ):
+            self.assertIn(line, text)
+
+    def test_request_labels_stay_low_cardinality(self):
+        other = make_bus(number='T-2')
+        for path in (
+            reverse('buses:detail', args=[self.bus.pk]),
+            reverse('buses:detail', args=[other.pk]),
+            reverse('buses:detail', args=[other.pk]) + '?date=2030-01-15',
+            '/no-such-page/12345/',
+        ):
+            self.client.get(path)
+        self.client.generic('BREW', reverse('buses:search'))
+        text = self.scrape()
+
+        labels = set(re.findall(r'^http_requests_total\{view="([^"]*)",method="([^"]*)"', text, re.M))
+        self.assertIn(('buses:detail', 'GET'), labels)
+        self.assertIn(('unmatched', 'GET'), labels)
+        self.assertIn(('buses:search', 'other'), labels)
+        # URL names only: no raw paths, ids or query strings
+        for view, method in labels:
+            self.assertNotRegex(view, r'[/?\d]')
+            self.assertIn(method, metrics.METHODS | {'other'})
@@ -2,6 +2,8 @@ from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
 
+from .views import metrics_view
+
 urlpatterns = [
     path('django-admin/', admin.site.urls),
     path('', TemplateView.as_view(template_name='home.html'), name='home'),
@@ -11,6 +13,7 @@ urlpatterns = [
     path('bookings/', include('bookings.urls')),
     path('tracking/', include('tracking.urls')),
     path('api/', include('api.urls')),
+    path('metrics/', metrics_view, name='metrics'),
 
     # ✅ ADMIN PANEL
     path('admin-panel/', include([
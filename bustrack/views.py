@@ -0,0 +1,25 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
+
+from users.admin_views import is_admin
+
+from . import metrics
+
+
+def _has_token(request):
+    token = settings.METRICS_TOKEN
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode())
+
+
+# =====================================================
+# PROMETHEUS SCRAPE ENDPOINT (staff or METRICS_TOKEN)
+# =====================================================
+@require_GET
+def metrics_view(request):
+    if not (is_admin(request.user) or _has_token(request)):
+        return JsonResponse({"error": "Admin access required"}, status=403)
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
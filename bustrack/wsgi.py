@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bustrack.settings')
 
 application = get_wsgi_application()
+
+from bustrack import metrics  # noqa: E402
+
+metrics.start_exporter()
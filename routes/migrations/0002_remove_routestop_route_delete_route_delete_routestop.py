@@ -1,6 +1,14 @@
 from django.db import migrations
 
 
+def drop_old_tables(apps, schema_editor):
+    # CASCADE is PostgreSQL syntax; SQLite (the test database) has no
+    # dependent objects to drop and rejects the keyword
+    cascade = ' CASCADE' if schema_editor.connection.vendor == 'postgresql' else ''
+    for table in ('routes_routestop', 'routes_route'):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {table}{cascade}')
+
+
 class Migration(migrations.Migration):
     """
     Route model has been consolidated into buses.models.Route.
@@ -13,11 +21,5 @@ class Migration(migrations.Migration):
     ]
 
     operations = [
-        migrations.RunSQL(
-            sql="""
-                DROP TABLE IF EXISTS routes_routestop CASCADE;
-                DROP TABLE IF EXISTS routes_route CASCADE;
-            """,
-            reverse_sql=migrations.RunSQL.noop,
-        ),
+        migrations.RunPython(drop_old_tables, migrations.RunPython.noop),
     ]
@@ -1,3 +1,12 @@
 from django.test import TestCase
 
-# Create your tests here.
+from benchmarks.plans import QueryPlanTestMixin
+from bustrack.querybudget import QueryBudgetTestMixin
+
+
+class HotPathTests(QueryPlanTestMixin, QueryBudgetTestMixin, TestCase):
+    def test_views_use_indexes(self):
+        self.assertHotPathsUseIndexes('routes')
+
+    def test_views_stay_within_query_budgets(self):
+        self.assertHotPathsWithinBudget('routes')
@@ -5,7 +5,9 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from .forms import RouteForm
+from buses.fares import fare_tables
 from buses.models import Route, Stop
+from bustrack.querybudget import query_budget
 
 
 def _haversine_km(lat1, lon1, lat2, lon2):
@@ -20,10 +22,13 @@ def _haversine_km(lat1, lon1, lat2, lon2):
 
 
 # --- 1. LIST ROUTES (NOW CRASH PROOF) ---
+@query_budget(5)
 def route_list(request):
     try:
         # Get all routes
-        routes = Route.objects.all()
+        routes = list(Route.objects.all())
+        # Load every route's distance table at once instead of one query per row
+        fare_tables([route.pk for route in routes])
         return render(request, 'routes/route_list.html', {'routes': routes})
     except Exception as e:
         # If this page crashes, SHOW THE ERROR
@@ -1,27 +1,30 @@
 document.addEventListener("DOMContentLoaded", function () {
 
-    if (typeof bookingData === "undefined") return;
+    const dataElement = document.getElementById("analytics-data");
+    if (!dataElement) return;
+
+    const filters = document.getElementById("analytics-filters");
+
+    const colours = {
+        pending: "#ffc107",
+        confirmed: "#28a745",
+        cancelled: "#dc3545",
+        completed: "#6c757d",
+        not_started: "#17a2b8",
+        running: "#28a745",
+        delayed: "#ffc107"
+    };
 
     // ------------------------
     // Booking Status Chart
     // ------------------------
-    const bookingLabels = bookingData.map(b => 
-        b.status.charAt(0).toUpperCase() + b.status.slice(1)
-    );
-    const bookingCounts = bookingData.map(b => b.count);
-
-    new Chart(document.getElementById("bookingChart"), {
+    const bookingChart = new Chart(document.getElementById("bookingChart"), {
         type: "doughnut",
         data: {
-            labels: bookingLabels.length ? bookingLabels : ["No Data"],
+            labels: [],
             datasets: [{
-                data: bookingCounts.length ? bookingCounts : [1],
-                backgroundColor: [
-                    "#28a745",
-                    "#ffc107",
-                    "#dc3545",
-                    "#6c757d"
-                ]
+                data: [],
+                backgroundColor: []
             }]
         },
         options: { responsive: true }
@@ -30,24 +33,13 @@ document.addEventListener("DOMContentLoaded", function () {
     // ------------------------
     // Trip Status Chart
     // ------------------------
-    const tripLabels = tripData.map(t =>
-        t.status.replace("_", " ").toUpperCase()
-    );
-    const tripCounts = tripData.map(t => t.count);
-
-    new Chart(document.getElementById("tripChart"), {
+    const tripChart = new Chart(document.getElementById("tripChart"), {
         type: "doughnut",
         data: {
-            labels: tripLabels.length ? tripLabels : ["No Data"],
+            labels: [],
             datasets: [{
-                data: tripCounts.length ? tripCounts : [1],
-                backgroundColor: [
-                    "#17a2b8",
-                    "#28a745",
-                    "#ffc107",
-                    "#dc3545",
-                    "#6c757d"
-                ]
+                data: [],
+                backgroundColor: []
             }]
         },
         options: { responsive: true }
@@ -56,16 +48,13 @@ document.addEventListener("DOMContentLoaded", function () {
     // ------------------------
     // Daily bookings chart
     // ------------------------
-    const dailyLabels = dailyData.map(d => d.date);
-    const dailyCounts = dailyData.map(d => d.count);
-
-    new Chart(document.getElementById("dailyChart"), {
+    const dailyChart = new Chart(document.getElementById("dailyChart"), {
         type: "bar",
         data: {
-            labels: dailyLabels,
+            labels: [],
             datasets: [{
                 label: "Bookings",
-                data: dailyCounts,
+                data: [],
                 backgroundColor: "#e63946"
             }]
         },
@@ -76,4 +65,48 @@ document.addEventListener("DOMContentLoaded", function () {
             }
         }
     });
+
+    function showStatuses(chart, stats, label) {
+        chart.data.labels = stats.length ? stats.map(s => label(s.status)) : ["No Data"];
+        chart.data.datasets[0].data = stats.length ? stats.map(s => s.count) : [1];
+        chart.data.datasets[0].backgroundColor = stats.length
+            ? stats.map(s => colours[s.status] || "#6c757d")
+            : ["#e9ecef"];
+        chart.update();
+    }
+
+    // Every chart is drawn from the daily rollups (users.rollups)
+    function show(data) {
+        showStatuses(bookingChart, data.booking_stats, status =>
+            status.charAt(0).toUpperCase() + status.slice(1)
+        );
+        showStatuses(tripChart, data.trip_stats, status =>
+            status.replace("_", " ").toUpperCase()
+        );
+        dailyChart.data.labels = data.daily_bookings.map(d => d.date);
+        dailyChart.data.datasets[0].data = data.daily_bookings.map(d => d.count);
+        dailyChart.update();
+    }
+
+    show(JSON.parse(dataElement.textContent));
+
+    // ------------------------
+    // Filters: redraw in place instead of reloading the page
+    // ------------------------
+    if (!filters) return;
+
+    filters.addEventListener("submit", async function (event) {
+        event.preventDefault();
+        const params = new URLSearchParams(new FormData(filters));
+        const res = await fetch(`${filters.dataset.url}?${params}`);
+        const data = await res.json();
+        if (!res.ok) {
+            alert(data.error || "Could not load analytics");
+            return;
+        }
+        filters.elements.start.value = data.start;
+        filters.elements.end.value = data.end;
+        history.replaceState(null, "", `?${params}`);
+        show(data);
+    });
 });
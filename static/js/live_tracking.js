@@ -63,10 +63,9 @@ document.addEventListener("DOMContentLoaded", function () {
     const busMarkers = {};
 
     const ws_scheme = window.location.protocol === "https:" ? "wss" : "ws";
-    const socket = new WebSocket(`${ws_scheme}://${window.location.host}/ws/live-buses/`);
+    let retries = 0;
 
-    socket.onmessage = function (event) {
-        const data = JSON.parse(event.data);
+    function showBus(data) {
         const busId = data.bus_id;
         const latlng = [data.latitude, data.longitude];
 
@@ -87,8 +86,33 @@ document.addEventListener("DOMContentLoaded", function () {
                 .addTo(map)
                 .bindPopup(popupContent);
         }
-    };
-
-    socket.onopen = () => console.log("Connected to live bus WebSocket");
-    socket.onclose = () => console.log("Disconnected from live bus WebSocket");
+    }
+
+    function connect() {
+        const socket = new WebSocket(`${ws_scheme}://${window.location.host}/ws/live-buses/`);
+
+        socket.onmessage = function (event) {
+            const data = JSON.parse(event.data);
+            if (data.type === "frame") {
+                // One frame per tick with every bus that moved
+                data.buses.forEach(showBus);
+            } else if (data.bus_id) {
+                showBus(data);
+            }
+        };
+
+        socket.onopen = () => {
+            retries = 0;
+            console.log("Connected to live bus WebSocket");
+        };
+        socket.onclose = () => {
+            // Back off (with jitter) so a worker restart doesn't bring every client back at once
+            const delay = Math.min(30000, 1000 * 2 ** retries) * (0.5 + Math.random() / 2);
+            retries += 1;
+            console.log(`Disconnected from live bus WebSocket, retrying in ${Math.round(delay / 1000)}s`);
+            setTimeout(connect, delay);
+        };
+    }
+
+    connect();
 });
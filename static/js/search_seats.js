@@ -0,0 +1,39 @@
+// Seat maps for every bus on the search results page, fetched from the
+// batch endpoint in as few calls as it allows (it caps buses per call).
+document.addEventListener("DOMContentLoaded", function () {
+    const results = document.getElementById("search-results");
+    if (!results) return;
+
+    const MAX_BUSES_PER_CALL = 100;
+    const strips = {};
+    results.querySelectorAll(".seat-strip").forEach(strip => {
+        strips[strip.dataset.busId] = strip;
+    });
+    const busIds = Object.keys(strips);
+
+    function render(strip, map) {
+        strip.innerHTML = "";
+        map.seats.forEach((number, i) => {
+            const seat = document.createElement("span");
+            seat.title = number;
+            if (map.booked[i] === "1") seat.classList.add("booked");
+            strip.appendChild(seat);
+        });
+    }
+
+    async function load(ids) {
+        const params = new URLSearchParams({ buses: ids.join(","), date: results.dataset.date });
+        if (results.dataset.source && results.dataset.destination) {
+            params.set("source", results.dataset.source);
+            params.set("destination", results.dataset.destination);
+        }
+        const res = await fetch(`${results.dataset.seatMapUrl}?${params}`);
+        if (!res.ok) return;
+        const data = await res.json();
+        Object.entries(data.buses).forEach(([busId, map]) => render(strips[busId], map));
+    }
+
+    for (let i = 0; i < busIds.length; i += MAX_BUSES_PER_CALL) {
+        load(busIds.slice(i, i + MAX_BUSES_PER_CALL));
+    }
+});
@@ -5,6 +5,8 @@ document.addEventListener("DOMContentLoaded", function () {
     const busId = container.dataset.busId;
     const dateInput = document.getElementById("id_travel_date");
     const seatCountInput = document.getElementById("id_seats_booked");
+    const fromStopInput = document.getElementById("id_from_stop");
+    const toStopInput = document.getElementById("id_to_stop");
 
     let selectedSeats = new Set();
 
@@ -12,7 +14,13 @@ document.addEventListener("DOMContentLoaded", function () {
         const date = dateInput.value;
         if (!date) return;
 
-        const res = await fetch(`/bookings/api/seats/${busId}/?date=${date}`);
+        const params = new URLSearchParams({ date: date });
+        if (fromStopInput && toStopInput && fromStopInput.value && toStopInput.value) {
+            params.set("from_stop", fromStopInput.value);
+            params.set("to_stop", toStopInput.value);
+        }
+
+        const res = await fetch(`/bookings/api/seats/${busId}/?${params}`);
         const data = await res.json();
 
         container.innerHTML = "";
@@ -50,5 +58,7 @@ document.addEventListener("DOMContentLoaded", function () {
     }
 
     dateInput.addEventListener("change", loadSeats);
+    if (fromStopInput) fromStopInput.addEventListener("change", loadSeats);
+    if (toStopInput) toStopInput.addEventListener("change", loadSeats);
     loadSeats();
 });
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import LiveLocation, ETACalculation
+from .models import LiveLocation, ETACalculation, TripTrajectory
 
 
 @admin.register(LiveLocation)
@@ -24,3 +24,18 @@ class ETACalculationAdmin(admin.ModelAdmin):
         'estimated_arrival_time',
     )
     list_filter = ('bus',)
+
+
+@admin.register(TripTrajectory)
+class TripTrajectoryAdmin(admin.ModelAdmin):
+    list_display = (
+        'bus',
+        'trip',
+        'date',
+        'points',
+        'started_at',
+        'ended_at',
+    )
+    list_filter = ('bus',)
+    exclude = ('data',)
+    ordering = ('-started_at',)
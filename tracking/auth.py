@@ -0,0 +1,77 @@
+"""
+Driver authentication for the async GPS ingest paths.
+
+A driver app posts a ping every few seconds with the same session cookie,
+so ``driver_for_session`` remembers which sessions belong to a driver for
+``SESSION_TTL`` seconds. A ping on a known session then needs no database
+query and no hop into a sync thread; only the first ping of a session (or
+the first after the TTL) loads the session, user and role. Logging out
+forgets the session in this process at once; other processes forget it
+within ``SESSION_TTL``.
+
+``assigned_bus_id`` binds a driver's WebSocket to their bus at connect.
+"""
+import threading
+import time
+from importlib import import_module
+from types import SimpleNamespace
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+
+SESSION_TTL = 30
+MAX_SESSIONS = 10000
+
+_sessions = {}      # session_key -> (user_id, expires)
+_lock = threading.Lock()
+
+
+def _load_driver(session_key):
+    from users.models import UserProfile
+
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = get_user(SimpleNamespace(session=session))
+    if not user.is_authenticated:
+        return None, None
+    role = UserProfile.objects.filter(user=user).values_list('role', flat=True).first()
+    return user.pk, role
+
+
+async def driver_for_session(session_key):
+    """``(user_id, role)`` of the session's user; ``(None, None)`` if anonymous."""
+    if not session_key:
+        return None, None
+    now = time.monotonic()
+    cached = _sessions.get(session_key)
+    if cached is not None and cached[1] > now:
+        return cached[0], 'driver'
+
+    user_id, role = await database_sync_to_async(_load_driver)(session_key)
+    if role == 'driver':
+        with _lock:
+            if len(_sessions) >= MAX_SESSIONS:
+                for key, (_, expires) in list(_sessions.items()):
+                    if expires <= now:
+                        del _sessions[key]
+            if len(_sessions) < MAX_SESSIONS:
+                _sessions[session_key] = (user_id, now + SESSION_TTL)
+    return user_id, role
+
+
+def forget_session(session_key):
+    with _lock:
+        _sessions.pop(session_key, None)
+
+
+def assigned_bus_id(user):
+    """Id of the bus assigned to ``user`` if they are a driver, else None."""
+    from buses.models import Bus
+
+    if not user.is_authenticated:
+        return None
+    return (
+        Bus.objects.filter(driver__user=user, driver__user__profile__role='driver')
+        .values_list('pk', flat=True)
+        .first()
+    )
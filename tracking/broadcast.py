@@ -0,0 +1,357 @@
+"""
+WebSocket fan-out of live bus updates.
+
+Every update goes to a handful of channel-layer groups instead of one
+fleet-wide group, so a client only receives what it subscribed to:
+
+* ``live_buses``          the whole fleet (admin map)
+* ``bus_<id>``            one bus (passenger tracking a booking)
+* ``route_<id>``          every bus on a route
+* ``tile_<z>_<x>_<y>``    every bus inside a slippy-map tile at ``TILE_ZOOM``
+
+When a bus crosses into a new tile, its update is also sent to the old
+tile so clients watching that tile see it leave.
+
+Updates are coalesced by ``Broadcaster``: it keeps only the latest state
+per bus and, every ``TICK`` seconds (``settings.TRACKING_BROADCAST``),
+sends each group a single frame listing the buses that changed. The
+frame is JSON-encoded once and consumers forward the text as is. A
+``TICK`` of 0 sends every update on its own instead.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import logging
+import math
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from bustrack import metrics
+
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+FLEET_GROUP = 'live_buses'
+DEFAULTS = {
+    'TICK': 0.5,
+}
+TILE_ZOOM = 11
+MAX_TILES_PER_SUBSCRIPTION = 64
+
+SEND_TIMEOUT = 5
+SEND_RETRIES = 3
+SEND_BACKOFF = 0.2
+# Raised by the Redis layer while the server restarts or fails over
+RETRYABLE_ERRORS = (OSError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+try:
+    from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+except ImportError:
+    pass
+else:
+    RETRYABLE_ERRORS += (RedisConnectionError, RedisTimeoutError)
+
+FANOUT = metrics.histogram(
+    'tracking_broadcast_fanout_messages', 'Group messages handed to the channel layer per send.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+SEND_SECONDS = metrics.histogram('tracking_broadcast_send_seconds', 'Time to hand one send to the channel layer.')
+DROPPED = metrics.counter('tracking_broadcast_dropped_messages_total', 'Group messages dropped after retries.')
+
+_last_tiles = {}
+_lock = threading.Lock()
+_server_loop = None
+
+
+def bus_group(bus_id):
+    return f'bus_{int(bus_id)}'
+
+
+def route_group(route_id):
+    return f'route_{int(route_id)}'
+
+
+def tile_group(x, y, zoom=TILE_ZOOM):
+    return f'tile_{int(zoom)}_{int(x)}_{int(y)}'
+
+
+def tile_for(latitude, longitude, zoom=TILE_ZOOM):
+    """Slippy-map (x, y) of the tile containing the point."""
+    n = 2 ** zoom
+    latitude = max(min(float(latitude), 85.0511), -85.0511)
+    x = int((float(longitude) + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bbox(south, west, north, east, zoom=TILE_ZOOM):
+    x1, y1 = tile_for(north, west, zoom)
+    x2, y2 = tile_for(south, east, zoom)
+    if (x2 - x1 + 1) * (y2 - y1 + 1) > MAX_TILES_PER_SUBSCRIPTION:
+        raise ValueError("Bounding box covers too many tiles; zoom in or subscribe to a route.")
+    return [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+
+def groups_for_subscription(message):
+    """Group names named by a client ``subscribe``/``unsubscribe`` message.
+
+    Accepts any of ``fleet`` (true), ``bus``, ``route`` (ids or lists of
+    ids), ``tile`` ([x, y] at ``TILE_ZOOM``) and ``bbox`` ([south, west,
+    north, east]). Raises ValueError on anything malformed.
+    """
+    def ids(value):
+        values = value if isinstance(value, list) else [value]
+        return [int(v) for v in values]
+
+    groups = set()
+    try:
+        if message.get('fleet'):
+            groups.add(FLEET_GROUP)
+        if 'bus' in message:
+            groups.update(bus_group(bus_id) for bus_id in ids(message['bus']))
+        if 'route' in message:
+            groups.update(route_group(route_id) for route_id in ids(message['route']))
+        if 'tile' in message:
+            x, y = message['tile']
+            groups.add(tile_group(x, y))
+        if 'bbox' in message:
+            south, west, north, east = (float(v) for v in message['bbox'])
+            groups.update(tile_group(x, y) for x, y in tiles_for_bbox(south, west, north, east))
+    except (TypeError, ValueError) as exc:
+        raise ValueError(str(exc) or "Malformed subscription") from exc
+    if not groups:
+        raise ValueError("Nothing to subscribe to")
+    return groups
+
+
+def groups_for_state(state):
+    groups = [FLEET_GROUP, bus_group(state['bus_id'])]
+    if state.get('route_id'):
+        groups.append(route_group(state['route_id']))
+
+    tile = tile_for(state['latitude'], state['longitude'])
+    with _lock:
+        previous = _last_tiles.get(state['bus_id'])
+        _last_tiles[state['bus_id']] = tile
+    groups.append(tile_group(*tile))
+    if previous is not None and previous != tile:
+        groups.append(tile_group(*previous))
+    return groups
+
+
+def location_update(state):
+    eta = state.get('eta')
+    return {
+        'bus_id': state['bus_id'],
+        'bus_name': state.get('bus_name'),
+        'bus_number': state.get('bus_number'),
+        'route_id': state.get('route_id'),
+        'route': state.get('route', ''),
+        'status': state.get('status'),
+        'latitude': state['latitude'],
+        'longitude': state['longitude'],
+        'speed': state.get('speed', 0.0),
+        'heading': state.get('heading', 0.0),
+        'timestamp': state.get('timestamp'),
+        'next_stop': state.get('next_stop'),
+        'next_stop_index': state.get('next_stop_index'),
+        'eta': eta['estimated_arrival'] if eta else None,
+        'distance_remaining_km': eta['distance_remaining_km'] if eta else None,
+    }
+
+
+def location_event(state):
+    """Channel-layer event for a single update (``TICK`` = 0)."""
+    return {'type': 'send_location', **location_update(state)}
+
+
+def frame_events(states, tick):
+    """(group, event) pairs carrying one pre-encoded frame per group.
+
+    Each frame lists the latest update of every bus in ``states`` that
+    belongs to the group. It is encoded once as JSON and once per binary
+    subprotocol (``tracking.protocol``), however many clients are in the
+    group. The bus metadata rides along for binary clients' dictionary
+    frames, and each update's timestamp for consumers to drop the ones a
+    client already got through another group.
+    """
+    updates = {}
+    for state in states:
+        update = location_update(state)
+        for group in groups_for_state(state):
+            updates.setdefault(group, []).append(update)
+
+    events = []
+    for group, buses in updates.items():
+        events.append((group, {
+            'type': 'send_frame',
+            'text': json.dumps({'type': 'frame', 'tick': tick, 'buses': buses}, separators=(',', ':')),
+            'binary': protocol.encoded_frames(tick, [protocol.update_row(u) for u in buses]),
+            'buses': [protocol.bus_row(u) for u in buses],
+            'timestamps': [u['timestamp'] for u in buses],
+            'routes': sorted({(u['route_id'], u['route']) for u in buses if u['route_id']}),
+        }))
+    return events
+
+
+async def _send_all(channel_layer, messages, sent):
+    """Send ``messages`` from ``sent[0]`` on, counting each one sent in ``sent[0]``."""
+    for group, event in messages[sent[0]:]:
+        await channel_layer.group_send(group, event)
+        sent[0] += 1
+
+
+def bind_loop(loop):
+    """Remember the server's event loop so background threads send on it."""
+    global _server_loop
+    _server_loop = loop
+
+
+def _send_once(channel_layer, messages, sent):
+    loop = _server_loop
+    if loop is not None and loop.is_running():
+        # The in-memory layer only works on the loop its consumers run on
+        future = asyncio.run_coroutine_threadsafe(_send_all(channel_layer, messages, sent), loop)
+        try:
+            future.result(SEND_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Stop it before a retry sends the rest, or both would
+            future.cancel()
+            raise
+    else:
+        async_to_sync(_send_all)(channel_layer, messages, sent)
+
+
+def _send(messages):
+    """Send to the channel layer, retrying while a shared layer reconnects.
+
+    A retry resumes after the last message the channel layer accepted, so
+    no group gets a frame twice. Messages that still fail after
+    ``SEND_RETRIES`` attempts are dropped: the next tick carries fresher
+    positions anyway.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or not messages:
+        return
+    FANOUT.observe(len(messages))
+    started = time.perf_counter()
+    sent = [0]
+    for attempt in range(SEND_RETRIES):
+        try:
+            _send_once(channel_layer, messages, sent)
+            SEND_SECONDS.observe(time.perf_counter() - started)
+            return
+        except RETRYABLE_ERRORS as exc:
+            if attempt == SEND_RETRIES - 1:
+                dropped = len(messages) - sent[0]
+                logger.warning("Dropped %d live bus messages; channel layer unavailable: %s", dropped, exc)
+                DROPPED.inc(dropped)
+                return
+            time.sleep(SEND_BACKOFF * 2 ** attempt)
+
+
+# -----------------------------
+# COALESCING BROADCASTER
+# -----------------------------
+class Broadcaster:
+    """Keeps the latest state per bus and sends one frame per group every tick."""
+
+    def __init__(self, tick=0.5):
+        self.tick = tick
+        self.ticks = 0
+        self._pending = {}
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self):
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(
+                    target=self._run, name='tracking-broadcast', daemon=True
+                )
+                self._thread.start()
+
+    def collect(self, states):
+        with self._cond:
+            for state in states:
+                self._pending[state['bus_id']] = state
+
+    def frames(self):
+        """Take everything collected since the last tick and build its frames."""
+        with self._cond:
+            states, self._pending = list(self._pending.values()), {}
+        if not states:
+            return []
+        self.ticks += 1
+        return frame_events(states, self.ticks)
+
+    def close(self, timeout=5):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.tick)
+                closed = self._closed
+            try:
+                _send(self.frames())
+            except Exception:
+                if not closed:
+                    logger.exception("Failed to broadcast a live bus frame")
+                else:
+                    # atexit runs after asgiref's executor has shut down, so
+                    # the last flush of an exiting process can fail; clients
+                    # are being disconnected anyway
+                    logger.debug("Dropped the last live bus frame on close", exc_info=True)
+            if closed:
+                return
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'TRACKING_BROADCAST', {})}
+
+
+def get_broadcaster():
+    global _broadcaster
+    if _broadcaster is None:
+        with _broadcaster_lock:
+            if _broadcaster is None:
+                _broadcaster = Broadcaster(tick=get_config()['TICK'])
+                _broadcaster.start()
+                atexit.register(_broadcaster.close)
+    return _broadcaster
+
+
+def publish_many(states):
+    """Publish updated states: coalesced into the next frame, or sent now when ``TICK`` is 0."""
+    if not states:
+        return
+    if get_config()['TICK'] > 0:
+        get_broadcaster().collect(states)
+        return
+    _send([
+        (group, location_event(state))
+        for state in states
+        for group in groups_for_state(state)
+    ])
+
+
+def send_event(group, event):
+    """Send one event to a group from any thread, with the retries of ``_send``."""
+    _send([(group, event)])
@@ -1,20 +1,309 @@
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.http.cookie import parse_cookie
+import asyncio
 import json
+import time
+
+from bustrack import metrics
+
+from . import auth, broadcast, ingest, protocol
+
+CONNECTIONS = metrics.gauge('tracking_websocket_connections', 'Open WebSocket connections.', ['consumer'])
+SEND_SECONDS = metrics.histogram(
+    'tracking_websocket_send_seconds', 'Time to hand one frame to the server, per consumer.', ['consumer'],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+
+
+class MeteredConsumerMixin:
+    """Counts open connections and times every frame sent."""
+
+    _counted = False
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        if not self._counted:
+            self._counted = True
+            CONNECTIONS.labels(type(self).__name__).inc()
+
+    async def websocket_disconnect(self, message):
+        if self._counted:
+            self._counted = False
+            CONNECTIONS.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        started = time.perf_counter()
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        SEND_SECONDS.labels(type(self).__name__).observe(time.perf_counter() - started)
+
+
+class LiveBusConsumer(MeteredConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Live bus updates for the groups a client subscribes to.
+
+    Clients send ``{"action": "subscribe", "bus": 12}`` (or ``route``,
+    ``tile``, ``bbox``, ``fleet``; see ``broadcast.groups_for_subscription``)
+    and ``"unsubscribe"`` with the same keys. With ``subscribe_fleet`` the
+    client starts on the whole fleet until it first subscribes to
+    something narrower.
+
+    Clients offering a binary subprotocol (see ``tracking.protocol``) get
+    updates as binary frames; subscription replies stay JSON text.
+    """
+
+    subscribe_fleet = True
+    max_subscriptions = 100
+
+    def __init__(self, *args, subscribe_fleet=None, max_subscriptions=None, **kwargs):
+        # channels hands as_asgi()'s keyword arguments to __init__ and drops them
+        super().__init__(*args, **kwargs)
+        if subscribe_fleet is not None:
+            self.subscribe_fleet = subscribe_fleet
+        if max_subscriptions is not None:
+            self.max_subscriptions = max_subscriptions
 
-class LiveBusConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        # All users join the same group to receive live bus updates
-        self.group_name = "live_buses"
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        broadcast.bind_loop(asyncio.get_running_loop())
+        self.subscriptions = set()
+        self.implicit_fleet = self.subscribe_fleet
+        self.last_sent = {}
+        self.known_buses = {}
+        self.known_routes = set()
+        self.subprotocol = protocol.negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol=self.subprotocol)
+        if self.subscribe_fleet:
+            try:
+                await self._join({broadcast.FLEET_GROUP})
+            except broadcast.RETRYABLE_ERRORS:
+                # Channel layer unreachable; the client reconnects with backoff
+                await self.close(code=1011)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        try:
+            await self._leave(set(self.subscriptions))
+        except broadcast.RETRYABLE_ERRORS:
+            pass  # group memberships expire on their own
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data or "")
+            action = message.get("action")
+            if action not in ("subscribe", "unsubscribe"):
+                raise ValueError("Unknown action")
+            groups = broadcast.groups_for_subscription(message)
+        except (AttributeError, ValueError) as exc:
+            await self.send(text_data=json.dumps({"type": "error", "error": str(exc)}))
+            return
+
+        if action == "subscribe":
+            if self.implicit_fleet and broadcast.FLEET_GROUP not in groups:
+                await self._leave({broadcast.FLEET_GROUP})
+            self.implicit_fleet = False
+            if len(self.subscriptions | groups) > self.max_subscriptions:
+                await self.send(text_data=json.dumps({"type": "error", "error": "Too many subscriptions"}))
+                return
+            await self._join(groups)
+        else:
+            await self._leave(groups)
+
+        await self.send(text_data=json.dumps({
+            "type": "subscriptions",
+            "groups": sorted(self.subscriptions),
+        }))
+
+    async def _join(self, groups):
+        for group in groups - self.subscriptions:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.subscriptions |= groups
+
+    async def _leave(self, groups):
+        for group in groups & self.subscriptions:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.subscriptions -= groups
+
+    async def _send_dictionary(self, buses, routes):
+        """Send metadata for buses the client hasn't seen (or that changed)."""
+        new = [row for row in buses if self.known_buses.get(row[0]) != list(row)]
+        if not new:
+            return
+        wanted = {row[3] for row in new} - self.known_routes
+        labels = {route_id: label for route_id, label in routes if route_id in wanted}
+        route_rows = await database_sync_to_async(protocol.route_rows)(list(labels), labels) if labels else []
 
-    # Receive messages from WebSocket (optional if driver uses WebSocket)
-    async def receive(self, text_data):
-        pass  # we push updates from server-side, driver posts via API
+        await self.send(bytes_data=protocol.encode(
+            self.subprotocol, protocol.dictionary_frame(new, route_rows)
+        ))
+        self.known_buses.update((row[0], list(row)) for row in new)
+        self.known_routes.update(row[0] for row in route_rows)
 
     # Send location updates to clients
     async def send_location(self, event):
-        await self.send(text_data=json.dumps(event))
+        # A client in several groups (bus and route, say) gets each update once
+        if self.last_sent.get(event["bus_id"]) == event["timestamp"]:
+            return
+        self.last_sent[event["bus_id"]] = event["timestamp"]
+        if self.subprotocol is None:
+            await self.send(text_data=json.dumps(event))
+            return
+        await self._send_dictionary(
+            [protocol.bus_row(event)],
+            [(event["route_id"], event["route"])] if event["route_id"] else [],
+        )
+        await self.send(bytes_data=protocol.encode(
+            self.subprotocol, protocol.updates_frame(0, [protocol.update_row(event)])
+        ))
+
+    # Coalesced frames arrive already encoded
+    async def send_frame(self, event):
+        # A client in several groups gets every group's frame each tick;
+        # forward only the updates it hasn't had yet
+        fresh = [
+            self.last_sent.get(row[0]) != timestamp
+            for row, timestamp in zip(event["buses"], event["timestamps"])
+        ]
+        if not any(fresh):
+            return
+        for row, timestamp in zip(event["buses"], event["timestamps"]):
+            self.last_sent[row[0]] = timestamp
+        if not all(fresh):
+            event = self._without_sent(event, fresh)
+
+        if self.subprotocol is None:
+            await self.send(text_data=event["text"])
+            return
+        await self._send_dictionary(event["buses"], event["routes"])
+        await self.send(bytes_data=event["binary"][self.subprotocol])
+
+    def _without_sent(self, event, fresh):
+        """``event`` re-encoded with only the updates where ``fresh`` is true, for this client."""
+        def keep(items):
+            return [item for item, wanted in zip(items, fresh) if wanted]
+
+        event = {**event, "buses": keep(event["buses"])}
+        if self.subprotocol is None:
+            frame = json.loads(event["text"])
+            frame["buses"] = keep(frame["buses"])
+            event["text"] = json.dumps(frame, separators=(",", ":"))
+        else:
+            kind, tick, rows = protocol.decode(self.subprotocol, event["binary"][self.subprotocol])
+            event["binary"] = {self.subprotocol: protocol.encode(self.subprotocol, [kind, tick, keep(rows)])}
+        return event
+
+
+class DriverLocationConsumer(MeteredConsumerMixin, AsyncWebsocketConsumer):
+    """
+    A driver's GPS stream on ``ws/driver/``.
+
+    The connection is authorised once: the session user must be a driver
+    with an assigned bus, and every position on the socket is for that
+    bus. Frames are the ``update_location`` JSON body, whose ``bus_id``
+    may be left out (``{"latitude": .., "longitude": .., "speed": ..,
+    "heading": ..}``), and go straight onto the write-behind queue
+    (``tracking.ingest``).
+    Nothing is sent back except errors, so a ping costs one queue append.
+    """
+
+    async def connect(self):
+        self.bus_id = await database_sync_to_async(auth.assigned_bus_id)(self.scope["user"])
+        if self.bus_id is None:
+            # Accept first so the close code reaches the browser
+            await self.accept()
+            await self.close(code=4403)
+            return
+        broadcast.bind_loop(asyncio.get_running_loop())
+        self.inline = not ingest.get_config()["ENABLED"]
+        await self.accept()
+        await self.send(text_data=json.dumps({"type": "bound", "bus_id": self.bus_id}))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            ping = ingest.parse_ping(text_data or bytes_data or "", bus_id=self.bus_id)
+        except ValueError as exc:
+            await self.send(text_data=json.dumps({"type": "error", "error": str(exc)}))
+            return
+
+        if self.inline:
+            outcome = await database_sync_to_async(ingest.submit)(ping)
+        else:
+            outcome = ingest.submit(ping)
+        if outcome == ingest.REJECTED:
+            await self.send(text_data=json.dumps({
+                "type": "error",
+                "error": "Too many pending location updates",
+                "retry_after": 1,
+            }))
+
+
+class LocationIngestConsumer(AsyncHttpConsumer):
+    """
+    ``POST /tracking/api/update-location/`` served on the event loop.
+
+    Same contract as ``views.update_location``, which still answers the
+    URL under WSGI, but it skips Django's middleware stack: a ping from a
+    recently seen driver session is parsed, queued for the write-behind
+    writer (``tracking.ingest``) and acknowledged without a database
+    query or a thread hop (``tracking.ingest.known_bus`` remembers the
+    bus the same way). Its latency is recorded under the URL name of
+    the view, as the middleware would.
+    """
+
+    async def handle(self, body):
+        self.started = time.perf_counter()
+        if self.scope["method"] != "POST":
+            await self._respond(405, {"error": "Method not allowed"}, [(b"Allow", b"POST")])
+            return
+
+        session_key = self._cookies().get(settings.SESSION_COOKIE_NAME)
+        user_id, role = await auth.driver_for_session(session_key)
+        if user_id is None:
+            await self._respond(401, {"error": "Authentication required"})
+            return
+        if role != "driver":
+            await self._respond(403, {"error": "Driver access required"})
+            return
+
+        try:
+            ping = ingest.parse_ping(body)
+        except ValueError as exc:
+            await self._respond(400, {"error": str(exc)})
+            return
+        if not await ingest.aknown_bus(ping.bus_id):
+            await self._respond(404, {"error": "Bus not found"})
+            return
+
+        # The writer thread publishes updates back onto this loop
+        broadcast.bind_loop(asyncio.get_running_loop())
+        if ingest.get_config()["ENABLED"]:
+            outcome = ingest.submit(ping)
+        else:
+            outcome = await database_sync_to_async(ingest.submit)(ping)
+        if outcome == ingest.REJECTED:
+            await self._respond(503, {"error": "Too many pending location updates"}, [(b"Retry-After", b"1")])
+            return
+
+        await self._respond(200, {"status": "success", "timestamp": ping.timestamp.isoformat()})
+
+    def _cookies(self):
+        for name, value in self.scope.get("headers", ()):
+            if name == b"cookie":
+                return parse_cookie(value.decode("latin1"))
+        return {}
+
+    async def _respond(self, status, data, headers=()):
+        body = json.dumps(data).encode()
+        await self.send_response(
+            status,
+            body,
+            headers=[
+                (b"Content-Type", b"application/json"),
+                (b"Content-Length", str(len(body)).encode()),
+                *headers,
+            ],
+        )
+        metrics.observe_request(
+            "tracking:update_location", self.scope["method"], status, time.perf_counter() - self.started
+        )
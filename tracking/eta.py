@@ -0,0 +1,258 @@
+"""
+Incremental next-stop and ETA tracking.
+
+``RouteGeometry`` projects a route's stops onto a local equirectangular
+plane (kilometres) and keeps the cumulative along-route distance at each
+stop. ``TripProgress`` remembers how far along the route a trip has got.
+Each ping is projected onto the polyline segments starting from the last
+matched one and looking ahead ``LOOKAHEAD`` segments. It only rescans the
+rest of the route when nothing in that window is close. Progress never
+moves backwards, so stops that were already passed are never reported
+again, and a ping costs a few multiplications per segment in the window.
+
+Geometries and trackers are cached in this process. Changing a stop gives
+its route a new geometry version in the Django cache (see
+``tracking.signals``), which every process compares with the version its
+copy was built at (one ``get_many`` per lookup), so no worker keeps
+matching pings against stops that have moved.
+
+A tracker only sees the pings its own process writes, so with several
+workers (or after a restart) it would start the trip over. The writer
+(``tracking.ingest.write_batch``) therefore keeps each bus's progress in
+the state store with the trip and geometry version it belongs to, and
+hands it back through ``TripProgress.resume`` before every update. With
+a shared store (``tracking.state``) progress is as monotonic across
+workers as within one; with the per-process default it is not.
+"""
+import math
+import threading
+import uuid
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+KM_PER_DEGREE = 111.32
+LOOKAHEAD = 4
+ARRIVAL_RADIUS_KM = 0.05
+OFF_ROUTE_KM = 0.5
+DEFAULT_SPEED_KMH = 40
+MIN_MOVING_SPEED_KMH = 5
+SPEED_SMOOTHING = 0.3
+MAX_TRACKERS = 10000
+VERSION_KEY = 'tracking:route-geometry:{route_id}'
+
+Progress = namedtuple(
+    'Progress',
+    'next_index next_stop distance_to_next_km along_km remaining_km eta off_route',
+)
+
+
+class RouteGeometry:
+    def __init__(self, route_id, stops):
+        """``stops`` is an ordered iterable of (name, latitude, longitude)."""
+        stops = [(name, float(lat), float(lng)) for name, lat, lng in stops]
+        self.route_id = route_id
+        # Set by ``geometries`` to the route's version in the Django cache
+        self.version = None
+        self.names = [name for name, _, _ in stops]
+        self.latitudes = [lat for _, lat, _ in stops]
+        self.longitudes = [lng for _, _, lng in stops]
+
+        mid_latitude = sum(self.latitudes) / len(stops) if stops else 0.0
+        self.kx = KM_PER_DEGREE * math.cos(math.radians(mid_latitude))
+        self.ky = KM_PER_DEGREE
+        self.xs = [lng * self.kx for lng in self.longitudes]
+        self.ys = [lat * self.ky for lat in self.latitudes]
+
+        # lengths[k] is the segment ending at stop k; cumulative[k] the distance to stop k
+        self.lengths = [0.0]
+        self.cumulative = [0.0]
+        for k in range(1, len(stops)):
+            length = math.hypot(self.xs[k] - self.xs[k - 1], self.ys[k] - self.ys[k - 1])
+            self.lengths.append(length)
+            self.cumulative.append(self.cumulative[-1] + length)
+
+    @classmethod
+    def build_many(cls, route_ids):
+        from buses.models import Stop
+
+        stops = {route_id: [] for route_id in route_ids}
+        for route_id, name, lat, lng in (
+            Stop.objects.filter(route_id__in=route_ids)
+            .order_by('route_id', 'sequence_number')
+            .values_list('route_id', 'name', 'latitude', 'longitude')
+        ):
+            stops[route_id].append((name, lat, lng))
+        return {route_id: cls(route_id, rows) for route_id, rows in stops.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def total_km(self):
+        return self.cumulative[-1] if self.cumulative else 0.0
+
+    def to_xy(self, latitude, longitude):
+        return longitude * self.kx, latitude * self.ky
+
+    def distance_to_stop(self, x, y, index):
+        return math.hypot(x - self.xs[index], y - self.ys[index])
+
+    def project(self, x, y, segment):
+        """(offset_km, t) of the point against the segment ending at stop ``segment``.
+
+        ``t`` is the unclamped position along the segment (0 at its start,
+        1 at its end); the offset is measured to the clamped point.
+        """
+        ax, ay = self.xs[segment - 1], self.ys[segment - 1]
+        dx, dy = self.xs[segment] - ax, self.ys[segment] - ay
+        length_sq = dx * dx + dy * dy
+        t = ((x - ax) * dx + (y - ay) * dy) / length_sq if length_sq else 0.0
+        clamped = min(max(t, 0.0), 1.0)
+        return math.hypot(x - (ax + clamped * dx), y - (ay + clamped * dy)), t
+
+
+class TripProgress:
+    def __init__(self, geometry, lookahead=LOOKAHEAD, arrival_radius_km=ARRIVAL_RADIUS_KM):
+        self.geometry = geometry
+        self.lookahead = lookahead
+        self.arrival_radius_km = arrival_radius_km
+        self.segment = 1
+        self.along_km = 0.0
+        self.started = False
+        self.speed_kmh = None
+
+    def _match(self, x, y):
+        g = self.geometry
+        last = len(g) - 1
+        window_end = min(self.segment + self.lookahead, last)
+
+        best = None
+        for segment in range(self.segment, window_end + 1):
+            offset, t = g.project(x, y, segment)
+            if best is None or offset < best[0]:
+                best = (offset, segment, t)
+
+        if best[0] > OFF_ROUTE_KM:
+            for segment in range(window_end + 1, last + 1):
+                offset, t = g.project(x, y, segment)
+                if offset < best[0]:
+                    best = (offset, segment, t)
+        return best
+
+    def resume(self, along_km):
+        """Catch up with progress recorded elsewhere; never moves backwards."""
+        g = self.geometry
+        if len(g) < 2 or along_km <= self.along_km:
+            return
+        self.along_km = min(along_km, g.total_km)
+        self.segment = min(max(bisect_right(g.cumulative, self.along_km), 1), len(g) - 1)
+        self.started = True
+
+    def _smoothed_speed(self, speed_kmh):
+        if self.speed_kmh is None:
+            self.speed_kmh = speed_kmh
+        else:
+            self.speed_kmh += SPEED_SMOOTHING * (speed_kmh - self.speed_kmh)
+        return self.speed_kmh if self.speed_kmh > MIN_MOVING_SPEED_KMH else DEFAULT_SPEED_KMH
+
+    def update(self, latitude, longitude, speed_kmh=0.0, now=None):
+        """Advance with a new position; returns a ``Progress`` or None for an empty route."""
+        g = self.geometry
+        if not len(g):
+            return None
+        now = now or timezone.now()
+        speed = self._smoothed_speed(float(speed_kmh))
+        x, y = g.to_xy(float(latitude), float(longitude))
+
+        off_route = False
+        if len(g) > 1:
+            offset, segment, t = self._match(x, y)
+            off_route = offset > OFF_ROUTE_KM
+            along = g.cumulative[segment - 1] + min(max(t, 0.0), 1.0) * g.lengths[segment]
+            if along > self.along_km:
+                self.along_km = along
+                self.segment = segment
+        else:
+            t = 0.0
+
+        # Approaching the first stop: not on the route yet
+        if not self.started:
+            to_first = g.distance_to_stop(x, y, 0)
+            if to_first > self.arrival_radius_km and self.along_km == 0.0 and t <= 0.0:
+                return self._progress(0, to_first, speed, now, off_route)
+            self.started = True
+
+        next_index = bisect_right(g.cumulative, self.along_km + self.arrival_radius_km)
+        if next_index >= len(g):
+            return Progress(None, None, 0.0, self.along_km, 0.0, None, off_route)
+        return self._progress(
+            next_index, g.cumulative[next_index] - self.along_km, speed, now, off_route
+        )
+
+    def _progress(self, index, distance_km, speed, now, off_route):
+        g = self.geometry
+        return Progress(
+            next_index=index,
+            next_stop=g.names[index],
+            distance_to_next_km=distance_km,
+            along_km=self.along_km,
+            remaining_km=g.total_km - self.along_km,
+            eta=now + timedelta(hours=distance_km / speed),
+            off_route=off_route,
+        )
+
+
+# -----------------------------
+# PROCESS-LOCAL REGISTRY
+# -----------------------------
+_geometries = {}    # route_id -> (version, geometry)
+_trackers = {}
+_lock = threading.Lock()
+
+
+def geometries(route_ids):
+    """Cached geometries for ``route_ids``; missing or outdated ones are loaded in one query."""
+    route_ids = set(route_ids) - {None}
+    keys = {route_id: VERSION_KEY.format(route_id=route_id) for route_id in route_ids}
+    versions = cache.get_many(keys.values())
+    current = {route_id: versions.get(key) for route_id, key in keys.items()}
+    cached = _geometries
+    stale = {
+        route_id for route_id in route_ids
+        if route_id not in cached or cached[route_id][0] != current[route_id]
+    }
+    if stale:
+        built = RouteGeometry.build_many(stale)
+        for route_id, geometry in built.items():
+            geometry.version = current[route_id]
+        with _lock:
+            _geometries.update((route_id, (current[route_id], geometry)) for route_id, geometry in built.items())
+        cached = _geometries
+    return {route_id: cached[route_id][1] for route_id in route_ids if route_id in cached}
+
+
+def tracker(key, geometry):
+    """The ``TripProgress`` for ``key`` (a trip or bus), restarted if the route changed."""
+    with _lock:
+        progress = _trackers.get(key)
+        if progress is None or progress.geometry is not geometry:
+            if len(_trackers) >= MAX_TRACKERS:
+                _trackers.pop(next(iter(_trackers)))
+            progress = _trackers[key] = TripProgress(geometry)
+    return progress
+
+
+def forget(key):
+    with _lock:
+        _trackers.pop(key, None)
+
+
+def invalidate(route_id):
+    """Make every process rebuild the route's geometry on its next lookup."""
+    cache.set(VERSION_KEY.format(route_id=route_id), uuid.uuid4().hex, None)
+    with _lock:
+        _geometries.pop(route_id, None)
@@ -0,0 +1,457 @@
+"""
+Write-behind ingestion of driver GPS pings.
+
+Drivers stream pings over ``consumers.DriverLocationConsumer`` or post
+them to ``consumers.LocationIngestConsumer`` (under ASGI) and
+``views.update_location`` (under WSGI). Each message becomes a ``Ping``
+via ``parse_ping`` and goes to ``submit``, which only queues it. A
+background thread drains the queue every ``FLUSH_INTERVAL`` seconds, or
+as soon as ``BATCH_SIZE`` pings are waiting, and writes each batch with a
+fixed number of queries: every ``LiveLocation`` row in one bulk INSERT,
+the ETA rows of all buses in the batch upserted in bulk, one state-store
+read for the batch (next-stop progress, see ``tracking.eta``) and one
+state-store update per bus for its newest ping only, published to that
+bus's groups (see ``tracking.broadcast``).
+
+Pings name their bus, so the views and the HTTP consumer first check the
+id with ``known_bus`` and answer 404 for a bus that does not exist
+instead of acknowledging a ping the writer would drop. Known ids are
+remembered for ``BUS_TTL`` seconds, so a driver's stream costs no query;
+a bus deleted meanwhile loses its pings at write time, which is logged.
+
+Backpressure: once ``MAX_PENDING`` pings are waiting, a new ping replaces
+its bus's newest queued ping, because that ping is now superseded. A bus
+with nothing queued is refused, and the view answers 503 so the driver
+app retries later. Pings older than the bus's last accepted ping are
+dropped. The queue is drained when the process exits.
+
+Configure with ``settings.TRACKING_INGEST``. With ``ENABLED`` off, each
+ping is written inline through the same code path.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from bustrack import metrics
+
+from . import broadcast
+from . import eta as progress
+from . import state as live_state
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'MAX_PENDING': 20000,
+}
+
+QUEUED = 'queued'
+COALESCED = 'coalesced'
+STALE = 'stale'
+REJECTED = 'rejected'
+UNKNOWN_BUS = 'unknown_bus'
+WRITTEN = 'written'
+
+BUS_TTL = 60
+MAX_BUSES = 10000
+# Pings are stamped when parsed, so one older than a bus's last accepted
+# ping is only ever a moment older; last-seen times can go after this long
+SEEN_TTL = 60
+
+Ping = namedtuple('Ping', 'bus_id latitude longitude speed heading timestamp')
+
+PINGS = metrics.counter('tracking_pings_total', 'GPS pings received, by what became of them.', ['outcome'])
+PINGS_STORED = metrics.counter('tracking_pings_stored_total', 'Queued GPS pings written or lost.', ['result'])
+BATCH_SECONDS = metrics.histogram('tracking_ingest_batch_seconds', 'Time to write one batch of pings.')
+QUEUE_DEPTH = metrics.gauge('tracking_ingest_queue_depth', 'GPS pings waiting to be written.')
+QUEUE_DEPTH.set_function(lambda: len(_queue) if _queue is not None else 0)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'TRACKING_INGEST', {})}
+
+
+def parse_ping(body, bus_id=None):
+    """Build a ``Ping`` from a driver's JSON message; raises ValueError if unusable.
+
+    ``bus_id`` is the bus of a connection already bound to one; messages
+    may leave their own out, but naming another bus is an error.
+    """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise ValueError("Invalid location data")
+    if bus_id is not None:
+        if str(data.setdefault("bus_id", bus_id)) != str(bus_id):
+            raise ValueError(f"This connection sends locations for bus {bus_id} only")
+        data["bus_id"] = bus_id
+    if not all([data.get("bus_id"), data.get("latitude"), data.get("longitude")]):
+        raise ValueError("Missing required fields")
+    try:
+        return Ping(
+            bus_id=int(data["bus_id"]),
+            latitude=float(data["latitude"]),
+            longitude=float(data["longitude"]),
+            speed=float(data.get("speed", 0)),
+            heading=float(data.get("heading", 0)),
+            timestamp=timezone.now(),
+        )
+    except (TypeError, ValueError) as exc:
+        raise ValueError("Invalid location data") from exc
+
+
+# -----------------------------
+# QUEUE
+# -----------------------------
+class PingQueue:
+    def __init__(self, batch_size=500, flush_interval=1.0, max_pending=20000, writer=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.writer = writer or write_batch
+        self.stats = Counter()
+
+        self._pending = []
+        self._newest = {}       # bus_id -> index in _pending of its newest ping
+        self._last_seen = {}    # bus_id -> timestamp of its last accepted ping
+        self._next_prune = time.monotonic() + SEEN_TTL
+        self._writing = 0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, ping):
+        with self._cond:
+            last = self._last_seen.get(ping.bus_id)
+            if last is not None and ping.timestamp < last:
+                self.stats[STALE] += 1
+                return STALE
+
+            if len(self._pending) >= self.max_pending:
+                index = self._newest.get(ping.bus_id)
+                if index is None:
+                    self.stats[REJECTED] += 1
+                    return REJECTED
+                self._pending[index] = ping
+                outcome = COALESCED
+            else:
+                self._newest[ping.bus_id] = len(self._pending)
+                self._pending.append(ping)
+                outcome = QUEUED
+
+            self._last_seen[ping.bus_id] = ping.timestamp
+            self.stats[outcome] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+            self._start()
+        return outcome
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written."""
+        with self._cond:
+            if self._thread is None:
+                batch = self._take()
+            else:
+                self._cond.notify_all()
+                return self._cond.wait_for(
+                    lambda: not self._pending and not self._writing, timeout
+                )
+        self._write(batch)
+        return True
+
+    def close(self, timeout=10):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        else:
+            self.flush()
+
+    def _start(self):
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(
+                target=self._run, name='tracking-ingest', daemon=True
+            )
+            self._thread.start()
+
+    def _take(self):
+        batch, self._pending, self._newest = self._pending, [], {}
+        if time.monotonic() >= self._next_prune:
+            self._forget_seen(timezone.now() - timedelta(seconds=SEEN_TTL))
+        return batch
+
+    def _forget_seen(self, before):
+        """Drop the last-seen times of buses quiet since ``before``, so the map stays bounded."""
+        self._last_seen = {
+            bus_id: seen for bus_id, seen in self._last_seen.items() if seen >= before
+        }
+        self._next_prune = time.monotonic() + SEEN_TTL
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                batch = self._take()
+                self._writing += 1
+                closed = self._closed
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing -= 1
+                    self._cond.notify_all()
+            if closed and not batch:
+                return
+
+    def _write(self, batch):
+        if not batch:
+            return
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            self.writer(batch)
+            result = WRITTEN
+        except Exception:
+            logger.exception("Dropped a batch of %d GPS pings", len(batch))
+            result = 'failed'
+        BATCH_SECONDS.observe(time.perf_counter() - started)
+        PINGS_STORED.labels(result).inc(len(batch))
+        self.stats[result] += len(batch)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                config = get_config()
+                _queue = PingQueue(
+                    batch_size=config['BATCH_SIZE'],
+                    flush_interval=config['FLUSH_INTERVAL'],
+                    max_pending=config['MAX_PENDING'],
+                )
+                atexit.register(_queue.close)
+    return _queue
+
+
+def reset_queue():
+    """Drain and forget the process queue so the next call re-reads settings."""
+    global _queue
+    with _queue_lock:
+        queue, _queue = _queue, None
+    if queue is not None:
+        queue.close()
+        atexit.unregister(queue.close)
+
+
+# -----------------------------
+# BUS CHECK
+# -----------------------------
+_known_buses = {}   # bus_id -> expires
+_known_lock = threading.Lock()
+
+
+def _remembered(bus_id):
+    expires = _known_buses.get(bus_id)
+    return expires is not None and expires > time.monotonic()
+
+
+def known_bus(bus_id):
+    """Whether ``bus_id`` is an existing bus; unknown ids are counted as rejected pings."""
+    from buses.models import Bus
+
+    if _remembered(bus_id):
+        return True
+    if not Bus.objects.filter(pk=bus_id).exists():
+        PINGS.labels(UNKNOWN_BUS).inc()
+        return False
+    now = time.monotonic()
+    with _known_lock:
+        if len(_known_buses) >= MAX_BUSES:
+            for key, expires in list(_known_buses.items()):
+                if expires <= now:
+                    del _known_buses[key]
+        if len(_known_buses) < MAX_BUSES:
+            _known_buses[bus_id] = now + BUS_TTL
+    return True
+
+
+async def aknown_bus(bus_id):
+    if _remembered(bus_id):
+        return True
+    return await database_sync_to_async(known_bus)(bus_id)
+
+
+def forget_buses():
+    with _known_lock:
+        _known_buses.clear()
+
+
+def submit(ping):
+    if get_config()['ENABLED']:
+        outcome = get_queue().submit(ping)
+    else:
+        write_batch([ping])
+        outcome = WRITTEN
+    PINGS.labels(outcome).inc()
+    return outcome
+
+
+# -----------------------------
+# BATCH WRITER
+# -----------------------------
+def _save_etas(rows):
+    """Upsert ETA rows keyed by (bus, trip, destination_name) in bulk."""
+    from .models import ETACalculation
+
+    if not rows:
+        return {}
+    existing = {}
+    for eta in ETACalculation.objects.filter(
+        trip_id__in={row.trip_id for row in rows},
+        destination_name__in={row.destination_name for row in rows},
+    ):
+        existing.setdefault((eta.bus_id, eta.trip_id, eta.destination_name), eta)
+
+    now = timezone.now()
+    saved, to_create, to_update = {}, [], []
+    for row in rows:
+        eta = existing.get((row.bus_id, row.trip_id, row.destination_name))
+        if eta is None:
+            eta = row
+            to_create.append(eta)
+        else:
+            eta.destination_latitude = row.destination_latitude
+            eta.destination_longitude = row.destination_longitude
+            eta.distance_remaining_km = row.distance_remaining_km
+            eta.estimated_arrival_time = row.estimated_arrival_time
+            eta.calculated_at = now
+            to_update.append(eta)
+        saved[row.bus_id] = eta
+
+    ETACalculation.objects.bulk_create(to_create)
+    ETACalculation.objects.bulk_update(to_update, [
+        'destination_latitude', 'destination_longitude', 'distance_remaining_km',
+        'estimated_arrival_time', 'calculated_at',
+    ])
+    return saved
+
+
+def write_batch(pings):
+    """Persist a batch of pings; only each bus's newest ping drives ETA and state."""
+    from buses.models import Bus, Trip
+    from .models import ETACalculation, LiveLocation
+
+    buses = Bus.objects.select_related('route').in_bulk({p.bus_id for p in pings})
+    known = [p for p in pings if p.bus_id in buses]
+    if len(known) < len(pings):
+        # Checked by known_bus when queued, so the bus has been deleted since
+        logger.warning("Dropped %d GPS ping(s) for deleted buses", len(pings) - len(known))
+    pings = known
+    if not pings:
+        return
+
+    today = timezone.now().date()
+    trips = {trip.bus_id: trip for trip in Trip.objects.filter(bus_id__in=buses, date=today)}
+
+    locations = LiveLocation.objects.bulk_create(
+        [
+            LiveLocation(
+                bus_id=p.bus_id,
+                trip=trips.get(p.bus_id),
+                latitude=p.latitude,
+                longitude=p.longitude,
+                speed_kmh=p.speed,
+                heading=p.heading,
+                timestamp=p.timestamp,
+            )
+            for p in pings
+        ],
+        batch_size=1000,
+    )
+
+    newest = {}
+    for location in locations:
+        current = newest.get(location.bus_id)
+        if current is None or location.timestamp >= current.timestamp:
+            newest[location.bus_id] = location
+
+    geometries = progress.geometries(buses[bus_id].route_id for bus_id in newest)
+    store = live_state.get_store()
+    # Progress other workers made, or this one before a restart
+    stored = store.get_many(list(newest))
+
+    next_stops, eta_rows, resumable = {}, [], {}
+    for bus_id, location in newest.items():
+        geometry = geometries.get(buses[bus_id].route_id)
+        trip = trips.get(bus_id)
+        if geometry is None:
+            next_stops[bus_id] = None
+            continue
+        tracker = progress.tracker(('trip', trip.id) if trip else ('bus', bus_id), geometry)
+        owner = resumable[bus_id] = {'trip_id': trip.id if trip else None, 'route_version': geometry.version}
+        previous = (stored.get(bus_id) or {}).get('progress')
+        if previous and all(previous.get(key) == value for key, value in owner.items()):
+            tracker.resume(previous['along_km'])
+        result = next_stops[bus_id] = tracker.update(
+            location.latitude, location.longitude, location.speed_kmh, now=location.timestamp
+        )
+        if result and result.next_stop is not None and trip:
+            eta_rows.append(ETACalculation(
+                bus_id=bus_id,
+                trip=trip,
+                destination_name=result.next_stop,
+                destination_latitude=geometry.latitudes[result.next_index],
+                destination_longitude=geometry.longitudes[result.next_index],
+                distance_remaining_km=round(result.distance_to_next_km, 2),
+                estimated_arrival_time=result.eta,
+            ))
+    etas = _save_etas(eta_rows)
+
+    updated = []
+    for bus_id, location in newest.items():
+        bus = buses[bus_id]
+        state = {
+            **live_state.bus_fields(bus),
+            **live_state.location_fields(location),
+            'next_stop': None,
+        }
+        result = next_stops[bus_id]
+        if result:
+            state.update({
+                'next_stop': result.next_stop,
+                'next_stop_index': result.next_index,
+                'along_route_km': round(result.along_km, 3),
+                'route_remaining_km': round(result.remaining_km, 3),
+                'off_route': result.off_route,
+                'progress': {**resumable[bus_id], 'along_km': result.along_km},
+            })
+        if bus_id in trips:
+            state.update(live_state.trip_fields(trips[bus_id]))
+        if bus_id in etas:
+            state.update(live_state.eta_fields(etas[bus_id]))
+        updated.append(store.update(bus_id, state))
+    broadcast.publish_many(updated)
@@ -0,0 +1,50 @@
+"""
+Channel-layer helpers for running several server processes.
+
+WebSocket updates only reach clients of other processes through a layer
+that is shared between them (``channels_redis``, enabled by ``REDIS_URL``).
+``check`` sends a message to a fresh channel and reads it back, which
+proves the layer is reachable and delivering. It backs the
+``/tracking/health/`` endpoint and ``manage.py runworkers``.
+"""
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+HEALTH_TIMEOUT = 2.0
+
+
+def backend_name(layer):
+    return f"{type(layer).__module__}.{type(layer).__name__}" if layer is not None else None
+
+
+def is_shared(layer):
+    """Whether ``layer`` delivers between processes."""
+    return layer is not None and not isinstance(layer, InMemoryChannelLayer)
+
+
+async def check(layer=None, timeout=HEALTH_TIMEOUT):
+    """Round-trip a message through the layer.
+
+    Returns a dict with ``ok``, ``backend``, ``shared`` and either
+    ``latency_ms`` or ``error``.
+    """
+    layer = layer or get_channel_layer()
+    result = {'backend': backend_name(layer), 'shared': is_shared(layer), 'ok': False}
+    if layer is None:
+        result['error'] = "CHANNEL_LAYERS is not configured"
+        return result
+
+    started = time.perf_counter()
+    try:
+        channel = await layer.new_channel('health.')
+        await layer.send(channel, {'type': 'health.ping', 'sent': started})
+        await asyncio.wait_for(layer.receive(channel), timeout)
+    except Exception as exc:
+        result['error'] = f"{type(exc).__name__}: {exc}" if str(exc) else type(exc).__name__
+        return result
+
+    result['ok'] = True
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return result
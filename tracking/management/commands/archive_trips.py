@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.dateparse import parse_date
+
+from buses.models import Trip
+from tracking import retention
+from tracking.models import LiveLocation, TripTrajectory
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill TripTrajectory archives for completed trips that have "
+        "LiveLocation rows but no archive (or rebuild them), and report the "
+        "storage they take against the rows they replace."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only trips on or after this date (YYYY-MM-DD).")
+        parser.add_argument('--rebuild', action='store_true', help="Rebuild existing archives too.")
+        parser.add_argument(
+            '--tolerance', type=float,
+            help="Simplification tolerance in metres (default: TRACKING_RETENTION['SIMPLIFY_METRES']).",
+        )
+
+    def handle(self, *args, **options):
+        trips = Trip.objects.filter(status='completed', locations__isnull=False).distinct().order_by('date', 'pk')
+        if options['since']:
+            trips = trips.filter(date__gte=parse_date(options['since']))
+        if not options['rebuild']:
+            trips = trips.filter(trajectory__isnull=True)
+
+        archived = 0
+        for trip_id in trips.values_list('pk', flat=True).iterator():
+            archived += retention.archive_trip(trip_id, options['tolerance'], rebuild=options['rebuild'])
+        self.stdout.write(f"Archived {archived} trip(s).")
+
+        totals = {'pings': 0, 'points': 0, 'bytes': 0}
+        for archive in TripTrajectory.objects.filter(trip__isnull=False).only('points', 'source_points', 'data').iterator():
+            totals['pings'] += archive.source_points
+            totals['points'] += archive.points
+            totals['bytes'] += len(archive.data)
+        if not totals['pings']:
+            return
+        line = (
+            f"Archives: {totals['pings']} pings -> {totals['points']} points in {totals['bytes']} bytes "
+            f"({totals['bytes'] / totals['pings']:.1f} bytes per ping)"
+        )
+        row_bytes = self._row_bytes()
+        if row_bytes:
+            line += f"; LiveLocation uses {row_bytes:.0f} bytes per row with indexes ({row_bytes * totals['pings'] / totals['bytes']:.0f}x)"
+        self.stdout.write(self.style.SUCCESS(line + "."))
+
+    @staticmethod
+    def _row_bytes():
+        """Average on-disk bytes per LiveLocation row, indexes included (PostgreSQL only)."""
+        if connection.vendor != 'postgresql':
+            return None
+        rows = LiveLocation.objects.count()
+        if not rows:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT COALESCE(SUM(pg_total_relation_size(c.oid)), pg_total_relation_size(%s::regclass)) "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass",
+                [LiveLocation._meta.db_table, LiveLocation._meta.db_table],
+            )
+            return cursor.fetchone()[0] / rows
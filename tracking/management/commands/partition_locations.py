@@ -0,0 +1,29 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from tracking import retention
+
+
+class Command(BaseCommand):
+    help = (
+        "PostgreSQL only: convert tracking_livelocation into a table "
+        "range-partitioned by day. Existing rows become one partition for "
+        "everything before today. Takes an exclusive lock while it runs; "
+        "afterwards prune_locations maintains the partitions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days-ahead', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Partitioning needs PostgreSQL.")
+        today = timezone.now().astimezone(datetime.timezone.utc).date()
+        if not retention.is_partitioned():
+            retention.convert_to_partitioned(today)
+            self.stdout.write(f"{retention.TABLE} is now partitioned by day.")
+        created = retention.ensure_partitions(today, options['days_ahead'])
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partition(s)."))
@@ -0,0 +1,81 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from tracking import retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply LiveLocation retention: downsample pings older than RAW_DAYS to "
+        "one per trip per minute, and archive pings older than DOWNSAMPLED_DAYS "
+        "into TripTrajectory rows before deleting them. Works in bounded "
+        "batches; run it daily. On a partitioned PostgreSQL table, expired "
+        "days are dropped as whole partitions and upcoming ones are created."
+    )
+
+    def add_arguments(self, parser):
+        config = retention.get_config()
+        parser.add_argument('--raw-days', type=int, default=config['RAW_DAYS'])
+        parser.add_argument('--downsampled-days', type=int, default=config['DOWNSAMPLED_DAYS'])
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'])
+        parser.add_argument('--pause', type=float, default=config['PAUSE'], help="Seconds between batches.")
+        parser.add_argument(
+            '--catch-up-days', type=int, default=2,
+            help="Days before the raw cutoff to downsample (days further back were done by earlier runs).",
+        )
+        parser.add_argument('--full', action='store_true', help="Downsample the whole downsampled tier.")
+        parser.add_argument('--partitions-ahead', type=int, default=3)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Report what would be archived, deleted and downsampled without changing anything.",
+        )
+
+    def handle(self, *args, **options):
+        if not 0 < options['raw_days'] <= options['downsampled_days']:
+            raise CommandError("Need 0 < --raw-days <= --downsampled-days.")
+        batch, pause = options['batch_size'], options['pause']
+        now = timezone.now()
+        archive_before, downsample_before = retention.cutoffs(
+            now, options['raw_days'], options['downsampled_days']
+        )
+
+        dry_run = options['dry_run']
+        # Counts of a dry run are of what a real run would do
+        note = " (dry run)" if dry_run else ""
+
+        partitioned = retention.is_partitioned()
+        if partitioned:
+            today = now.astimezone(datetime.timezone.utc).date()
+            if not dry_run:
+                created = retention.ensure_partitions(today, options['partitions_ahead'])
+                if created:
+                    self.stdout.write(f"Created partitions: {', '.join(created)}")
+
+            for day, name in sorted(retention.day_partitions().items()):
+                day_start = retention.utc_midnight(day)
+                day_end = day_start + datetime.timedelta(days=1)
+                if day_end > archive_before:
+                    break
+                written, _ = retention.archive_range(
+                    day_start, day_end, batch, pause, delete=False, dry_run=dry_run
+                )
+                if not dry_run:
+                    retention.drop_partition(name)
+                self.stdout.write(f"Archived {written} trajectories and dropped {name}{note}.")
+
+        # Rows outside droppable partitions (or every row, without partitioning)
+        written, deleted = retention.archive_range(None, archive_before, batch, pause, dry_run=dry_run)
+        self.stdout.write(
+            f"Archived {written} trajectories and deleted {deleted} pings "
+            f"before {archive_before:%Y-%m-%d}{note}."
+        )
+
+        start = archive_before
+        if not options['full']:
+            start = max(start, downsample_before - datetime.timedelta(days=options['catch_up_days']))
+        deleted = retention.downsample(start, downsample_before, batch, pause, dry_run=dry_run)
+        self.stdout.write(self.style.SUCCESS(
+            f"Downsampled {start:%Y-%m-%d} to {downsample_before:%Y-%m-%d}: removed {deleted} pings{note}."
+        ))
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+
+from tracking import layers
+from tracking import state as live_state
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve the ASGI app with several daphne processes sharing one "
+        "listening socket. More than one worker needs a channel layer, "
+        "state store and default cache shared between processes (set "
+        "REDIS_URL). Crashed workers are restarted; SIGTERM/SIGINT stop "
+        "them all. Workers pool their metrics in METRICS_DIR (a temporary "
+        "directory unless set) so /metrics/ on any of them covers all of "
+        "them."
+    )
+
+    RESTART_DELAY = 1.0
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--application', default='bustrack.asgi:application')
+        parser.add_argument(
+            '--proxy-headers', action='store_true',
+            help="Trust X-Forwarded-For from the load balancer.",
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError("--workers must be at least 1.")
+        if workers > 1:
+            self._check_shared()
+
+        sock = socket.socket(socket.AF_INET6 if ':' in options['bind'] else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((options['bind'], options['port']))
+        sock.listen(1024)
+        sock.set_inheritable(True)
+
+        command = [sys.executable, '-m', 'daphne', '--fd', str(sock.fileno())]
+        if options['proxy_headers']:
+            command.append('--proxy-headers')
+        command.append(options['application'])
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'bustrack.settings')}
+        env['METRICS_DIR'] = self._metrics_dir()
+
+        def spawn():
+            return subprocess.Popen(command, pass_fds=[sock.fileno()], env=env)
+
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for process in processes:
+                if process.poll() is None:
+                    process.send_signal(signal.SIGTERM)
+
+        processes = [spawn() for _ in range(workers)]
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.stdout.write(
+            f"Serving on {options['bind']}:{options['port']} with {workers} worker(s): "
+            + " ".join(str(p.pid) for p in processes)
+        )
+
+        while not stopping:
+            time.sleep(0.5)
+            for n, process in enumerate(processes):
+                code = process.poll()
+                if code is None or stopping:
+                    continue
+                self.stderr.write(f"Worker {process.pid} exited with {code}; restarting.")
+                time.sleep(self.RESTART_DELAY)
+                processes[n] = spawn()
+
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        sock.close()
+        if not settings.METRICS_DIR:
+            shutil.rmtree(env['METRICS_DIR'], ignore_errors=True)
+
+    def _metrics_dir(self):
+        """METRICS_DIR, emptied of the previous run's snapshots."""
+        if not settings.METRICS_DIR:
+            return tempfile.mkdtemp(prefix='bustrack-metrics-')
+        directory = Path(settings.METRICS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.glob('*.json'):
+            path.unlink(missing_ok=True)
+        return str(directory)
+
+    def _check_shared(self):
+        channel_layer = get_channel_layer()
+        if not layers.is_shared(channel_layer):
+            raise CommandError(
+                f"CHANNEL_LAYERS uses {layers.backend_name(channel_layer)}, which only delivers "
+                "inside one process; set REDIS_URL to run several workers."
+            )
+        if not live_state.get_store().shared:
+            raise CommandError(
+                "TRACKING_STATE_STORE is local to each process; set REDIS_URL to run several workers."
+            )
+        if isinstance(caches['default'], LocMemCache):
+            # Fare tables and route geometries would go stale in every worker but one
+            raise CommandError(
+                "CACHES['default'] is local to each process; set REDIS_URL to run several workers."
+            )
+        result = asyncio.run(layers.check(channel_layer))
+        if not result['ok']:
+            raise CommandError(f"Channel layer is not reachable: {result['error']}")
+        self.stdout.write(f"Channel layer {result['backend']} round trip {result['latency_ms']} ms.")
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0003_stopsearchindex'),
+        ('tracking', '0002_livelocation_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripTrajectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('points', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trajectories', to='buses.bus')),
+                ('trip', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='trajectory', to='buses.trip')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('trip__isnull', True)), fields=('bus', 'date'), name='unique_tripless_trajectory_per_bus_day')],
+            },
+        ),
+    ]
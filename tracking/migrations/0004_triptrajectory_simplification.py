@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0003_triptrajectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='triptrajectory',
+            name='source_points',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='triptrajectory',
+            name='tolerance_m',
+            field=models.FloatField(default=0),
+        ),
+    ]
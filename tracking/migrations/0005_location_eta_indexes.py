@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buses', '0004_trip_date_status_idx'),
+        ('tracking', '0004_triptrajectory_simplification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='etacalculation',
+            index=models.Index(fields=['bus', '-id'], name='eta_bus_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='livelocation',
+            index=models.Index(fields=['bus', '-timestamp'], name='livelocation_bus_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='livelocation',
+            index=models.Index(fields=['trip', 'timestamp'], name='livelocation_trip_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='livelocation',
+            index=models.Index(fields=['timestamp'], name='livelocation_time_idx'),
+        ),
+        migrations.AlterField(
+            model_name='etacalculation',
+            name='bus',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='eta_calculations', to='buses.bus'),
+        ),
+        migrations.AlterField(
+            model_name='livelocation',
+            name='bus',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='buses.bus'),
+        ),
+    ]
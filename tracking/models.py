@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from buses.models import Bus, Trip
 
 
@@ -6,7 +7,8 @@ class LiveLocation(models.Model):
     bus = models.ForeignKey(
         Bus,
         on_delete=models.CASCADE,
-        related_name='locations'
+        related_name='locations',
+        db_index=False,     # covered by the (bus, ...) index below
     )
     trip = models.ForeignKey(
         Trip,
@@ -22,7 +24,8 @@ class LiveLocation(models.Model):
     speed_kmh = models.DecimalField(max_digits=5, decimal_places=2, default=0)
     heading = models.DecimalField(max_digits=5, decimal_places=2, default=0)
 
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the ping is received, not when the batch is written
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return f"{self.bus} @ {self.latitude}, {self.longitude}"
@@ -30,13 +33,19 @@ class LiveLocation(models.Model):
     class Meta:
         ordering = ['-timestamp']
         get_latest_by = 'timestamp'
+        indexes = [
+            models.Index(fields=['bus', '-timestamp'], name='livelocation_bus_recent_idx'),
+            models.Index(fields=['trip', 'timestamp'], name='livelocation_trip_time_idx'),
+            models.Index(fields=['timestamp'], name='livelocation_time_idx'),
+        ]
 
 
 class ETACalculation(models.Model):
     bus = models.ForeignKey(
         Bus,
         on_delete=models.CASCADE,
-        related_name='eta_calculations'
+        related_name='eta_calculations',
+        db_index=False,     # covered by the (bus, ...) index below
     )
     trip = models.ForeignKey(
         Trip,
@@ -59,3 +68,52 @@ class ETACalculation(models.Model):
 
     class Meta:
         ordering = ['-calculated_at']
+        indexes = [
+            models.Index(fields=['bus', '-id'], name='eta_bus_latest_idx'),
+        ]
+
+
+class TripTrajectory(models.Model):
+    """A trip's track compacted into one blob (see ``tracking.trajectory``).
+
+    Written when a trip is completed, by ``manage.py archive_trips`` and by
+    ``manage.py prune_locations`` before old ``LiveLocation`` rows are
+    deleted. Pings recorded without a trip are archived per bus and day
+    with ``trip`` left empty.
+    """
+    bus = models.ForeignKey(
+        Bus,
+        on_delete=models.CASCADE,
+        related_name='trajectories'
+    )
+    trip = models.OneToOneField(
+        Trip,
+        on_delete=models.CASCADE,
+        related_name='trajectory',
+        null=True,
+        blank=True
+    )
+    date = models.DateField()
+
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    points = models.PositiveIntegerField()
+    # Pings the track was built from, and the simplification tolerance used
+    source_points = models.PositiveIntegerField(default=0)
+    tolerance_m = models.FloatField(default=0)
+    data = models.BinaryField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.bus} track on {self.date} ({self.points} points)"
+
+    class Meta:
+        ordering = ['-started_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['bus', 'date'],
+                condition=models.Q(trip__isnull=True),
+                name='unique_tripless_trajectory_per_bus_day',
+            ),
+        ]
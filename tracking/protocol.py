@@ -0,0 +1,109 @@
+"""
+Compact binary WebSocket protocol for live bus updates.
+
+Clients that offer ``bustrack.msgpack.v1`` or ``bustrack.cbor.v1`` in
+``Sec-WebSocket-Protocol`` receive binary messages instead of JSON. Each
+message is an array whose first element says what it is:
+
+* ``[0, buses, routes]`` dictionary frame, sent before the first update
+  of a bus and again whenever its metadata changes.
+  ``buses`` rows are ``[bus_id, name, number, route_id, status]``.
+  ``routes`` rows are ``[route_id, label, [stop names in order]]``.
+* ``[1, tick, updates]`` update frame. Each update is the fixed tuple
+  ``[bus_id, lat_e6, lng_e6, speed_dkmh, heading_ddeg, next_stop_index,
+  eta_epoch]``: latitude and longitude in millionths of a degree, speed
+  in 0.1 km/h, heading in 0.1 degree, the index of the next stop in the
+  route's stop list (-1 if unknown) and the ETA in Unix seconds (0 if
+  unknown).
+
+Clients that offer nothing, including ``static/js/live_tracking.js``, keep
+getting JSON.
+"""
+from datetime import datetime
+
+import cbor2
+import msgpack
+
+DICTIONARY = 0
+UPDATES = 1
+
+ENCODERS = {
+    'bustrack.msgpack.v1': msgpack.packb,
+    'bustrack.cbor.v1': cbor2.dumps,
+}
+DECODERS = {
+    'bustrack.msgpack.v1': msgpack.unpackb,
+    'bustrack.cbor.v1': cbor2.loads,
+}
+
+
+def negotiate(offered):
+    """First subprotocol offered by the client that we speak, or None for JSON."""
+    for name in offered or ():
+        if name in ENCODERS:
+            return name
+    return None
+
+
+def encode(subprotocol, message):
+    return ENCODERS[subprotocol](message)
+
+
+def decode(subprotocol, data):
+    return DECODERS[subprotocol](data)
+
+
+def _epoch(value):
+    if not value:
+        return 0
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def update_row(update):
+    """Fixed-schema tuple for a ``broadcast.location_update`` dict."""
+    next_index = update.get('next_stop_index')
+    return [
+        update['bus_id'],
+        round(float(update['latitude']) * 1e6),
+        round(float(update['longitude']) * 1e6),
+        round(float(update.get('speed') or 0) * 10),
+        round(float(update.get('heading') or 0) * 10),
+        -1 if next_index is None else next_index,
+        _epoch(update.get('eta')),
+    ]
+
+
+def bus_row(update):
+    return [
+        update['bus_id'],
+        update.get('bus_name'),
+        update.get('bus_number'),
+        update.get('route_id'),
+        update.get('status'),
+    ]
+
+
+def updates_frame(tick, rows):
+    return [UPDATES, tick, rows]
+
+
+def dictionary_frame(buses, routes):
+    return [DICTIONARY, buses, routes]
+
+
+def encoded_frames(tick, rows):
+    """The update frame in every binary encoding, for sharing across clients."""
+    frame = updates_frame(tick, rows)
+    return {name: encoder(frame) for name, encoder in ENCODERS.items()}
+
+
+def route_rows(route_ids, labels):
+    """Dictionary rows for routes; stop names come from the cached route geometry."""
+    from . import eta
+
+    geometries = eta.geometries(route_ids)
+    return [
+        [route_id, labels.get(route_id, ''), list(geometries[route_id].names)]
+        for route_id in route_ids
+        if route_id in geometries
+    ]
@@ -0,0 +1,390 @@
+"""
+Retention tiers for ``LiveLocation``, applied by ``manage.py prune_locations``.
+
+* Pings newer than ``RAW_DAYS`` are kept as received.
+* Older pings, up to ``DOWNSAMPLED_DAYS``, are thinned to the last ping
+  per trip (or per bus, for pings without a trip) per minute.
+* Anything older is compacted into a ``TripTrajectory`` per trip (or per
+  bus and day) and deleted. Trips are usually archived already, when
+  they complete (``archive_completed_trip``); tracks are simplified to
+  within ``SIMPLIFY_METRES``.
+
+Cutoffs fall on UTC midnights, so a day is always handled as a whole.
+Rows are deleted in batches of ``BATCH_SIZE`` primary keys with a short
+``PAUSE`` in between, and downsampling works one hour at a time, so no
+statement holds locks on more than one batch of rows.
+
+On PostgreSQL the table can be range-partitioned by day
+(``convert_to_partitioned``). Expired days are then archived and their
+partition dropped instead of deleted row by row. ``ensure_partitions``
+creates the coming days' partitions; a default partition catches
+anything else.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber, TruncDate, TruncMinute
+
+from . import trajectory
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'RAW_DAYS': 7,
+    'DOWNSAMPLED_DAYS': 90,
+    'BATCH_SIZE': 5000,
+    'PAUSE': 0.05,
+    'SIMPLIFY_METRES': 5.0,
+}
+ARCHIVE_FLUSH_TIMEOUT = 10
+
+TABLE = 'tracking_livelocation'
+PARTITION_FORMAT = TABLE + '_p%Y%m%d'
+DEFAULT_PARTITION = TABLE + '_default'
+LEGACY_PARTITION = TABLE + '_legacy'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'TRACKING_RETENTION', {})}
+
+
+def utc_midnight(day):
+    return datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+def cutoffs(now, raw_days, downsampled_days):
+    """(archive_before, downsample_before) as UTC midnights."""
+    today = now.astimezone(datetime.timezone.utc).date()
+    return (
+        utc_midnight(today - datetime.timedelta(days=downsampled_days)),
+        utc_midnight(today - datetime.timedelta(days=raw_days)),
+    )
+
+
+def _delete_batches(queryset, batch_size, pause):
+    """Delete ``queryset`` a batch of primary keys at a time; returns the count."""
+    from .models import LiveLocation
+
+    total = 0
+    while True:
+        ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += LiveLocation.objects.filter(pk__in=ids).delete()[0]
+        if pause:
+            time.sleep(pause)
+
+
+# -----------------------------
+# DOWNSAMPLING
+# -----------------------------
+def downsample(start, end, batch_size, pause=0, dry_run=False):
+    """Keep the last ping per trip (or tripless bus) per minute in [start, end).
+
+    Returns the number of pings removed, or with ``dry_run`` the number
+    that would be.
+    """
+    from .models import LiveLocation
+
+    total = 0
+    hour = datetime.timedelta(hours=1)
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + hour, end)
+        surplus = LiveLocation.objects.filter(
+            timestamp__gte=window_start, timestamp__lt=window_end
+        ).annotate(
+            rank=Window(
+                RowNumber(),
+                partition_by=[F('bus_id'), F('trip_id'), TruncMinute('timestamp')],
+                order_by=[F('timestamp').desc(), F('pk').desc()],
+            )
+        ).filter(rank__gt=1)
+        total += surplus.count() if dry_run else _delete_batches(surplus, batch_size, pause)
+        window_start = window_end
+    return total
+
+
+# -----------------------------
+# ARCHIVING
+# -----------------------------
+def _moment(epoch_ms):
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000, datetime.timezone.utc)
+
+
+def _track(rows, tolerance_m):
+    points = [trajectory.point(row) for row in rows.iterator(chunk_size=2000)]
+    return trajectory.simplify(points, tolerance_m), len(points)
+
+
+def archive_trip(trip_id, tolerance_m=None, rebuild=False):
+    """Write the trip's ``TripTrajectory`` from its rows.
+
+    An existing archive is kept, but pings stamped after it ends (written
+    late by another process's queue) are appended to it. ``rebuild``
+    replaces it from whatever rows are left. Returns True if anything was
+    written.
+    """
+    from buses.models import Trip
+    from .models import LiveLocation, TripTrajectory
+
+    if tolerance_m is None:
+        tolerance_m = get_config()['SIMPLIFY_METRES']
+    existing = TripTrajectory.objects.filter(trip_id=trip_id).first()
+    rows = LiveLocation.objects.filter(trip_id=trip_id).order_by('timestamp', 'pk')
+    if existing is not None and not rebuild:
+        rows = rows.filter(timestamp__gt=existing.ended_at)
+
+    points, source_points = _track(rows, tolerance_m)
+    if not points:
+        return False
+
+    if existing is not None and not rebuild:
+        existing.data = trajectory.encode(trajectory.decode(existing.data) + points)
+        existing.points += len(points)
+        existing.source_points += source_points
+        existing.ended_at = _moment(points[-1][0])
+        existing.save(update_fields=['data', 'points', 'source_points', 'ended_at'])
+        return True
+
+    trip = Trip.objects.get(pk=trip_id)
+    TripTrajectory.objects.update_or_create(
+        trip=trip,
+        defaults={
+            'bus_id': trip.bus_id,
+            'date': trip.date,
+            'started_at': _moment(points[0][0]),
+            'ended_at': _moment(points[-1][0]),
+            'points': len(points),
+            'source_points': source_points,
+            'tolerance_m': tolerance_m,
+            'data': trajectory.encode(points),
+        },
+    )
+    return True
+
+
+def archive_completed_trip(trip_id):
+    """Archive a trip that just completed, off the request thread.
+
+    Waits for this process's queued pings (``tracking.ingest``) to be
+    written first; pings still queued elsewhere are appended by a later
+    ``archive_trip``.
+    """
+    from . import ingest
+
+    def run():
+        try:
+            if ingest.get_config()['ENABLED']:
+                ingest.get_queue().flush(ARCHIVE_FLUSH_TIMEOUT)
+            close_old_connections()
+            archive_trip(trip_id)
+        except Exception:
+            logger.exception("Failed to archive trip %s", trip_id)
+        finally:
+            close_old_connections()
+
+    threading.Thread(target=run, name='tracking-archive', daemon=True).start()
+
+
+def archive_bus_day(bus_id, day):
+    """Merge a bus's tripless pings of one UTC day into its ``TripTrajectory``."""
+    from .models import LiveLocation, TripTrajectory
+
+    start = utc_midnight(day)
+    rows = LiveLocation.objects.filter(
+        bus_id=bus_id, trip__isnull=True,
+        timestamp__gte=start, timestamp__lt=start + datetime.timedelta(days=1),
+    ).order_by('timestamp', 'pk')
+    points, source_points = _track(rows, get_config()['SIMPLIFY_METRES'])
+    if not points:
+        return False
+
+    with transaction.atomic():
+        existing = TripTrajectory.objects.select_for_update().filter(
+            bus_id=bus_id, trip__isnull=True, date=day
+        ).first()
+        if existing is not None:
+            seen = {p[0] for p in points}
+            points = sorted(points + [p for p in trajectory.decode(existing.data) if p[0] not in seen])
+            source_points += existing.source_points
+            existing.delete()
+        TripTrajectory.objects.create(
+            bus_id=bus_id,
+            date=day,
+            started_at=_moment(points[0][0]),
+            ended_at=_moment(points[-1][0]),
+            points=len(points),
+            source_points=source_points,
+            tolerance_m=get_config()['SIMPLIFY_METRES'],
+            data=trajectory.encode(points),
+        )
+    return True
+
+
+def archive_range(start, end, batch_size, pause=0, delete=True, dry_run=False):
+    """Archive every trip and tripless bus-day with pings in [start, end).
+
+    With ``delete`` the archived rows older than ``end`` are deleted in
+    batches; without it the caller drops them (a whole partition).
+    Returns (trajectories written, rows deleted). With ``dry_run``
+    nothing is written and the counts are of the trajectories that would
+    be written or extended and the rows that would be deleted.
+    """
+    from .models import LiveLocation
+
+    in_range = LiveLocation.objects.order_by()
+    if start is not None:
+        in_range = in_range.filter(timestamp__gte=start)
+    in_range = in_range.filter(timestamp__lt=end)
+
+    trip_ids = list(in_range.filter(trip__isnull=False).values_list('trip_id', flat=True).distinct())
+    if dry_run:
+        bus_days = in_range.filter(trip__isnull=True).annotate(
+            day=TruncDate('timestamp', tzinfo=datetime.timezone.utc)
+        ).values_list('bus_id', 'day').distinct().count()
+        deleted = 0
+        if delete:
+            deleted = (
+                LiveLocation.objects.filter(trip_id__in=trip_ids, timestamp__lt=end).count()
+                + in_range.filter(trip__isnull=True).count()
+            )
+        return len(trip_ids) + bus_days, deleted
+
+    written = deleted = 0
+    for trip_id in trip_ids:
+        written += archive_trip(trip_id)
+        if delete:
+            deleted += _delete_batches(
+                LiveLocation.objects.filter(trip_id=trip_id, timestamp__lt=end), batch_size, pause
+            )
+
+    bus_days = list(
+        in_range.filter(trip__isnull=True)
+        .annotate(day=TruncDate('timestamp', tzinfo=datetime.timezone.utc))
+        .values_list('bus_id', 'day')
+        .distinct()
+    )
+    for bus_id, day in bus_days:
+        written += archive_bus_day(bus_id, day)
+        if delete:
+            day_start = utc_midnight(day)
+            deleted += _delete_batches(
+                LiveLocation.objects.filter(
+                    bus_id=bus_id, trip__isnull=True,
+                    timestamp__gte=day_start,
+                    timestamp__lt=min(day_start + datetime.timedelta(days=1), end),
+                ),
+                batch_size, pause,
+            )
+    return written, deleted
+
+
+# -----------------------------
+# POSTGRESQL PARTITIONS
+# -----------------------------
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def day_partitions():
+    """{day: partition name} of the daily partitions that exist."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        try:
+            partitions[datetime.datetime.strptime(name, PARTITION_FORMAT).date()] = name
+        except ValueError:
+            continue    # default and legacy partitions
+    return partitions
+
+
+def ensure_partitions(today, days_ahead):
+    """Create the daily partitions from ``today`` to ``days_ahead`` days later."""
+    existing = day_partitions()
+    created = []
+    with connection.cursor() as cursor:
+        for offset in range(days_ahead + 1):
+            day = today + datetime.timedelta(days=offset)
+            if day in existing:
+                continue
+            name = day.strftime(PARTITION_FORMAT)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE}" '
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [utc_midnight(day), utc_midnight(day + datetime.timedelta(days=1))],
+            )
+            created.append(name)
+    return created
+
+
+def drop_partition(name):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+
+
+def convert_to_partitioned(today):
+    """Turn the table into one range-partitioned by day, keeping existing rows.
+
+    The current table becomes the partition for everything before
+    ``today``; partitions from ``today`` on are daily. PostgreSQL needs the
+    partition key in the primary key, so it becomes (id, timestamp), and
+    ids come from a plain sequence because identity columns cannot be
+    shared with partitions before PostgreSQL 17.
+    """
+    from .models import LiveLocation
+
+    sequence = f'{TABLE}_id_seq_partitioned'
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(f'SELECT COALESCE(MAX("id"), 0) + 1 FROM "{TABLE}"')
+        next_id = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{LEGACY_PARTITION}"')
+        cursor.execute(f'ALTER TABLE "{LEGACY_PARTITION}" ALTER COLUMN "id" DROP IDENTITY IF EXISTS')
+        cursor.execute(f'ALTER TABLE "{LEGACY_PARTITION}" ALTER COLUMN "id" DROP DEFAULT')
+        cursor.execute(f'CREATE SEQUENCE "{sequence}" START WITH {int(next_id)}')
+        cursor.execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{LEGACY_PARTITION}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+        cursor.execute(f'ALTER TABLE "{TABLE}" ALTER COLUMN "id" SET DEFAULT nextval(\'"{sequence}"\')')
+        cursor.execute(f'ALTER SEQUENCE "{sequence}" OWNED BY "{TABLE}"."id"')
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY ("id", "timestamp")')
+        for column, target in (('bus_id', 'buses_bus'), ('trip_id', 'buses_trip')):
+            cursor.execute(
+                f'ALTER TABLE "{TABLE}" ADD FOREIGN KEY ("{column}") REFERENCES "{target}" ("id") '
+                f'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
+            )
+        # The model's indexes are recreated on the partitioned table; the
+        # renamed copies on the old table become its partition's indexes
+        for index in LiveLocation._meta.indexes:
+            cursor.execute(f'ALTER INDEX IF EXISTS "{index.name}" RENAME TO "{index.name}_legacy"')
+        with connection.schema_editor() as editor:
+            for index in LiveLocation._meta.indexes:
+                editor.add_index(LiveLocation, index)
+
+        # Existing rows stay where they are, as the partition before today
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{LEGACY_PARTITION}" '
+            f"FOR VALUES FROM (MINVALUE) TO (%s)",
+            [utc_midnight(today)],
+        )
+        cursor.execute(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+    ensure_partitions(today, 1)
@@ -1,6 +1,13 @@
 from django.urls import re_path
 from . import consumers
 
+# Served ahead of Django's URLconf by bustrack.asgi
+http_urlpatterns = [
+    re_path(r'^tracking/api/update-location/$', consumers.LocationIngestConsumer.as_asgi()),
+]
+
 websocket_urlpatterns = [
     re_path(r'ws/live-buses/$', consumers.LiveBusConsumer.as_asgi()),
+    re_path(r'ws/tracking/$', consumers.LiveBusConsumer.as_asgi(subscribe_fleet=False)),
+    re_path(r'ws/driver/$', consumers.DriverLocationConsumer.as_asgi()),
 ]
@@ -0,0 +1,46 @@
+from functools import partial
+
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from buses.models import Bus, Stop, Trip
+from . import auth, eta, retention, state
+
+
+@receiver(post_save, sender=Trip)
+def track_trip_status(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if instance.status in ('completed', 'cancelled'):
+        eta.forget(('trip', instance.pk))
+    if instance.status == 'completed':
+        transaction.on_commit(partial(retention.archive_completed_trip, instance.pk))
+    if instance.date != timezone.now().date():
+        return
+    state.get_store().update(
+        instance.bus_id,
+        {**state.bus_fields(instance.bus), **state.trip_fields(instance)},
+    )
+
+
+@receiver(post_save, sender=Bus)
+def track_bus_details(sender, instance, raw=False, **kwargs):
+    store = state.get_store()
+    if not raw and store.get(instance.pk) is not None:
+        store.update(instance.pk, state.bus_fields(instance))
+
+
+@receiver(post_save, sender=Stop)
+@receiver(post_delete, sender=Stop)
+def invalidate_route_geometry(sender, instance, **kwargs):
+    eta.invalidate(instance.route_id)
+
+
+@receiver(user_logged_out)
+def forget_driver_session(sender, request, user, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        auth.forget_session(session.session_key)
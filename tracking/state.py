@@ -0,0 +1,383 @@
+"""
+Latest known state per bus: position, speed, heading, next stop, ETA and
+trip status, so the live map endpoints can answer from memory instead of
+sorting ``LiveLocation`` per bus.
+
+The backend is chosen with ``settings.TRACKING_STATE_STORE``::
+
+    TRACKING_STATE_STORE = {
+        'BACKEND': 'tracking.state.LocalStateStore',   # one process (dev)
+        # 'BACKEND': 'tracking.state.RedisStateStore', # shared between workers
+        'OPTIONS': {'CACHE': 'tracking'},
+    }
+
+Several writers touch one bus at once (ingested pings set the position,
+trip and bus saves set their fields), so an update merges its fields into
+the stored state instead of replacing it. ``RedisStateStore`` keeps each
+state as a Redis hash and merges with HSET, which is atomic across
+processes. ``CacheStateStore`` works with any Django cache backend but can
+only merge under a process lock, so it never counts as shared. A cold
+store is filled from the database by ``warm_from_db`` with one window (or
+DISTINCT ON) query per table.
+"""
+import datetime
+import json
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+DEFAULT_STORE = {
+    'BACKEND': 'tracking.state.LocalStateStore',
+    'OPTIONS': {},
+}
+
+
+class BaseStateStore:
+    """Interface every backend implements. States are plain JSON-able dicts."""
+
+    # Whether every server process sees the same states
+    shared = False
+
+    def get(self, bus_id):
+        return self.get_many([bus_id]).get(bus_id)
+
+    def get_many(self, bus_ids):
+        raise NotImplementedError
+
+    def update(self, bus_id, fields):
+        """Merge the ``fields`` dict into the bus's state, creating it if needed."""
+        raise NotImplementedError
+
+    def all(self):
+        """Every known state, or None while the store is cold."""
+        raise NotImplementedError
+
+    def replace_all(self, states):
+        """Swap in a complete snapshot and mark the store warm."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalStateStore(BaseStateStore):
+    def __init__(self, **options):
+        self._states = {}
+        self._warm = False
+        self._lock = threading.Lock()
+
+    def get_many(self, bus_ids):
+        states = self._states
+        return {bus_id: dict(states[bus_id]) for bus_id in bus_ids if bus_id in states}
+
+    def update(self, bus_id, fields):
+        with self._lock:
+            state = dict(self._states.get(bus_id) or {'bus_id': bus_id})
+            state.update(fields)
+            self._states[bus_id] = state
+        return dict(state)
+
+    def all(self):
+        if not self._warm:
+            return None
+        return [dict(state) for state in list(self._states.values())]
+
+    def replace_all(self, states):
+        with self._lock:
+            self._states = {state['bus_id']: dict(state) for state in states}
+            self._warm = True
+
+    def clear(self):
+        with self._lock:
+            self._states = {}
+            self._warm = False
+
+
+class CacheStateStore(BaseStateStore):
+    """States in any Django cache, merged under a lock held by this process only."""
+
+    KEY = 'tracking:state:{bus_id}'
+    INDEX_KEY = 'tracking:state:index'
+    WARM_KEY = 'tracking:state:warm'
+
+    def __init__(self, CACHE='default', TIMEOUT=None, **options):
+        self.cache = caches[CACHE]
+        self.timeout = TIMEOUT
+        self._lock = threading.Lock()
+
+    def _key(self, bus_id):
+        return self.KEY.format(bus_id=bus_id)
+
+    def get_many(self, bus_ids):
+        keys = {self._key(bus_id): bus_id for bus_id in bus_ids}
+        found = self.cache.get_many(list(keys))
+        return {keys[key]: state for key, state in found.items()}
+
+    def update(self, bus_id, fields):
+        key = self._key(bus_id)
+        with self._lock:
+            state = self.cache.get(key) or {'bus_id': bus_id}
+            state.update(fields)
+            self.cache.set(key, state, self.timeout)
+
+            index = self.cache.get(self.INDEX_KEY) or []
+            if bus_id not in index:
+                self.cache.set(self.INDEX_KEY, index + [bus_id], self.timeout)
+        return state
+
+    def all(self):
+        if not self.cache.has_key(self.WARM_KEY):
+            return None
+        return list(self.get_many(self.cache.get(self.INDEX_KEY) or []).values())
+
+    def replace_all(self, states):
+        with self._lock:
+            self._delete_states()
+            self.cache.set_many({self._key(s['bus_id']): s for s in states}, self.timeout)
+            self.cache.set(self.INDEX_KEY, [s['bus_id'] for s in states], self.timeout)
+            self.cache.set(self.WARM_KEY, True, self.timeout)
+
+    def clear(self):
+        with self._lock:
+            self._delete_states()
+            self.cache.delete(self.WARM_KEY)
+
+    def _delete_states(self):
+        index = self.cache.get(self.INDEX_KEY) or []
+        self.cache.delete_many([self._key(bus_id) for bus_id in index] + [self.INDEX_KEY])
+
+
+class RedisStateStore(BaseStateStore):
+    """States as Redis hashes (one per bus, fields as JSON) listed in a Redis set.
+
+    An update is one MULTI of HSET, SADD to the index and HGETALL of the
+    merged state, so updates from different processes never drop each
+    other's fields or buses. Connects through the Django ``RedisCache``
+    named by ``CACHE`` and uses its key prefix. ``all`` is None until
+    ``replace_all`` has warmed the store (``WARM_KEY``).
+    """
+
+    shared = True
+    KEY = 'tracking:state:{bus_id}'
+    INDEX_KEY = 'tracking:state:index'
+    WARM_KEY = 'tracking:state:warm'
+
+    def __init__(self, CACHE='default', TIMEOUT=None, **options):
+        self.cache = caches[CACHE]
+        if not isinstance(self.cache, RedisCache):
+            raise ImproperlyConfigured(
+                f"RedisStateStore needs a RedisCache; CACHES[{CACHE!r}] is {type(self.cache).__name__}."
+            )
+        self.timeout = TIMEOUT
+        self.index_key = self.cache.make_and_validate_key(self.INDEX_KEY)
+        self.warm_key = self.cache.make_and_validate_key(self.WARM_KEY)
+
+    def _client(self):
+        return self.cache._cache.get_client(write=True)
+
+    def _key(self, bus_id):
+        return self.cache.make_and_validate_key(self.KEY.format(bus_id=bus_id))
+
+    @staticmethod
+    def _encode(fields):
+        return {field: json.dumps(value) for field, value in fields.items()}
+
+    @staticmethod
+    def _decode(fields):
+        return {field.decode(): json.loads(value) for field, value in fields.items()}
+
+    def _write(self, pipe, bus_id, fields):
+        key = self._key(bus_id)
+        pipe.hset(key, mapping=self._encode(fields))
+        if self.timeout:
+            pipe.expire(key, self.timeout)
+
+    def get_many(self, bus_ids):
+        bus_ids = list(bus_ids)
+        with self._client().pipeline(transaction=False) as pipe:
+            for bus_id in bus_ids:
+                pipe.hgetall(self._key(bus_id))
+            found = pipe.execute()
+        return {bus_id: self._decode(state) for bus_id, state in zip(bus_ids, found) if state}
+
+    def update(self, bus_id, fields):
+        with self._client().pipeline() as pipe:
+            self._write(pipe, bus_id, {'bus_id': bus_id, **fields})
+            pipe.sadd(self.index_key, bus_id)
+            pipe.hgetall(self._key(bus_id))
+            state = pipe.execute()[-1]
+        return self._decode(state)
+
+    def all(self):
+        client = self._client()
+        if not client.exists(self.warm_key):
+            return None
+        return list(self.get_many(int(bus_id) for bus_id in client.smembers(self.index_key)).values())
+
+    def replace_all(self, states):
+        client = self._client()
+        stale = [self._key(int(bus_id)) for bus_id in client.smembers(self.index_key)]
+        with client.pipeline() as pipe:
+            pipe.delete(self.index_key, *stale)
+            for state in states:
+                self._write(pipe, state['bus_id'], state)
+            if states:
+                pipe.sadd(self.index_key, *(state['bus_id'] for state in states))
+            pipe.set(self.warm_key, 1, ex=self.timeout)
+            pipe.execute()
+
+    def clear(self):
+        client = self._client()
+        stale = [self._key(int(bus_id)) for bus_id in client.smembers(self.index_key)]
+        client.delete(self.index_key, self.warm_key, *stale)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'TRACKING_STATE_STORE', DEFAULT_STORE)
+                backend = import_string(config['BACKEND'])
+                _store = backend(**config.get('OPTIONS', {}))
+    return _store
+
+
+def reset_store():
+    global _store
+    _store = None
+
+
+# -----------------------------
+# STATE CONSTRUCTION
+# -----------------------------
+def bus_fields(bus):
+    return {
+        'bus_id': bus.id,
+        'bus_name': bus.bus_name,
+        'bus_number': bus.bus_number,
+        'is_active': bus.is_active,
+        'route_id': bus.route_id,
+        'route': str(bus.route) if bus.route_id else '',
+    }
+
+
+def trip_fields(trip):
+    return {
+        'trip_id': trip.id,
+        'trip_date': trip.date.isoformat(),
+        'status': trip.status,
+    }
+
+
+def location_fields(location):
+    return {
+        'latitude': float(location.latitude),
+        'longitude': float(location.longitude),
+        'speed': float(location.speed_kmh),
+        'heading': float(location.heading),
+        'timestamp': location.timestamp.isoformat(),
+    }
+
+
+def eta_fields(eta):
+    return {
+        'next_stop': eta.destination_name,
+        'eta': {
+            'destination': eta.destination_name,
+            'distance_remaining_km': round(float(eta.distance_remaining_km), 2),
+            'estimated_arrival': eta.estimated_arrival_time.isoformat(),
+        }
+    }
+
+
+def _latest_per_bus(queryset, order_field):
+    """Newest row per bus in one query: DISTINCT ON where supported, else ROW_NUMBER()."""
+    if connection.features.can_distinct_on_fields:
+        return queryset.order_by('bus_id', f'-{order_field}').distinct('bus_id')
+    return queryset.annotate(
+        recency=Window(
+            RowNumber(),
+            partition_by=F('bus_id'),
+            order_by=F(order_field).desc(),
+        )
+    ).filter(recency=1)
+
+
+def latest_locations(bus_ids):
+    """Newest location per bus within the raw retention window.
+
+    Older pings are downsampled or archived (``tracking.retention``), so
+    bounding the search keeps it on recent rows (and partitions) however
+    long the table grows.
+    """
+    from .models import LiveLocation
+    from .retention import get_config
+
+    since = timezone.now() - datetime.timedelta(days=get_config()['RAW_DAYS'])
+    rows = _latest_per_bus(
+        LiveLocation.objects.filter(bus_id__in=bus_ids, timestamp__gte=since), 'timestamp'
+    )
+    return {row.bus_id: row for row in rows}
+
+
+def latest_etas(bus_ids):
+    from .models import ETACalculation
+
+    rows = _latest_per_bus(ETACalculation.objects.filter(bus_id__in=bus_ids), 'id')
+    return {row.bus_id: row for row in rows}
+
+
+def warm_from_db(store=None):
+    """Load today's trips with their latest location and ETA into the store."""
+    from buses.models import Trip
+
+    store = store or get_store()
+    trips = list(
+        Trip.objects
+        .filter(date=timezone.now().date())
+        .select_related('bus__route')
+    )
+    bus_ids = [trip.bus_id for trip in trips]
+    locations = latest_locations(bus_ids)
+    etas = latest_etas(bus_ids)
+
+    states = []
+    for trip in trips:
+        state = {**bus_fields(trip.bus), **trip_fields(trip)}
+        if trip.bus_id in locations:
+            state.update(location_fields(locations[trip.bus_id]))
+        if trip.bus_id in etas:
+            state.update(eta_fields(etas[trip.bus_id]))
+        states.append(state)
+
+    store.replace_all(states)
+    return states
+
+
+def running_states(store=None):
+    """States of buses on a running trip today that have reported a position."""
+    store = store or get_store()
+    states = store.all()
+    if states is None:
+        states = warm_from_db(store)
+
+    today = timezone.now().date().isoformat()
+    return [
+        state for state in states
+        if state.get('status') == 'running'
+        and state.get('trip_date') == today
+        and 'latitude' in state
+    ]
@@ -1,3 +1,875 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import threading
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from benchmarks.plans import QueryPlanTestMixin
+from bookings.tests import make_bus, stop
+from buses.models import Bus, Trip
+from bustrack.querybudget import QueryBudgetTestMixin, assert_max_queries
+from users.models import Driver, UserProfile
+
+from . import auth, broadcast, eta, ingest, protocol, retention, trajectory
+from . import state as live_state
+from .consumers import DriverLocationConsumer, LiveBusConsumer, LocationIngestConsumer
+from .models import LiveLocation, TripTrajectory
+
+LOCMEM = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'tracking': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tracking-tests'},
+}
+
+
+class StateStoreTests:
+    """Run against each backend by the subclasses below."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.store.clear()
+        self.addCleanup(self.store.clear)
+
+    def test_cold_until_replaced(self):
+        self.store.update(1, {'speed': 10.0})
+        self.assertIsNone(self.store.all())
+        self.store.replace_all([{'bus_id': 2, 'status': 'running'}])
+        self.assertEqual(self.store.all(), [{'bus_id': 2, 'status': 'running'}])
+        self.assertEqual(self.store.get_many([1, 2, 3]), {2: {'bus_id': 2, 'status': 'running'}})
+
+    def test_update_merges_fields(self):
+        self.store.replace_all([])
+        self.store.update(1, {'speed': 10.0, 'eta': {'destination': "Stop 2"}})
+        merged = self.store.update(1, {'speed': 20.0, 'status': 'running'})
+        expected = {'bus_id': 1, 'speed': 20.0, 'status': 'running', 'eta': {'destination': "Stop 2"}}
+        self.assertEqual(merged, expected)
+        self.assertEqual(self.store.get(1), expected)
+        self.assertEqual(self.store.all(), [expected])
+
+    def test_concurrent_updates_keep_every_field_and_bus(self):
+        self.store.replace_all([])
+        writers = 8
+        barrier = threading.Barrier(writers)
+
+        def write(writer):
+            barrier.wait()
+            for bus_id in range(20):
+                self.store.update(bus_id, {f'field_{writer}': writer})
+
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        states = sorted(self.store.all(), key=lambda state: state['bus_id'])
+        self.assertEqual([state['bus_id'] for state in states], list(range(20)))
+        for state in states:
+            self.assertEqual(state, {'bus_id': state['bus_id'], **{f'field_{n}': n for n in range(writers)}})
+
+    def test_clear(self):
+        self.store.replace_all([{'bus_id': 1}])
+        self.store.clear()
+        self.assertIsNone(self.store.all())
+        self.assertIsNone(self.store.get(1))
+
+
+class LocalStateStoreTests(StateStoreTests, SimpleTestCase):
+    def make_store(self):
+        return live_state.LocalStateStore()
+
+
+@override_settings(CACHES=LOCMEM)
+class CacheStateStoreTests(StateStoreTests, SimpleTestCase):
+    def make_store(self):
+        return live_state.CacheStateStore(CACHE='tracking')
+
+    def test_not_shared(self):
+        self.assertFalse(self.store.shared)
+
+
+@skipUnless(settings.REDIS_URL, "needs REDIS_URL")
+class RedisStateStoreTests(StateStoreTests, SimpleTestCase):
+    def make_store(self):
+        return live_state.RedisStateStore(CACHE='tracking')
+
+
+@override_settings(CACHES=LOCMEM)
+class RedisStateStoreConfigTests(SimpleTestCase):
+    def test_needs_a_redis_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            live_state.RedisStateStore(CACHE='tracking')
+
+
+class DriverPingTestMixin:
+    """A logged-in driver and a bus, with ingest caches reset around each test."""
+
+    def setUp(self):
+        self.bus = make_bus()
+        self.driver = User.objects.create(username='driver')
+        UserProfile.objects.create(user=self.driver, role='driver')
+        self.client.force_login(self.driver)
+        self.url = reverse('tracking:update_location')
+        for reset in (ingest.forget_buses, live_state.reset_store):
+            reset()
+            self.addCleanup(reset)
+
+
+@override_settings(TRACKING_INGEST={'ENABLED': False}, TRACKING_BROADCAST={'TICK': 0})
+class UpdateLocationTests(DriverPingTestMixin, TestCase):
+    def post(self, bus_id):
+        ping = {'bus_id': bus_id, 'latitude': 18.52, 'longitude': 73.85, 'speed': 30}
+        return self.client.post(self.url, json.dumps(ping), content_type='application/json')
+
+    def test_records_a_ping(self):
+        response = self.post(self.bus.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(LiveLocation.objects.filter(bus=self.bus).count(), 1)
+        self.assertEqual(live_state.get_store().get(self.bus.pk)['speed'], 30.0)
+
+    def test_unknown_bus(self):
+        rejected = ingest.PINGS.labels(ingest.UNKNOWN_BUS)
+        before = rejected.snapshot()
+        response = self.post(self.bus.pk + 1)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"error": "Bus not found"})
+        self.assertEqual(rejected.snapshot(), before + 1)
+        self.assertFalse(LiveLocation.objects.exists())
+
+    def test_known_bus_is_remembered(self):
+        self.post(self.bus.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(ingest.known_bus(self.bus.pk))
+
+    def test_batch_queries_do_not_grow_with_buses(self):
+        buses = [self.bus] + [make_bus(number=f'T-{n}') for n in range(2, 6)]
+        for bus in buses:
+            Trip.objects.create(bus=bus, date=timezone.now().date(), status='running')
+
+        def pings(offset):
+            return [
+                ingest.parse_ping(json.dumps({'bus_id': bus.pk, 'latitude': 18.51 + offset, 'longitude': 73.81}))
+                for bus in buses
+            ]
+
+        ingest.write_batch(pings(0))    # warms the route geometries
+        with assert_max_queries(None) as one_bus:
+            ingest.write_batch(pings(0.001)[:1])
+        with assert_max_queries(one_bus.count):
+            ingest.write_batch(pings(0.002))
+
+    def test_progress_resumes_from_the_state_store(self):
+        Trip.objects.create(bus=self.bus, date=timezone.now().date(), status='running')
+
+        def write(latitude, longitude):
+            ingest.write_batch([ingest.parse_ping(json.dumps(
+                {'bus_id': self.bus.pk, 'latitude': latitude, 'longitude': longitude}
+            ))])
+            return live_state.get_store().get(self.bus.pk)['next_stop_index']
+
+        self.assertEqual(write(18.531, 73.831), 3)     # just past Stop 3
+        # Another worker, with no tracker of its own, gets a ping jittering back
+        eta._trackers.clear()
+        self.assertEqual(write(18.529, 73.829), 3)
+
+    def test_last_seen_times_are_forgotten(self):
+        queue = ingest.PingQueue(writer=lambda batch: None)
+        self.addCleanup(queue.close)
+        now = timezone.now()
+        for bus_id, age in ((1, ingest.SEEN_TTL + 1), (2, 0)):
+            queue.submit(ingest.Ping(bus_id, 18.52, 73.85, 0.0, 0.0, now - datetime.timedelta(seconds=age)))
+        queue._next_prune = 0
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(set(queue._last_seen), {2})
+
+    def test_pings_of_a_deleted_bus_are_logged(self):
+        ping = ingest.parse_ping(json.dumps({'bus_id': self.bus.pk, 'latitude': 18.52, 'longitude': 73.85}))
+        self.bus.delete()
+        with self.assertLogs('tracking.ingest', 'WARNING') as logs:
+            ingest.write_batch([ping])
+        self.assertIn("Dropped 1 GPS ping(s) for deleted buses", logs.output[0])
+        self.assertFalse(LiveLocation.objects.exists())
+
+
+# Queue full: every ping is refused
+FULL_QUEUE = {'ENABLED': True, 'MAX_PENDING': 0}
+
+
+@override_settings(TRACKING_INGEST={'ENABLED': False}, TRACKING_BROADCAST={'TICK': 0})
+class IngestConsumerTests(DriverPingTestMixin, TransactionTestCase):
+    driver_socket = staticmethod(DriverLocationConsumer.as_asgi())
+    ingest_http = staticmethod(LocationIngestConsumer.as_asgi())
+
+    def setUp(self):
+        super().setUp()
+        Bus.objects.filter(pk=self.bus.pk).update(
+            driver=Driver.objects.create(user=self.driver, license_number="MH-0001")
+        )
+        self.other_bus = make_bus(number='T-2')
+        self.passenger = User.objects.create(username='passenger')
+        UserProfile.objects.create(user=self.passenger, role='user')
+        for reset in (auth._sessions.clear, ingest.reset_queue):
+            reset()
+            self.addCleanup(reset)
+        self.addCleanup(broadcast.bind_loop, None)
+
+    def ping(self, **fields):
+        return {'latitude': 18.52, 'longitude': 73.85, 'speed': 30, **fields}
+
+    def stored(self):
+        return dict(LiveLocation.objects.values_list('bus_id').annotate(pings=Count('id')))
+
+    async def open_socket(self, user):
+        communicator = WebsocketCommunicator(self.driver_socket, '/ws/driver/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_socket_is_bound_to_the_drivers_bus(self):
+        communicator = await self.open_socket(self.driver)
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'bound', 'bus_id': self.bus.pk})
+        await communicator.send_json_to(self.ping())
+        await communicator.send_json_to(self.ping(bus_id=self.bus.pk))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+        self.assertEqual(await database_sync_to_async(self.stored)(), {self.bus.pk: 2})
+
+    async def test_socket_refuses_anyone_but_an_assigned_driver(self):
+        unassigned = await database_sync_to_async(User.objects.create)(username='relief')
+        await database_sync_to_async(UserProfile.objects.create)(user=unassigned, role='driver')
+        for user in (AnonymousUser(), self.passenger, unassigned):
+            with self.subTest(user=user):
+                communicator = await self.open_socket(user)
+                self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4403})
+
+    async def test_socket_answers_bad_pings_with_errors(self):
+        communicator = await self.open_socket(self.driver)
+        await communicator.receive_json_from()
+        for frame, error in (
+            ("not json", "Invalid location data"),
+            (json.dumps({'latitude': 18.52}), "Missing required fields"),
+            (json.dumps(self.ping(speed="fast")), "Invalid location data"),
+            (json.dumps(self.ping(bus_id=self.other_bus.pk)),
+             f"This connection sends locations for bus {self.bus.pk} only"),
+        ):
+            with self.subTest(frame=frame):
+                await communicator.send_to(text_data=frame)
+                self.assertEqual(await communicator.receive_json_from(), {'type': 'error', 'error': error})
+        await communicator.disconnect()
+        self.assertEqual(await database_sync_to_async(self.stored)(), {})
+
+    @override_settings(TRACKING_INGEST=FULL_QUEUE)
+    async def test_socket_asks_to_retry_when_the_queue_is_full(self):
+        communicator = await self.open_socket(self.driver)
+        await communicator.receive_json_from()
+        await communicator.send_json_to(self.ping())
+        self.assertEqual(await communicator.receive_json_from(), {
+            'type': 'error', 'error': "Too many pending location updates", 'retry_after': 1,
+        })
+        await communicator.disconnect()
+
+    async def post(self, body, session=True, method='POST'):
+        headers = []
+        if session:
+            cookie = self.client.cookies[settings.SESSION_COOKIE_NAME]
+            headers.append((b'cookie', f'{cookie.key}={cookie.value}'.encode()))
+        communicator = HttpCommunicator(
+            self.ingest_http, method, '/tracking/api/update-location/', body=body.encode(), headers=headers
+        )
+        response = await communicator.get_response()
+        return response['status'], dict(response['headers']), json.loads(response['body'])
+
+    async def test_http_records_a_ping(self):
+        status, _, body = await self.post(json.dumps(self.ping(bus_id=self.bus.pk)))
+        self.assertEqual((status, body['status']), (200, 'success'))
+        self.assertEqual(await database_sync_to_async(self.stored)(), {self.bus.pk: 1})
+
+    async def test_http_errors(self):
+        ping = json.dumps(self.ping(bus_id=self.bus.pk))
+        for request, status, error in (
+            ({'body': ping, 'session': False}, 401, "Authentication required"),
+            ({'body': "{"}, 400, "Invalid location data"),
+            ({'body': json.dumps(self.ping())}, 400, "Missing required fields"),
+            ({'body': json.dumps(self.ping(bus_id=self.other_bus.pk + 1))}, 404, "Bus not found"),
+            ({'body': "", 'method': 'GET'}, 405, "Method not allowed"),
+        ):
+            with self.subTest(request=request):
+                self.assertEqual((await self.post(**request))[::2], (status, {'error': error}))
+        self.assertEqual(await database_sync_to_async(self.stored)(), {})
+
+    async def test_http_refuses_non_drivers(self):
+        await database_sync_to_async(self.client.force_login)(self.passenger)
+        status, _, body = await self.post(json.dumps(self.ping(bus_id=self.bus.pk)))
+        self.assertEqual((status, body), (403, {'error': "Driver access required"}))
+
+    @override_settings(TRACKING_INGEST=FULL_QUEUE)
+    async def test_http_asks_to_retry_when_the_queue_is_full(self):
+        status, headers, body = await self.post(json.dumps(self.ping(bus_id=self.bus.pk)))
+        self.assertEqual((status, body), (503, {'error': "Too many pending location updates"}))
+        self.assertEqual(headers[b'Retry-After'], b'1')
+
+
+class StallingLayer:
+    """Channel layer whose ``stall``-th group_send hangs, only the first time if it ``recovers``."""
+
+    def __init__(self, stall, recovers=True):
+        self.stall = stall
+        self.recovers = recovers
+        self.received = []
+        self.cancelled = 0
+
+    async def group_send(self, group, message):
+        if len(self.received) == self.stall and not (self.recovers and self.cancelled):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        self.received.append(group)
+
+
+@mock.patch.multiple(broadcast, SEND_TIMEOUT=0.05, SEND_BACKOFF=0)
+class BroadcastSendTests(SimpleTestCase):
+    def setUp(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        broadcast.bind_loop(loop)
+        self.addCleanup(broadcast.bind_loop, None)
+        self.addCleanup(loop.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(self.drain(), loop).result())
+        self.groups = [f'bus_{n}' for n in range(4)]
+
+    @staticmethod
+    async def drain():
+        """Let cancelled sends finish unwinding."""
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def send(self, layer):
+        with mock.patch.object(broadcast, 'get_channel_layer', return_value=layer):
+            broadcast._send([(group, {'type': 'send_frame'}) for group in self.groups])
+
+    def test_timed_out_send_is_cancelled_and_resumed(self):
+        layer = StallingLayer(stall=2)
+        self.send(layer)
+        self.assertEqual(layer.cancelled, 1)
+        self.assertEqual(layer.received, self.groups)
+
+    def test_gives_up_after_retries(self):
+        layer = StallingLayer(stall=1, recovers=False)
+        with self.assertLogs('tracking.broadcast', 'WARNING') as logs:
+            self.send(layer)
+        self.assertEqual(layer.received, self.groups[:1])
+        self.assertIn("Dropped 3 live bus messages", logs.output[0])
+
+
+class GroupsForSubscriptionTests(SimpleTestCase):
+    def test_groups(self):
+        x, y = broadcast.tile_for(18.52, 73.85)
+        for message, groups in (
+            ({'fleet': True}, {'live_buses'}),
+            ({'bus': 3}, {'bus_3'}),
+            ({'bus': [3, "4"], 'route': 7}, {'bus_3', 'bus_4', 'route_7'}),
+            ({'tile': [x, y]}, {f'tile_11_{x}_{y}'}),
+            ({'bbox': [18.52, 73.85, 18.52, 73.85]}, {f'tile_11_{x}_{y}'}),
+        ):
+            with self.subTest(message=message):
+                self.assertEqual(broadcast.groups_for_subscription(message), groups)
+
+    def test_a_bbox_covers_its_tiles(self):
+        self.assertEqual(len(broadcast.groups_for_subscription({'bbox': [18.4, 73.7, 18.6, 73.9]})), 4)
+
+    def test_rejects_malformed_subscriptions(self):
+        for message in (
+            {}, {'fleet': False}, {'bus': 'x'}, {'bus': None}, {'route': [1, []]},
+            {'tile': [1]}, {'tile': 5}, {'bbox': [1, 2, 3]}, {'bbox': [0, 0, 60, 60]},
+        ):
+            with self.subTest(message=message), self.assertRaises(ValueError):
+                broadcast.groups_for_subscription(message)
+
+
+def bus_state(bus_id, timestamp, route_id=None, latitude=18.52, longitude=73.85):
+    return {
+        'bus_id': bus_id, 'route_id': route_id, 'route': f"Route {route_id}" if route_id else '',
+        'latitude': latitude, 'longitude': longitude, 'timestamp': timestamp,
+    }
+
+
+class LiveBusConsumerTests(SimpleTestCase):
+    application = staticmethod(LiveBusConsumer.as_asgi(subscribe_fleet=False))
+
+    def setUp(self):
+        broadcast._last_tiles.clear()
+        self.addCleanup(broadcast._last_tiles.clear)
+        self.addCleanup(broadcast.bind_loop, None)
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(self.application, '/ws/tracking/', subprotocols=subprotocols)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, **keys):
+        await communicator.send_json_to({'action': 'subscribe', **keys})
+        return await communicator.receive_json_from()
+
+    async def publish(self, states, tick=1):
+        channel_layer = get_channel_layer()
+        for group, event in broadcast.frame_events(states, tick):
+            await channel_layer.group_send(group, event)
+
+    async def frame_bus_ids(self, communicator):
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'frame')
+        return [bus['bus_id'] for bus in frame['buses']]
+
+    async def test_subscribe_and_unsubscribe(self):
+        communicator = await self.connect()
+        self.assertEqual(await self.subscribe(communicator, bus=[1, 2]), {
+            'type': 'subscriptions', 'groups': ['bus_1', 'bus_2'],
+        })
+        await communicator.send_json_to({'action': 'unsubscribe', 'bus': 1})
+        self.assertEqual((await communicator.receive_json_from())['groups'], ['bus_2'])
+
+        await self.publish([bus_state(1, 't1')])
+        self.assertTrue(await communicator.receive_nothing())
+        await self.publish([bus_state(2, 't1')])
+        self.assertEqual(await self.frame_bus_ids(communicator), [2])
+        await communicator.disconnect()
+
+    async def test_rejects_bad_subscriptions(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, bus=1)
+        for message in ('not json', '["subscribe"]', '{"action": "watch", "bus": 2}', '{"action": "subscribe"}',
+                        '{"action": "subscribe", "bus": "two"}'):
+            with self.subTest(message=message):
+                await communicator.send_to(text_data=message)
+                self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        # Nothing changed: still on bus_1 only
+        self.assertEqual((await self.subscribe(communicator, bus=1))['groups'], ['bus_1'])
+        await communicator.disconnect()
+
+    async def test_subscriptions_are_limited(self):
+        self.application = LiveBusConsumer.as_asgi(subscribe_fleet=False, max_subscriptions=3)
+        communicator = await self.connect()
+        await self.subscribe(communicator, bus=[1, 2])
+        self.assertEqual(await self.subscribe(communicator, route=[7, 8]), {
+            'type': 'error', 'error': "Too many subscriptions",
+        })
+        self.assertEqual((await self.subscribe(communicator, route=7))['groups'], ['bus_1', 'bus_2', 'route_7'])
+        await communicator.disconnect()
+
+    async def test_starts_unsubscribed_without_subscribe_fleet(self):
+        communicator = await self.connect()
+        await self.publish([bus_state(1, 't1')])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_starts_on_the_fleet_until_it_subscribes(self):
+        self.application = LiveBusConsumer.as_asgi()
+        communicator = await self.connect()
+        await self.publish([bus_state(1, 't1')])
+        self.assertEqual(await self.frame_bus_ids(communicator), [1])
+
+        self.assertEqual((await self.subscribe(communicator, bus=2))['groups'], ['bus_2'])
+        await self.publish([bus_state(1, 't2')])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_overlapping_groups_send_an_update_once(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, bus=1, route=7)
+        await self.publish([bus_state(1, 't1', route_id=7)])
+        self.assertEqual(await self.frame_bus_ids(communicator), [1])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await self.publish([bus_state(1, 't2', route_id=7)], tick=2)
+        self.assertEqual(await self.frame_bus_ids(communicator), [1])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_a_frame_loses_only_the_updates_already_sent(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, bus=1, route=7)
+        # bus_1's frame goes out first, then route_7's with both buses
+        await self.publish([bus_state(1, 't1', route_id=7), bus_state(2, 't1', route_id=7)])
+        self.assertEqual(await self.frame_bus_ids(communicator), [1])
+        self.assertEqual(await self.frame_bus_ids(communicator), [2])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_json_without_a_subprotocol(self):
+        communicator = WebsocketCommunicator(self.application, '/ws/tracking/')
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual((connected, subprotocol), (True, None))
+        await self.subscribe(communicator, bus=1)
+
+        await self.publish([bus_state(1, 't1')])
+        self.assertNotIn('bytes', await communicator.receive_output())
+        await get_channel_layer().group_send('bus_1', broadcast.location_event(bus_state(1, 't2')))
+        update = await communicator.receive_json_from()
+        self.assertEqual((update['type'], update['bus_id'], update['timestamp']), ('send_location', 1, 't2'))
+        await communicator.disconnect()
+
+    async def test_binary_clients_get_the_dictionary_first(self):
+        subprotocol = 'bustrack.cbor.v1'
+        communicator = WebsocketCommunicator(self.application, '/ws/tracking/', subprotocols=[subprotocol])
+        self.assertEqual(await communicator.connect(), (True, subprotocol))
+        await self.subscribe(communicator, bus=1)
+
+        async def receive():
+            return protocol.decode(subprotocol, (await communicator.receive_output())['bytes'])
+
+        state = {**bus_state(1, 't1', route_id=7), 'bus_name': "Deccan Queen", 'bus_number': "MH-12", 'status': 'running'}
+        stops = [7, "Route 7", ["Swargate", "Pimpri"]]
+        with mock.patch.object(protocol, 'route_rows', return_value=[stops]) as route_rows:
+            await self.publish([state])
+            self.assertEqual(await receive(), [protocol.DICTIONARY, [[1, "Deccan Queen", "MH-12", 7, 'running']], [stops]])
+            self.assertEqual(await receive(), [protocol.UPDATES, 1, [protocol.update_row(state)]])
+
+            # Known metadata is not sent again, and a change resends only the bus
+            await self.publish([{**state, 'timestamp': 't2'}], tick=2)
+            self.assertEqual((await receive())[0], protocol.UPDATES)
+            await self.publish([{**state, 'timestamp': 't3', 'status': 'completed'}], tick=3)
+            self.assertEqual(await receive(), [protocol.DICTIONARY, [[1, "Deccan Queen", "MH-12", 7, 'completed']], []])
+            self.assertEqual((await receive())[0], protocol.UPDATES)
+        route_rows.assert_called_once_with([7], {7: "Route 7"})
+        await communicator.disconnect()
+
+    async def test_binary_frames_are_re_encoded_without_sent_updates(self):
+        subprotocol = 'bustrack.msgpack.v1'
+        communicator = await self.connect([subprotocol])
+        tile = broadcast.tile_for(18.52, 73.85)
+        await self.subscribe(communicator, bus=1, tile=list(tile))
+        await self.publish([bus_state(1, 't1'), bus_state(2, 't1')])
+
+        updates = []
+        while not await communicator.receive_nothing():
+            message = protocol.decode(subprotocol, (await communicator.receive_output())['bytes'])
+            if message[0] == protocol.UPDATES:
+                updates.append([row[0] for row in message[2]])
+        self.assertEqual(updates, [[1], [2]])
+        await communicator.disconnect()
+
+
+class ProtocolTests(SimpleTestCase):
+    update = {
+        'bus_id': 12, 'latitude': 18.520123, 'longitude': 73.856789, 'speed': 31.26, 'heading': 271.04,
+        'next_stop_index': 2, 'eta': '2030-01-15T08:30:00+00:00',
+    }
+
+    def test_negotiate(self):
+        self.assertEqual(protocol.negotiate(['v2', 'bustrack.cbor.v1', 'bustrack.msgpack.v1']), 'bustrack.cbor.v1')
+        for offered in (None, [], ['v2']):
+            self.assertIsNone(protocol.negotiate(offered))
+
+    def test_update_row(self):
+        self.assertEqual(protocol.update_row(self.update), [
+            12, 18520123, 73856789, 313, 2710, 2,
+            int(datetime.datetime(2030, 1, 15, 8, 30, tzinfo=datetime.timezone.utc).timestamp()),
+        ])
+        unknown = {**self.update, 'speed': None, 'next_stop_index': None, 'eta': None}
+        self.assertEqual(protocol.update_row(unknown)[3:], [0, 2710, -1, 0])
+
+    def test_round_trips(self):
+        updates = protocol.updates_frame(4, [protocol.update_row(self.update)])
+        dictionary = protocol.dictionary_frame(
+            [[12, "Deccan Queen", "MH-12", 7, 'running'], [13, None, None, None, None]],
+            [[7, "Swargate - Pimpri", ["Swargate", "Shivaji Nagar", "Pimpri"]]],
+        )
+        for subprotocol in protocol.ENCODERS:
+            for frame in (updates, dictionary):
+                with self.subTest(subprotocol=subprotocol, kind=frame[0]):
+                    encoded = protocol.encode(subprotocol, frame)
+                    self.assertIsInstance(encoded, bytes)
+                    self.assertEqual(protocol.decode(subprotocol, encoded), frame)
+
+    def test_encoded_frames(self):
+        rows = [protocol.update_row(self.update)]
+        frames = protocol.encoded_frames(4, rows)
+        self.assertEqual(set(frames), set(protocol.ENCODERS))
+        for subprotocol, encoded in frames.items():
+            self.assertEqual(protocol.decode(subprotocol, encoded), [protocol.UPDATES, 4, rows])
+            # Smaller than the JSON it replaces
+            self.assertLess(len(encoded), len(json.dumps(self.update)))
+
+
+class RouteGeometryTests(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        for reset in (cache.clear, eta._geometries.clear):
+            reset()
+            self.addCleanup(reset)
+
+    def geometry(self):
+        return eta.geometries([self.bus.route_id])[self.bus.route_id]
+
+    def test_cached_in_the_process(self):
+        geometry = self.geometry()
+        self.assertEqual(geometry.names, ["Stop 1", "Stop 2", "Stop 3", "Stop 4"])
+        with self.assertNumQueries(0):
+            self.assertIs(self.geometry(), geometry)
+
+    def test_route_rows(self):
+        self.assertEqual(
+            protocol.route_rows([self.bus.route_id], {self.bus.route_id: "Route T-1"}),
+            [[self.bus.route_id, "Route T-1", ["Stop 1", "Stop 2", "Stop 3", "Stop 4"]]],
+        )
+
+    def test_stop_change_rebuilds(self):
+        geometry = self.geometry()
+        moved = stop(self.bus, 2)
+        moved.name = "Moved"
+        moved.save()
+        self.assertIsNot(self.geometry(), geometry)
+        self.assertEqual(self.geometry().names[1], "Moved")
+
+    def test_stop_change_in_another_process_rebuilds(self):
+        geometry = self.geometry()
+        # Another worker's invalidate only reaches this one through the cache
+        stop(self.bus, 4).delete()
+        eta._geometries[self.bus.route_id] = (None, geometry)
+        self.assertEqual(len(self.geometry()), 3)
+
+
+class TripProgressTests(SimpleTestCase):
+    # Four stops due north, about 1.1 km apart
+    geometry = eta.RouteGeometry(1, [(f"Stop {n}", 18.50 + n / 100, 73.8) for n in range(4)])
+
+    def setUp(self):
+        eta._trackers.clear()
+        self.addCleanup(eta._trackers.clear)
+
+    def update(self, tracker, latitude):
+        return tracker.update(latitude, 73.8, speed_kmh=30)
+
+    def test_next_stop_only_moves_forward(self):
+        tracker = eta.TripProgress(self.geometry)
+        self.assertEqual(self.update(tracker, 18.49).next_index, 0)    # approaching the first stop
+        seen = []
+        for latitude in (18.500, 18.505, 18.512, 18.518, 18.523, 18.526, 18.522, 18.521):
+            result = self.update(tracker, latitude)
+            seen.append((result.next_index, result.along_km))
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual([index for index, _ in seen], [1, 1, 2, 2, 3, 3, 3, 3])
+
+    def test_jitter_near_a_stop_does_not_go_back(self):
+        tracker = eta.TripProgress(self.geometry)
+        self.update(tracker, 18.500)
+        passed = self.update(tracker, 18.5205)
+        self.assertEqual(passed.next_stop, "Stop 3")
+        for latitude in (18.5195, 18.5185, 18.5202):
+            result = self.update(tracker, latitude)
+            self.assertEqual((result.next_stop, result.along_km), ("Stop 3", passed.along_km))
+
+    def test_end_of_route(self):
+        tracker = eta.TripProgress(self.geometry)
+        self.update(tracker, 18.500)
+        result = self.update(tracker, 18.535)
+        self.assertEqual((result.next_index, result.remaining_km), (None, 0.0))
+
+    def test_resume(self):
+        tracker = eta.TripProgress(self.geometry)
+        tracker.resume(self.geometry.cumulative[2] + 0.1)
+        self.assertEqual(self.update(tracker, 18.519).next_stop, "Stop 3")
+        tracker.resume(0.0)
+        self.assertEqual(self.update(tracker, 18.519).next_stop, "Stop 3")
+
+    def test_trackers_are_kept_per_key(self):
+        tracker = eta.tracker(('trip', 1), self.geometry)
+        self.assertIs(eta.tracker(('trip', 1), self.geometry), tracker)
+        moved = eta.RouteGeometry(1, [("A", 18.5, 73.8), ("B", 18.6, 73.8)])
+        self.assertIsNot(eta.tracker(('trip', 1), moved), tracker)
+        eta.forget(('trip', 1))
+        self.assertNotIn(('trip', 1), eta._trackers)
+
+    @mock.patch.object(eta, 'MAX_TRACKERS', 2)
+    def test_trackers_are_bounded(self):
+        for trip_id in range(5):
+            eta.tracker(('trip', trip_id), self.geometry)
+        self.assertEqual(list(eta._trackers), [('trip', 3), ('trip', 4)])
+
+
+class RunWorkersTests(SimpleTestCase):
+    def test_refuses_several_workers_on_a_process_local_cache(self):
+        shared_store = mock.Mock(shared=True)
+        with mock.patch('tracking.layers.is_shared', return_value=True), \
+                mock.patch.object(live_state, 'get_store', return_value=shared_store), \
+                self.assertRaisesMessage(CommandError, "CACHES['default'] is local to each process"):
+            call_command('runworkers', workers=2)
+
+
+class TrajectoryTests(SimpleTestCase):
+    points = [
+        (1_700_000_000_000 + n * 1000, (18_500_000 + n * 10) / 1e6, (73_800_000 + n * 20) / 1e6, 30.5, 90.0)
+        for n in range(trajectory.CHUNK_POINTS * 2 + 10)
+    ]
+
+    def test_round_trip(self):
+        self.assertEqual(trajectory.decode(trajectory.encode(self.points)), self.points)
+        self.assertEqual(trajectory.decode(trajectory.encode([])), [])
+
+    def test_seek(self):
+        blob = trajectory.encode(self.points)
+        since, until = self.points[300][0], self.points[520][0]
+        self.assertEqual(list(trajectory.iter_points(blob, since, until)), self.points[300:520])
+
+    def test_unknown_version(self):
+        blob = bytes([trajectory.VERSION + 1]) + trajectory.encode(self.points)[1:]
+        with self.assertRaisesMessage(ValueError, "Unknown trajectory encoding"):
+            trajectory.decode(blob)
+
+
+@override_settings(TRACKING_RETENTION={'SIMPLIFY_METRES': 0, 'PAUSE': 0})
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.bus = make_bus()
+        self.midnight = retention.utc_midnight(timezone.now().astimezone(datetime.timezone.utc).date())
+
+    def ping(self, timestamp, trip=None, bus=None, n=0):
+        # Whole microdegrees and seconds, which the trajectory encoding keeps exactly
+        return LiveLocation.objects.create(
+            bus=bus or self.bus, trip=trip, timestamp=timestamp.replace(microsecond=0),
+            latitude=Decimal('18.500000') + Decimal(n) / 10**6, longitude=Decimal('73.800000') + Decimal(n) / 10**6,
+            speed_kmh=Decimal('30.5'), heading=Decimal('90.0'),
+        )
+
+    def trip_on(self, moment, bus=None):
+        return Trip.objects.create(bus=bus or self.bus, date=moment.date(), status='completed')
+
+    def points(self, archive):
+        return list(trajectory.iter_points(bytes(archive.data)))
+
+    def test_cutoffs_fall_on_utc_midnights(self):
+        now = datetime.datetime(2026, 10, 18, 15, 30, tzinfo=datetime.timezone.utc)
+        self.assertEqual(retention.cutoffs(now, 7, 90), (
+            datetime.datetime(2026, 7, 20, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2026, 10, 11, tzinfo=datetime.timezone.utc),
+        ))
+
+    def test_downsample_keeps_the_last_ping_per_trip_per_minute(self):
+        start = self.midnight - datetime.timedelta(days=2)
+        trip = self.trip_on(start)
+        other_bus = make_bus(number='T-2')
+        kept = []
+        for minute in range(2):
+            pings = [self.ping(start + datetime.timedelta(minutes=minute, seconds=10 * n), trip, n=n) for n in range(3)]
+            kept.append(pings[-1])
+        tripless = [self.ping(start + datetime.timedelta(seconds=n), bus=other_bus) for n in range(2)]
+        kept.append(tripless[-1])
+
+        self.assertEqual(retention.downsample(start, start + datetime.timedelta(days=1), 2, dry_run=True), 5)
+        self.assertEqual(retention.downsample(start, start + datetime.timedelta(days=1), 2), 5)
+        self.assertEqual(set(LiveLocation.objects.all()), set(kept))
+
+    def test_archive_then_delete_round_trips(self):
+        start = self.midnight - datetime.timedelta(days=5)
+        trip = self.trip_on(start)
+        rows = [self.ping(start + datetime.timedelta(seconds=n), trip, n=n) for n in range(300)]
+        tripless = self.ping(start + datetime.timedelta(hours=1), n=7)
+
+        written, deleted = retention.archive_range(None, self.midnight, 100)
+        self.assertEqual((written, deleted), (2, 301))
+        self.assertFalse(LiveLocation.objects.exists())
+        archive = TripTrajectory.objects.get(trip=trip)
+        self.assertEqual((archive.points, archive.source_points), (300, 300))
+        self.assertEqual(self.points(archive), [trajectory.point(row) for row in rows])
+        day_archive = TripTrajectory.objects.get(bus=self.bus, trip__isnull=True)
+        self.assertEqual(self.points(day_archive), [trajectory.point(tripless)])
+
+    def test_late_pings_are_appended_to_the_archive(self):
+        start = self.midnight - datetime.timedelta(days=5)
+        trip = self.trip_on(start)
+        rows = [self.ping(start + datetime.timedelta(seconds=n), trip, n=n) for n in range(3)]
+        self.assertTrue(retention.archive_trip(trip.pk))
+        late = self.ping(start + datetime.timedelta(seconds=60), trip, n=60)
+        self.assertTrue(retention.archive_trip(trip.pk))
+        self.assertFalse(retention.archive_trip(trip.pk))
+
+        archive = TripTrajectory.objects.get(trip=trip)
+        self.assertEqual((archive.points, archive.source_points), (4, 4))
+        self.assertEqual(archive.ended_at, late.timestamp)
+        self.assertEqual(self.points(archive), [trajectory.point(row) for row in rows + [late]])
+
+    def prune(self, *args):
+        out = StringIO()
+        call_command('prune_locations', '--raw-days=1', '--downsampled-days=3', *args, stdout=out)
+        return out.getvalue()
+
+    def tiers(self):
+        """Two pings a few seconds apart in each tier."""
+        hour = datetime.timedelta(hours=1)
+        return {
+            tier: [self.ping(moment), self.ping(moment + datetime.timedelta(seconds=5))]
+            for tier, moment in (
+                ('raw', self.midnight - hour),
+                ('downsampled', self.midnight - datetime.timedelta(days=2) + hour),
+                ('archived', self.midnight - datetime.timedelta(days=5) + hour),
+            )
+        }
+
+    def test_prune_applies_each_tier(self):
+        tiers = self.tiers()
+        self.prune()
+        self.assertEqual(
+            set(LiveLocation.objects.all()),
+            {*tiers['raw'], tiers['downsampled'][1]},
+        )
+        self.assertEqual(TripTrajectory.objects.get().points, 2)
+
+    def test_dry_run_changes_nothing(self):
+        self.tiers()
+        before = list(LiveLocation.objects.order_by('pk').values())
+        output = self.prune('--dry-run')
+        self.assertIn("Archived 1 trajectories and deleted 2 pings", output)
+        self.assertIn("removed 1 pings (dry run)", output)
+        self.assertEqual(list(LiveLocation.objects.order_by('pk').values()), before)
+        self.assertFalse(TripTrajectory.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "needs PostgreSQL")
+class PartitionTests(TestCase):
+    def test_convert_keeps_rows_and_adds_day_partitions(self):
+        bus = make_bus()
+        old = LiveLocation.objects.create(
+            bus=bus, latitude=18.5, longitude=73.8, timestamp=timezone.now() - datetime.timedelta(days=2)
+        )
+        today = timezone.now().astimezone(datetime.timezone.utc).date()
+        retention.convert_to_partitioned(today)
+
+        self.assertTrue(retention.is_partitioned())
+        self.assertEqual(set(retention.day_partitions()), {today, today + datetime.timedelta(days=1)})
+        new = LiveLocation.objects.create(bus=bus, latitude=18.5, longitude=73.8)
+        self.assertGreater(new.pk, old.pk)
+        self.assertEqual(set(LiveLocation.objects.values_list('pk', flat=True)), {old.pk, new.pk})
+
+
+class HotPathTests(QueryPlanTestMixin, QueryBudgetTestMixin, TestCase):
+    def test_views_use_indexes(self):
+        self.assertHotPathsUseIndexes('tracking')
+
+    def test_views_stay_within_query_budgets(self):
+        self.assertHotPathsWithinBudget('tracking')
@@ -0,0 +1,182 @@
+"""
+Compact encoding of a bus's track for ``TripTrajectory`` archives.
+
+A track is a list of points ``(epoch_ms, latitude, longitude, speed_kmh,
+heading)``. Each field is scaled to an integer (milliseconds, 1e-6
+degree, 0.1 km/h, 0.1 degree), delta-encoded against the previous point,
+zigzag-mapped and written as a varint, field by field. Consecutive pings
+of a moving bus differ by a few metres and a second or so, so most
+deltas take one or two bytes before compression.
+
+Points are stored in chunks of ``CHUNK_POINTS``, each zlib-compressed on
+its own, behind an index of every chunk's first timestamp, point count
+and length. ``iter_points`` uses the index to seek to a time and only
+decompresses the chunks it returns.
+
+``simplify`` thins a track with Douglas-Peucker using the
+time-synchronised distance: a point is dropped only if the bus would be
+within the tolerance of it when interpolating between the kept points at
+that moment, so dwell times at stops survive as well as the shape.
+"""
+import bisect
+import math
+import zlib
+
+VERSION = 1
+SCALES = (1, 1e6, 1e6, 10, 10)
+CHUNK_POINTS = 256
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def point(location):
+    """Track point for a ``LiveLocation``."""
+    return (
+        int(location.timestamp.timestamp() * 1000),
+        float(location.latitude),
+        float(location.longitude),
+        float(location.speed_kmh),
+        float(location.heading),
+    )
+
+
+# -----------------------------
+# SIMPLIFICATION
+# -----------------------------
+def simplify(points, tolerance_m):
+    """Douglas-Peucker on time-synchronised distance; keeps first and last points."""
+    if tolerance_m <= 0 or len(points) < 3:
+        return list(points)
+
+    lat0 = math.radians(sum(p[1] for p in points) / len(points))
+    kx = math.radians(1) * EARTH_RADIUS_M * math.cos(lat0)
+    ky = math.radians(1) * EARTH_RADIUS_M
+    xs = [p[2] * kx for p in points]
+    ys = [p[1] * ky for p in points]
+    ts = [p[0] for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        span = ts[last] - ts[first]
+        worst, worst_index = tolerance_m, None
+        for i in range(first + 1, last):
+            ratio = (ts[i] - ts[first]) / span if span else 0.0
+            dx = xs[first] + (xs[last] - xs[first]) * ratio - xs[i]
+            dy = ys[first] + (ys[last] - ys[first]) * ratio - ys[i]
+            distance = math.hypot(dx, dy)
+            if distance > worst:
+                worst, worst_index = distance, i
+        if worst_index is not None:
+            keep[worst_index] = True
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    return [p for p, kept in zip(points, keep) if kept]
+
+
+# -----------------------------
+# ENCODING
+# -----------------------------
+def _encode_chunk(points):
+    out = bytearray()
+    previous = (0,) * len(SCALES)
+    for values in points:
+        scaled = tuple(round(value * scale) for value, scale in zip(values, SCALES))
+        for current, last in zip(scaled, previous):
+            _write_varint(out, _zigzag(current - last))
+        previous = scaled
+    return zlib.compress(bytes(out), 9)
+
+
+def _decode_chunk(data, count, pos=0):
+    current = [0] * len(SCALES)
+    for _ in range(count):
+        for field in range(len(SCALES)):
+            delta, pos = _read_varint(data, pos)
+            current[field] += _unzigzag(delta)
+        yield (
+            current[0],
+            current[1] / SCALES[1],
+            current[2] / SCALES[2],
+            current[3] / SCALES[3],
+            current[4] / SCALES[4],
+        )
+
+
+def encode(points):
+    chunks = [points[i:i + CHUNK_POINTS] for i in range(0, len(points), CHUNK_POINTS)]
+    bodies = [_encode_chunk(chunk) for chunk in chunks]
+    header = bytearray([VERSION])
+    _write_varint(header, len(chunks))
+    for chunk, body in zip(chunks, bodies):
+        _write_varint(header, chunk[0][0])
+        _write_varint(header, len(chunk))
+        _write_varint(header, len(body))
+    return bytes(header) + b''.join(bodies)
+
+
+def _index(blob):
+    """[(first_ms, count, offset, length)] for every chunk."""
+    if not blob or blob[0] != VERSION:
+        raise ValueError("Unknown trajectory encoding")
+    chunks, pos = _read_varint(blob, 1)
+    entries = []
+    for _ in range(chunks):
+        first_ms, pos = _read_varint(blob, pos)
+        count, pos = _read_varint(blob, pos)
+        length, pos = _read_varint(blob, pos)
+        entries.append([first_ms, count, 0, length])
+    for entry in entries:
+        entry[2] = pos
+        pos += entry[3]
+    return entries
+
+
+def iter_points(blob, since_ms=None, until_ms=None):
+    """Points with ``since_ms <= epoch_ms < until_ms``, decompressing only the chunks needed."""
+    blob = bytes(blob)
+    index = _index(blob)
+    start = 0
+    if since_ms is not None:
+        start = max(bisect.bisect_right([entry[0] for entry in index], since_ms) - 1, 0)
+    for first_ms, count, offset, length in index[start:]:
+        if until_ms is not None and first_ms >= until_ms:
+            return
+        for values in _decode_chunk(zlib.decompress(blob[offset:offset + length]), count):
+            if since_ms is not None and values[0] < since_ms:
+                continue
+            if until_ms is not None and values[0] >= until_ms:
+                return
+            yield values
+
+
+def decode(blob):
+    return list(iter_points(blob))
@@ -7,9 +7,11 @@ urlpatterns = [
     path("api/update-location/", views.update_location, name="update_location"),
     path("api/bus/<int:bus_id>/", views.get_bus_location, name="get_bus_location"),
     path("api/active-buses/", views.get_all_active_buses, name="get_active_buses"),
+    path("health/", views.health, name="health"),
 
     path("api/trip/start/", views.start_trip, name="start_trip"),
     path("api/trip/end/", views.end_trip, name="end_trip"),
+    path("api/trip/<int:trip_id>/replay/", views.trip_replay, name="trip_replay"),
 
     path("driver/", views.driver_tracking_view, name="driver_view"),
 ]
@@ -1,19 +1,21 @@
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
 from django.contrib.auth.decorators import login_required
 
-from geopy.distance import geodesic
+import datetime
 import json
+import os
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-
-from .models import LiveLocation, ETACalculation
+from . import ingest, layers, trajectory
+from . import state as live_state
+from .models import LiveLocation, TripTrajectory
 from buses.models import Bus, Trip
 from users.decorators import driver_required
+from bustrack.querybudget import query_budget
 
 
 # =====================================================
@@ -25,114 +27,49 @@ from users.decorators import driver_required
 @require_POST
 def update_location(request):
     try:
-        data = json.loads(request.body)
-
-        bus_id = data.get("bus_id")
-        latitude = data.get("latitude")
-        longitude = data.get("longitude")
-        speed = float(data.get("speed", 0))
-        heading = float(data.get("heading", 0))
-
-        if not all([bus_id, latitude, longitude]):
-            return JsonResponse({"error": "Missing required fields"}, status=400)
-
-        bus = get_object_or_404(Bus, id=bus_id)
-        today = timezone.now().date()
-        trip = Trip.objects.filter(bus=bus, date=today).first()
-
-        location = LiveLocation.objects.create(
-            bus=bus,
-            trip=trip,
-            latitude=latitude,
-            longitude=longitude,
-            speed_kmh=speed,
-            heading=heading,
-        )
-
-        next_stop = None
-        eta_time = None
-
-        if bus.route:
-            stops = bus.route.stops.order_by("sequence_number")
-
-            for stop in stops:
-                stop_pos = (float(stop.latitude), float(stop.longitude))
-                dist = geodesic((latitude, longitude), stop_pos).km
-
-                if dist > 0.05:
-                    next_stop = stop
-                    speed_used = speed if speed > 5 else 40
-                    minutes = (dist / speed_used) * 60
-                    eta_time = timezone.now() + timezone.timedelta(minutes=minutes)
-                    break
-
-        # Save ETA
-        if next_stop and trip:
-            ETACalculation.objects.update_or_create(
-                bus=bus,
-                trip=trip,
-                destination_name=next_stop.name,
-                defaults={
-                    "destination_latitude": next_stop.latitude,
-                    "destination_longitude": next_stop.longitude,
-                    "distance_remaining_km": dist,
-                    "estimated_arrival_time": eta_time,
-                },
-            )
-
-        # WebSocket broadcast
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            "live_buses",
-            {
-                "type": "send_location",
-                "bus_id": bus.id,
-                "bus_name": bus.bus_name,
-                "latitude": float(latitude),
-                "longitude": float(longitude),
-                "speed": speed,
-                "route": str(bus.route) if bus.route else "",
-                "next_stop": next_stop.name if next_stop else None,
-                "eta": eta_time.isoformat() if eta_time else None,
-            },
-        )
-
-        return JsonResponse({"status": "success"})
-
-    except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
+        ping = ingest.parse_ping(request.body)
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+    if not ingest.known_bus(ping.bus_id):
+        return JsonResponse({"error": "Bus not found"}, status=404)
+
+    # Queued and written in batches by tracking.ingest
+    if ingest.submit(ping) == ingest.REJECTED:
+        response = JsonResponse({"error": "Too many pending location updates"}, status=503)
+        response["Retry-After"] = "1"
+        return response
+
+    return JsonResponse({"status": "success", "timestamp": ping.timestamp.isoformat()})
 
 
 # =====================================================
 # GET SINGLE BUS LIVE DATA
 # =====================================================
+@query_budget(5)
 @require_GET
 def get_bus_location(request, bus_id):
-    bus = get_object_or_404(Bus, pk=bus_id)
+    state = live_state.get_store().get(bus_id)
+    if state and "latitude" in state:
+        return JsonResponse(state)
+
+    # Cold store: load this bus from the database once
+    bus = get_object_or_404(Bus.objects.select_related("route"), pk=bus_id)
 
-    latest = LiveLocation.objects.filter(bus=bus).order_by("-timestamp").first()
+    latest = live_state.latest_locations([bus.id]).get(bus.id)
     if not latest:
         return JsonResponse({"error": "No location found"}, status=404)
 
-    eta = ETACalculation.objects.filter(bus=bus).order_by("-id").first()
-
-    data = {
-        "bus_id": bus.id,
-        "bus_name": bus.bus_name,
-        "latitude": float(latest.latitude),
-        "longitude": float(latest.longitude),
-        "speed": float(latest.speed_kmh),
-        "timestamp": latest.timestamp.isoformat(),
-    }
+    state = {**live_state.bus_fields(bus), **live_state.location_fields(latest)}
 
+    eta = live_state.latest_etas([bus.id]).get(bus.id)
     if eta:
-        data["eta"] = {
-            "destination": eta.destination_name,
-            "distance_remaining_km": float(eta.distance_remaining_km),
-            "estimated_arrival": eta.estimated_arrival_time.isoformat(),
-        }
+        state.update(live_state.eta_fields(eta))
 
-    return JsonResponse(data)
+    trip = Trip.objects.filter(bus=bus, date=timezone.now().date()).first()
+    if trip:
+        state.update(live_state.trip_fields(trip))
+
+    return JsonResponse(live_state.get_store().update(bus.id, state))
 
 
 # =====================================================
@@ -140,38 +77,23 @@ def get_bus_location(request, bus_id):
 # =====================================================
 @require_GET
 def get_all_active_buses(request):
-    today = timezone.now().date()
-    trips = Trip.objects.filter(date=today, status="running").select_related("bus")
+    return JsonResponse({"buses": live_state.running_states()})
 
-    result = []
 
-    for trip in trips:
-        loc = LiveLocation.objects.filter(bus=trip.bus).order_by("-timestamp").first()
-        if not loc:
-            continue
-
-        eta = ETACalculation.objects.filter(bus=trip.bus).order_by("-id").first()
-
-        item = {
-            "bus_id": trip.bus.id,
-            "bus_name": trip.bus.bus_name,
-            "bus_number": trip.bus.bus_number,
-            "latitude": float(loc.latitude),
-            "longitude": float(loc.longitude),
-            "speed": float(loc.speed_kmh),
-            "status": trip.status,
-        }
-
-        if eta:
-            item["eta"] = {
-                "destination": eta.destination_name,
-                "distance_remaining_km": float(eta.distance_remaining_km),
-                "estimated_arrival": eta.estimated_arrival_time.isoformat(),
-            }
-
-        result.append(item)
-
-    return JsonResponse({"buses": result})
+# =====================================================
+# HEALTH (CHANNEL LAYER + STATE STORE)
+# =====================================================
+@require_GET
+async def health(request):
+    channel_layer = await layers.check()
+    store = live_state.get_store()
+    status = 200 if channel_layer["ok"] else 503
+    return JsonResponse({
+        "ok": channel_layer["ok"],
+        "pid": os.getpid(),
+        "channel_layer": channel_layer,
+        "state_store": {"backend": type(store).__name__, "shared": store.shared},
+    }, status=status)
 
 
 # =====================================================
@@ -223,9 +145,90 @@ def end_trip(request):
     return JsonResponse({"status": "success"})
 
 
+# =====================================================
+# TRIP REPLAY
+# =====================================================
+REPLAY_FIELDS = ["epoch_ms", "latitude", "longitude", "speed_kmh", "heading"]
+REPLAY_LINES_PER_CHUNK = 256
+
+
+def _epoch_ms(moment):
+    return int(moment.timestamp() * 1000)
+
+
+@query_budget(6)
+@require_GET
+def trip_replay(request, trip_id):
+    """
+    Stream a trip's track as NDJSON: one header object, then one
+    ``[epoch_ms, latitude, longitude, speed_kmh, heading]`` array per line.
+
+    Seek with ``?from=`` / ``?to=`` (ISO datetimes) or ``?offset=``
+    (seconds after the first point). Archived trips are read from their
+    ``TripTrajectory``, decompressing only the chunks in range; trips not
+    archived yet fall back to their ``LiveLocation`` rows.
+    """
+    trip = get_object_or_404(Trip, id=trip_id)
+    archive = TripTrajectory.objects.filter(trip=trip).first()
+    rows = LiveLocation.objects.filter(trip=trip).order_by("timestamp", "pk")
+
+    if archive is not None:
+        started_at, ended_at, points = archive.started_at, archive.ended_at, archive.points
+    else:
+        first, last = rows.first(), rows.last()
+        if first is None:
+            return JsonResponse({"error": "No track recorded for this trip"}, status=404)
+        started_at, ended_at, points = first.timestamp, last.timestamp, rows.count()
+
+    try:
+        since = until = None
+        if request.GET.get("offset"):
+            since = _epoch_ms(started_at) + int(float(request.GET["offset"]) * 1000)
+        elif request.GET.get("from"):
+            since = _epoch_ms(parse_datetime(request.GET["from"]))
+        if request.GET.get("to"):
+            until = _epoch_ms(parse_datetime(request.GET["to"]))
+    except (AttributeError, TypeError, ValueError):
+        return JsonResponse({"error": "Invalid seek parameters"}, status=400)
+
+    if archive is not None:
+        track = trajectory.iter_points(archive.data, since, until)
+    else:
+        if since is not None:
+            rows = rows.filter(timestamp__gte=datetime.datetime.fromtimestamp(since / 1000, datetime.timezone.utc))
+        if until is not None:
+            rows = rows.filter(timestamp__lt=datetime.datetime.fromtimestamp(until / 1000, datetime.timezone.utc))
+        track = (trajectory.point(row) for row in rows.iterator(chunk_size=2000))
+
+    header = {
+        "trip_id": trip.id,
+        "bus_id": trip.bus_id,
+        "date": trip.date.isoformat(),
+        "started_at": started_at.isoformat(),
+        "ended_at": ended_at.isoformat(),
+        "points": points,
+        "archived": archive is not None,
+        "fields": REPLAY_FIELDS,
+    }
+
+    def lines():
+        yield json.dumps(header) + "\n"
+        chunk = []
+        for values in track:
+            chunk.append(json.dumps(values, separators=(",", ":")))
+            if len(chunk) == REPLAY_LINES_PER_CHUNK:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+
 # =====================================================
 # DRIVER DASHBOARD
 # =====================================================
+@query_budget(10)
 @login_required
 @driver_required
 def driver_tracking_view(request):
@@ -27,4 +27,5 @@ urlpatterns = [
     path('live-tracking/', admin_views.live_tracking, name='live_tracking'),
     
     path('analytics/', admin_views.analytics, name='analytics'),
+    path('analytics/data/', admin_views.analytics_data, name='analytics_data'),
 ]
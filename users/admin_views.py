@@ -1,14 +1,19 @@
+import datetime
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Count
+from django.http import JsonResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 from bookings.models import Booking
-from buses.models import Bus, Route, Trip
+from buses.models import Bus, Route
 from buses.forms import BusForm, RouteForm
-from tracking.models import LiveLocation
+from bustrack.querybudget import query_budget
+from tracking.state import running_states
+from . import dashboard, rollups
 from .models import UserProfile, Driver
 from .forms import DriverForm
 
@@ -23,21 +28,15 @@ def is_admin(user):
 # -------------------------------------------------
 # DASHBOARD
 # -------------------------------------------------
+@query_budget(5)
 @login_required
 @user_passes_test(is_admin)
 def admin_dashboard(request):
-    today = timezone.now().date()
-
+    # Counters are kept by users.dashboard; reading them is one query
     context = {
-        'total_buses': Bus.objects.count(),
-        'active_buses': Bus.objects.filter(is_active=True).count(),
-        'total_routes': Route.objects.count(),
-        'total_drivers': Driver.objects.count(),
-        'total_users': UserProfile.objects.filter(role='user').count(),
-        'total_bookings': Booking.objects.count(),
-        'today_bookings': Booking.objects.filter(travel_date=today).count(),
-        'active_trips': Trip.objects.filter(date=today, status='running').count(),
-        'recent_bookings': Booking.objects.order_by('-booked_at')[:10],
+        **dashboard.snapshot(),
+        'live': dashboard.get_config()['LIVE'],
+        'recent_bookings': Booking.objects.select_related('user', 'bus').order_by('-booked_at')[:10],
     }
 
     return render(request, 'admin_panel/dashboard.html', context)
@@ -46,10 +45,11 @@ def admin_dashboard(request):
 # -------------------------------------------------
 # BUS MANAGEMENT
 # -------------------------------------------------
+@query_budget(4)
 @login_required
 @user_passes_test(is_admin)
 def bus_list(request):
-    buses = Bus.objects.select_related('route', 'driver')
+    buses = Bus.objects.select_related('route', 'driver__user')
     return render(request, 'admin_panel/bus_list.html', {'buses': buses})
 
 
@@ -174,6 +174,7 @@ def route_delete(request, pk):
 # -------------------------------------------------
 # DRIVERS
 # -------------------------------------------------
+@query_budget(4)
 @login_required
 @user_passes_test(is_admin)
 def driver_list(request):
@@ -264,6 +265,7 @@ def driver_delete(request, pk):
 # -------------------------------------------------
 # USERS
 # -------------------------------------------------
+@query_budget(4)
 @login_required
 @user_passes_test(is_admin)
 def user_list(request):
@@ -274,36 +276,22 @@ def user_list(request):
 # -------------------------------------------------
 # BOOKINGS
 # -------------------------------------------------
+@query_budget(4)
 @login_required
 @user_passes_test(is_admin)
 def booking_list(request):
-    bookings = Booking.objects.select_related('user', 'bus').order_by('-booked_at')
+    bookings = Booking.objects.select_related('user', 'bus__route').order_by('-booked_at')
     return render(request, 'admin_panel/booking_list.html', {'bookings': bookings})
 
 
 # -------------------------------------------------
 # LIVE TRACKING (ADMIN VIEW)
 # -------------------------------------------------
+@query_budget(6)
 @login_required
 @user_passes_test(is_admin)
 def live_tracking(request):
-    today = timezone.now().date()
-
-    active_buses = Bus.objects.filter(
-        is_active=True,
-        trips__status='running',
-        trips__date=today
-    ).distinct()
-
-    bus_locations = []
-
-    for bus in active_buses:
-        latest_location = LiveLocation.objects.filter(bus=bus).order_by('-timestamp').first()
-        if latest_location:
-            bus_locations.append({
-                'bus': bus,
-                'location': latest_location
-            })
+    bus_locations = [state for state in running_states() if state.get('is_active', True)]
 
     return render(request, 'admin_panel/live_tracking.html', {
         'bus_locations': bus_locations
@@ -313,28 +301,61 @@ def live_tracking(request):
 # -------------------------------------------------
 # ANALYTICS
 # -------------------------------------------------
-@login_required
-@user_passes_test(is_admin)
-def analytics(request):
-    today = timezone.now().date()
+ANALYTICS_DEFAULT_DAYS = 30
+# The chart has a point per day, so the range is bounded
+ANALYTICS_MAX_DAYS = 3660
 
-    booking_stats = Booking.objects.values('status').annotate(count=Count('id'))
 
-    trip_stats = Trip.objects.filter(
-        date__gte=today - timezone.timedelta(days=30)
-    ).values('status').annotate(count=Count('id'))
+def _analytics_filters(request):
+    """(start, end, route id) from the query string; raises ValueError on a bad value.
 
-    daily_bookings = (
-        Booking.objects
-        .filter(booked_at__date__gte=today - timezone.timedelta(days=7))
-        .extra({'date': 'date(booked_at)'})
-        .values('date')
-        .annotate(count=Count('id'))
-        .order_by('date')
-    )
+    Defaults to the last ``ANALYTICS_DEFAULT_DAYS`` days and every route,
+    and refuses ranges longer than ``ANALYTICS_MAX_DAYS``.
+    """
+    today = timezone.now().date()
+    start = request.GET.get('start') or ''
+    end = request.GET.get('end') or ''
+    start = parse_date(start) if start else today - datetime.timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    end = parse_date(end) if end else today
+    if start is None or end is None:
+        raise ValueError("Dates must be YYYY-MM-DD")
+    if start > end:
+        start, end = end, start
+    if (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise ValueError(f"Pick a range of at most {ANALYTICS_MAX_DAYS} days")
+    route = request.GET.get('route') or None
+    if route is not None and not route.isdigit():
+        raise ValueError("Invalid route")
+    return start, end, int(route) if route is not None else None
+
+
+# Everything is read from the daily rollups kept by users.rollups, so a
+# range of years costs about as much as a range of days
+@query_budget(6)
+@login_required
+@user_passes_test(is_admin)
+def analytics(request):
+    try:
+        start, end, route_id = _analytics_filters(request)
+    except ValueError as exc:
+        messages.error(request, str(exc) or "Invalid filter")
+        return redirect('admin_panel:analytics')
 
     return render(request, 'admin_panel/analytics.html', {
-        'booking_stats': booking_stats,
-        'trip_stats': trip_stats,
-        'daily_bookings': list(daily_bookings),
+        'analytics': rollups.analytics(start, end, route_id),
+        'routes': Route.objects.order_by('name').values_list('pk', 'name'),
+        'route_id': route_id,
     })
+
+
+@query_budget(5)
+@login_required
+@user_passes_test(is_admin)
+def analytics_data(request):
+    """Chart data for ``?start=YYYY-MM-DD&end=YYYY-MM-DD[&route=<id>]``."""
+    try:
+        start, end, route_id = _analytics_filters(request)
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc) or "Invalid filter"}, status=400)
+
+    return JsonResponse(rollups.analytics(start, end, route_id))
@@ -0,0 +1,44 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
+import json
+
+from tracking import broadcast
+from tracking.consumers import MeteredConsumerMixin
+
+from . import dashboard
+from .admin_views import is_admin
+
+
+class DashboardConsumer(MeteredConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Live admin dashboard counters on ``ws/admin/dashboard/``.
+
+    Staff only. Sends ``{"type": "counters", "counters": {...}}`` (the
+    keys of ``dashboard.FIELDS``) on connect and whenever they change.
+    """
+
+    joined = False
+
+    async def connect(self):
+        if not dashboard.get_config()["LIVE"] or not is_admin(self.scope["user"]):
+            # Accept first so the close code reaches the browser
+            await self.accept()
+            await self.close(code=4403)
+            return
+        broadcast.bind_loop(asyncio.get_running_loop())
+        await self.channel_layer.group_add(dashboard.GROUP, self.channel_name)
+        self.joined = True
+        await self.accept()
+        counters = await database_sync_to_async(dashboard.snapshot)()
+        await self.send(text_data=json.dumps({"type": "counters", "counters": counters}))
+
+    async def disconnect(self, close_code):
+        if self.joined:
+            try:
+                await self.channel_layer.group_discard(dashboard.GROUP, self.channel_name)
+            except broadcast.RETRYABLE_ERRORS:
+                pass  # group memberships expire on their own
+
+    async def dashboard_counters(self, event):
+        await self.send(text_data=json.dumps({"type": "counters", "counters": event["counters"]}))
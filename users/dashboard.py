@@ -0,0 +1,269 @@
+"""
+Admin dashboard counters.
+
+``admin_dashboard`` used to count buses, routes, drivers, passengers,
+bookings and running trips on every page load, which on ``Booking`` is a
+scan of the whole table. The numbers now live in ``DashboardCounter``
+rows, one per key, and the page reads the ones it shows in one query.
+
+Counters move with the rows they count. ``users.signals`` hands every
+save and delete of a model in ``tracked()`` to ``remember_counted`` /
+``record_save`` / ``record_delete``, which work out the keys the row
+counted towards before and after and add the difference once the
+transaction commits: outside the booking's own transaction, so the busy
+``bookings`` row is locked only for its one UPDATE. Per-day counters
+(bookings by travel date, running trips by date) carry the date in the
+key, so "today" needs no reset at midnight.
+
+Writes that skip signals leave the counters behind: call
+``record_created`` after a ``bulk_create``, and ``rebuild`` (``manage.py
+rebuild_dashboard``) after a raw load such as ``manage.py
+generate_fleet``. ``manage.py check_dashboard`` reports drift.
+
+With ``ADMIN_DASHBOARD['LIVE']`` a change schedules a push: at most once
+per ``PUSH_INTERVAL`` the current snapshot goes to the ``GROUP`` channel
+group, which ``users.consumers.DashboardConsumer`` forwards to open
+dashboards.
+"""
+import functools
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'LIVE': True,
+    'PUSH_INTERVAL': 1.0,
+}
+GROUP = 'admin.dashboard'
+
+# Context name on the dashboard -> counter key
+FIELDS = {
+    'total_buses': 'buses',
+    'active_buses': 'buses:active',
+    'total_routes': 'routes',
+    'total_drivers': 'drivers',
+    'total_users': 'users',
+    'total_bookings': 'bookings',
+    'today_bookings': 'bookings:{today}',
+    'active_trips': 'trips:running:{today}',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ADMIN_DASHBOARD', {})}
+
+
+# -----------------------------
+# WHAT IS COUNTED
+# -----------------------------
+def _bus_keys(is_active):
+    return ('buses', 'buses:active') if is_active else ('buses',)
+
+
+def _route_keys():
+    return ('routes',)
+
+
+def _driver_keys():
+    return ('drivers',)
+
+
+def _profile_keys(role):
+    return ('users',) if role == 'user' else ()
+
+
+def _booking_keys(travel_date):
+    return ('bookings', f'bookings:{travel_date}')
+
+
+def _trip_keys(date, status):
+    return (f'trips:running:{date}',) if status == 'running' else ()
+
+
+@functools.cache
+def tracked():
+    """{model: (fields, keys)}: ``keys(*values of fields)`` are the counters a row adds 1 to."""
+    from bookings.models import Booking
+    from buses.models import Bus, Route, Trip
+    from .models import Driver, UserProfile
+
+    return {
+        Bus: (('is_active',), _bus_keys),
+        Route: ((), _route_keys),
+        Driver: ((), _driver_keys),
+        UserProfile: (('role',), _profile_keys),
+        Booking: (('travel_date',), _booking_keys),
+        Trip: (('date', 'status'), _trip_keys),
+    }
+
+
+# -----------------------------
+# SIGNAL HANDLERS
+# -----------------------------
+def remember_counted(sender, instance, raw=False, **kwargs):
+    """pre_save: note the keys the stored row counts towards."""
+    if raw or instance._state.adding:
+        return
+    fields, keys = tracked()[sender]
+    if not fields:
+        stored = ()
+    elif hasattr(instance, '_occupancy_state'):
+        # Booking.save has just loaded (bus, travel_date, ...) as stored
+        stored = instance._occupancy_state and (instance._occupancy_state[1],)
+    else:
+        stored = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+    instance._dashboard_counted = keys(*stored) if stored is not None else ()
+
+
+def record_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    fields, keys = tracked()[sender]
+    delta = Counter(keys(*(getattr(instance, field) for field in fields)))
+    delta.subtract(() if created else instance.__dict__.pop('_dashboard_counted', ()))
+    _add_on_commit(delta)
+
+
+def record_delete(sender, instance, **kwargs):
+    fields, keys = tracked()[sender]
+    delta = Counter(keys(*(getattr(instance, field) for field in fields)))
+    _add_on_commit({key: -change for key, change in delta.items()})
+
+
+def record_created(model, instances):
+    """Count rows written with ``bulk_create``, which sends no signals."""
+    fields, keys = tracked()[model]
+    _add_on_commit(Counter(
+        key for instance in instances for key in keys(*(getattr(instance, field) for field in fields))
+    ))
+
+
+def _add_on_commit(delta):
+    delta = {key: change for key, change in delta.items() if change}
+    if delta:
+        # Not a partial: robust on_commit logs a failing callback by its __qualname__
+        transaction.on_commit(lambda: add(delta), robust=True)
+
+
+# -----------------------------
+# STORE
+# -----------------------------
+def add(delta):
+    """Add ``{key: change}`` to the counters, creating missing ones."""
+    from .models import DashboardCounter
+
+    now = timezone.now()
+    # One key at a time in a fixed order, so two writers never deadlock
+    for key, change in sorted(delta.items()):
+        counter = DashboardCounter.objects.filter(key=key)
+        if counter.update(value=F('value') + change, updated_at=now):
+            continue
+        try:
+            with transaction.atomic():
+                DashboardCounter.objects.create(key=key, value=change)
+        except IntegrityError:
+            counter.update(value=F('value') + change, updated_at=now)
+    changed()
+
+
+def snapshot(today=None):
+    """The dashboard's numbers, keyed as in ``FIELDS``, in one query."""
+    from .models import DashboardCounter
+
+    today = today or timezone.now().date()
+    keys = {name: key.format(today=today) for name, key in FIELDS.items()}
+    values = dict(DashboardCounter.objects.filter(key__in=keys.values()).values_list('key', 'value'))
+    return {name: values.get(key, 0) for name, key in keys.items()}
+
+
+def expected():
+    """Every counter, recounted from the tables."""
+    counts = Counter()
+    for model, (fields, keys) in tracked().items():
+        if fields:
+            groups = (
+                (row[:-1], row[-1])
+                for row in model.objects.values_list(*fields).annotate(rows=Count('pk')).order_by()
+            )
+        else:
+            groups = [((), model.objects.count())]
+        for values, rows in groups:
+            for key in keys(*values):
+                counts[key] += rows
+    return counts
+
+
+def rebuild():
+    """Replace the counters with a fresh count; returns the number of counters.
+
+    Changes committed while it counts can be missed, so run it when the
+    site is quiet or run it twice.
+    """
+    from .models import DashboardCounter
+
+    counts = expected()
+    with transaction.atomic():
+        DashboardCounter.objects.all().delete()
+        DashboardCounter.objects.bulk_create(
+            [DashboardCounter(key=key, value=value) for key, value in counts.items() if value],
+            batch_size=1000,
+        )
+    changed()
+    return sum(1 for value in counts.values() if value)
+
+
+def find_drift():
+    """List (key, expected, stored) for counters that disagree with the tables."""
+    from .models import DashboardCounter
+
+    want = expected()
+    have = dict(DashboardCounter.objects.values_list('key', 'value'))
+    return [
+        (key, want.get(key, 0), have.get(key, 0))
+        for key in sorted(set(want) | set(have))
+        if want.get(key, 0) != have.get(key, 0)
+    ]
+
+
+# -----------------------------
+# LIVE PUSH
+# -----------------------------
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def changed():
+    """Push the counters to open dashboards within ``PUSH_INTERVAL``."""
+    global _timer
+    config = get_config()
+    if not config['LIVE']:
+        return
+    with _timer_lock:
+        if _timer is not None:
+            return
+        _timer = threading.Timer(config['PUSH_INTERVAL'], _push)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _push():
+    global _timer
+    from tracking import broadcast
+
+    with _timer_lock:
+        _timer = None
+    try:
+        counters = snapshot()
+    except Exception:
+        logger.exception("Could not read the dashboard counters")
+        return
+    finally:
+        connection.close()
+    broadcast.send_event(GROUP, {'type': 'dashboard.counters', 'counters': counters})
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import dashboard
+
+
+class Command(BaseCommand):
+    help = "Compare the stored admin dashboard counters against the tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help="Rebuild the counters when mismatches are found.",
+        )
+
+    def handle(self, *args, **options):
+        drift = dashboard.find_drift()
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS("Dashboard counters are consistent."))
+            return
+
+        for key, expected, stored in drift:
+            self.stdout.write(f"counter={key} expected={expected} stored={stored}")
+
+        if options['fix']:
+            counters = dashboard.rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {counters} dashboard counter(s)."))
+            return
+
+        raise CommandError(f"{len(drift)} inconsistent dashboard counter(s).")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users import dashboard
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the admin dashboard counters from the tables (needed after "
+        "writes that skip model signals, such as bulk loads)."
+    )
+
+    def handle(self, *args, **options):
+        counters = dashboard.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {counters} dashboard counter(s)."))
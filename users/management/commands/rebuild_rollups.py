@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily booking and trip rollups behind the analytics page "
+        "from the tables, for a range of days or for all of them (needed after "
+        "writes that skip model signals, such as bulk loads)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start', type=datetime.date.fromisoformat, default=None,
+            help="First day to recompute, YYYY-MM-DD (default: the earliest).",
+        )
+        parser.add_argument(
+            '--end', type=datetime.date.fromisoformat, default=None,
+            help="Last day to recompute, YYYY-MM-DD (default: the latest).",
+        )
+
+    def handle(self, *args, **options):
+        if options['start'] and options['end'] and options['start'] > options['end']:
+            raise CommandError("--start is after --end.")
+
+        written = rollups.rebuild(options['start'], options['end'])
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt " + ", ".join(f"{rows} {model._meta.verbose_name} row(s)" for model, rows in written.items())
+            + "."
+        ))
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:32
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_dashboard(apps, schema_editor):
+    Booking = apps.get_model('bookings', 'Booking')
+    Bus = apps.get_model('buses', 'Bus')
+    Route = apps.get_model('buses', 'Route')
+    Trip = apps.get_model('buses', 'Trip')
+    Driver = apps.get_model('users', 'Driver')
+    UserProfile = apps.get_model('users', 'UserProfile')
+    DashboardCounter = apps.get_model('users', 'DashboardCounter')
+
+    counts = Counter({
+        'buses': Bus.objects.count(),
+        'buses:active': Bus.objects.filter(is_active=True).count(),
+        'routes': Route.objects.count(),
+        'drivers': Driver.objects.count(),
+        'users': UserProfile.objects.filter(role='user').count(),
+    })
+    for travel_date, rows in Booking.objects.values_list('travel_date').annotate(rows=Count('pk')).order_by():
+        counts['bookings'] += rows
+        counts[f'bookings:{travel_date}'] = rows
+    for date, rows in Trip.objects.filter(status='running').values_list('date').annotate(rows=Count('pk')).order_by():
+        counts[f'trips:running:{date}'] = rows
+    DashboardCounter.objects.bulk_create(
+        [DashboardCounter(key=key, value=value) for key, value in counts.items() if value],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_userprofile_role_idx'),
+        ('bookings', '0006_booking_indexes'),
+        ('buses', '0004_trip_date_status_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardCounter',
+            fields=[
+                ('key', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(count_dashboard, migrations.RunPython.noop),
+    ]
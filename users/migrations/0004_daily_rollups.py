@@ -0,0 +1,90 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def roll_up(apps, schema_editor):
+    Booking = apps.get_model('bookings', 'Booking')
+    Trip = apps.get_model('buses', 'Trip')
+    DailyBookingRollup = apps.get_model('users', 'DailyBookingRollup')
+    DailyTripRollup = apps.get_model('users', 'DailyTripRollup')
+
+    bookings = (
+        Booking.objects.annotate(day=TruncDate('booked_at'))
+        .values_list('day', 'status', 'bus_id', 'bus__route_id')
+        .annotate(Count('pk'), Sum('seats_booked'), Sum('total_fare'))
+        .order_by()
+    )
+    DailyBookingRollup.objects.bulk_create(
+        [
+            DailyBookingRollup(
+                date=day, status=status, bus_id=bus_id, route_id=route_id,
+                bookings=count, seats=seats or 0, revenue=revenue or 0,
+            )
+            for day, status, bus_id, route_id, count, seats, revenue in bookings
+        ],
+        batch_size=1000,
+    )
+    trips = (
+        Trip.objects.values_list('date', 'status', 'bus_id', 'bus__route_id')
+        .annotate(Count('pk'), Sum('delay_minutes'))
+        .order_by()
+    )
+    DailyTripRollup.objects.bulk_create(
+        [
+            DailyTripRollup(
+                date=day, status=status, bus_id=bus_id, route_id=route_id, trips=count, delay_minutes=delay or 0,
+            )
+            for day, status, bus_id, route_id, count, delay in trips
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookings', '0006_booking_indexes'),
+        ('buses', '0004_trip_date_status_idx'),
+        ('users', '0003_dashboardcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyBookingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(max_length=20)),
+                ('bookings', models.IntegerField(default=0)),
+                ('seats', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='booking_rollups', to='buses.bus')),
+                ('route', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='booking_rollups', to='buses.route')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['route', 'date'], name='bookingrollup_route_date_idx')],
+                'unique_together': {('date', 'status', 'bus')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyTripRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(max_length=20)),
+                ('trips', models.IntegerField(default=0)),
+                ('delay_minutes', models.IntegerField(default=0)),
+                ('bus', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trip_rollups', to='buses.bus')),
+                ('route', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='trip_rollups', to='buses.route')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['route', 'date'], name='triprollup_route_date_idx')],
+                'unique_together': {('date', 'status', 'bus')},
+            },
+        ),
+        migrations.RunPython(roll_up, migrations.RunPython.noop),
+    ]
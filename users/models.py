@@ -31,6 +31,11 @@ class UserProfile(models.Model):
     def is_passenger(self):
         return self.role == 'user'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['role'], name='userprofile_role_idx'),
+        ]
+
 
 class Driver(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='driver_profile')
@@ -42,3 +47,53 @@ class Driver(models.Model):
     
     def __str__(self):
         return f"Driver: {self.user.get_full_name() or self.user.username}"
+
+
+class DashboardCounter(models.Model):
+    """One number on the admin dashboard, kept current by ``users.dashboard``."""
+    key = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
+
+
+class DailyBookingRollup(models.Model):
+    """Bookings made on one day per status and bus, kept current by ``users.rollups``."""
+    date = models.DateField()
+    status = models.CharField(max_length=20)
+    bus = models.ForeignKey('buses.Bus', on_delete=models.CASCADE, related_name='booking_rollups')
+    # The bus's route when the row was started; history stays put if the bus moves
+    route = models.ForeignKey('buses.Route', on_delete=models.SET_NULL, null=True, related_name='booking_rollups')
+    bookings = models.IntegerField(default=0)
+    seats = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.date} {self.status} bus {self.bus_id}: {self.bookings}"
+
+    class Meta:
+        unique_together = ['date', 'status', 'bus']
+        indexes = [
+            models.Index(fields=['route', 'date'], name='bookingrollup_route_date_idx'),
+        ]
+
+
+class DailyTripRollup(models.Model):
+    """Trips run on one day per status and bus, kept current by ``users.rollups``."""
+    date = models.DateField()
+    status = models.CharField(max_length=20)
+    bus = models.ForeignKey('buses.Bus', on_delete=models.CASCADE, related_name='trip_rollups')
+    route = models.ForeignKey('buses.Route', on_delete=models.SET_NULL, null=True, related_name='trip_rollups')
+    trips = models.IntegerField(default=0)
+    delay_minutes = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.date} {self.status} bus {self.bus_id}: {self.trips}"
+
+    class Meta:
+        unique_together = ['date', 'status', 'bus']
+        indexes = [
+            models.Index(fields=['route', 'date'], name='triprollup_route_date_idx'),
+        ]
@@ -0,0 +1,260 @@
+"""
+Daily booking and trip rollups for the analytics page.
+
+``analytics`` used to group the whole ``Booking`` table by status and
+the bookings of the last week by ``date(booked_at)`` on every load, so
+the page got slower as history grew and could not show a longer range.
+``DailyBookingRollup`` and ``DailyTripRollup`` hold one row per day,
+status and bus (bookings by the day they were made, trips by the day
+they run), with the bus's route alongside. A range of any length is a
+sum over those rows.
+
+Rows move with the bookings and trips they count, the same way as the
+dashboard counters (``users.dashboard``): ``users.signals`` hands every
+save and delete to ``remember_rolled_up`` / ``record_save`` /
+``record_delete``, which move the row's amounts from the rollup it was
+in to the one it is in now once the transaction commits. A rollup whose
+bus has been deleted goes with the bus; changes arriving for it later
+are dropped.
+
+Writes that skip signals leave the rollups behind: call
+``record_created`` after a ``bulk_create``, and ``rebuild`` (``manage.py
+rebuild_rollups [--start] [--end]``) after a raw load or to repair a
+range of days.
+"""
+import datetime
+import functools
+import itertools
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from bookings.models import Booking
+from buses.models import Bus, Trip
+
+from .models import DailyBookingRollup, DailyTripRollup
+
+logger = logging.getLogger(__name__)
+
+REBUILD_CHUNK = 5000
+
+
+def _day(moment):
+    return timezone.localdate(moment) if timezone.is_aware(moment) else moment.date()
+
+
+def _booking_row(booked_at, status, bus_id, seats_booked, total_fare):
+    return (_day(booked_at), status, bus_id), (1, seats_booked, total_fare or 0)
+
+
+def _trip_row(date, status, bus_id, delay_minutes):
+    return (date, status, bus_id), (1, delay_minutes or 0)
+
+
+@functools.cache
+def tracked():
+    """{model: (rollup, fields, amounts, row)}.
+
+    ``row(*values of fields)`` is the rollup key (day, status, bus) and
+    what the row adds to each of ``amounts``.
+    """
+    return {
+        Booking: (
+            DailyBookingRollup,
+            ('booked_at', 'status', 'bus_id', 'seats_booked', 'total_fare'),
+            ('bookings', 'seats', 'revenue'),
+            _booking_row,
+        ),
+        Trip: (
+            DailyTripRollup,
+            ('date', 'status', 'bus_id', 'delay_minutes'),
+            ('trips', 'delay_minutes'),
+            _trip_row,
+        ),
+    }
+
+
+# -----------------------------
+# SIGNAL HANDLERS
+# -----------------------------
+def _stored(sender, instance):
+    """Values of the tracked fields as stored, or None if the row is gone."""
+    _, fields, _, _ = tracked()[sender]
+    if sender is Booking and '_loaded_fare' in instance.__dict__:
+        # Booking remembers what it was loaded with; reading it again here,
+        # inside the save's transaction, would turn it into a read-then-write
+        # that SQLite refuses under concurrent bookings
+        if instance._occupancy_state is None:
+            return None
+        bus_id, _, _, _, seats, status = instance._occupancy_state
+        return instance.booked_at, status, bus_id, seats, instance._loaded_fare
+    return sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+def remember_rolled_up(sender, instance, raw=False, **kwargs):
+    """pre_save: note the rollup the stored row is counted in."""
+    if raw or instance._state.adding or '_rolled_up' in instance.__dict__:
+        # Already known from this instance's last save
+        return
+    _, _, _, row = tracked()[sender]
+    stored = _stored(sender, instance)
+    instance._rolled_up = row(*stored) if stored is not None else None
+
+
+def record_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    rollup, fields, _, row = tracked()[sender]
+    current = row(*(getattr(instance, field) for field in fields))
+    previous = None if created else instance.__dict__.get('_rolled_up')
+    instance._rolled_up = current
+    _add_on_commit(rollup, _delta([current], [previous]))
+
+
+def record_delete(sender, instance, **kwargs):
+    rollup, fields, _, row = tracked()[sender]
+    instance.__dict__.pop('_rolled_up', None)
+    _add_on_commit(rollup, _delta([], [row(*(getattr(instance, field) for field in fields))]))
+
+
+def record_created(model, instances):
+    """Roll up rows written with ``bulk_create``, which sends no signals."""
+    rollup, fields, _, row = tracked()[model]
+    _add_on_commit(rollup, _delta(
+        [row(*(getattr(instance, field) for field in fields)) for instance in instances], [],
+    ))
+
+
+def _delta(added, removed):
+    """{key: amounts} of ``added`` minus ``removed`` rows, without the keys that net to nothing."""
+    delta = {}
+    for rows, sign in ((added, 1), (removed, -1)):
+        for key, amounts in filter(None, rows):
+            total = delta.setdefault(key, [0] * len(amounts))
+            for index, amount in enumerate(amounts):
+                total[index] += sign * amount
+    return {key: amounts for key, amounts in delta.items() if any(amounts)}
+
+
+def _add_on_commit(rollup, delta):
+    if delta:
+        # Not a partial: robust on_commit logs a failing callback by its __qualname__
+        transaction.on_commit(lambda: add(rollup, delta), robust=True)
+
+
+# -----------------------------
+# STORE
+# -----------------------------
+def add(rollup, delta):
+    """Add ``{(day, status, bus_id): amounts}`` to the rollups, starting missing rows."""
+    amounts = next(entry[2] for entry in tracked().values() if entry[0] is rollup)
+    # One row at a time in a fixed order, so two writers never deadlock
+    for (day, status, bus_id), changes in sorted(delta.items()):
+        rows = rollup.objects.filter(date=day, status=status, bus_id=bus_id)
+        updates = {field: F(field) + change for field, change in zip(amounts, changes)}
+        if rows.update(**updates):
+            continue
+        route = Bus.objects.filter(pk=bus_id).values_list('route_id', flat=True)
+        if changes[0] <= 0 or not route:
+            # Nothing to take from: the bus and its rollups were deleted
+            logger.debug("Dropped a %s change for bus %s on %s", rollup.__name__, bus_id, day)
+            continue
+        try:
+            with transaction.atomic():
+                rollup.objects.create(
+                    date=day, status=status, bus_id=bus_id, route_id=route[0], **dict(zip(amounts, changes)),
+                )
+        except IntegrityError:
+            rows.update(**updates)
+
+
+def _midnight(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _booking_groups(start, end):
+    bookings = Booking.objects.all()
+    if start:
+        bookings = bookings.filter(booked_at__gte=_midnight(start))
+    if end:
+        bookings = bookings.filter(booked_at__lt=_midnight(end + datetime.timedelta(days=1)))
+    groups = (
+        bookings.annotate(day=TruncDate('booked_at'))
+        .values_list('day', 'status', 'bus_id', 'bus__route_id')
+        .annotate(Count('pk'), Sum('seats_booked'), Sum('total_fare'))
+        .order_by()
+    )
+    for day, status, bus_id, route_id, count, seats, revenue in groups.iterator(REBUILD_CHUNK):
+        yield DailyBookingRollup(
+            date=day, status=status, bus_id=bus_id, route_id=route_id,
+            bookings=count, seats=seats or 0, revenue=revenue or 0,
+        )
+
+
+def _trip_groups(start, end):
+    trips = Trip.objects.all()
+    if start:
+        trips = trips.filter(date__gte=start)
+    if end:
+        trips = trips.filter(date__lte=end)
+    groups = (
+        trips.values_list('date', 'status', 'bus_id', 'bus__route_id')
+        .annotate(Count('pk'), Sum('delay_minutes'))
+        .order_by()
+    )
+    for day, status, bus_id, route_id, count, delay in groups.iterator(REBUILD_CHUNK):
+        yield DailyTripRollup(
+            date=day, status=status, bus_id=bus_id, route_id=route_id, trips=count, delay_minutes=delay or 0,
+        )
+
+
+def rebuild(start=None, end=None):
+    """Recompute the rollups of days ``start`` to ``end`` (inclusive; open-ended when None).
+
+    Returns {rollup model: rows written}. Rows take the bus's current
+    route. Changes committed while it runs can be missed, so repair a
+    busy range when the site is quiet.
+    """
+    written = {}
+    with transaction.atomic():
+        for rollup, groups in ((DailyBookingRollup, _booking_groups), (DailyTripRollup, _trip_groups)):
+            stale = rollup.objects.all()
+            if start:
+                stale = stale.filter(date__gte=start)
+            if end:
+                stale = stale.filter(date__lte=end)
+            stale.delete()
+            rows = groups(start, end)
+            written[rollup] = 0
+            while chunk := list(itertools.islice(rows, REBUILD_CHUNK)):
+                rollup.objects.bulk_create(chunk, batch_size=1000)
+                written[rollup] += len(chunk)
+    return written
+
+
+# -----------------------------
+# READING
+# -----------------------------
+def analytics(start, end, route_id=None):
+    """Chart data for days ``start`` to ``end``: bookings and trips by status, bookings per day."""
+    # Rows whose bookings or trips have all moved on stay behind empty
+    bookings = DailyBookingRollup.objects.filter(date__range=(start, end), bookings__gt=0)
+    trips = DailyTripRollup.objects.filter(date__range=(start, end), trips__gt=0)
+    if route_id is not None:
+        bookings = bookings.filter(route_id=route_id)
+        trips = trips.filter(route_id=route_id)
+
+    per_day = dict(bookings.values_list('date').annotate(Sum('bookings')).order_by())
+    days = (start + datetime.timedelta(days=n) for n in range((end - start).days + 1))
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'booking_stats': list(
+            bookings.values('status').annotate(count=Sum('bookings'), revenue=Sum('revenue')).order_by('status')
+        ),
+        'trip_stats': list(trips.values('status').annotate(count=Sum('trips')).order_by('status')),
+        'daily_bookings': [{'date': day.isoformat(), 'count': per_day.get(day, 0)} for day in days],
+    }
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from . import dashboard, rollups
+
+for model in dashboard.tracked():
+    label = model._meta.label_lower
+    pre_save.connect(dashboard.remember_counted, sender=model, dispatch_uid=f'dashboard-pre-save-{label}')
+    post_save.connect(dashboard.record_save, sender=model, dispatch_uid=f'dashboard-save-{label}')
+    post_delete.connect(dashboard.record_delete, sender=model, dispatch_uid=f'dashboard-delete-{label}')
+
+for model in rollups.tracked():
+    label = model._meta.label_lower
+    pre_save.connect(rollups.remember_rolled_up, sender=model, dispatch_uid=f'rollups-pre-save-{label}')
+    post_save.connect(rollups.record_save, sender=model, dispatch_uid=f'rollups-save-{label}')
+    post_delete.connect(rollups.record_delete, sender=model, dispatch_uid=f'rollups-delete-{label}')
@@ -1,3 +1,270 @@
-from django.test import TestCase
+import datetime
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from benchmarks.plans import QueryPlanTestMixin
+from bookings.models import Booking
+from bookings.tests import TRAVEL_DATE, make_bus, new_booking
+from buses.models import Trip
+from bustrack.querybudget import QueryBudgetTestMixin
+from tracking import broadcast
+
+from . import admin_views, dashboard, rollups
+from .consumers import DashboardConsumer
+from .models import DailyBookingRollup, DailyTripRollup, DashboardCounter, UserProfile
+
+
+class HotPathTests(QueryPlanTestMixin, QueryBudgetTestMixin, TestCase):
+    def test_admin_views_use_indexes(self):
+        self.assertHotPathsUseIndexes('admin_panel')
+
+    def test_admin_views_stay_within_query_budgets(self):
+        self.assertHotPathsWithinBudget('admin_panel')
+
+
+class AnalyticsRangeTests(TestCase):
+    def setUp(self):
+        admin = User.objects.create(username='admin', is_staff=True)
+        UserProfile.objects.create(user=admin, role='admin')
+        self.client.force_login(admin)
+
+    def test_range_is_capped(self):
+        url = reverse('admin_panel:analytics_data')
+        start = datetime.date(2030, 1, 1)
+        longest = start + datetime.timedelta(days=admin_views.ANALYTICS_MAX_DAYS - 1)
+
+        response = self.client.get(url, {'start': start.isoformat(), 'end': longest.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['daily_bookings']), admin_views.ANALYTICS_MAX_DAYS)
+
+        for params in (
+            {'start': start.isoformat(), 'end': (longest + datetime.timedelta(days=1)).isoformat()},
+            {'start': '0001-01-01', 'end': '9999-12-31'},
+        ):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("at most", response.json()['error'])
+
+    def test_page_reports_a_long_range(self):
+        response = self.client.get(reverse('admin_panel:analytics'), {'start': '0001-01-01', 'end': '9999-12-31'})
+        self.assertRedirects(response, reverse('admin_panel:analytics'), fetch_redirect_response=False)
+
+
+class RollupTests(TestCase):
+    """The rollups answer what aggregating bookings and trips directly would."""
+
+    start = datetime.date(2030, 3, 1)
+    end = datetime.date(2030, 3, 10)
+
+    def setUp(self):
+        self.user = User.objects.create(username='passenger')
+        self.buses = [make_bus(number='R-1'), make_bus(number='R-2')]
+
+    def at(self, day, hour=12):
+        moment = datetime.datetime.combine(self.start + datetime.timedelta(days=day), datetime.time(hour))
+        return mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(moment))
+
+    def book(self, bus, day, seats=1, status='confirmed'):
+        with self.at(day):
+            booking = new_booking(self.user, bus, 1, 3, seats, status=status)
+            booking.save()
+        return booking
+
+    def direct(self, route_id=None):
+        """The analytics page's data aggregated from Booking and Trip rows."""
+        bookings = Booking.objects.filter(
+            booked_at__date__gte=self.start, booked_at__date__lte=self.end,
+        )
+        trips = Trip.objects.filter(date__range=(self.start, self.end))
+        if route_id is not None:
+            bookings = bookings.filter(bus__route_id=route_id)
+            trips = trips.filter(bus__route_id=route_id)
+        per_day = dict(
+            bookings.annotate(day=TruncDate('booked_at')).values_list('day').annotate(Count('pk')).order_by()
+        )
+        days = (self.start + datetime.timedelta(days=n) for n in range((self.end - self.start).days + 1))
+        return {
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'booking_stats': list(
+                bookings.values('status').annotate(count=Count('pk'), revenue=Sum('total_fare')).order_by('status')
+            ),
+            'trip_stats': list(trips.values('status').annotate(count=Count('pk')).order_by('status')),
+            'daily_bookings': [{'date': day.isoformat(), 'count': per_day.get(day, 0)} for day in days],
+        }
+
+    def assertMatchesDirect(self):
+        for route_id in (None, self.buses[0].route_id):
+            with self.subTest(route_id=route_id):
+                self.assertEqual(rollups.analytics(self.start, self.end, route_id), self.direct(route_id))
+
+    def test_follows_saves_and_deletes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.book(self.buses[0], 0, seats=2)
+            self.book(self.buses[0], 0, status='pending')
+            self.book(self.buses[1], 3, seats=3)
+            cancelled = self.book(self.buses[1], 9)
+            self.book(self.buses[0], 12)    # outside the range
+            for bus, day, status in ((self.buses[0], 0, 'completed'), (self.buses[0], 4, 'running'),
+                                     (self.buses[1], 4, 'delayed'), (self.buses[1], 11, 'scheduled')):
+                Trip.objects.create(bus=bus, date=self.start + datetime.timedelta(days=day), status=status)
+        self.assertMatchesDirect()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cancelled.status = 'cancelled'
+            cancelled.save()
+            first.seats_booked = 4
+            first.save()
+            Booking.objects.get(bus=self.buses[1], seats_booked=3).delete()
+            trip = Trip.objects.get(status='running')
+            trip.status = 'completed'
+            trip.save()
+        self.assertMatchesDirect()
+
+    def test_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book(self.buses[0], 1, seats=2)
+            Trip.objects.create(bus=self.buses[1], date=self.start, status='completed')
+        DailyBookingRollup.objects.all().delete()
+        DailyTripRollup.objects.all().delete()
+        rollups.rebuild(self.start, self.end)
+        self.assertMatchesDirect()
+
+
+@override_settings(ADMIN_DASHBOARD={'LIVE': False})
+class DashboardCounterTests(TestCase):
+    """Counters move once the change commits, and agree with a recount."""
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bus = make_bus()
+            self.user = User.objects.create(username='passenger')
+            UserProfile.objects.create(user=self.user, role='user')
+
+    def counters(self, *keys):
+        values = dict(DashboardCounter.objects.values_list('key', 'value'))
+        return [values.get(key, 0) for key in keys]
+
+    def assertNoDrift(self):
+        self.assertEqual(dashboard.find_drift(), [])
+
+    def test_setup_is_counted(self):
+        self.assertEqual(self.counters('buses', 'buses:active', 'routes', 'users'), [1, 1, 1, 1])
+        self.assertNoDrift()
+
+    def test_booking_save_change_and_delete(self):
+        keys = ('bookings', f'bookings:{TRAVEL_DATE}', f'bookings:{TRAVEL_DATE + datetime.timedelta(days=1)}')
+        with self.captureOnCommitCallbacks(execute=True):
+            booking = new_booking(self.user, self.bus, 1, 3)
+            booking.save()
+        self.assertEqual(self.counters(*keys), [1, 1, 0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.status = 'cancelled'
+            booking.save()
+        self.assertEqual(self.counters(*keys), [1, 1, 0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.travel_date += datetime.timedelta(days=1)
+            booking.save()
+        self.assertEqual(self.counters(*keys), [1, 0, 1])
+        self.assertNoDrift()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.delete()
+        self.assertEqual(self.counters(*keys), [0, 0, 0])
+        self.assertNoDrift()
+
+    def test_trip_status_change(self):
+        today = timezone.now().date()
+        with self.captureOnCommitCallbacks(execute=True):
+            trip = Trip.objects.create(bus=self.bus, date=today, status='scheduled')
+        self.assertEqual(dashboard.snapshot()['active_trips'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            trip.status = 'running'
+            trip.save()
+        self.assertEqual(dashboard.snapshot()['active_trips'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            trip.status = 'completed'
+            trip.save()
+        self.assertEqual(dashboard.snapshot()['active_trips'], 0)
+        self.assertNoDrift()
+
+    def test_rolled_back_changes_are_not_counted(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(ZeroDivisionError), transaction.atomic():
+                new_booking(self.user, self.bus, 1, 3).save()
+                Trip.objects.create(bus=self.bus, date=timezone.now().date(), status='running')
+                1 / 0
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.counters('bookings', f'bookings:{TRAVEL_DATE}'), [0, 0])
+        self.assertNoDrift()
+
+    def test_rebuild_fixes_drift(self):
+        DashboardCounter.objects.filter(key='buses').update(value=5)
+        DashboardCounter.objects.create(key='bookings', value=2)
+        self.assertEqual(dashboard.find_drift(), [('bookings', 0, 2), ('buses', 1, 5)])
+        self.assertEqual(dashboard.rebuild(), 4)
+        self.assertNoDrift()
+
+    def test_check_dashboard(self):
+        out = StringIO()
+        call_command('check_dashboard', stdout=out)
+        self.assertIn("consistent", out.getvalue())
+
+        DashboardCounter.objects.filter(key='routes').update(value=3)
+        with self.assertRaisesMessage(CommandError, "1 inconsistent dashboard counter(s)"):
+            call_command('check_dashboard', stdout=StringIO())
+
+        out = StringIO()
+        call_command('check_dashboard', fix=True, stdout=out)
+        self.assertIn("counter=routes expected=1 stored=3", out.getvalue())
+        self.assertNoDrift()
+
+
+@override_settings(ADMIN_DASHBOARD={'LIVE': True, 'PUSH_INTERVAL': 0})
+class DashboardConsumerTests(TransactionTestCase):
+    application = staticmethod(DashboardConsumer.as_asgi())
+
+    def setUp(self):
+        self.bus = make_bus()
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.passenger = User.objects.create(username='passenger')
+        self.addCleanup(broadcast.bind_loop, None)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(self.application, '/ws/admin/dashboard/')
+        communicator.scope['user'] = user
+        return communicator, await communicator.connect()
+
+    async def test_rejects_anonymous_and_non_staff(self):
+        for user in (AnonymousUser(), self.passenger):
+            with self.subTest(user=user):
+                communicator, (connected, _) = await self.connect(user)
+                self.assertTrue(connected)
+                self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4403})
+
+    async def test_staff_get_a_push_after_a_booking_commits(self):
+        communicator, (connected, _) = await self.connect(self.staff)
+        self.assertTrue(connected)
+        first = await communicator.receive_json_from()
+        self.assertEqual((first['type'], first['counters']['total_bookings']), ('counters', 0))
+
+        await database_sync_to_async(lambda: new_booking(self.passenger, self.bus, 1, 3).save())()
+        pushed = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((pushed['type'], pushed['counters']['total_bookings']), ('counters', 1))
+        await communicator.disconnect()